@@ -2,6 +2,12 @@
 #include <Python.h>
 #include <structmember.h>
 
+#ifdef _WIN32
+# include <windows.h>
+#else
+# include <time.h>
+#endif
+
 
 // Py_UNREACHABLE is only available starting with Python 3.7.
 #ifdef Py_UNREACHABLE
@@ -17,8 +23,22 @@
 #endif
 
 
-#define MAX_KEYS   63
-#define MAX_STENO  (MAX_KEYS + 1) // All keys + one hyphen.
+#define MAX_KEYS     63
+#define MAX_STENO    (MAX_KEYS + 1) // All keys + one hyphen.
+#define MAX_LETTERS  (MAX_KEYS + 10) // All keys letters + all digits.
+
+// Must be a power of 2, and bigger than MAX_LETTERS.
+#define LETTERS_HASH_SIZE  128
+
+// Wide mode (see `WideStrokeHelper`): up to 127 keys, using 2 words masks.
+#define MAX_WIDE_KEYS     127
+#define MAX_WIDE_STENO    (MAX_WIDE_KEYS + 1) // All keys + one hyphen.
+#define MAX_WIDE_LETTERS  (MAX_WIDE_KEYS + 10) // All keys letters + all digits.
+
+// Must be a power of 2, and bigger than MAX_WIDE_LETTERS.
+#define WIDE_LETTERS_HASH_SIZE  256
+
+#define NO_KEY  0xff
 
 typedef uint64_t stroke_uint_t;
 typedef int64_t  stroke_int_t;
@@ -51,6 +71,24 @@ typedef enum
 
 } key_side_t;
 
+// A system definition, in terms of keys indexes (see `parse_system`),
+// compiled by each helper into its own masks and tables.
+typedef struct
+{
+    unsigned    num_keys;
+    key_side_t  key_side[MAX_WIDE_KEYS];
+    Py_UCS4     key_letter[MAX_WIDE_KEYS];
+    Py_UCS4     key_number[MAX_WIDE_KEYS];
+    uint8_t     key_has_number[MAX_WIDE_KEYS];
+    unsigned    right_keys_index;
+    // Implicit hyphen keys: `[implicit_hyphen_start, implicit_hyphen_end[`.
+    unsigned    implicit_hyphen_start;
+    unsigned    implicit_hyphen_end;
+    int         number_key_index; // -1 if there's no number key.
+    Py_UCS4     feral_number_key_letter;
+
+} system_t;
+
 typedef enum
 {
     CMP_OP_CMP,
@@ -74,13 +112,117 @@ typedef struct
     stroke_uint_t number_key_mask;
     stroke_uint_t numbers_mask;
     unsigned      right_keys_index;
+    // Parsing tables: letter to letter index (0 for an invalid letter),
+    // with a fast path for ASCII letters, and a transition table:
+    // (key index + 1, letter index) to the index of the next matching
+    // key (or `NO_KEY`).
+    unsigned      num_letters;
+    uint8_t       ascii_letter_index[128];
+    Py_UCS4       letters_hash[LETTERS_HASH_SIZE];
+    uint8_t       letters_hash_index[LETTERS_HASH_SIZE];
+    uint8_t       next_key[MAX_KEYS + 1][MAX_LETTERS + 1];
+    // Interned keys strings (letter and number variants).
+    PyObject     *key_str[2][MAX_KEYS];
+    // For each key, the mask of its adjacent keys (for weighted distances).
+    stroke_uint_t adjacent_keys[MAX_KEYS];
+    // Note: a compiled helper is never modified once shared (copy on
+    // write), and the reference count is only updated with the GIL held,
+    // so it can be used without the GIL by holding a reference.
+    Py_ssize_t    refcount;
 
 } stroke_helper_t;
 
+// Must be a power of 2.
+#define KEYS_CACHE_SIZE  256
+
+typedef struct
+{
+    PyObject      *steno;
+    Py_hash_t      hash;
+    stroke_uint_t  mask;
+    int            referenced;
+
+} steno_cache_entry_t;
+
+// Bounded cache of steno <-> mask, with CLOCK eviction:
+// - entries are stored in a fixed size array (cycled through by
+//   the eviction hand)
+// - and indexed by an open addressing (linear probing) hash table
+//   of entry index + 1 (0 for an empty slot).
+typedef struct
+{
+    int                  by_mask; // Key is the mask (else the steno).
+    Py_ssize_t           max_size;
+    Py_ssize_t           size;
+    Py_ssize_t           hand;
+    Py_ssize_t           hits;
+    Py_ssize_t           misses;
+    steno_cache_entry_t *entries;
+    Py_ssize_t          *table;
+    size_t               table_mask;
+
+} steno_cache_t;
+
+// Instrumentation: operations counters.
+typedef enum
+{
+    STAT_FROM_STENO,     // Steno to stroke.
+    STAT_FROM_KEYS,      // Keys to stroke.
+    STAT_TO_STENO,       // Stroke to steno.
+    STAT_TO_KEYS,        // Stroke to keys.
+    STAT_STENO_TO_MASKS, // Steno (outlines) to masks.
+    STAT_MASKS_TO_STENO, // Masks (outlines) to steno.
+    STAT_VALIDATE,       // Steno (outlines) validation.
+    STAT_SORT_OUTLINES,
+    STAT_NEAR_STROKES,
+    NUM_STATS,
+
+} stat_op_t;
+
+static const char *stat_op_name[NUM_STATS] =
+{
+    "from_steno",
+    "from_keys",
+    "to_steno",
+    "to_keys",
+    "steno_to_masks",
+    "masks_to_steno",
+    "validate",
+    "sort_outlines",
+    "near_strokes",
+};
+
+typedef enum
+{
+    STATS_DISABLED,
+    STATS_COUNTERS,
+    STATS_TIMING,  // Counters, and cumulative time.
+
+} stats_mode_t;
+
+typedef struct
+{
+    uint64_t calls;
+    uint64_t failures;
+    uint64_t chars;   // Steno characters parsed / rendered.
+    uint64_t strokes; // Strokes parsed / rendered / processed.
+    uint64_t ns;
+
+} stat_counters_t;
+
 typedef struct
 {
     PyObject_HEAD
-    stroke_helper_t helper;
+    stroke_helper_t *helper;
+    // Note: the counters are only updated with the GIL held.
+    stats_mode_t     stats_mode;
+    stat_counters_t  stats[NUM_STATS];
+    // Direct-mapped cache of mask to tuple of keys.
+    stroke_uint_t   keys_cache_mask[KEYS_CACHE_SIZE];
+    PyObject       *keys_cache_tuple[KEYS_CACHE_SIZE];
+    // Optional caches for steno to mask and mask to steno.
+    steno_cache_t   from_steno_cache;
+    steno_cache_t   to_steno_cache;
 
 } StrokeHelper;
 
@@ -120,6 +262,66 @@ static unsigned popcount(stroke_uint_t x)
     return x & 0x7f;
 }
 
+// Index of the (single) bit set in `x`.
+static unsigned bit_index(stroke_uint_t x)
+{
+    return popcount(x - 1);
+}
+
+static stroke_uint_t bit_reverse(stroke_uint_t x)
+{
+    x = ((x >>  1) & 0x5555555555555555) | ((x & 0x5555555555555555) <<  1);
+    x = ((x >>  2) & 0x3333333333333333) | ((x & 0x3333333333333333) <<  2);
+    x = ((x >>  4) & 0x0f0f0f0f0f0f0f0f) | ((x & 0x0f0f0f0f0f0f0f0f) <<  4);
+    x = ((x >>  8) & 0x00ff00ff00ff00ff) | ((x & 0x00ff00ff00ff00ff) <<  8);
+    x = ((x >> 16) & 0x0000ffff0000ffff) | ((x & 0x0000ffff0000ffff) << 16);
+    return (x >> 32) | (x << 32);
+}
+
+// Convert a stroke to an integer preserving the steno order: this is
+// the rank of the stroke when all possible strokes (as sequences of
+// keys) are sorted in lexicographical order (a prefix sorting first).
+//
+// For a stroke with keys `k1 < k2 < ... < kn`, counting the strokes
+// preceding it in a pre-order walk of the strokes tree gives:
+//
+//   n + sum(2 ** (62 - k) for k not in the stroke, k < kn)
+//
+// which is computed using `r`, the mask bits reversed (so key `k`
+// maps to bit `62 - k`): `n + 2 ** 63 - r - lsb(r)`.
+static stroke_uint_t stroke_to_order_key(stroke_uint_t mask)
+{
+    stroke_uint_t r;
+
+    if (!mask)
+        return 0;
+
+    r = bit_reverse(mask) >> 1;
+
+    return popcount(mask) + ((STROKE_1 << 63) - r - lsb(r));
+}
+
+// Inverse of `stroke_to_order_key`.
+static stroke_uint_t order_key_to_stroke(stroke_uint_t key)
+{
+    stroke_uint_t mask;
+    unsigned      k;
+
+    // Walk down the strokes tree: at each level, skip the
+    // current node, then the subtrees of the smaller keys.
+    mask = 0;
+    k = 0;
+    while (key)
+    {
+        --key;
+        while (key >= (STROKE_1 << (62 - k)))
+            key -= STROKE_1 << (62 - k++);
+        mask |= STROKE_1 << k++;
+    }
+
+    return mask;
+}
+
 static Py_UCS4 key_to_letter(PyObject *key, key_side_t *side)
 {
     int         kind;
@@ -163,61 +365,6 @@ static Py_UCS4 key_to_letter(PyObject *key, key_side_t *side)
     return 0;
 }
 
-static stroke_uint_t stroke_from_ucs4(const stroke_helper_t *helper,
-                                      const Py_UCS4         *stroke_ucs4,
-                                      Py_ssize_t             stroke_len)
-{
-    stroke_uint_t  mask;
-    Py_UCS4        letter;
-    int            key_index;
-    unsigned       stroke_index;
-    const Py_UCS4 *possible_letters;
-    int            implicit_number_key;
-
-    mask = 0;
-    key_index = -1;
-    implicit_number_key = 0;
-
-    for (stroke_index = 0; stroke_index < stroke_len; ++stroke_index)
-    {
-        letter = stroke_ucs4[stroke_index];
-        if (letter == helper->feral_number_key_letter)
-        {
-            if ((mask & helper->number_key_mask))
-                return INVALID_STROKE;
-            mask |= helper->number_key_mask;
-            continue;
-        }
-        if (letter == '-')
-        {
-            if (key_index > (int)helper->right_keys_index)
-                return INVALID_STROKE;
-            key_index = helper->right_keys_index - 1;
-            continue;
-        }
-        if ('0' <= letter && letter <= '9')
-        {
-            implicit_number_key = 1;
-            possible_letters = helper->key_number;
-        }
-        else
-        {
-            possible_letters = helper->key_letter;
-        }
-        do
-        {
-            if (++key_index == (int)helper->num_keys)
-                return INVALID_STROKE;
-        } while (letter != possible_letters[key_index]);
-        mask |= STROKE_1 << key_index;
-    }
-
-    if (implicit_number_key)
-        mask |= helper->number_key_mask;
-
-    return mask;
-}
-
 static stroke_uint_t stroke_from_int(const stroke_helper_t *helper, PyObject *integer)
 {
     stroke_uint_t mask = PyLong_AsStrokeUint(integer);
@@ -234,289 +381,494 @@ static stroke_uint_t stroke_from_int(const stroke_helper_t *helper, PyObject *in
     return mask;
 }
 
-static stroke_uint_t stroke_from_keys(const stroke_helper_t *helper, PyObject *keys_sequence) \
+// Return the (interned) string for a key letter.
+static PyObject *key_str_new(Py_UCS4 letter, key_side_t side)
 {
-    stroke_uint_t  mask;
-    PyObject      *key;
-    Py_UCS4        key_letter;
-    key_side_t     key_side;
-    const Py_UCS4 *possible_letters;
-    unsigned       k, k_end;
+    Py_UCS4   key_ucs4[2];
+    unsigned  key_ucs4_len;
+    PyObject *key;
 
-    mask = 0;
+    key_ucs4[0] = letter;
 
-    for (Py_ssize_t num_keys = PySequence_Fast_GET_SIZE(keys_sequence); num_keys--; )
+    switch (side)
     {
-        key = PySequence_Fast_GET_ITEM(keys_sequence, num_keys);
-        if (!PyUnicode_Check(key))
-        {
-            PyErr_Format(PyExc_ValueError, "invalid `keys`; key %u is not a string: %R", num_keys, key);
-            return INVALID_STROKE;
-        }
-
-        key_letter = key_to_letter(key, &key_side);
-        if (!key_letter)
-        {
-            PyErr_Format(PyExc_ValueError, "invalid `keys`; key %u is not valid: %R", num_keys, key);
-            return INVALID_STROKE;
-        }
-
-        if ('0' <= key_letter && key_letter <= '9')
-        {
-            mask |= helper->number_key_mask;
-            possible_letters = helper->key_number;
-        }
-        else
-        {
-            possible_letters = helper->key_letter;
-        }
+    case KEY_SIDE_NONE:
+        key_ucs4_len = 1;
+        break;
+    case KEY_SIDE_LEFT:
+        key_ucs4[1] = '-';
+        key_ucs4_len = 2;
+        break;
+    case KEY_SIDE_RIGHT:
+        key_ucs4[1] = key_ucs4[0];
+        key_ucs4[0] = '-';
+        key_ucs4_len = 2;
+        break;
+    default:
+        UNREACHABLE();
+    }
 
-        switch (key_side)
-        {
-        case KEY_SIDE_NONE:
-            k = 0;
-            k_end = helper->num_keys;
-            break;
-        case KEY_SIDE_LEFT:
-            k = 0;
-            k_end = helper->right_keys_index;
-            break;
-        case KEY_SIDE_RIGHT:
-            k = helper->right_keys_index;
-            k_end = helper->num_keys;
-            break;
-        default:
-            UNREACHABLE();
-        }
+    key = PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, key_ucs4, key_ucs4_len);
+    if (key != NULL)
+        PyUnicode_InternInPlace(&key);
 
-        for (;;)
-        {
-           if (key_letter == possible_letters[k] && key_side == helper->key_side[k])
-           {
-               mask |= STROKE_1 << k;
-               break;
-           }
+    return key;
+}
 
-           if (++k == k_end)
-           {
-               PyErr_Format(PyExc_ValueError, "invalid key: %R", key);
-               return INVALID_STROKE;
-           }
-        }
-    }
+// Compiled helper code, for single word masks.
+#define HELPER_T                  stroke_helper_t
+#define HELPER_MAX_KEYS           MAX_KEYS
+#define HELPER_MAX_STENO          MAX_STENO
+#define HELPER_MAX_LETTERS        MAX_LETTERS
+#define HELPER_LETTERS_HASH_SIZE  LETTERS_HASH_SIZE
+#define HELPER_PY_T               StrokeHelper
+#define HELPER_OF(self)           ((self)->helper)
+#define HELPER_FN(name)           name
+#define HELPER_PY_FN(name)        StrokeHelper_##name
+#define MASK_T                    stroke_uint_t
+#define MASK_INVALID              INVALID_STROKE
+#define MASK_IS_INVALID(m)        ((m) == INVALID_STROKE)
+#define MASK_ZERO                 ((stroke_uint_t)0)
+#define MASK_BIT(k)               (STROKE_1 << (k))
+#define MASK_TEST(m, k)           (((m) >> (k)) & 1)
+#define MASK_SHR1(m)              ((m) >> 1)
+#define MASK_OR(m1, m2)           ((m1) | (m2))
+#define MASK_AND(m1, m2)          ((m1) & (m2))
+#define MASK_AND_NOT(m1, m2)      ((m1) & ~(m2))
+#define MASK_IS_ZERO(m)           (!(m))
+#define MASK_POPCOUNT(m)          popcount(m)
+#define MASK_FIRST_KEY(m)         bit_index(lsb(m))
+#define MASK_TO_PYLONG(m)         PyLong_FromStrokeUint(m)
+#include "_plover_stroke_helper.h"
+
+static Py_hash_t mask_hash(stroke_uint_t mask)
+{
+    uint64_t h = mask * 0x9e3779b97f4a7c15ULL;
 
-    return mask;
+    return (Py_hash_t)((h >> 32) ^ (h & 0xffffffff));
 }
 
-static stroke_uint_t stroke_from_steno(const stroke_helper_t *helper, PyObject *steno)
+static int unicode_eq(PyObject *s1, PyObject *s2)
 {
-    Py_ssize_t    steno_len;
-    Py_UCS4       steno_ucs4[MAX_STENO];
-    stroke_uint_t mask;
+    Py_ssize_t len;
+    int        kind;
 
-    if (PyUnicode_READY(steno))
-        return INVALID_STROKE;
+    if (s1 == s2)
+        return 1;
 
-    steno_len = PyUnicode_GET_LENGTH(steno);
-    if (steno_len > MAX_STENO)
-        goto invalid;
+    len = PyUnicode_GET_LENGTH(s1);
+    kind = PyUnicode_KIND(s1);
+    if (PyUnicode_GET_LENGTH(s2) != len || PyUnicode_KIND(s2) != kind)
+        return 0;
 
-    if (NULL == PyUnicode_AsUCS4(steno, steno_ucs4, MAX_STENO, 0))
-        return INVALID_STROKE;
+    return !memcmp(PyUnicode_DATA(s1), PyUnicode_DATA(s2), len * kind);
+}
 
-    mask = stroke_from_ucs4(helper, steno_ucs4, steno_len);
-    if (mask == INVALID_STROKE)
-        goto invalid;
+static void steno_cache_clear(steno_cache_t *cache)
+{
+    for (Py_ssize_t n = 0; n < cache->size; ++n)
+        Py_CLEAR(cache->entries[n].steno);
 
-    return mask;
+    if (cache->table != NULL)
+        memset(cache->table, 0, (cache->table_mask + 1) * sizeof (*cache->table));
 
-invalid:
-    PyErr_Format(PyExc_ValueError, "invalid steno: %R", steno);
-    return INVALID_STROKE;
+    cache->size = 0;
+    cache->hand = 0;
+    cache->hits = 0;
+    cache->misses = 0;
 }
 
-static stroke_uint_t stroke_from_any(const stroke_helper_t *helper, PyObject *obj)
+static int steno_cache_resize(steno_cache_t *cache, Py_ssize_t max_size)
 {
-    if (PyLong_Check(obj))
-        return stroke_from_int(helper, obj);
+    steno_cache_entry_t *entries;
+    Py_ssize_t          *table;
+    size_t               table_size;
 
-    if (PyUnicode_Check(obj))
-        return stroke_from_steno(helper, obj);
+    steno_cache_clear(cache);
+
+    if (max_size)
+    {
+        for (table_size = 8; table_size < (size_t)max_size * 2; table_size *= 2)
+            ;
+        entries = PyMem_Malloc(max_size * sizeof (*entries));
+        table = PyMem_Calloc(table_size, sizeof (*table));
+        if (entries == NULL || table == NULL)
+        {
+            PyMem_Free(table);
+            PyMem_Free(entries);
+            PyErr_NoMemory();
+            return -1;
+        }
+    }
+    else
+    {
+        entries = NULL;
+        table = NULL;
+        table_size = 0;
+    }
 
-    obj = PySequence_Fast(obj, "expected a list or tuple");
-    if (obj != NULL)
-        return stroke_from_keys(helper, obj);
+    PyMem_Free(cache->table);
+    PyMem_Free(cache->entries);
+    cache->entries = entries;
+    cache->table = table;
+    cache->table_mask = table_size - 1;
+    cache->max_size = max_size;
 
-    PyErr_Format(PyExc_TypeError,
-                 "expected an integer (mask of keys), "
-                 "sequence of keys, or a string (steno), "
-                 "got: %R", obj);
-    return INVALID_STROKE;
+    return 0;
 }
 
-static int stroke_has_digit(const stroke_helper_t *helper, stroke_uint_t mask)
+// Return the table slot for the given key: either the slot
+// of the corresponding entry, or an empty slot.
+static size_t steno_cache_slot(const steno_cache_t *cache, Py_hash_t hash, PyObject *steno, stroke_uint_t mask)
 {
-    return (mask & helper->number_key_mask) && (mask & helper->numbers_mask);
-}
+    size_t                     slot;
+    Py_ssize_t                 index;
+    const steno_cache_entry_t *entry;
 
-static int stroke_is_number(const stroke_helper_t *helper, stroke_uint_t mask)
-{
-    // Must have the number key, at least one digit, and no other non-digit key.
-    return (mask & helper->number_key_mask) && mask > helper->number_key_mask && mask == (mask & (helper->number_key_mask | helper->numbers_mask));
+    for (slot = (size_t)hash & cache->table_mask; ; slot = (slot + 1) & cache->table_mask)
+    {
+        index = cache->table[slot];
+        if (!index)
+            return slot;
+        entry = &cache->entries[index - 1];
+        if (entry->hash != hash)
+            continue;
+        if (cache->by_mask ? entry->mask == mask : unicode_eq(entry->steno, steno))
+            return slot;
+    }
 }
 
-static int unpack_2_strokes(const stroke_helper_t *helper, PyObject *args, const char *fn_name, stroke_uint_t *first_stroke, stroke_uint_t *second_stroke)
+static steno_cache_entry_t *steno_cache_lookup(steno_cache_t *cache, Py_hash_t hash, PyObject *steno, stroke_uint_t mask)
 {
-    PyObject *s1, *s2;
+    Py_ssize_t index;
 
-    if (!PyArg_UnpackTuple(args, fn_name, 2, 2, &s1, &s2))
-        return 0;
+    index = cache->table[steno_cache_slot(cache, hash, steno, mask)];
+    if (!index)
+    {
+        ++cache->misses;
+        return NULL;
+    }
 
-    *first_stroke = stroke_from_any(helper, s1);
-    if (*first_stroke == INVALID_STROKE)
-        return 0;
+    ++cache->hits;
+    cache->entries[index - 1].referenced = 1;
 
-    *second_stroke = stroke_from_any(helper, s2);
-    if (*second_stroke == INVALID_STROKE)
-        return 0;
+    return &cache->entries[index - 1];
+}
 
-    return 1;
+static void steno_cache_remove(steno_cache_t *cache, Py_ssize_t index)
+{
+    const steno_cache_entry_t *entry;
+    size_t                     slot, next, home;
+
+    entry = &cache->entries[index];
+    slot = steno_cache_slot(cache, entry->hash, entry->steno, entry->mask);
+    assert(cache->table[slot] == index + 1);
+
+    // Backward shift deletion.
+    for (next = slot; ; )
+    {
+        next = (next + 1) & cache->table_mask;
+        if (!cache->table[next])
+            break;
+        home = (size_t)cache->entries[cache->table[next] - 1].hash & cache->table_mask;
+        // Can the entry at `next` be moved to `slot`?
+        if (slot <= next ? (home <= slot || home > next) : (home <= slot && home > next))
+        {
+            cache->table[slot] = cache->table[next];
+            slot = next;
+        }
+    }
+    cache->table[slot] = 0;
 }
 
-static PyObject *stroke_to_keys(const stroke_helper_t *helper, stroke_uint_t mask)
+static void steno_cache_insert(steno_cache_t *cache, Py_hash_t hash, PyObject *steno, stroke_uint_t mask)
 {
-    PyObject *stroke_keys[MAX_KEYS];
-    unsigned  stroke_index;
-    unsigned  key_index;
-    PyObject *keys_tuple;
-    Py_UCS4   key_ucs4[2];
-    unsigned  key_ucs4_len;
-    PyObject *key;
+    Py_ssize_t           index;
+    steno_cache_entry_t *entry;
 
-    for (stroke_index = key_index = 0; mask; ++key_index, mask >>= 1)
+    if (cache->size < cache->max_size)
+        index = cache->size++;
+    else
     {
-        if ((mask & 1))
+        // Evict the first entry not referenced since the last sweep.
+        while (cache->entries[cache->hand].referenced)
         {
-            switch (helper->key_side[key_index])
-            {
-            case KEY_SIDE_NONE:
-                key_ucs4[0] = helper->key_letter[key_index];
-                key_ucs4_len = 1;
-                break;
-            case KEY_SIDE_LEFT:
-                key_ucs4[0] = helper->key_letter[key_index];
-                key_ucs4[1] = '-';
-                key_ucs4_len = 2;
-                break;
-            case KEY_SIDE_RIGHT:
-                key_ucs4[0] = '-';
-                key_ucs4[1] = helper->key_letter[key_index];
-                key_ucs4_len = 2;
-                break;
-            default:
-                UNREACHABLE();
-            }
-            key = PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, key_ucs4, key_ucs4_len);
-            if (key == NULL)
-                goto error;
-            stroke_keys[stroke_index++] = key;
+            cache->entries[cache->hand].referenced = 0;
+            cache->hand = (cache->hand + 1) % cache->max_size;
         }
+        index = cache->hand;
+        cache->hand = (cache->hand + 1) % cache->max_size;
+        steno_cache_remove(cache, index);
+        Py_DECREF(cache->entries[index].steno);
     }
 
-    keys_tuple = PyTuple_New(stroke_index);
-    if (keys_tuple == NULL)
-        goto error;
+    entry = &cache->entries[index];
+    Py_INCREF(steno);
+    entry->steno = steno;
+    entry->hash = hash;
+    entry->mask = mask;
+    entry->referenced = 0;
+    cache->table[steno_cache_slot(cache, hash, steno, mask)] = index + 1;
+}
 
-    while (stroke_index--)
-        PyTuple_SET_ITEM(keys_tuple, stroke_index, stroke_keys[stroke_index]);
+static uint64_t monotonic_ns(void)
+{
+#ifdef _WIN32
+    static LARGE_INTEGER frequency;
+    LARGE_INTEGER        counter;
 
-    return keys_tuple;
+    if (!frequency.QuadPart)
+        QueryPerformanceFrequency(&frequency);
+    QueryPerformanceCounter(&counter);
 
-error:
-    while (stroke_index--)
-        Py_DECREF(stroke_keys[stroke_index]);
-    return NULL;
+    return (uint64_t)((double)counter.QuadPart * 1e9 / (double)frequency.QuadPart);
+#else
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+
+    return (uint64_t)ts.tv_sec * 1000000000 + (uint64_t)ts.tv_nsec;
+#endif
 }
 
-static PyObject *stroke_to_str(const stroke_helper_t *helper, stroke_uint_t mask)
+// Note: only call when stats are enabled (`self->stats_mode != STATS_DISABLED`),
+// so the cost when disabled is a single test per operation.
+static uint64_t stats_start(const StrokeHelper *self)
 {
-    const Py_UCS4 *letters;
-    unsigned       key_index;
-    unsigned       hyphen_index;
-    unsigned       stroke_index;
-    Py_UCS4        stroke[MAX_STENO];
+    return self->stats_mode == STATS_TIMING ? monotonic_ns() : 0;
+}
 
-    if (stroke_has_digit(helper, mask))
-    {
-        mask &= ~helper->number_key_mask;
-        letters = helper->key_number;
-    }
-    else
-    {
-        letters = helper->key_letter;
-    }
+static void stats_record(StrokeHelper *self,
+                         stat_op_t     op,
+                         uint64_t      start,
+                         Py_ssize_t    failures,
+                         Py_ssize_t    chars,
+                         Py_ssize_t    strokes)
+{
+    stat_counters_t *counters = &self->stats[op];
+
+    ++counters->calls;
+    counters->failures += failures;
+    counters->chars += chars;
+    counters->strokes += strokes;
+    if (self->stats_mode == STATS_TIMING)
+        counters->ns += monotonic_ns() - start;
+}
 
-    if ((mask & helper->implicit_hyphen_mask))
-        hyphen_index = MAX_KEYS;
-    else
-        hyphen_index = helper->right_keys_index;
+static stroke_uint_t helper_stroke_from_steno_uncounted(StrokeHelper *self, PyObject *steno)
+{
+    steno_cache_t       *cache = &self->from_steno_cache;
+    steno_cache_entry_t *entry;
+    Py_hash_t            hash;
+    stroke_uint_t        mask;
 
-    for (stroke_index = key_index = 0; mask; ++key_index, mask >>= 1)
-    {
-        if ((mask & 1))
-        {
-            if (key_index >= hyphen_index)
-            {
-                stroke[stroke_index++] = '-';
-                hyphen_index = MAX_KEYS;
-            }
-            stroke[stroke_index++] = letters[key_index];
-        }
-    }
+    if (!cache->max_size)
+        return stroke_from_steno(self->helper, steno);
+
+    hash = PyObject_Hash(steno);
+    if (hash == -1)
+        return INVALID_STROKE;
 
-    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, stroke, stroke_index);
+    entry = steno_cache_lookup(cache, hash, steno, 0);
+    if (entry != NULL)
+        return entry->mask;
+
+    mask = stroke_from_steno(self->helper, steno);
+    if (mask != INVALID_STROKE)
+        steno_cache_insert(cache, hash, steno, mask);
+
+    return mask;
 }
 
-unsigned stroke_to_sort_key(const stroke_helper_t *helper, stroke_uint_t mask, char *sort_key)
+static stroke_uint_t helper_stroke_from_steno(StrokeHelper *self, PyObject *steno)
 {
-    unsigned key_num;
-    unsigned sort_key_index;
+    uint64_t      start;
+    stroke_uint_t mask;
 
-    for (key_num = sort_key_index = 0; mask; mask >>= 1)
-    {
-        ++key_num;
-        if ((mask & 1))
-            sort_key[sort_key_index++] = key_num;
-    }
+    if (!self->stats_mode)
+        return helper_stroke_from_steno_uncounted(self, steno);
 
-    return sort_key_index;
+    start = stats_start(self);
+    mask = helper_stroke_from_steno_uncounted(self, steno);
+    stats_record(self, STAT_FROM_STENO, start, mask == INVALID_STROKE,
+                 PyUnicode_Check(steno) ? PyUnicode_GET_LENGTH(steno) : 0,
+                 mask != INVALID_STROKE);
+
+    return mask;
 }
 
-static PyObject *stroke_cmp(const stroke_helper_t *helper, PyObject *args, const char *fn_name, cmp_op_t op)
+static stroke_uint_t helper_stroke_from_keys(StrokeHelper *self, PyObject *keys_sequence)
 {
-    stroke_uint_t si1, si2, lsb1, lsb2, m;
-    stroke_int_t  c;
-    int           b;
+    uint64_t      start;
+    stroke_uint_t mask;
 
-    if (!unpack_2_strokes(helper, args, fn_name, &si1, &si2))
-        return NULL;
+    if (!self->stats_mode)
+        return stroke_from_keys(self->helper, keys_sequence);
 
-    c = 0;
-    while (si1 != si2)
-    {
-        lsb1 = lsb(si1);
-        lsb2 = lsb(si2);
-        c = lsb1 - lsb2;
-        if (c)
-            break;
-        m = ~lsb1;
-        si1 &= m;
-        si2 &= m;
-    }
+    start = stats_start(self);
+    mask = stroke_from_keys(self->helper, keys_sequence);
+    stats_record(self, STAT_FROM_KEYS, start, mask == INVALID_STROKE, 0, mask != INVALID_STROKE);
 
-    switch (op)
-    {
-    case CMP_OP_CMP:
+    return mask;
+}
+
+static stroke_uint_t helper_stroke_from_any(StrokeHelper *self, PyObject *obj)
+{
+    uint64_t      start;
+    stroke_uint_t mask;
+
+    if (PyUnicode_Check(obj))
+        return helper_stroke_from_steno(self, obj);
+
+    if (!self->stats_mode || PyLong_Check(obj))
+        return stroke_from_any(self->helper, obj);
+
+    // Sequence of keys.
+    start = stats_start(self);
+    mask = stroke_from_any(self->helper, obj);
+    stats_record(self, STAT_FROM_KEYS, start, mask == INVALID_STROKE, 0, mask != INVALID_STROKE);
+
+    return mask;
+}
+
+static PyObject *helper_stroke_to_str_uncounted(StrokeHelper *self, stroke_uint_t mask)
+{
+    steno_cache_t       *cache = &self->to_steno_cache;
+    steno_cache_entry_t *entry;
+    Py_hash_t            hash;
+    PyObject            *steno;
+
+    if (!cache->max_size)
+        return stroke_to_str(self->helper, mask);
+
+    hash = mask_hash(mask);
+
+    entry = steno_cache_lookup(cache, hash, NULL, mask);
+    if (entry != NULL)
+    {
+        Py_INCREF(entry->steno);
+        return entry->steno;
+    }
+
+    steno = stroke_to_str(self->helper, mask);
+    if (steno != NULL)
+        steno_cache_insert(cache, hash, steno, mask);
+
+    return steno;
+}
+
+static PyObject *helper_stroke_to_str(StrokeHelper *self, stroke_uint_t mask)
+{
+    uint64_t  start;
+    PyObject *steno;
+
+    if (!self->stats_mode)
+        return helper_stroke_to_str_uncounted(self, mask);
+
+    start = stats_start(self);
+    steno = helper_stroke_to_str_uncounted(self, mask);
+    stats_record(self, STAT_TO_STENO, start, steno == NULL,
+                 steno == NULL ? 0 : PyUnicode_GET_LENGTH(steno),
+                 steno != NULL);
+
+    return steno;
+}
+
+static int unpack_2_strokes(StrokeHelper *self, PyObject *args, const char *fn_name, stroke_uint_t *first_stroke, stroke_uint_t *second_stroke)
+{
+    PyObject *s1, *s2;
+
+    if (!PyArg_UnpackTuple(args, fn_name, 2, 2, &s1, &s2))
+        return 0;
+
+    *first_stroke = helper_stroke_from_any(self, s1);
+    if (*first_stroke == INVALID_STROKE)
+        return 0;
+
+    *second_stroke = helper_stroke_from_any(self, s2);
+    if (*second_stroke == INVALID_STROKE)
+        return 0;
+
+    return 1;
+}
+
+unsigned stroke_to_sort_key(const stroke_helper_t *helper, stroke_uint_t mask, char *sort_key)
+{
+    unsigned key_num;
+    unsigned sort_key_index;
+
+    for (key_num = sort_key_index = 0; mask; mask >>= 1)
+    {
+        ++key_num;
+        if ((mask & 1))
+            sort_key[sort_key_index++] = key_num;
+    }
+
+    return sort_key_index;
+}
+
+static stroke_int_t stroke_compare(stroke_uint_t si1, stroke_uint_t si2)
+{
+    stroke_uint_t k1, k2;
+
+    if (si1 == si2)
+        return 0;
+
+    k1 = stroke_to_order_key(si1);
+    k2 = stroke_to_order_key(si2);
+
+    return k1 < k2 ? -1 : 1;
+}
+
+// Weighted (Hamming) distance between 2 strokes: each key present
+// in only one of the strokes counts for 1, except for a key replaced
+// by an adjacent key, which counts for 1 (instead of 2). Note: the
+// substitutions are matched greedily, from the lowest key.
+// Return a value greater than `max_distance` if the strokes are too far.
+static unsigned stroke_distance(const stroke_helper_t *helper,
+                                stroke_uint_t          m1,
+                                stroke_uint_t          m2,
+                                unsigned               max_distance)
+{
+    stroke_uint_t missing, extra, candidates;
+    unsigned      distance;
+    unsigned      num_missing;
+
+    distance = popcount(m1 ^ m2);
+    // Quick lower bound: all keys substituted.
+    if ((distance + 1) / 2 > max_distance)
+        return max_distance + 1;
+    if (!distance)
+        return 0;
+
+    missing = m1 & ~m2;
+    extra = m2 & ~m1;
+    num_missing = popcount(missing);
+
+    // Tighter lower bound: all possible substitutions.
+    if (distance - Py_MIN(num_missing, distance - num_missing) > max_distance)
+        return max_distance + 1;
+
+    for (; missing && extra; missing &= missing - 1)
+    {
+        candidates = extra & helper->adjacent_keys[bit_index(lsb(missing))];
+        if (candidates)
+        {
+            extra &= ~lsb(candidates);
+            --distance;
+        }
+    }
+
+    return distance;
+}
+
+static PyObject *cmp_result(stroke_int_t c, cmp_op_t op)
+{
+    int b;
+
+    switch (op)
+    {
+    case CMP_OP_CMP:
         return PyLong_FromStrokeInt(c);
     case CMP_OP_EQ:
         b = c == 0;
@@ -546,970 +898,6846 @@ static PyObject *stroke_cmp(const stroke_helper_t *helper, PyObject *args, const
     Py_RETURN_FALSE;
 }
 
-static PyObject *normalize_stroke_ucs4(const stroke_helper_t *helper,
-                                       const Py_UCS4         *stroke_ucs4,
-                                       Py_ssize_t             stroke_len)
-{
-    stroke_uint_t mask;
+static PyObject *stroke_cmp(StrokeHelper *self, PyObject *args, const char *fn_name, cmp_op_t op)
+{
+    stroke_uint_t si1, si2;
+
+    if (!unpack_2_strokes(self, args, fn_name, &si1, &si2))
+        return NULL;
+
+    return cmp_result(stroke_compare(si1, si2), op);
+}
+
+// Parse steno (one or more strokes separated by '/') into `masks`,
+// which must have room for at least `steno_len / 2 + 1` entries.
+// Return the number of strokes, or -1 if the steno is invalid
+// (without setting an exception).
+static Py_ssize_t steno_to_masks(const stroke_helper_t *helper,
+                                 int                    steno_kind,
+                                 const void            *steno_data,
+                                 Py_ssize_t             steno_len,
+                                 stroke_uint_t         *masks)
+{
+    Py_ssize_t     steno_index;
+    Py_ssize_t     stroke_start;
+    Py_ssize_t     num_strokes;
+    stroke_uint_t  mask;
+
+    if (!steno_len)
+        return 0;
+
+    num_strokes = 0;
+    stroke_start = 0;
+
+    for (steno_index = 0; ; ++steno_index)
+    {
+        if (steno_index < steno_len && PyUnicode_READ(steno_kind, steno_data, steno_index) != '/')
+            continue;
+        if (steno_index == stroke_start)
+        {
+            // Allow one '/' at the start, but
+            // no trailing '/', nor empty strokes.
+            if (steno_index || steno_index == steno_len)
+                return -1;
+            mask = 0;
+        }
+        else
+        {
+            mask = stroke_from_data(helper, steno_kind,
+                                    (const char *)steno_data + stroke_start * steno_kind,
+                                    steno_index - stroke_start);
+            if (mask == INVALID_STROKE)
+                return -1;
+        }
+        masks[num_strokes++] = mask;
+        if (steno_index == steno_len)
+            break;
+        stroke_start = steno_index + 1;
+    }
+
+    return num_strokes;
+}
+
+// Steno validation error codes (see `validate_steno_list`).
+typedef enum
+{
+    STENO_OK,
+    STENO_ERROR_EMPTY_STROKE,
+    STENO_ERROR_TOO_LONG,
+    STENO_ERROR_INVALID_LETTER,
+    STENO_ERROR_MISORDERED_KEY,
+    STENO_ERROR_DUPLICATE_NUMBER_KEY,
+    STENO_ERROR_MISPLACED_HYPHEN,
+    STENO_ERROR_NOT_STENO,
+    NUM_STENO_ERRORS,
+
+} steno_error_t;
+
+static const char *steno_error_name[NUM_STENO_ERRORS] =
+{
+    "OK",
+    "EMPTY_STROKE",
+    "TOO_LONG",
+    "INVALID_LETTER",
+    "MISORDERED_KEY",
+    "DUPLICATE_NUMBER_KEY",
+    "MISPLACED_HYPHEN",
+    "NOT_STENO",
+};
+
+// Diagnose why a stroke is invalid: must follow the same
+// logic as `stroke_from_kind_data` (only used on failures).
+static steno_error_t stroke_error(const stroke_helper_t *helper,
+                                  int                    kind,
+                                  const void            *data,
+                                  Py_ssize_t             len)
+{
+    stroke_uint_t  mask;
+    Py_UCS4        letter;
+    unsigned       letter_idx;
+    int            key_index;
+
+    if (len > MAX_STENO)
+        return STENO_ERROR_TOO_LONG;
+
+    mask = 0;
+    key_index = -1;
+
+    for (Py_ssize_t index = 0; index < len; ++index)
+    {
+        letter = PyUnicode_READ(kind, data, index);
+        if (letter == helper->feral_number_key_letter)
+        {
+            if ((mask & helper->number_key_mask))
+                return STENO_ERROR_DUPLICATE_NUMBER_KEY;
+            mask |= helper->number_key_mask;
+            continue;
+        }
+        if (letter == '-')
+        {
+            if (key_index > (int)helper->right_keys_index)
+                return STENO_ERROR_MISPLACED_HYPHEN;
+            key_index = helper->right_keys_index - 1;
+            continue;
+        }
+        letter_idx = letter_index(helper, letter);
+        if (!letter_idx)
+            return STENO_ERROR_INVALID_LETTER;
+        key_index = helper->next_key[key_index + 1][letter_idx];
+        if (key_index == NO_KEY)
+            return STENO_ERROR_MISORDERED_KEY;
+        mask |= STROKE_1 << key_index;
+    }
+
+    return STENO_OK;
+}
+
+// Validate steno (one or more strokes separated by '/'): like
+// `steno_to_masks`, but return an error code instead of the strokes.
+// Note: can be used without the GIL.
+static steno_error_t steno_error(const stroke_helper_t *helper,
+                                 int                    steno_kind,
+                                 const void            *steno_data,
+                                 Py_ssize_t             steno_len)
+{
+    Py_ssize_t     steno_index;
+    Py_ssize_t     stroke_start;
+    const void    *stroke_data;
+    steno_error_t  error;
+
+    if (!steno_len)
+        return STENO_OK;
+
+    stroke_start = 0;
+
+    for (steno_index = 0; ; ++steno_index)
+    {
+        if (steno_index < steno_len && PyUnicode_READ(steno_kind, steno_data, steno_index) != '/')
+            continue;
+        if (steno_index == stroke_start)
+        {
+            if (steno_index || steno_index == steno_len)
+                return STENO_ERROR_EMPTY_STROKE;
+        }
+        else
+        {
+            stroke_data = (const char *)steno_data + stroke_start * steno_kind;
+            if (stroke_from_data(helper, steno_kind, stroke_data,
+                                 steno_index - stroke_start) == INVALID_STROKE)
+            {
+                error = stroke_error(helper, steno_kind, stroke_data,
+                                     steno_index - stroke_start);
+                // Note: should not happen, but never report an invalid stroke as valid.
+                return error == STENO_OK ? STENO_ERROR_INVALID_LETTER : error;
+            }
+        }
+        if (steno_index == steno_len)
+            break;
+        stroke_start = steno_index + 1;
+    }
+
+    return STENO_OK;
+}
+
+static PyObject *array_type;
+static PyObject *str_slash;
+
+// Create a new `array.array` of type `typecode` from a raw buffer.
+static PyObject *new_array(const char *typecode, const void *data, Py_ssize_t size)
+{
+    PyObject *array;
+    PyObject *result;
+
+    array = PyObject_CallFunction(array_type, "s", typecode);
+    if (array == NULL || !size)
+        return array;
+
+    result = PyObject_CallMethod(array, "frombytes", "y#", data, size);
+    if (result == NULL)
+    {
+        Py_DECREF(array);
+        return NULL;
+    }
+    Py_DECREF(result);
+
+    return array;
+}
+
+// Outline: an immutable sequence of strokes (keys masks),
+// stored inline, with a precomputed hash.
+typedef struct
+{
+    PyObject_VAR_HEAD
+    Py_hash_t     hash;
+    stroke_uint_t strokes[1];
+
+} Outline;
+
+static PyTypeObject OutlineType;
+
+// Same mixing as used for tuples hashing (xxHash based).
+static Py_hash_t outline_hash(const stroke_uint_t *strokes, Py_ssize_t num_strokes)
+{
+    uint64_t acc = 0x27d4eb2f165667c5ULL;
+
+    for (Py_ssize_t n = 0; n < num_strokes; ++n)
+    {
+        acc += strokes[n] * 0xc2b2ae3d27d4eb4fULL;
+        acc = (acc << 31) | (acc >> 33);
+        acc *= 0x9e3779b185ebca87ULL;
+    }
+    acc += (uint64_t)num_strokes ^ (0x27d4eb2f165667c5ULL ^ 3527539UL);
+
+    if ((Py_hash_t)acc == -1)
+        return 1546275796;
+
+    return (Py_hash_t)acc;
+}
+
+static PyObject *outline_new(const stroke_uint_t *strokes, Py_ssize_t num_strokes)
+{
+    Outline *outline;
+
+    outline = PyObject_NewVar(Outline, &OutlineType, num_strokes);
+    if (outline == NULL)
+        return NULL;
+
+    memcpy(outline->strokes, strokes, num_strokes * sizeof (*strokes));
+    outline->hash = outline_hash(strokes, num_strokes);
+
+    return (PyObject *)outline;
+}
+
+static stroke_uint_t outline_mask_from_obj(PyObject *obj)
+{
+    stroke_uint_t mask;
+
+    if (!PyLong_Check(obj))
+    {
+        PyErr_Format(PyExc_TypeError, "expected an integer (keys mask), got: %R", obj);
+        return INVALID_STROKE;
+    }
+
+    mask = PyLong_AsStrokeUint(obj);
+    if (mask == INVALID_STROKE && PyErr_Occurred())
+        return INVALID_STROKE;
+
+    if ((mask >> MAX_KEYS))
+    {
+        char error[40];
+
+        snprintf(error, sizeof (error), "invalid keys mask: "STROKE_UINT_FMT, mask);
+        PyErr_SetString(PyExc_ValueError, error);
+        return INVALID_STROKE;
+    }
+
+    return mask;
+}
+
+// Get the strokes (keys masks) of `obj`, an outline or a sequence of
+// strokes: for an outline, `*masks` points directly to its strokes,
+// otherwise to `buffer` if big enough, or to a newly allocated array.
+// Return the number of strokes, or -1 on error.
+static Py_ssize_t strokes_to_masks(PyObject       *obj,
+                                   stroke_uint_t  *buffer,
+                                   Py_ssize_t      buffer_len,
+                                   stroke_uint_t **masks)
+{
+    PyObject   *strokes;
+    Py_ssize_t  num_strokes;
+
+    if (PyObject_TypeCheck(obj, &OutlineType))
+    {
+        *masks = ((Outline *)obj)->strokes;
+        return Py_SIZE(obj);
+    }
+
+    strokes = PySequence_Fast(obj, "expected an outline or a sequence of strokes");
+    if (strokes == NULL)
+        return -1;
+
+    num_strokes = PySequence_Fast_GET_SIZE(strokes);
+    if (num_strokes <= buffer_len)
+        *masks = buffer;
+    else
+    {
+        *masks = PyMem_Malloc(num_strokes * sizeof (**masks));
+        if (*masks == NULL)
+        {
+            Py_DECREF(strokes);
+            PyErr_NoMemory();
+            return -1;
+        }
+    }
+
+    for (Py_ssize_t n = 0; n < num_strokes; ++n)
+    {
+        (*masks)[n] = outline_mask_from_obj(PySequence_Fast_GET_ITEM(strokes, n));
+        if ((*masks)[n] == INVALID_STROKE)
+        {
+            if (*masks != buffer)
+                PyMem_Free(*masks);
+            Py_DECREF(strokes);
+            return -1;
+        }
+    }
+
+    Py_DECREF(strokes);
+    return num_strokes;
+}
+
+static void strokes_masks_free(PyObject *obj, stroke_uint_t *buffer, stroke_uint_t *masks)
+{
+    if (masks != buffer && !PyObject_TypeCheck(obj, &OutlineType))
+        PyMem_Free(masks);
+}
+
+#define MASKS_BUFFER_LEN  16
+
+// Check for a buffer format of native unsigned integers.
+static int is_native_unsigned_format(const char *format)
+{
+    if (format == NULL)
+        return 0;
+    if (format[0] == '@' || format[0] == '=')
+        ++format;
+    return (format[0] == 'Q' || format[0] == 'L') && format[1] == '\0';
+}
+
+// Like `strokes_to_masks`, but with a fast path for a buffer of
+// unsigned 64 bits integers (e.g. `array('Q')`): `view` is used to
+// hold the buffer, call `masks_from_obj_release` when done.
+static Py_ssize_t masks_from_obj(PyObject       *obj,
+                                 Py_buffer      *view,
+                                 stroke_uint_t  *buffer,
+                                 Py_ssize_t      buffer_len,
+                                 stroke_uint_t **masks)
+{
+    view->obj = NULL;
+
+    if (PyObject_TypeCheck(obj, &OutlineType) || !PyObject_CheckBuffer(obj))
+        return strokes_to_masks(obj, buffer, buffer_len, masks);
+
+    if (PyObject_GetBuffer(obj, view, PyBUF_FORMAT | PyBUF_C_CONTIGUOUS))
+        return -1;
+
+    if (view->itemsize != sizeof (stroke_uint_t) || !is_native_unsigned_format(view->format))
+    {
+        PyErr_Format(PyExc_TypeError, "expected a buffer of unsigned 64 bits integers, got format: %s",
+                     view->format == NULL ? "B" : view->format);
+        PyBuffer_Release(view);
+        view->obj = NULL;
+        return -1;
+    }
+
+    *masks = view->buf;
+    return view->len / view->itemsize;
+}
+
+static void masks_from_obj_release(PyObject      *obj,
+                                   Py_buffer     *view,
+                                   stroke_uint_t *buffer,
+                                   stroke_uint_t *masks)
+{
+    if (view->obj != NULL)
+        PyBuffer_Release(view);
+    else
+        strokes_masks_free(obj, buffer, masks);
+}
+
+
+static stroke_helper_t *stroke_helper_new(void)
+{
+    stroke_helper_t *helper;
+
+    helper = PyMem_Calloc(1, sizeof (*helper));
+    if (helper == NULL)
+        return (stroke_helper_t *)PyErr_NoMemory();
+
+    helper->refcount = 1;
+
+    return helper;
+}
+
+// Return a (private) copy of a compiled helper.
+static stroke_helper_t *stroke_helper_copy(const stroke_helper_t *helper)
+{
+    stroke_helper_t *copy;
+
+    copy = PyMem_Malloc(sizeof (*copy));
+    if (copy == NULL)
+        return (stroke_helper_t *)PyErr_NoMemory();
+
+    *copy = *helper;
+    copy->refcount = 1;
+    for (unsigned k = 0; k < copy->num_keys; ++k)
+    {
+        Py_INCREF(copy->key_str[0][k]);
+        Py_INCREF(copy->key_str[1][k]);
+    }
+
+    return copy;
+}
+
+// Batch operations release the GIL while working on native buffers,
+// but only when there's enough work for it to be worth it.
+#define GIL_RELEASE_THRESHOLD  256
+
+#define BEGIN_ALLOW_THREADS_IF(cond) \
+    { PyThreadState *_save = (cond) ? PyEval_SaveThread() : NULL;
+#define END_ALLOW_THREADS_IF \
+    if (_save != NULL) PyEval_RestoreThread(_save); }
+
+// Note: the reference count is only ever updated with the GIL held;
+// batch operations take a reference to the compiled helper before
+// releasing the GIL, so a concurrent `setup` cannot free it from
+// under them (`setup` swaps in a new compiled helper).
+static void stroke_helper_incref(stroke_helper_t *helper)
+{
+    ++helper->refcount;
+}
+
+static void stroke_helper_decref(stroke_helper_t *helper)
+{
+    if (helper == NULL || --helper->refcount)
+        return;
+
+    stroke_helper_clear(helper);
+    PyMem_Free(helper);
+}
+
+static void keys_cache_clear(StrokeHelper *self)
+{
+    for (unsigned n = 0; n < KEYS_CACHE_SIZE; ++n)
+        Py_CLEAR(self->keys_cache_tuple[n]);
+}
+
+static PyObject *helper_stroke_to_keys(StrokeHelper *self, stroke_uint_t mask)
+{
+    uint64_t  start;
+    unsigned  slot;
+    PyObject *keys_tuple;
+
+    start = self->stats_mode ? stats_start(self) : 0;
+
+    slot = (unsigned)mask_hash(mask) & (KEYS_CACHE_SIZE - 1);
+    keys_tuple = self->keys_cache_tuple[slot];
+    if (keys_tuple == NULL || self->keys_cache_mask[slot] != mask)
+    {
+        keys_tuple = stroke_to_keys(self->helper, mask);
+        if (keys_tuple == NULL)
+            return NULL;
+        Py_XSETREF(self->keys_cache_tuple[slot], keys_tuple);
+        self->keys_cache_mask[slot] = mask;
+    }
+
+    Py_INCREF(keys_tuple);
+
+    if (self->stats_mode)
+        stats_record(self, STAT_TO_KEYS, start, 0, 0, 1);
+
+    return keys_tuple;
+}
+
+// Parse and validate a system definition (the `setup` arguments),
+// with up to `max_keys` keys.
+static int parse_system(PyObject *args, PyObject *kwargs, unsigned max_keys, system_t *system)
+{
+    static char *kwlist[] = {"keys", "implicit_hyphen_keys", "number_key", "numbers", "feral_number_key", NULL};
+
+    PyObject   *implicit_hyphen_keys = Py_None;
+    PyObject   *number_key = Py_None;
+    PyObject   *numbers = Py_None;
+    int         feral_number_key = 0;
+    PyObject   *keys_sequence;
+    Py_ssize_t  num_keys;
+    uint8_t     unique_letter[MAX_WIDE_KEYS];
+    unsigned    num_implicit_hyphen_keys;
+    unsigned    num_numbers;
+    Py_UCS4     number_key_letter;
+    PyObject   *key;
+    Py_UCS4     key_letter;
+    key_side_t  key_side;
+    int         contains;
+    int         result;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OOOp", kwlist,
+                                     &keys_sequence, &implicit_hyphen_keys,
+                                     &number_key, &numbers,
+                                     &feral_number_key))
+        return -1;
+
+    keys_sequence = PySequence_Fast(keys_sequence, "expected `keys` to be a list or tuple");
+    if (keys_sequence == NULL)
+        return -1;
+
+    result = -1;
+
+    num_keys = PySequence_Fast_GET_SIZE(keys_sequence);
+    if (num_keys == 0 || num_keys > max_keys)
+    {
+        PyErr_SetString(PyExc_ValueError, "unsupported number of keys");
+        goto end;
+    }
+
+    if (number_key == Py_None)
+    {
+        if (numbers != Py_None)
+        {
+            PyErr_SetString(PyExc_TypeError, "expected `numbers` to be None (since `number_key` is None)");
+            goto end;
+        }
+
+        if (feral_number_key)
+        {
+            PyErr_SetString(PyExc_TypeError, "expected `feral_number_key` to be False (since `number_key` is None)");
+            goto end;
+        }
+
+        number_key_letter = 0;
+        numbers = NULL;
+    }
+    else
+    {
+        if (!PyUnicode_Check(number_key))
+        {
+            PyErr_SetString(PyExc_TypeError, "expected `number_key` to be a string");
+            goto end;
+        }
+
+        number_key_letter = key_to_letter(number_key, &key_side);
+        if (!number_key_letter)
+        {
+            PyErr_SetString(PyExc_ValueError, "invalid `number_key`");
+            goto end;
+        }
+
+        if (!PyDict_Check(numbers))
+        {
+            PyErr_SetString(PyExc_TypeError, "expected `numbers` to be a dictionary");
+            goto end;
+        }
+    }
+
+    if (implicit_hyphen_keys != Py_None && !PySet_Check(implicit_hyphen_keys))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected `implicit_hyphen_keys` to be a set");
+        goto end;
+    }
+
+    system->num_keys = (unsigned)num_keys;
+    system->right_keys_index = system->num_keys;
+    system->implicit_hyphen_start = system->implicit_hyphen_end = 0;
+    system->number_key_index = -1;
+    system->feral_number_key_letter = 0;
+    num_implicit_hyphen_keys = 0;
+    num_numbers = 0;
+
+    for (unsigned k = 0; k < system->num_keys; ++k)
+    {
+        key = PySequence_Fast_GET_ITEM(keys_sequence, k);
+        if (!PyUnicode_Check(key))
+        {
+            PyErr_Format(PyExc_ValueError, "invalid `keys`; key %u is not a string: %R", k, key);
+            goto end;
+        }
+
+        key_letter = key_to_letter(key, &key_side);
+        if (!key_letter)
+        {
+            PyErr_Format(PyExc_ValueError, "invalid `keys`; key %u is not valid: %R", k, key);
+            goto end;
+        }
+
+        switch (key_side)
+        {
+        case KEY_SIDE_NONE:
+            break;
+        case KEY_SIDE_LEFT:
+            if (system->right_keys_index != system->num_keys)
+            {
+                PyErr_Format(PyExc_ValueError, "invalid `keys`; left-key on the right-hand side: %R", key);
+                goto end;
+            }
+            break;
+        case KEY_SIDE_RIGHT:
+            if (system->right_keys_index == system->num_keys)
+                system->right_keys_index = k;
+            break;
+        default:
+            UNREACHABLE();
+        }
+
+        if (key_letter == number_key_letter)
+            system->number_key_index = k;
+
+        if (implicit_hyphen_keys != Py_None)
+        {
+            contains = PySet_Contains(implicit_hyphen_keys, key);
+            if (contains < 0)
+                goto end;
+            if (contains)
+            {
+                if (!num_implicit_hyphen_keys++)
+                    system->implicit_hyphen_start = k;
+                system->implicit_hyphen_end = k + 1;
+            }
+        }
+
+        system->key_side[k] = key_side;
+        system->key_letter[k] = key_letter;
+        system->key_has_number[k] = 0;
+
+        if (number_key_letter)
+        {
+            number_key = PyDict_GetItem(numbers, key);
+            if (number_key != NULL)
+            {
+                key_letter = key_to_letter(number_key, &key_side);
+                if (!key_letter)
+                {
+                    PyErr_Format(PyExc_ValueError, "invalid `numbers`; entry for %R is not valid: %R", key, number_key);
+                    goto end;
+                }
+                system->key_has_number[k] = 1;
+                ++num_numbers;
+            }
+        }
+
+        system->key_number[k] = key_letter;
+    }
+
+    if (number_key_letter)
+    {
+        if (system->number_key_index < 0)
+        {
+            PyErr_SetString(PyExc_ValueError, "invalid `number_key`");
+            goto end;
+        }
+
+        if (num_numbers != 10)
+        {
+            PyErr_SetString(PyExc_ValueError, "invalid `numbers`");
+            goto end;
+        }
+    }
+
+    // Find out unique letters.
+    {
+        unsigned k, l;
+
+        for (k = 0; k < system->num_keys; ++k)
+        {
+            for (l = 0; l < system->num_keys; ++l)
+                if (l != k && system->key_letter[l] == system->key_letter[k])
+                    break;
+            unique_letter[k] = l == system->num_keys;
+        }
+    }
+
+    if (implicit_hyphen_keys != Py_None)
+    {
+        if ((Py_ssize_t)num_implicit_hyphen_keys != PySet_GET_SIZE(implicit_hyphen_keys))
+        {
+            PyErr_SetString(PyExc_ValueError, "invalid `implicit_hyphen_keys`: not all keys accounted for");
+            goto end;
+        }
+
+        // Implicit hyphen keys must be a continuous block.
+        if (num_implicit_hyphen_keys != system->implicit_hyphen_end - system->implicit_hyphen_start)
+        {
+            PyErr_SetString(PyExc_ValueError, "invalid `implicit_hyphen_keys`: not a continuous block");
+            goto end;
+        }
+
+        for (unsigned k = system->implicit_hyphen_start; k < system->implicit_hyphen_end; ++k)
+        {
+            if (!unique_letter[k])
+            {
+                PyErr_SetString(PyExc_ValueError, "invalid `implicit_hyphen_keys`: some letters are not unique");
+                goto end;
+            }
+        }
+    }
+    else
+    {
+        unsigned k, l;
+
+        // Default: the block of keys with a unique letter around the hyphen.
+        for (k = system->right_keys_index; k && unique_letter[k - 1]; --k)
+            ;
+        for (l = system->right_keys_index; l < system->num_keys && unique_letter[l]; ++l)
+            ;
+
+        system->implicit_hyphen_start = k;
+        system->implicit_hyphen_end = l;
+    }
+
+    if (feral_number_key)
+    {
+        if ((unsigned)system->number_key_index >= system->implicit_hyphen_start &&
+            (unsigned)system->number_key_index < system->implicit_hyphen_end)
+        {
+            PyErr_SetString(PyExc_ValueError, "invalid `number_key`: cannot be both feral and an implicit hyphen key");
+            goto end;
+        }
+
+        system->feral_number_key_letter = number_key_letter;
+    }
+
+    result = 0;
+
+end:
+    Py_DECREF(keys_sequence);
+    return result;
+}
+
+// Default keys adjacency: consecutive keys on the same side.
+static void compile_adjacent_keys(stroke_helper_t *helper)
+{
+    memset(helper->adjacent_keys, 0, sizeof (helper->adjacent_keys));
+
+    for (unsigned k = 1; k < helper->num_keys; ++k)
+    {
+        if (helper->key_side[k] == KEY_SIDE_NONE || helper->key_side[k] != helper->key_side[k - 1])
+            continue;
+        helper->adjacent_keys[k - 1] |= STROKE_1 << k;
+        helper->adjacent_keys[k] |= STROKE_1 << (k - 1);
+    }
+}
+
+static PyObject *StrokeHelper_setup(StrokeHelper *self, PyObject *args, PyObject *kwargs)
+{
+    system_t         system;
+    stroke_helper_t  helper;
+    stroke_helper_t *new_helper;
+
+    if (parse_system(args, kwargs, MAX_KEYS, &system) ||
+        compile_system(&helper, &system))
+        return NULL;
+
+    compile_adjacent_keys(&helper);
+
+    new_helper = PyMem_Malloc(sizeof (*new_helper));
+    if (new_helper == NULL)
+    {
+        stroke_helper_clear(&helper);
+        return PyErr_NoMemory();
+    }
+    *new_helper = helper;
+    new_helper->refcount = 1;
+
+    keys_cache_clear(self);
+    steno_cache_clear(&self->from_steno_cache);
+    steno_cache_clear(&self->to_steno_cache);
+    stroke_helper_decref(self->helper);
+    self->helper = new_helper;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *StrokeHelper_set_cache_size(StrokeHelper *self, PyObject *size)
+{
+    Py_ssize_t max_size;
+
+    max_size = PyNumber_AsSsize_t(size, PyExc_OverflowError);
+    if (max_size == -1 && PyErr_Occurred())
+        return NULL;
+
+    if (max_size < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid cache size");
+        return NULL;
+    }
+
+    self->to_steno_cache.by_mask = 1;
+
+    if (steno_cache_resize(&self->from_steno_cache, max_size) ||
+        steno_cache_resize(&self->to_steno_cache, max_size))
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *StrokeHelper_cache_clear(StrokeHelper *self, PyObject *Py_UNUSED(ignored))
+{
+    steno_cache_clear(&self->from_steno_cache);
+    steno_cache_clear(&self->to_steno_cache);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *StrokeHelper_cache_info(StrokeHelper *self, PyObject *Py_UNUSED(ignored))
+{
+    return Py_BuildValue("{s:n,s:n,s:n,s:n,s:n,s:n,s:n}",
+                         "max_size"          , self->from_steno_cache.max_size,
+                         "from_steno_hits"   , self->from_steno_cache.hits,
+                         "from_steno_misses" , self->from_steno_cache.misses,
+                         "from_steno_size"   , self->from_steno_cache.size,
+                         "to_steno_hits"     , self->to_steno_cache.hits,
+                         "to_steno_misses"   , self->to_steno_cache.misses,
+                         "to_steno_size"     , self->to_steno_cache.size);
+}
+
+static PyObject *StrokeHelper_set_stats(StrokeHelper *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "enabled", "timing", NULL };
+    int enabled;
+    int timing;
+
+    timing = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "p|p", kwlist, &enabled, &timing))
+        return NULL;
+
+    self->stats_mode = !enabled ? STATS_DISABLED : timing ? STATS_TIMING : STATS_COUNTERS;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *StrokeHelper_reset_stats(StrokeHelper *self, PyObject *Py_UNUSED(ignored))
+{
+    memset(self->stats, 0, sizeof (self->stats));
+    self->from_steno_cache.hits = self->from_steno_cache.misses = 0;
+    self->to_steno_cache.hits = self->to_steno_cache.misses = 0;
+
+    Py_RETURN_NONE;
+}
+
+static int set_stat(PyObject *stats, const char *name, uint64_t value)
+{
+    PyObject *value_obj;
+    int       ret;
+
+    value_obj = PyLong_FromUnsignedLongLong(value);
+    if (value_obj == NULL)
+        return -1;
+
+    ret = PyDict_SetItemString(stats, name, value_obj);
+    Py_DECREF(value_obj);
+
+    return ret;
+}
+
+static PyObject *StrokeHelper_stats(StrokeHelper *self, PyObject *Py_UNUSED(ignored))
+{
+    const stat_counters_t *counters;
+    const steno_cache_t   *cache;
+    PyObject              *stats;
+    PyObject              *op_stats;
+
+    stats = PyDict_New();
+    if (stats == NULL)
+        return NULL;
+
+    for (unsigned op = 0; op < NUM_STATS; ++op)
+    {
+        counters = &self->stats[op];
+        op_stats = PyDict_New();
+        if (op_stats == NULL || PyDict_SetItemString(stats, stat_op_name[op], op_stats))
+            goto error;
+        if (set_stat(op_stats, "calls", counters->calls) ||
+            set_stat(op_stats, "failures", counters->failures) ||
+            set_stat(op_stats, "chars", counters->chars) ||
+            set_stat(op_stats, "strokes", counters->strokes))
+            goto error;
+        if (self->stats_mode == STATS_TIMING && set_stat(op_stats, "ns", counters->ns))
+            goto error;
+        cache = op == STAT_FROM_STENO ? &self->from_steno_cache
+              : op == STAT_TO_STENO ? &self->to_steno_cache
+              : NULL;
+        if (cache != NULL && cache->max_size &&
+            (set_stat(op_stats, "cache_hits", cache->hits) ||
+             set_stat(op_stats, "cache_misses", cache->misses)))
+            goto error;
+        Py_CLEAR(op_stats);
+    }
+
+    return stats;
+
+error:
+    Py_XDECREF(op_stats);
+    Py_DECREF(stats);
+    return NULL;
+}
+
+#define STROKE_CMP_FN(FnName, Op) \
+    static PyObject *StrokeHelper_##FnName(StrokeHelper *self, PyObject *args) \
+    { \
+        return stroke_cmp(self, args, #FnName, Op); \
+    }
+
+STROKE_CMP_FN(stroke_cmp, CMP_OP_CMP);
+STROKE_CMP_FN(stroke_eq, CMP_OP_EQ);
+STROKE_CMP_FN(stroke_ne, CMP_OP_NE);
+STROKE_CMP_FN(stroke_ge, CMP_OP_GE);
+STROKE_CMP_FN(stroke_gt, CMP_OP_GT);
+STROKE_CMP_FN(stroke_le, CMP_OP_LE);
+STROKE_CMP_FN(stroke_lt, CMP_OP_LT);
+
+#undef STROKE_CMP_FN
+
+static PyObject *StrokeHelper_stroke_in(StrokeHelper *self, PyObject *args)
+{
+    stroke_uint_t mask1, mask2;
+
+    if (!unpack_2_strokes(self, args, "stroke_in", &mask1, &mask2))
+        return NULL;
+
+    if ((mask1 & mask2) == mask1)
+        Py_RETURN_TRUE;
+
+    Py_RETURN_FALSE;
+}
+
+static PyObject *StrokeHelper_stroke_or(StrokeHelper *self, PyObject *args)
+{
+    stroke_uint_t mask1, mask2;
+
+    if (!unpack_2_strokes(self, args, "stroke_or", &mask1, &mask2))
+        return NULL;
+
+    return PyLong_FromStrokeUint(mask1 | mask2);
+}
+
+static PyObject *StrokeHelper_stroke_and(StrokeHelper *self, PyObject *args)
+{
+    stroke_uint_t mask1, mask2;
+
+    if (!unpack_2_strokes(self, args, "stroke_and", &mask1, &mask2))
+        return NULL;
+
+    return PyLong_FromStrokeUint(mask1 & mask2);
+}
+
+static PyObject *StrokeHelper_stroke_add(StrokeHelper *self, PyObject *args)
+{
+    stroke_uint_t mask1, mask2;
+
+    if (!unpack_2_strokes(self, args, "stroke_add", &mask1, &mask2))
+        return NULL;
+
+    return PyLong_FromStrokeUint(mask1 | mask2);
+}
+
+static PyObject *StrokeHelper_stroke_sub(StrokeHelper *self, PyObject *args)
+{
+    stroke_uint_t mask1, mask2;
+
+    if (!unpack_2_strokes(self, args, "stroke_sub", &mask1, &mask2))
+        return NULL;
+
+    return PyLong_FromStrokeUint(mask1 & ~mask2);
+}
+
+static PyObject *StrokeHelper_stroke_is_prefix(StrokeHelper *self, PyObject *args)
+{
+    stroke_uint_t mask1, mask2;
+
+    if (!unpack_2_strokes(self, args, "stroke_is_prefix", &mask1, &mask2))
+        return NULL;
+
+    if (msb(mask1) < lsb(mask2))
+        Py_RETURN_TRUE;
+
+    Py_RETURN_FALSE;
+}
+
+static PyObject *StrokeHelper_stroke_is_suffix(StrokeHelper *self, PyObject *args)
+{
+    stroke_uint_t mask1, mask2;
+
+    if (!unpack_2_strokes(self, args, "stroke_is_suffix", &mask1, &mask2))
+        return NULL;
+
+    if (lsb(mask1) > msb(mask2))
+        Py_RETURN_TRUE;
+
+    Py_RETURN_FALSE;
+}
+
+static PyObject *StrokeHelper_normalize_stroke(StrokeHelper *self, PyObject *stroke)
+{
+    Py_ssize_t     stroke_len;
+    stroke_uint_t  mask;
+
+    if (!PyUnicode_Check(stroke))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a string");
+        return NULL;
+    }
+
+    if (PyUnicode_READY(stroke))
+        return NULL;
+
+    stroke_len = PyUnicode_GET_LENGTH(stroke);
+    if (!stroke_len)
+        goto invalid;
+
+    mask = stroke_from_data(self->helper,
+                            PyUnicode_KIND(stroke),
+                            PyUnicode_DATA(stroke),
+                            stroke_len);
+    if (mask == INVALID_STROKE)
+        goto invalid;
+
+    return helper_stroke_to_str(self, mask);
+
+invalid:
+    PyErr_Format(PyExc_ValueError, "invalid stroke: %R", stroke);
+    return NULL;
+}
+
+static PyObject *StrokeHelper_normalize_steno(StrokeHelper *self, PyObject *steno)
+{
+    Py_ssize_t     steno_len;
+    stroke_uint_t *masks;
+    Py_ssize_t     num_strokes;
+    PyObject      *stroke;
+    PyObject      *result;
+
+    masks = NULL;
+    result = NULL;
+
+    if (!PyUnicode_Check(steno))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a string");
+        goto end;
+    }
+
+    if (PyUnicode_READY(steno))
+        goto end;
+
+    steno_len = PyUnicode_GET_LENGTH(steno);
+
+    masks = PyMem_Malloc((steno_len / 2 + 1) * sizeof (*masks));
+    if (masks == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    num_strokes = steno_to_masks(self->helper,
+                                 PyUnicode_KIND(steno),
+                                 PyUnicode_DATA(steno),
+                                 steno_len, masks);
+    if (num_strokes < 0)
+    {
+        PyErr_Format(PyExc_ValueError, "invalid steno: %R", steno);
+        goto end;
+    }
+
+    result = PyTuple_New(num_strokes);
+    if (result == NULL)
+        goto end;
+
+    for (Py_ssize_t n = 0; n < num_strokes; ++n)
+    {
+        stroke = helper_stroke_to_str(self, masks[n]);
+        if (stroke == NULL)
+        {
+            Py_CLEAR(result);
+            goto end;
+        }
+        PyTuple_SET_ITEM(result, n, stroke);
+    }
+
+end:
+    PyMem_Free(masks);
+    return result;
+}
+
+static PyObject *StrokeHelper_steno_to_sort_key(StrokeHelper *self, PyObject *steno)
+{
+    Py_ssize_t     steno_len;
+    stroke_uint_t *masks;
+    Py_ssize_t     num_strokes;
+    char          *sort_key;
+    Py_ssize_t     sort_key_index;
+    PyObject      *result;
+
+    masks = NULL;
+    sort_key = NULL;
+    result = NULL;
+
+    if (!PyUnicode_Check(steno))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a string");
+        goto end;
+    }
+
+    if (PyUnicode_READY(steno))
+        goto end;
+
+    steno_len = PyUnicode_GET_LENGTH(steno);
+    if (!steno_len)
+        goto invalid;
+
+    masks = PyMem_Malloc((steno_len / 2 + 1) * sizeof (*masks));
+    // Note: account for possible extra hyphens.
+    sort_key = PyMem_Malloc(steno_len * 2 * sizeof (*sort_key));
+    if (masks == NULL || sort_key == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    num_strokes = steno_to_masks(self->helper,
+                                 PyUnicode_KIND(steno),
+                                 PyUnicode_DATA(steno),
+                                 steno_len, masks);
+    if (num_strokes < 0)
+        goto invalid;
+
+    sort_key_index = 0;
+    for (Py_ssize_t n = 0; n < num_strokes; ++n)
+    {
+        if (n)
+            sort_key[sort_key_index++] = 0;
+        sort_key_index += stroke_to_sort_key(self->helper, masks[n], &sort_key[sort_key_index]);
+    }
+    assert(sort_key_index <= steno_len * 2);
+
+    result = PyBytes_FromStringAndSize(sort_key, sort_key_index);
+
+    goto end;
+
+invalid:
+    PyErr_Format(PyExc_ValueError, "invalid steno: %R", steno);
+end:
+    PyMem_Free(sort_key);
+    PyMem_Free(masks);
+    return result;
+}
+
+typedef struct
+{
+    int         kind; // 0 if not steno.
+    const void *data;
+    Py_ssize_t  len;  // -1 once parsed, if invalid.
+} steno_item_t;
+
+// A list of steno, gathered for processing without the GIL.
+typedef struct
+{
+    PyObject     *list;  // Private copy of the input.
+    steno_item_t *items;
+    Py_ssize_t    num_items;
+    Py_buffer    *views; // Mutable buffers are kept locked until we're done.
+    Py_ssize_t    num_views;
+    Py_ssize_t    num_chars;
+} steno_list_t;
+
+static void steno_list_release(steno_list_t *steno_list)
+{
+    while (steno_list->num_views)
+        PyBuffer_Release(&steno_list->views[--steno_list->num_views]);
+    PyMem_Free(steno_list->views);
+    PyMem_Free(steno_list->items);
+    Py_XDECREF(steno_list->list);
+}
+
+// Gather a list of steno: strings, or bytes-like objects (parsed as
+// ASCII steno). Other objects raise a `TypeError` if `strict`, else
+// are flagged (`kind == 0`). Return 0 on error.
+static int steno_list_init(steno_list_t *steno_list, PyObject *steno_iterable, int strict)
+{
+    steno_item_t *item;
+    PyObject     *steno;
+    Py_buffer    *view;
+
+    memset(steno_list, 0, sizeof (*steno_list));
+
+    // Note: always work on a private list, since the
+    // items are accessed without holding the GIL.
+    steno_list->list = PySequence_List(steno_iterable);
+    if (steno_list->list == NULL)
+        return 0;
+
+    steno_list->num_items = PyList_GET_SIZE(steno_list->list);
+    steno_list->items = PyMem_New(steno_item_t, steno_list->num_items + 1);
+    if (steno_list->items == NULL)
+    {
+        PyErr_NoMemory();
+        goto error;
+    }
+
+    for (Py_ssize_t n = 0; n < steno_list->num_items; ++n)
+    {
+        steno = PyList_GET_ITEM(steno_list->list, n);
+        item = &steno_list->items[n];
+        if (PyUnicode_Check(steno))
+        {
+            if (PyUnicode_READY(steno))
+                goto error;
+            item->kind = PyUnicode_KIND(steno);
+            item->data = PyUnicode_DATA(steno);
+            item->len = PyUnicode_GET_LENGTH(steno);
+        }
+        else if (PyBytes_Check(steno))
+        {
+            item->kind = PyUnicode_1BYTE_KIND;
+            item->data = PyBytes_AS_STRING(steno);
+            item->len = PyBytes_GET_SIZE(steno);
+        }
+        else if (PyObject_CheckBuffer(steno))
+        {
+            if (steno_list->views == NULL)
+            {
+                steno_list->views = PyMem_New(Py_buffer, steno_list->num_items - n);
+                if (steno_list->views == NULL)
+                {
+                    PyErr_NoMemory();
+                    goto error;
+                }
+            }
+            view = &steno_list->views[steno_list->num_views];
+            if (PyObject_GetBuffer(steno, view, PyBUF_SIMPLE))
+                goto error;
+            ++steno_list->num_views;
+            item->kind = PyUnicode_1BYTE_KIND;
+            item->data = view->buf;
+            item->len = view->len;
+        }
+        else if (strict)
+        {
+            PyErr_Format(PyExc_TypeError, "expected a string or bytes-like object, got: %R", steno);
+            goto error;
+        }
+        else
+        {
+            item->kind = 0;
+            item->data = NULL;
+            item->len = 0;
+        }
+        steno_list->num_chars += item->len;
+    }
+
+    return 1;
+
+error:
+    steno_list_release(steno_list);
+    return 0;
+}
+
+static PyObject *StrokeHelper_steno_list_to_masks(StrokeHelper *self, PyObject *steno_iterable)
+{
+    stroke_helper_t *helper;
+    steno_list_t     steno_list;
+    steno_item_t    *items;
+    Py_ssize_t       num_items;
+    Py_ssize_t       n;
+    stroke_uint_t   *masks;
+    Py_ssize_t       masks_len;
+    Py_ssize_t       masks_max_len;
+    uint64_t        *offsets;
+    Py_ssize_t       num_strokes;
+    PyObject        *invalid;
+    Py_ssize_t       num_invalid;
+    PyObject        *index;
+    PyObject        *masks_array;
+    PyObject        *offsets_array;
+    PyObject        *result;
+    uint64_t         stats_start_ns;
+
+    stats_start_ns = self->stats_mode ? stats_start(self) : 0;
+
+    if (!steno_list_init(&steno_list, steno_iterable, 1))
+        return NULL;
+
+    items = steno_list.items;
+    num_items = steno_list.num_items;
+    invalid = NULL;
+    result = NULL;
+
+    // Note: parsing needs room for at most `len / 2 + 1` strokes per steno.
+    masks_max_len = steno_list.num_chars / 2 + num_items + 1;
+    masks = PyMem_New(stroke_uint_t, masks_max_len);
+    offsets = PyMem_New(uint64_t, num_items + 1);
+    if (masks == NULL || offsets == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    helper = self->helper;
+    stroke_helper_incref(helper);
+    BEGIN_ALLOW_THREADS_IF(masks_max_len >= GIL_RELEASE_THRESHOLD)
+
+    masks_len = 0;
+    for (n = 0; n < num_items; ++n)
+    {
+        offsets[n] = masks_len;
+        num_strokes = steno_to_masks(helper, items[n].kind, items[n].data,
+                                     items[n].len, &masks[masks_len]);
+        if (num_strokes < 0)
+            items[n].len = -1;
+        else
+            masks_len += num_strokes;
+    }
+    offsets[num_items] = masks_len;
+
+    END_ALLOW_THREADS_IF
+    stroke_helper_decref(helper);
+
+    num_invalid = 0;
+
+    invalid = PyList_New(0);
+    if (invalid == NULL)
+        goto end;
+    for (n = 0; n < num_items; ++n)
+    {
+        if (items[n].len >= 0)
+            continue;
+        ++num_invalid;
+        index = PyLong_FromSsize_t(n);
+        if (index == NULL || PyList_Append(invalid, index))
+        {
+            Py_XDECREF(index);
+            goto end;
+        }
+        Py_DECREF(index);
+    }
+
+    if (self->stats_mode)
+        stats_record(self, STAT_STENO_TO_MASKS, stats_start_ns, num_invalid,
+                     steno_list.num_chars, masks_len);
+
+    masks_array = new_array("Q", masks, masks_len * sizeof (*masks));
+    offsets_array = new_array("Q", offsets, (num_items + 1) * sizeof (*offsets));
+    if (masks_array != NULL && offsets_array != NULL)
+        result = PyTuple_Pack(3, masks_array, offsets_array, invalid);
+    Py_XDECREF(offsets_array);
+    Py_XDECREF(masks_array);
+
+end:
+    Py_XDECREF(invalid);
+    PyMem_Free(offsets);
+    PyMem_Free(masks);
+    steno_list_release(&steno_list);
+    return result;
+}
+
+static PyObject *StrokeHelper_validate_steno_list(StrokeHelper *self, PyObject *steno_iterable)
+{
+    stroke_helper_t *helper;
+    steno_list_t     steno_list;
+    steno_item_t    *items;
+    uint8_t         *errors;
+    Py_ssize_t       num_invalid;
+    PyObject        *result;
+    uint64_t         stats_start_ns;
+
+    stats_start_ns = self->stats_mode ? stats_start(self) : 0;
+
+    if (!steno_list_init(&steno_list, steno_iterable, 0))
+        return NULL;
+
+    items = steno_list.items;
+    result = NULL;
+
+    errors = PyMem_Malloc(Py_MAX(steno_list.num_items, 1));
+    if (errors == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    num_invalid = 0;
+    helper = self->helper;
+    stroke_helper_incref(helper);
+    BEGIN_ALLOW_THREADS_IF(steno_list.num_chars >= GIL_RELEASE_THRESHOLD)
+
+    for (Py_ssize_t n = 0; n < steno_list.num_items; ++n)
+    {
+        errors[n] = items[n].kind
+                  ? steno_error(helper, items[n].kind, items[n].data, items[n].len)
+                  : STENO_ERROR_NOT_STENO;
+        num_invalid += errors[n] != STENO_OK;
+    }
+
+    END_ALLOW_THREADS_IF
+    stroke_helper_decref(helper);
+
+    if (self->stats_mode)
+        stats_record(self, STAT_VALIDATE, stats_start_ns, num_invalid,
+                     steno_list.num_chars, 0);
+
+    result = new_array("B", errors, steno_list.num_items);
+
+end:
+    PyMem_Free(errors);
+    steno_list_release(&steno_list);
+    return result;
+}
+
+// Parse the `(buffer, start=0, end=None)` arguments: on success,
+// `view` must be released by the caller, and `[*start, *end)` is the
+// range to parse (with `start` / `end` clamped like slice indices).
+static int parse_buffer_range(PyObject   *args,
+                              PyObject   *kwargs,
+                              Py_buffer  *view,
+                              Py_ssize_t *start,
+                              Py_ssize_t *end)
+{
+    static char *kwlist[] = { "buffer", "start", "end", NULL };
+    PyObject *end_obj;
+
+    *start = 0;
+    end_obj = Py_None;
+
+    // Fast path for the common case: positional arguments.
+    if (kwargs == NULL && PyTuple_GET_SIZE(args) >= 1 && PyTuple_GET_SIZE(args) <= 3)
+    {
+        if (PyTuple_GET_SIZE(args) >= 2)
+        {
+            *start = PyNumber_AsSsize_t(PyTuple_GET_ITEM(args, 1), PyExc_OverflowError);
+            if (*start == -1 && PyErr_Occurred())
+                return 0;
+            if (PyTuple_GET_SIZE(args) == 3)
+                end_obj = PyTuple_GET_ITEM(args, 2);
+        }
+        if (PyObject_GetBuffer(PyTuple_GET_ITEM(args, 0), view, PyBUF_SIMPLE))
+            return 0;
+    }
+    else if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*|nO", kwlist,
+                                          view, start, &end_obj))
+        return 0;
+
+    if (end_obj == Py_None)
+        *end = view->len;
+    else
+    {
+        *end = PyNumber_AsSsize_t(end_obj, PyExc_OverflowError);
+        if (*end == -1 && PyErr_Occurred())
+        {
+            PyBuffer_Release(view);
+            return 0;
+        }
+    }
+
+    PySlice_AdjustIndices(view->len, start, end, 1);
+
+    return 1;
+}
+
+static void invalid_buffer_steno(const Py_buffer *view, Py_ssize_t start, Py_ssize_t end)
+{
+    PyObject *steno;
+
+    steno = PyBytes_FromStringAndSize((const char *)view->buf + start, end - start);
+    if (steno == NULL)
+        return;
+
+    PyErr_Format(PyExc_ValueError, "invalid steno: %R", steno);
+    Py_DECREF(steno);
+}
+
+static PyObject *StrokeHelper_stroke_from_buffer(StrokeHelper *self, PyObject *args, PyObject *kwargs)
+{
+    Py_buffer      view;
+    Py_ssize_t     start;
+    Py_ssize_t     end;
+    stroke_uint_t  mask;
+    uint64_t       stats_start_ns;
+
+    if (!parse_buffer_range(args, kwargs, &view, &start, &end))
+        return NULL;
+
+    stats_start_ns = self->stats_mode ? stats_start(self) : 0;
+
+    mask = stroke_from_data(self->helper, PyUnicode_1BYTE_KIND,
+                            (const char *)view.buf + start, end - start);
+    if (mask == INVALID_STROKE)
+        invalid_buffer_steno(&view, start, end);
+
+    if (self->stats_mode)
+        stats_record(self, STAT_FROM_STENO, stats_start_ns,
+                     mask == INVALID_STROKE, end - start,
+                     mask != INVALID_STROKE);
+
+    PyBuffer_Release(&view);
+
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return PyLong_FromStrokeUint(mask);
+}
+
+static PyObject *StrokeHelper_steno_buffer_to_masks(StrokeHelper *self, PyObject *args, PyObject *kwargs)
+{
+    Py_buffer      view;
+    Py_ssize_t     start;
+    Py_ssize_t     end;
+    stroke_uint_t  masks_buffer[32];
+    stroke_uint_t *masks;
+    Py_ssize_t     num_strokes;
+    PyObject      *result;
+    uint64_t       stats_start_ns;
+
+    if (!parse_buffer_range(args, kwargs, &view, &start, &end))
+        return NULL;
+
+    stats_start_ns = self->stats_mode ? stats_start(self) : 0;
+
+    result = NULL;
+
+    if ((end - start) / 2 + 1 <= (Py_ssize_t)Py_ARRAY_LENGTH(masks_buffer))
+        masks = masks_buffer;
+    else
+    {
+        masks = PyMem_Malloc(((end - start) / 2 + 1) * sizeof (*masks));
+        if (masks == NULL)
+        {
+            PyErr_NoMemory();
+            goto end;
+        }
+    }
+
+    num_strokes = steno_to_masks(self->helper, PyUnicode_1BYTE_KIND,
+                                 (const char *)view.buf + start,
+                                 end - start, masks);
+    if (self->stats_mode)
+        stats_record(self, STAT_STENO_TO_MASKS, stats_start_ns,
+                     num_strokes < 0, end - start,
+                     Py_MAX(num_strokes, 0));
+    if (num_strokes < 0)
+    {
+        invalid_buffer_steno(&view, start, end);
+        goto end;
+    }
+
+    result = PyTuple_New(num_strokes);
+    if (result == NULL)
+        goto end;
+
+    for (Py_ssize_t n = 0; n < num_strokes; ++n)
+    {
+        PyObject *mask = PyLong_FromStrokeUint(masks[n]);
+        if (mask == NULL)
+        {
+            Py_CLEAR(result);
+            goto end;
+        }
+        PyTuple_SET_ITEM(result, n, mask);
+    }
+
+end:
+    if (masks != masks_buffer)
+        PyMem_Free(masks);
+    PyBuffer_Release(&view);
+    return result;
+}
+
+// Parse steno to a new outline. Return NULL (without
+// setting an exception) if the steno is invalid.
+static PyObject *steno_data_to_outline(const stroke_helper_t *helper,
+                                       int                    steno_kind,
+                                       const void            *steno_data,
+                                       Py_ssize_t             steno_len,
+                                       int                   *invalid)
+{
+    stroke_uint_t  masks_buffer[32];
+    stroke_uint_t *masks;
+    Py_ssize_t     num_strokes;
+    PyObject      *outline;
+
+    *invalid = 0;
+
+    if (steno_len / 2 + 1 <= (Py_ssize_t)Py_ARRAY_LENGTH(masks_buffer))
+        masks = masks_buffer;
+    else
+    {
+        masks = PyMem_Malloc((steno_len / 2 + 1) * sizeof (*masks));
+        if (masks == NULL)
+            return PyErr_NoMemory();
+    }
+
+    num_strokes = steno_to_masks(helper, steno_kind, steno_data, steno_len, masks);
+    if (num_strokes < 0)
+    {
+        *invalid = 1;
+        outline = NULL;
+    }
+    else
+        outline = outline_new(masks, num_strokes);
+
+    if (masks != masks_buffer)
+        PyMem_Free(masks);
+
+    return outline;
+}
+
+static PyObject *StrokeHelper_steno_to_outline(StrokeHelper *self, PyObject *steno)
+{
+    PyObject *outline;
+    int       invalid;
+    uint64_t  stats_start_ns;
+
+    if (!PyUnicode_Check(steno))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a string");
+        return NULL;
+    }
+
+    if (PyUnicode_READY(steno))
+        return NULL;
+
+    stats_start_ns = self->stats_mode ? stats_start(self) : 0;
+
+    outline = steno_data_to_outline(self->helper,
+                                    PyUnicode_KIND(steno),
+                                    PyUnicode_DATA(steno),
+                                    PyUnicode_GET_LENGTH(steno),
+                                    &invalid);
+    if (self->stats_mode)
+        stats_record(self, STAT_STENO_TO_MASKS, stats_start_ns, invalid,
+                     PyUnicode_GET_LENGTH(steno),
+                     outline == NULL ? 0 : Py_SIZE(outline));
+    if (invalid)
+        PyErr_Format(PyExc_ValueError, "invalid steno: %R", steno);
+
+    return outline;
+}
+
+static PyObject *StrokeHelper_steno_buffer_to_outline(StrokeHelper *self, PyObject *args, PyObject *kwargs)
+{
+    Py_buffer   view;
+    Py_ssize_t  start;
+    Py_ssize_t  end;
+    PyObject   *outline;
+    int         invalid;
+    uint64_t    stats_start_ns;
+
+    if (!parse_buffer_range(args, kwargs, &view, &start, &end))
+        return NULL;
+
+    stats_start_ns = self->stats_mode ? stats_start(self) : 0;
+
+    outline = steno_data_to_outline(self->helper, PyUnicode_1BYTE_KIND,
+                                    (const char *)view.buf + start,
+                                    end - start, &invalid);
+    if (self->stats_mode)
+        stats_record(self, STAT_STENO_TO_MASKS, stats_start_ns, invalid,
+                     end - start, outline == NULL ? 0 : Py_SIZE(outline));
+    if (invalid)
+        invalid_buffer_steno(&view, start, end);
+
+    PyBuffer_Release(&view);
+
+    return outline;
+}
+
+static PyObject *StrokeHelper_outline_to_steno(StrokeHelper *self, PyObject *outline)
+{
+    Py_ssize_t     num_strokes;
+    PyObject      *strokes;
+    PyObject      *stroke;
+    PyObject      *steno;
+    stroke_uint_t  mask;
+
+    if (!PyObject_TypeCheck(outline, &OutlineType))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected an outline");
+        return NULL;
+    }
+
+    num_strokes = Py_SIZE(outline);
+
+    strokes = PyList_New(num_strokes);
+    if (strokes == NULL)
+        return NULL;
+
+    for (Py_ssize_t n = 0; n < num_strokes; ++n)
+    {
+        mask = ((Outline *)outline)->strokes[n];
+        if ((mask >> self->helper->num_keys))
+        {
+            char error[40];
+
+            snprintf(error, sizeof (error), "invalid keys mask: "STROKE_UINT_FMT, mask);
+            PyErr_SetString(PyExc_ValueError, error);
+            Py_DECREF(strokes);
+            return NULL;
+        }
+        stroke = helper_stroke_to_str(self, mask);
+        if (stroke == NULL)
+        {
+            Py_DECREF(strokes);
+            return NULL;
+        }
+        PyList_SET_ITEM(strokes, n, stroke);
+    }
+
+    steno = PyUnicode_Join(str_slash, strokes);
+    Py_DECREF(strokes);
+
+    return steno;
+}
+
+static PyObject *StrokeHelper_masks_to_steno_list(StrokeHelper *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "masks", "offsets", NULL };
+    stroke_helper_t *helper;
+    PyObject        *masks_obj;
+    PyObject        *offsets_obj;
+    Py_buffer        masks_view;
+    stroke_uint_t    masks_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t   *masks;
+    Py_ssize_t       num_masks;
+    Py_buffer        offsets_view;
+    stroke_uint_t    offsets_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t   *offsets;
+    Py_ssize_t       num_items;
+    Py_ssize_t      *ends;
+    Py_UCS4         *steno;
+    Py_ssize_t       steno_len;
+    Py_ssize_t       steno_max_len;
+    Py_ssize_t       invalid_index;
+    int              no_memory;
+    Py_ssize_t       n;
+    PyObject        *item;
+    PyObject        *result;
+    uint64_t         stats_start_ns;
+
+    offsets_obj = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|O", kwlist, &masks_obj, &offsets_obj))
+        return NULL;
+
+    num_masks = masks_from_obj(masks_obj, &masks_view, masks_buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_masks < 0)
+        return NULL;
+
+    stats_start_ns = self->stats_mode ? stats_start(self) : 0;
+
+    offsets = NULL;
+    offsets_view.obj = NULL;
+    ends = NULL;
+    steno = NULL;
+    result = NULL;
+
+    // Without offsets, each mask is rendered as its own steno.
+    if (offsets_obj == Py_None)
+        num_items = num_masks;
+    else
+    {
+        num_items = masks_from_obj(offsets_obj, &offsets_view, offsets_buffer, MASKS_BUFFER_LEN, &offsets);
+        if (num_items < 0)
+            goto end;
+        // Note: `offsets` has one more entry than there are outlines.
+        num_items = Py_MAX(num_items - 1, 0);
+        for (n = 0; n < num_items; ++n)
+        {
+            if (offsets[n] > offsets[n + 1] || offsets[n + 1] > (stroke_uint_t)num_masks)
+            {
+                PyErr_SetString(PyExc_ValueError, "invalid offsets");
+                goto end;
+            }
+        }
+    }
+
+    ends = PyMem_New(Py_ssize_t, Py_MAX(num_items, 1));
+    steno_max_len = Py_MAX(num_masks, 1) * 8 + MAX_STENO + 1;
+    steno = PyMem_RawMalloc(steno_max_len * sizeof (*steno));
+    if (ends == NULL || steno == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    invalid_index = -1;
+    no_memory = 0;
+    helper = self->helper;
+    stroke_helper_incref(helper);
+    BEGIN_ALLOW_THREADS_IF(num_masks >= GIL_RELEASE_THRESHOLD)
+
+    steno_len = 0;
+    for (n = 0; n < num_items; ++n)
+    {
+        Py_ssize_t start = offsets == NULL ? n : (Py_ssize_t)offsets[n];
+        Py_ssize_t end = offsets == NULL ? n + 1 : (Py_ssize_t)offsets[n + 1];
+
+        for (Py_ssize_t s = start; s < end; ++s)
+        {
+            if ((masks[s] >> helper->num_keys))
+            {
+                invalid_index = s;
+                break;
+            }
+            // Room for a separator and a full stroke.
+            if (steno_len + MAX_STENO + 1 > steno_max_len)
+            {
+                Py_UCS4 *buffer;
+
+                steno_max_len *= 2;
+                buffer = PyMem_RawRealloc(steno, steno_max_len * sizeof (*steno));
+                if (buffer == NULL)
+                {
+                    no_memory = 1;
+                    break;
+                }
+                steno = buffer;
+            }
+            if (s != start)
+                steno[steno_len++] = '/';
+            steno_len += stroke_to_ucs4(helper, masks[s], &steno[steno_len]);
+        }
+        if (invalid_index >= 0 || no_memory)
+            break;
+        ends[n] = steno_len;
+    }
+
+    END_ALLOW_THREADS_IF
+    stroke_helper_decref(helper);
+
+    if (self->stats_mode)
+        stats_record(self, STAT_MASKS_TO_STENO, stats_start_ns,
+                     invalid_index >= 0 || no_memory, steno_len,
+                     invalid_index >= 0 || no_memory || !num_items ? 0
+                     : offsets == NULL ? num_items
+                     : (Py_ssize_t)(offsets[num_items] - offsets[0]));
+
+    if (no_memory)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+    if (invalid_index >= 0)
+    {
+        char error[40];
+
+        snprintf(error, sizeof (error), "invalid keys mask: "STROKE_UINT_FMT, masks[invalid_index]);
+        PyErr_SetString(PyExc_ValueError, error);
+        goto end;
+    }
+
+    result = PyList_New(num_items);
+    if (result == NULL)
+        goto end;
+
+    for (n = 0; n < num_items; ++n)
+    {
+        steno_len = n ? ends[n - 1] : 0;
+        item = PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, &steno[steno_len], ends[n] - steno_len);
+        if (item == NULL)
+        {
+            Py_CLEAR(result);
+            goto end;
+        }
+        PyList_SET_ITEM(result, n, item);
+    }
+
+end:
+    PyMem_RawFree(steno);
+    PyMem_Free(ends);
+    if (offsets != NULL)
+        masks_from_obj_release(offsets_obj, &offsets_view, offsets_buffer, offsets);
+    masks_from_obj_release(masks_obj, &masks_view, masks_buffer, masks);
+    return result;
+}
+
+typedef struct
+{
+    stroke_uint_t        first;  // First stroke key (for faster comparisons).
+    const stroke_uint_t *keys;
+    Py_ssize_t           offset;
+    Py_ssize_t           len;
+    Py_ssize_t           index;
+
+} sort_entry_t;
+
+// Compare 2 outlines order keys: lexicographical order,
+// with the original index as a tie-breaker (stable sort).
+static int sort_entry_cmp(const void *p1, const void *p2)
+{
+    const sort_entry_t *e1 = p1;
+    const sort_entry_t *e2 = p2;
+    Py_ssize_t          len;
+
+    if (e1->first != e2->first)
+        return e1->first < e2->first ? -1 : 1;
+
+    len = Py_MIN(e1->len, e2->len);
+    for (Py_ssize_t n = 0; n < len; ++n)
+    {
+        if (e1->keys[n] != e2->keys[n])
+            return e1->keys[n] < e2->keys[n] ? -1 : 1;
+    }
+    if (e1->len != e2->len)
+        return e1->len < e2->len ? -1 : 1;
+
+    return e1->index < e2->index ? -1 : 1;
+}
+
+static PyObject *StrokeHelper_sort_outlines(StrokeHelper *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "outlines", "in_place", NULL };
+    stroke_helper_t *helper;
+    PyObject        *outlines;
+    int              in_place;
+    PyObject        *items;
+    Py_ssize_t       num_items;
+    sort_entry_t    *entries;
+    steno_item_t    *steno;
+    stroke_uint_t   *keys;
+    Py_ssize_t       keys_len;
+    Py_ssize_t       keys_max_len;
+    stroke_uint_t    masks_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t   *masks;
+    Py_ssize_t       num_strokes;
+    Py_ssize_t       max_strokes;
+    Py_ssize_t       invalid_index;
+    PyObject        *item;
+    void            *buffer;
+    PyObject        *result;
+    Py_ssize_t       total_strokes;
+    uint64_t         stats_start_ns;
+
+    in_place = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|p", kwlist, &outlines, &in_place))
+        return NULL;
+
+    if (in_place && !PyList_Check(outlines))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a list when sorting in place");
+        return NULL;
+    }
+
+    stats_start_ns = self->stats_mode ? stats_start(self) : 0;
+
+    // Note: work on a copy, in case the original is modified
+    // (including while the GIL is released).
+    items = PySequence_List(outlines);
+    if (items == NULL)
+        return NULL;
+
+    num_items = PyList_GET_SIZE(items);
+    entries = PyMem_New(sort_entry_t, Py_MAX(num_items, 1));
+    steno = PyMem_New(steno_item_t, Py_MAX(num_items, 1));
+    keys = NULL;
+    keys_len = keys_max_len = 0;
+    result = NULL;
+
+    if (entries == NULL || steno == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    // Gather the outlines strokes: steno strings are
+    // only parsed later, once the GIL is released.
+    for (Py_ssize_t i = 0; i < num_items; ++i)
+    {
+        item = PyList_GET_ITEM(items, i);
+
+        if (PyUnicode_Check(item))
+        {
+            if (PyUnicode_READY(item))
+                goto end;
+            steno[i].kind = PyUnicode_KIND(item);
+            steno[i].data = PyUnicode_DATA(item);
+            steno[i].len = PyUnicode_GET_LENGTH(item);
+            max_strokes = steno[i].len / 2 + 1;
+            masks = NULL;
+        }
+        else
+        {
+            max_strokes = strokes_to_masks(item, masks_buffer, MASKS_BUFFER_LEN, &masks);
+            if (max_strokes < 0)
+            {
+                if (PyErr_ExceptionMatches(PyExc_TypeError))
+                {
+                    PyErr_Clear();
+                    PyErr_Format(PyExc_TypeError, "expected a string, outline, "
+                                 "or sequence of strokes, got: %R", item);
+                }
+                goto end;
+            }
+            steno[i].kind = 0;
+        }
+
+        if (keys_len + max_strokes > keys_max_len)
+        {
+            keys_max_len = Py_MAX(keys_max_len * 2, keys_len + max_strokes);
+            buffer = PyMem_Realloc(keys, keys_max_len * sizeof (*keys));
+            if (buffer == NULL)
+            {
+                if (masks != NULL)
+                    strokes_masks_free(item, masks_buffer, masks);
+                PyErr_NoMemory();
+                goto end;
+            }
+            keys = buffer;
+        }
+
+        if (masks != NULL)
+        {
+            memcpy(&keys[keys_len], masks, max_strokes * sizeof (*keys));
+            strokes_masks_free(item, masks_buffer, masks);
+        }
+
+        entries[i].offset = keys_len;
+        entries[i].len = max_strokes;
+        entries[i].index = i;
+        keys_len += max_strokes;
+    }
+
+    // Parse, compute the order keys of all the outlines strokes, and sort.
+    invalid_index = -1;
+    total_strokes = 0;
+    helper = self->helper;
+    stroke_helper_incref(helper);
+    BEGIN_ALLOW_THREADS_IF(keys_len >= GIL_RELEASE_THRESHOLD)
+
+    for (Py_ssize_t i = 0; i < num_items; ++i)
+    {
+        num_strokes = entries[i].len;
+        entries[i].keys = &keys[entries[i].offset];
+        if (steno[i].kind)
+        {
+            num_strokes = steno_to_masks(helper, steno[i].kind, steno[i].data,
+                                         steno[i].len, &keys[entries[i].offset]);
+            if (num_strokes < 0)
+            {
+                invalid_index = i;
+                break;
+            }
+            entries[i].len = num_strokes;
+        }
+        for (Py_ssize_t n = 0; n < num_strokes; ++n)
+            keys[entries[i].offset + n] = stroke_to_order_key(keys[entries[i].offset + n]);
+        entries[i].first = num_strokes ? entries[i].keys[0] : 0;
+        total_strokes += num_strokes;
+    }
+
+    if (invalid_index < 0)
+        qsort(entries, num_items, sizeof (*entries), sort_entry_cmp);
+
+    END_ALLOW_THREADS_IF
+    stroke_helper_decref(helper);
+
+    if (self->stats_mode)
+        stats_record(self, STAT_SORT_OUTLINES, stats_start_ns,
+                     invalid_index >= 0, 0, total_strokes);
+
+    if (invalid_index >= 0)
+    {
+        PyErr_Format(PyExc_ValueError, "invalid steno: %R", PyList_GET_ITEM(items, invalid_index));
+        goto end;
+    }
+
+    result = PyList_New(num_items);
+    if (result == NULL)
+        goto end;
+
+    for (Py_ssize_t i = 0; i < num_items; ++i)
+    {
+        if (in_place)
+        {
+            item = PyList_GET_ITEM(items, entries[i].index);
+            Py_INCREF(item);
+        }
+        else
+        {
+            item = PyLong_FromSsize_t(entries[i].index);
+            if (item == NULL)
+            {
+                Py_CLEAR(result);
+                goto end;
+            }
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+
+    if (in_place)
+    {
+        if (PyList_SetSlice(outlines, 0, PY_SSIZE_T_MAX, result))
+        {
+            Py_CLEAR(result);
+            goto end;
+        }
+        Py_DECREF(result);
+        result = Py_None;
+        Py_INCREF(result);
+    }
+
+end:
+    PyMem_Free(keys);
+    PyMem_Free(steno);
+    PyMem_Free(entries);
+    Py_DECREF(items);
+    return result;
+}
+
+static PyObject *StrokeHelper_stroke_from_any(StrokeHelper *self, PyObject *obj)
+{
+    stroke_uint_t mask;
+
+    mask = helper_stroke_from_any(self, obj);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return PyLong_FromStrokeUint(mask);
+}
+
+static PyObject *StrokeHelper_stroke_from_int(StrokeHelper *self, PyObject *integer)
+{
+    stroke_uint_t mask;
+
+    mask = stroke_from_int(self->helper, integer);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return PyLong_FromStrokeUint(mask);
+}
+
+static PyObject *StrokeHelper_stroke_from_keys(StrokeHelper *self, PyObject *keys_sequence)
+{
+    stroke_uint_t mask;
+
+    keys_sequence = PySequence_Fast(keys_sequence, "expected a list or tuple");
+    if (keys_sequence == NULL)
+        return NULL;
+
+    mask = helper_stroke_from_keys(self, keys_sequence);
+    Py_DECREF(keys_sequence);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return PyLong_FromStrokeUint(mask);
+}
+
+static PyObject *StrokeHelper_stroke_from_steno(StrokeHelper *self, PyObject *steno)
+{
+    stroke_uint_t mask;
+
+    if (!PyUnicode_Check(steno))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a string");
+        return NULL;
+    }
+
+    mask = helper_stroke_from_steno(self, steno);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return PyLong_FromStrokeUint(mask);
+}
+
+static PyObject *StrokeHelper_stroke_to_keys(StrokeHelper *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return helper_stroke_to_keys(self, mask);
+}
+
+static PyObject *StrokeHelper_stroke_first_key(StrokeHelper *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+    unsigned      first_key;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    if (!mask)
+    {
+        PyErr_SetString(PyExc_ValueError, "empty stroke");
+        return NULL;
+    }
+
+    first_key = popcount(lsb(mask) - 1);
+
+    return key_str(self->helper, first_key, 0);
+}
+
+static PyObject *StrokeHelper_stroke_last_key(StrokeHelper *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+    unsigned      last_key;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    if (!mask)
+    {
+        PyErr_SetString(PyExc_ValueError, "empty stroke");
+        return NULL;
+    }
+
+    last_key = popcount(msb(mask) - 1);
+
+    return key_str(self->helper, last_key, 0);
+}
+
+static PyObject *StrokeHelper_stroke_invert(StrokeHelper *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    mask = ~mask & ((STROKE_1 << self->helper->num_keys) - 1);
+
+    return PyLong_FromStrokeUint(mask);
+}
+
+static PyObject *StrokeHelper_stroke_len(StrokeHelper *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return PyLong_FromStrokeInt(popcount(mask));
+}
+
+static PyObject *StrokeHelper_stroke_has_digit(StrokeHelper *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    if (stroke_has_digit(self->helper, mask))
+        Py_RETURN_TRUE;
+
+    Py_RETURN_FALSE;
+}
+
+static PyObject *StrokeHelper_stroke_is_number(StrokeHelper *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    if (stroke_is_number(self->helper, mask))
+        Py_RETURN_TRUE;
+
+    Py_RETURN_FALSE;
+}
+
+static PyObject *StrokeHelper_stroke_to_steno(StrokeHelper *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return helper_stroke_to_str(self, mask);
+}
+
+// Ensure the compiled helper is not shared before modifying it.
+static int stroke_helper_make_private(StrokeHelper *self)
+{
+    stroke_helper_t *helper;
+
+    if (self->helper->refcount == 1)
+        return 1;
+
+    helper = stroke_helper_copy(self->helper);
+    if (helper == NULL)
+        return 0;
+
+    stroke_helper_decref(self->helper);
+    self->helper = helper;
+
+    return 1;
+}
+
+static PyObject *StrokeHelper_near_strokes(StrokeHelper *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "stroke", "masks", "max_distance", "limit", NULL };
+    stroke_helper_t *helper;
+    PyObject      *stroke;
+    PyObject      *masks_obj;
+    unsigned int   max_distance;
+    PyObject      *limit_obj;
+    Py_ssize_t     limit;
+    stroke_uint_t  mask;
+    Py_buffer      view;
+    stroke_uint_t  masks_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t *masks;
+    Py_ssize_t     num_masks;
+    Py_ssize_t    *matches;
+    uint8_t       *distances;
+    Py_ssize_t     num_matches;
+    Py_ssize_t     invalid_index;
+    Py_ssize_t     counts[2 * MAX_KEYS + 2];
+    stroke_uint_t *result_masks;
+    uint8_t       *result_distances;
+    Py_ssize_t     num_results;
+    unsigned       distance;
+    PyObject      *masks_array;
+    PyObject      *distances_array;
+    PyObject      *result;
+    uint64_t       stats_start_ns;
+
+    max_distance = 1;
+    limit_obj = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|IO", kwlist,
+                                     &stroke, &masks_obj, &max_distance, &limit_obj))
+        return NULL;
+
+    if (limit_obj == Py_None)
+        limit = PY_SSIZE_T_MAX;
+    else
+    {
+        limit = PyNumber_AsSsize_t(limit_obj, PyExc_OverflowError);
+        if (limit == -1 && PyErr_Occurred())
+            return NULL;
+        if (limit < 0)
+        {
+            PyErr_SetString(PyExc_ValueError, "invalid limit");
+            return NULL;
+        }
+    }
+
+    max_distance = Py_MIN(max_distance, 2 * MAX_KEYS);
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    num_masks = masks_from_obj(masks_obj, &view, masks_buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_masks < 0)
+        return NULL;
+
+    stats_start_ns = self->stats_mode ? stats_start(self) : 0;
+
+    result = NULL;
+    result_masks = NULL;
+    result_distances = NULL;
+    matches = PyMem_Malloc(Py_MAX(num_masks, 1) * sizeof (*matches));
+    distances = PyMem_Malloc(Py_MAX(num_masks, 1) * sizeof (*distances));
+    if (matches == NULL || distances == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    // Find the candidates, and count them by distance: in top-N mode,
+    // the maximum distance is lowered as soon as enough candidates
+    // closer than it have been found.
+    memset(counts, 0, sizeof (counts));
+    num_matches = 0;
+    invalid_index = -1;
+    helper = self->helper;
+    stroke_helper_incref(helper);
+    BEGIN_ALLOW_THREADS_IF(num_masks >= GIL_RELEASE_THRESHOLD)
+    for (Py_ssize_t n = 0; n < num_masks; ++n)
+    {
+        if ((masks[n] >> helper->num_keys))
+        {
+            invalid_index = n;
+            break;
+        }
+        distance = stroke_distance(helper, mask, masks[n], max_distance);
+        if (distance > max_distance)
+            continue;
+        matches[num_matches] = n;
+        distances[num_matches] = distance;
+        ++num_matches;
+        ++counts[distance];
+        if (limit != PY_SSIZE_T_MAX)
+        {
+            Py_ssize_t total = 0;
+            for (unsigned d = 0; d < max_distance; ++d)
+            {
+                total += counts[d];
+                if (total >= limit)
+                {
+                    max_distance = d;
+                    break;
+                }
+            }
+        }
+    }
+    END_ALLOW_THREADS_IF
+    stroke_helper_decref(helper);
+
+    if (invalid_index >= 0)
+    {
+        char error[40];
+
+        snprintf(error, sizeof (error), "invalid keys mask: "STROKE_UINT_FMT, masks[invalid_index]);
+        PyErr_SetString(PyExc_ValueError, error);
+        goto end;
+    }
+
+    if (self->stats_mode)
+        stats_record(self, STAT_NEAR_STROKES, stats_start_ns, 0, 0, num_masks);
+
+    // Counting sort by distance (stable: in `masks` order).
+    num_results = 0;
+    for (unsigned d = 0; d <= max_distance; ++d)
+    {
+        Py_ssize_t count = counts[d];
+        counts[d] = num_results;
+        num_results += count;
+    }
+    num_results = Py_MIN(num_results, limit);
+
+    result_masks = PyMem_Malloc(Py_MAX(num_results, 1) * sizeof (*result_masks));
+    result_distances = PyMem_Malloc(Py_MAX(num_results, 1) * sizeof (*result_distances));
+    if (result_masks == NULL || result_distances == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    for (Py_ssize_t n = 0; n < num_matches; ++n)
+    {
+        Py_ssize_t index;
+
+        distance = distances[n];
+        if (distance > max_distance)
+            continue;
+        index = counts[distance]++;
+        if (index >= num_results)
+            continue;
+        result_masks[index] = masks[matches[n]];
+        result_distances[index] = distance;
+    }
+
+    masks_array = new_array("Q", result_masks, num_results * sizeof (*result_masks));
+    distances_array = new_array("B", result_distances, num_results * sizeof (*result_distances));
+    if (masks_array != NULL && distances_array != NULL)
+        result = PyTuple_Pack(2, masks_array, distances_array);
+    Py_XDECREF(distances_array);
+    Py_XDECREF(masks_array);
+
+end:
+    PyMem_Free(result_distances);
+    PyMem_Free(result_masks);
+    PyMem_Free(distances);
+    PyMem_Free(matches);
+    masks_from_obj_release(masks_obj, &view, masks_buffer, masks);
+    return result;
+}
+
+static PyObject *StrokeHelper_set_adjacent_keys(StrokeHelper *self, PyObject *pairs)
+{
+    stroke_uint_t  adjacent_keys[MAX_KEYS];
+    PyObject      *iterator;
+    PyObject      *pair;
+    stroke_uint_t  mask;
+    unsigned       k1, k2;
+
+    if (pairs == Py_None)
+    {
+        if (!stroke_helper_make_private(self))
+            return NULL;
+        compile_adjacent_keys(self->helper);
+        Py_RETURN_NONE;
+    }
+
+    iterator = PyObject_GetIter(pairs);
+    if (iterator == NULL)
+        return NULL;
+
+    memset(adjacent_keys, 0, sizeof (adjacent_keys));
+
+    while ((pair = PyIter_Next(iterator)) != NULL)
+    {
+        PyObject *keys = PySequence_Fast(pair, "expected a pair of keys");
+        if (keys == NULL)
+        {
+            Py_DECREF(pair);
+            break;
+        }
+        mask = PySequence_Fast_GET_SIZE(keys) == 2
+             ? stroke_from_keys(self->helper, keys)
+             : INVALID_STROKE;
+        Py_DECREF(keys);
+        if (mask == INVALID_STROKE || popcount(mask) != 2)
+        {
+            if (!PyErr_Occurred())
+                PyErr_Format(PyExc_ValueError, "invalid pair of adjacent keys: %R", pair);
+            Py_DECREF(pair);
+            break;
+        }
+        Py_DECREF(pair);
+        k1 = bit_index(lsb(mask));
+        k2 = bit_index(msb(mask));
+        adjacent_keys[k1] |= STROKE_1 << k2;
+        adjacent_keys[k2] |= STROKE_1 << k1;
+    }
+
+    Py_DECREF(iterator);
+
+    if (PyErr_Occurred() || !stroke_helper_make_private(self))
+        return NULL;
+
+    memcpy(self->helper->adjacent_keys, adjacent_keys, sizeof (adjacent_keys));
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *StrokeHelper_stroke_to_order_key(StrokeHelper *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return PyLong_FromStrokeUint(stroke_to_order_key(mask));
+}
+
+static PyObject *StrokeHelper_masks_to_order_keys(StrokeHelper *self, PyObject *masks_obj)
+{
+    Py_buffer      view;
+    stroke_uint_t  masks_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t *masks;
+    Py_ssize_t     num_masks;
+    stroke_uint_t *keys;
+    Py_ssize_t     invalid_index;
+    PyObject      *result;
+
+    num_masks = masks_from_obj(masks_obj, &view, masks_buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_masks < 0)
+        return NULL;
+
+    result = NULL;
+
+    keys = PyMem_Malloc(Py_MAX(num_masks, 1) * sizeof (*keys));
+    if (keys == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    invalid_index = -1;
+    BEGIN_ALLOW_THREADS_IF(num_masks >= GIL_RELEASE_THRESHOLD)
+    for (Py_ssize_t n = 0; n < num_masks; ++n)
+    {
+        if ((masks[n] >> MAX_KEYS))
+        {
+            invalid_index = n;
+            break;
+        }
+        keys[n] = stroke_to_order_key(masks[n]);
+    }
+    END_ALLOW_THREADS_IF
+
+    if (invalid_index >= 0)
+    {
+        char error[40];
+
+        snprintf(error, sizeof (error), "invalid keys mask: "STROKE_UINT_FMT, masks[invalid_index]);
+        PyErr_SetString(PyExc_ValueError, error);
+        goto end;
+    }
+
+    result = new_array("Q", keys, num_masks * sizeof (*keys));
+
+end:
+    PyMem_Free(keys);
+    masks_from_obj_release(masks_obj, &view, masks_buffer, masks);
+    return result;
+}
+
+// Element-wise operations over a buffer of masks.
+typedef enum
+{
+    MASKS_OP_VALID,
+    MASKS_OP_LEN,
+    MASKS_OP_FIRST_KEY,
+    MASKS_OP_LAST_KEY,
+    MASKS_OP_HAS_DIGIT,
+    MASKS_OP_IS_NUMBER,
+    MASKS_OP_OR,
+    MASKS_OP_AND,
+    MASKS_OP_SUB,
+
+} masks_op_t;
+
+static PyObject *invalid_mask_error(stroke_uint_t mask)
+{
+    char error[40];
+
+    snprintf(error, sizeof (error), "invalid keys mask: "STROKE_UINT_FMT, mask);
+    PyErr_SetString(PyExc_ValueError, error);
+    return NULL;
+}
+
+// Unary operations: the result is an `array('B')`,
+// or an `array('b')` for keys indexes (-1 if empty).
+static PyObject *masks_unary_op(StrokeHelper *self, PyObject *masks_obj, masks_op_t op)
+{
+    stroke_helper_t *helper;
+    Py_buffer        view;
+    stroke_uint_t    masks_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t   *masks;
+    Py_ssize_t       num_masks;
+    stroke_uint_t    invalid_keys;
+    Py_ssize_t       invalid_index;
+    uint8_t         *values;
+    PyObject        *result;
+
+    num_masks = masks_from_obj(masks_obj, &view, masks_buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_masks < 0)
+        return NULL;
+
+    result = NULL;
+
+    values = PyMem_Malloc(Py_MAX(num_masks, 1) * sizeof (*values));
+    if (values == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    invalid_index = -1;
+    helper = self->helper;
+    stroke_helper_incref(helper);
+    invalid_keys = ~((STROKE_1 << helper->num_keys) - 1);
+    BEGIN_ALLOW_THREADS_IF(num_masks >= GIL_RELEASE_THRESHOLD)
+    for (Py_ssize_t n = 0; n < num_masks; ++n)
+    {
+        stroke_uint_t mask = masks[n];
+
+        if (op == MASKS_OP_VALID)
+        {
+            values[n] = !(mask & invalid_keys);
+            continue;
+        }
+        if ((mask & invalid_keys))
+        {
+            invalid_index = n;
+            break;
+        }
+        switch (op)
+        {
+        case MASKS_OP_LEN:
+            values[n] = popcount(mask);
+            break;
+        case MASKS_OP_FIRST_KEY:
+            values[n] = mask ? popcount(lsb(mask) - 1) : (uint8_t)-1;
+            break;
+        case MASKS_OP_LAST_KEY:
+            values[n] = mask ? popcount(msb(mask) - 1) : (uint8_t)-1;
+            break;
+        case MASKS_OP_HAS_DIGIT:
+            values[n] = stroke_has_digit(helper, mask);
+            break;
+        case MASKS_OP_IS_NUMBER:
+            values[n] = stroke_is_number(helper, mask);
+            break;
+        default:
+            break;
+        }
+    }
+    END_ALLOW_THREADS_IF
+    stroke_helper_decref(helper);
+
+    if (invalid_index >= 0)
+    {
+        invalid_mask_error(masks[invalid_index]);
+        goto end;
+    }
+
+    result = new_array(op == MASKS_OP_FIRST_KEY || op == MASKS_OP_LAST_KEY ? "b" : "B",
+                       values, num_masks * sizeof (*values));
+
+end:
+    PyMem_Free(values);
+    masks_from_obj_release(masks_obj, &view, masks_buffer, masks);
+    return result;
+}
+
+// Binary operations: the second operand is either a single stroke
+// (broadcast to all masks), or a buffer of masks of the same length
+// (or with a single mask). The result is an `array('Q')`.
+static PyObject *masks_binary_op(StrokeHelper *self, PyObject *args, masks_op_t op)
+{
+    PyObject      *masks_obj;
+    PyObject      *other_obj;
+    Py_buffer      view;
+    Py_buffer      other_view;
+    stroke_uint_t  masks_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t  other_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t *masks;
+    stroke_uint_t *other_masks;
+    stroke_uint_t  other_mask;
+    Py_ssize_t     num_masks;
+    Py_ssize_t     num_other_masks;
+    stroke_uint_t  invalid_keys;
+    Py_ssize_t     invalid_index;
+    stroke_uint_t *values;
+    PyObject      *result;
+
+    if (!PyArg_UnpackTuple(args, "masks_op", 2, 2, &masks_obj, &other_obj))
+        return NULL;
+
+    num_masks = masks_from_obj(masks_obj, &view, masks_buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_masks < 0)
+        return NULL;
+
+    result = NULL;
+    values = NULL;
+
+    if (PyLong_Check(other_obj) || PyUnicode_Check(other_obj))
+    {
+        other_mask = helper_stroke_from_any(self, other_obj);
+        if (other_mask == INVALID_STROKE)
+            goto release_masks;
+        other_masks = &other_mask;
+        num_other_masks = 1;
+        other_view.obj = NULL;
+        other_obj = NULL;
+    }
+    else
+    {
+        num_other_masks = masks_from_obj(other_obj, &other_view, other_buffer, MASKS_BUFFER_LEN, &other_masks);
+        if (num_other_masks < 0)
+            goto release_masks;
+        if (num_other_masks != num_masks && num_other_masks != 1)
+        {
+            PyErr_Format(PyExc_ValueError, "operands could not be broadcast together: %zd != %zd",
+                         num_masks, num_other_masks);
+            goto end;
+        }
+    }
+
+    values = PyMem_Malloc(Py_MAX(num_masks, 1) * sizeof (*values));
+    if (values == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    invalid_index = -1;
+    invalid_keys = ~((STROKE_1 << self->helper->num_keys) - 1);
+    BEGIN_ALLOW_THREADS_IF(num_masks >= GIL_RELEASE_THRESHOLD)
+    for (Py_ssize_t n = 0; n < num_masks; ++n)
+    {
+        stroke_uint_t m1 = masks[n];
+        stroke_uint_t m2 = other_masks[num_other_masks == 1 ? 0 : n];
+
+        if (((m1 | m2) & invalid_keys))
+        {
+            invalid_index = n;
+            break;
+        }
+        switch (op)
+        {
+        case MASKS_OP_OR:
+            values[n] = m1 | m2;
+            break;
+        case MASKS_OP_AND:
+            values[n] = m1 & m2;
+            break;
+        default:
+            values[n] = m1 & ~m2;
+            break;
+        }
+    }
+    END_ALLOW_THREADS_IF
+
+    if (invalid_index >= 0)
+    {
+        stroke_uint_t m1 = masks[invalid_index];
+        invalid_mask_error((m1 & invalid_keys) ? m1 : other_masks[num_other_masks == 1 ? 0 : invalid_index]);
+        goto end;
+    }
+
+    result = new_array("Q", values, num_masks * sizeof (*values));
+
+end:
+    PyMem_Free(values);
+    if (other_obj != NULL)
+        masks_from_obj_release(other_obj, &other_view, other_buffer, other_masks);
+release_masks:
+    masks_from_obj_release(masks_obj, &view, masks_buffer, masks);
+    return result;
+}
+
+static PyObject *StrokeHelper_masks_valid(StrokeHelper *self, PyObject *masks_obj)
+{
+    return masks_unary_op(self, masks_obj, MASKS_OP_VALID);
+}
+
+static PyObject *StrokeHelper_masks_len(StrokeHelper *self, PyObject *masks_obj)
+{
+    return masks_unary_op(self, masks_obj, MASKS_OP_LEN);
+}
+
+static PyObject *StrokeHelper_masks_first_key(StrokeHelper *self, PyObject *masks_obj)
+{
+    return masks_unary_op(self, masks_obj, MASKS_OP_FIRST_KEY);
+}
+
+static PyObject *StrokeHelper_masks_last_key(StrokeHelper *self, PyObject *masks_obj)
+{
+    return masks_unary_op(self, masks_obj, MASKS_OP_LAST_KEY);
+}
+
+static PyObject *StrokeHelper_masks_has_digit(StrokeHelper *self, PyObject *masks_obj)
+{
+    return masks_unary_op(self, masks_obj, MASKS_OP_HAS_DIGIT);
+}
+
+static PyObject *StrokeHelper_masks_is_number(StrokeHelper *self, PyObject *masks_obj)
+{
+    return masks_unary_op(self, masks_obj, MASKS_OP_IS_NUMBER);
+}
+
+static PyObject *StrokeHelper_masks_or(StrokeHelper *self, PyObject *args)
+{
+    return masks_binary_op(self, args, MASKS_OP_OR);
+}
+
+static PyObject *StrokeHelper_masks_and(StrokeHelper *self, PyObject *args)
+{
+    return masks_binary_op(self, args, MASKS_OP_AND);
+}
+
+static PyObject *StrokeHelper_masks_sub(StrokeHelper *self, PyObject *args)
+{
+    return masks_binary_op(self, args, MASKS_OP_SUB);
+}
+
+static PyObject *StrokeHelper_stroke_to_sort_key(StrokeHelper *self, PyObject *stroke)
+{
+    char          sort_key[MAX_KEYS];
+    unsigned      sort_key_len;
+    stroke_uint_t mask;
+
+    mask = helper_stroke_from_any(self, stroke);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    sort_key_len = stroke_to_sort_key(self->helper, mask, sort_key);
+
+    return PyBytes_FromStringAndSize(sort_key, sort_key_len);
+}
+
+static PyObject *StrokeHelper_get_adjacent_keys(const StrokeHelper *self, void *Py_UNUSED(closure))
+{
+    PyObject      *adjacent_keys;
+    PyObject      *pair;
+    stroke_uint_t  keys;
+    unsigned       k2;
+
+    adjacent_keys = PyList_New(0);
+    if (adjacent_keys == NULL)
+        return NULL;
+
+    for (unsigned k1 = 0; k1 < self->helper->num_keys; ++k1)
+    {
+        // Note: only list each pair once.
+        for (keys = self->helper->adjacent_keys[k1] >> k1 << k1; keys; keys &= keys - 1)
+        {
+            k2 = bit_index(lsb(keys));
+            pair = Py_BuildValue("(NN)", key_str(self->helper, k1, 0), key_str(self->helper, k2, 0));
+            if (pair == NULL || PyList_Append(adjacent_keys, pair))
+            {
+                Py_XDECREF(pair);
+                Py_DECREF(adjacent_keys);
+                return NULL;
+            }
+            Py_DECREF(pair);
+        }
+    }
+
+    return adjacent_keys;
+}
+
+// Pickle support: the helper is rebuilt from its system definition.
+// Return a new helper object sharing the compiled helper (copy on write).
+static PyObject *StrokeHelper_copy(StrokeHelper *self, PyObject *Py_UNUSED(ignored))
+{
+    StrokeHelper *copy;
+
+    copy = (StrokeHelper *)PyObject_CallObject((PyObject *)Py_TYPE(self), NULL);
+    if (copy == NULL)
+        return NULL;
+
+    stroke_helper_decref(copy->helper);
+    copy->helper = self->helper;
+    stroke_helper_incref(copy->helper);
+
+    return (PyObject *)copy;
+}
+
+// Snapshot of a compiled helper: a header, followed by the raw
+// compiled helper (without the keys strings), so it's only valid
+// for the same build of the module (checked using the header).
+typedef struct
+{
+    char     magic[4];
+    uint32_t version;
+    uint32_t size;
+    uint32_t max_keys;
+
+} helper_snapshot_header_t;
+
+#define HELPER_SNAPSHOT_MAGIC    "PLSH"
+#define HELPER_SNAPSHOT_VERSION  1
+
+static PyObject *StrokeHelper_to_bytes(StrokeHelper *self, PyObject *Py_UNUSED(ignored))
+{
+    helper_snapshot_header_t  header;
+    stroke_helper_t          *helper;
+    PyObject                 *result;
+
+    memcpy(header.magic, HELPER_SNAPSHOT_MAGIC, sizeof (header.magic));
+    header.version = HELPER_SNAPSHOT_VERSION;
+    header.size = sizeof (stroke_helper_t);
+    header.max_keys = MAX_KEYS;
+
+    result = PyBytes_FromStringAndSize(NULL, sizeof (header) + sizeof (stroke_helper_t));
+    if (result == NULL)
+        return NULL;
+
+    memcpy(PyBytes_AS_STRING(result), &header, sizeof (header));
+    helper = (stroke_helper_t *)(PyBytes_AS_STRING(result) + sizeof (header));
+    memcpy(helper, self->helper, sizeof (*helper));
+    memset(helper->key_str, 0, sizeof (helper->key_str));
+    helper->refcount = 0;
+
+    return result;
+}
+
+// Cheap consistency checks of a restored compiled helper (so a corrupted
+// snapshot cannot result in out of bounds accesses), no revalidation of
+// the system definition is done.
+static int helper_snapshot_is_valid(const stroke_helper_t *helper)
+{
+    stroke_uint_t invalid_keys;
+
+    if (helper->num_keys > MAX_KEYS ||
+        helper->right_keys_index > helper->num_keys ||
+        helper->num_letters > MAX_LETTERS)
+        return 0;
+
+    invalid_keys = ~((STROKE_1 << helper->num_keys) - 1);
+    if ((helper->implicit_hyphen_mask | helper->number_key_mask | helper->numbers_mask) & invalid_keys)
+        return 0;
+
+    if (popcount(helper->number_key_mask) > 1)
+        return 0;
+
+    for (unsigned k = 0; k < helper->num_keys; ++k)
+    {
+        if (helper->key_side[k] > KEY_SIDE_RIGHT || (helper->adjacent_keys[k] & invalid_keys))
+            return 0;
+        // Left keys first, then right keys (starting at `right_keys_index`).
+        if (helper->key_side[k] == (k < helper->right_keys_index ? KEY_SIDE_RIGHT : KEY_SIDE_LEFT))
+            return 0;
+        if (k == helper->right_keys_index && helper->key_side[k] != KEY_SIDE_RIGHT)
+            return 0;
+        // The feral number key letter must be the number key letter.
+        if (helper->feral_number_key_letter &&
+            (helper->number_key_mask & (STROKE_1 << k)) &&
+            helper->feral_number_key_letter != helper->key_letter[k])
+            return 0;
+    }
+    if (helper->feral_number_key_letter && !helper->number_key_mask)
+        return 0;
+    for (unsigned n = 0; n < Py_ARRAY_LENGTH(helper->ascii_letter_index); ++n)
+    {
+        if (helper->ascii_letter_index[n] > helper->num_letters)
+            return 0;
+    }
+    // The hash table must have at least one empty slot (or
+    // `letters_hash_slot` would never end), and each letter
+    // must be found at its slot when probing.
+    {
+        unsigned num_empty = 0;
+
+        for (unsigned n = 0; n < LETTERS_HASH_SIZE; ++n)
+        {
+            if (helper->letters_hash[n])
+                continue;
+            if (helper->letters_hash_index[n])
+                return 0;
+            ++num_empty;
+        }
+        if (!num_empty)
+            return 0;
+    }
+    for (unsigned n = 0; n < LETTERS_HASH_SIZE; ++n)
+    {
+        if (!helper->letters_hash[n])
+            continue;
+        if (!helper->letters_hash_index[n] ||
+            helper->letters_hash_index[n] > helper->num_letters ||
+            letters_hash_slot(helper, helper->letters_hash[n]) != n)
+            return 0;
+    }
+    // Note: only the part of the transition table used
+    // when parsing (see `stroke_from_kind_data`) is checked.
+    for (unsigned k = 0; helper->num_keys && k <= helper->num_keys; ++k)
+    {
+        for (unsigned l = 0; l <= helper->num_letters; ++l)
+        {
+            if (helper->next_key[k][l] != NO_KEY && helper->next_key[k][l] >= helper->num_keys)
+                return 0;
+        }
+    }
+
+    return 1;
+}
+
+static PyObject *StrokeHelper_from_bytes(PyTypeObject *type, PyObject *data)
+{
+    Py_buffer                 view;
+    helper_snapshot_header_t  header;
+    stroke_helper_t          *helper;
+    StrokeHelper             *self;
+
+    if (PyObject_GetBuffer(data, &view, PyBUF_SIMPLE))
+        return NULL;
+
+    helper = NULL;
+    if (view.len == sizeof (header) + sizeof (*helper))
+    {
+        memcpy(&header, view.buf, sizeof (header));
+        if (!memcmp(header.magic, HELPER_SNAPSHOT_MAGIC, sizeof (header.magic)) &&
+            header.version == HELPER_SNAPSHOT_VERSION &&
+            header.size == sizeof (*helper) &&
+            header.max_keys == MAX_KEYS)
+        {
+            helper = PyMem_Malloc(sizeof (*helper));
+            if (helper == NULL)
+            {
+                PyBuffer_Release(&view);
+                return PyErr_NoMemory();
+            }
+            memcpy(helper, (const char *)view.buf + sizeof (header), sizeof (*helper));
+            helper->refcount = 1;
+        }
+    }
+
+    PyBuffer_Release(&view);
+
+    if (helper == NULL || !helper_snapshot_is_valid(helper))
+    {
+        PyMem_Free(helper);
+        PyErr_SetString(PyExc_ValueError, "invalid helper snapshot");
+        return NULL;
+    }
+
+    if (compile_key_strs(helper))
+    {
+        PyMem_Free(helper);
+        return NULL;
+    }
+
+    self = (StrokeHelper *)PyObject_CallObject((PyObject *)type, NULL);
+    if (self == NULL)
+    {
+        stroke_helper_decref(helper);
+        return NULL;
+    }
+
+    stroke_helper_decref(self->helper);
+    self->helper = helper;
+
+    return (PyObject *)self;
+}
+
+static PyObject *StrokeHelper_reduce(StrokeHelper *self, PyObject *Py_UNUSED(ignored))
+{
+    PyObject *state;
+
+    if (!self->helper->num_keys)
+        return Py_BuildValue("(O())", Py_TYPE(self));
+
+    state = Py_BuildValue("{sNsNsNsNsNsN}",
+                          "keys", StrokeHelper_get_keys(self, NULL),
+                          "implicit_hyphen_keys", StrokeHelper_get_implicit_hyphen_keys(self, NULL),
+                          "number_key", StrokeHelper_get_number_key(self, NULL),
+                          "numbers", StrokeHelper_get_numbers(self, NULL),
+                          "feral_number_key", StrokeHelper_get_feral_number_key(self, NULL),
+                          "adjacent_keys", StrokeHelper_get_adjacent_keys(self, NULL));
+    if (state == NULL)
+        return NULL;
+
+    return Py_BuildValue("(O()N)", Py_TYPE(self), state);
+}
+
+static PyObject *StrokeHelper_setstate(StrokeHelper *self, PyObject *state)
+{
+    PyObject *kwargs;
+    PyObject *adjacent_keys;
+    PyObject *args;
+    PyObject *result;
+
+    if (!PyDict_Check(state))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a dictionary");
+        return NULL;
+    }
+
+    kwargs = PyDict_Copy(state);
+    if (kwargs == NULL)
+        return NULL;
+
+    adjacent_keys = PyDict_GetItemString(kwargs, "adjacent_keys");
+    Py_XINCREF(adjacent_keys);
+    if (adjacent_keys != NULL && PyDict_DelItemString(kwargs, "adjacent_keys"))
+    {
+        Py_DECREF(adjacent_keys);
+        Py_DECREF(kwargs);
+        return NULL;
+    }
+
+    args = PyTuple_New(0);
+    result = args == NULL ? NULL : StrokeHelper_setup(self, args, kwargs);
+    if (result != NULL && adjacent_keys != NULL)
+    {
+        Py_DECREF(result);
+        result = StrokeHelper_set_adjacent_keys(self, adjacent_keys);
+    }
+
+    Py_XDECREF(args);
+    Py_XDECREF(adjacent_keys);
+    Py_DECREF(kwargs);
+
+    return result;
+}
+
+static PyGetSetDef StrokeHelper_getset[] =
+{
+    // For getting back the arguments passed to setup.
+    {"keys", (getter)StrokeHelper_get_keys, NULL, "List of supported keys.", NULL},
+    {"implicit_hyphen_keys", (getter)StrokeHelper_get_implicit_hyphen_keys, NULL, "Set of implicit hyphen keys.", NULL},
+    {"number_key", (getter)StrokeHelper_get_number_key, NULL, "Number key.", NULL},
+    {"numbers", (getter)StrokeHelper_get_numbers, NULL, "Mapping of key to number.", NULL},
+    {"feral_number_key", (getter)StrokeHelper_get_feral_number_key, NULL, "Is the number key feral?", NULL},
+    {"adjacent_keys", (getter)StrokeHelper_get_adjacent_keys, NULL, "List of pairs of adjacent keys.", NULL},
+    // Other derived fields.
+    {"key_letter", (getter)StrokeHelper_get_key_letter, NULL, "Letters for the supported keys.", NULL},
+    {"key_number", (getter)StrokeHelper_get_key_number, NULL, "Numbers for the supported keys.", NULL},
+    {"feral_number_key_letter", (getter)StrokeHelper_get_feral_number_key_letter, NULL, "Letter for the feral number key.", NULL},
+    {"num_keys", (getter)StrokeHelper_get_num_keys, NULL, "Number of keys.", NULL},
+    {"implicit_hyphen_mask", (getter)StrokeHelper_get_implicit_hyphen_mask, NULL, "Implicit hyphen mask.", NULL},
+    {"number_key_mask", (getter)StrokeHelper_get_number_key_mask, NULL, "Number key mask.", NULL},
+    {"numbers_mask", (getter)StrokeHelper_get_numbers_mask, NULL, "Numbers mask.", NULL},
+    {"right_keys_index", (getter)StrokeHelper_get_right_keys_index, NULL, "Right keys index.", NULL},
+    {NULL}
+};
+
+static PyMethodDef StrokeHelper_methods[] =
+{
+    {"setup"             , (PyCFunction)StrokeHelper_setup             , METH_VARARGS | METH_KEYWORDS, "Setup."},
+    // Pickle.
+    {"__reduce__"        , (PyCFunction)StrokeHelper_reduce            , METH_NOARGS, NULL},
+    {"__setstate__"      , (PyCFunction)StrokeHelper_setstate          , METH_O, NULL},
+    {"copy"              , (PyCFunction)StrokeHelper_copy              , METH_NOARGS, "Return a new helper, sharing the compiled system (but with its own caches and stats)."},
+    {"to_bytes"          , (PyCFunction)StrokeHelper_to_bytes          , METH_NOARGS, "Return a snapshot of the compiled system, for use with `from_bytes` (with the same build of the module)."},
+    {"from_bytes"        , (PyCFunction)StrokeHelper_from_bytes        , METH_O | METH_CLASS, "Return a new helper, restored from a snapshot returned by `to_bytes`."},
+    // Cache.
+    {"set_cache_size"    , (PyCFunction)StrokeHelper_set_cache_size    , METH_O, "Set the maximum size of the steno <-> stroke caches (0 to disable)."},
+    {"cache_clear"       , (PyCFunction)StrokeHelper_cache_clear       , METH_NOARGS, "Clear the steno <-> stroke caches (and their statistics)."},
+    {"cache_info"        , (PyCFunction)StrokeHelper_cache_info        , METH_NOARGS, "Return the steno <-> stroke caches statistics."},
+    // Instrumentation.
+    {"set_stats"         , (PyCFunction)StrokeHelper_set_stats         , METH_VARARGS | METH_KEYWORDS, "Enable / disable the operations counters (and optionally, timing)."},
+    {"stats"             , (PyCFunction)StrokeHelper_stats             , METH_NOARGS, "Return the operations counters."},
+    {"reset_stats"       , (PyCFunction)StrokeHelper_reset_stats       , METH_NOARGS, "Reset the operations counters (and the caches statistics)."},
+    // Steno.
+    {"normalize_stroke"  , (PyCFunction)StrokeHelper_normalize_stroke  , METH_O, "Normalize stroke."},
+    {"normalize_steno"   , (PyCFunction)StrokeHelper_normalize_steno   , METH_O, "Normalize steno."},
+    {"steno_to_sort_key" , (PyCFunction)StrokeHelper_steno_to_sort_key , METH_O, "Convert steno to a binary sort key."},
+    {"steno_list_to_masks", (PyCFunction)StrokeHelper_steno_list_to_masks, METH_O, "Convert an iterable of steno to a tuple: `(masks, offsets, invalid)`."},
+    {"validate_steno_list", (PyCFunction)StrokeHelper_validate_steno_list, METH_O, "Validate an iterable of steno, without raising: return an `array('B')` of error codes (0 if valid), one per item."},
+    {"steno_buffer_to_masks", (PyCFunction)StrokeHelper_steno_buffer_to_masks, METH_VARARGS | METH_KEYWORDS, "Convert ASCII steno from a bytes-like object (`buffer[start:end]`) to a tuple of masks."},
+    {"steno_to_outline"  , (PyCFunction)StrokeHelper_steno_to_outline  , METH_O, "Convert steno to an outline."},
+    {"steno_buffer_to_outline", (PyCFunction)StrokeHelper_steno_buffer_to_outline, METH_VARARGS | METH_KEYWORDS, "Convert ASCII steno from a bytes-like object (`buffer[start:end]`) to an outline."},
+    {"outline_to_steno"  , (PyCFunction)StrokeHelper_outline_to_steno  , METH_O, "Convert an outline to (normalized) steno."},
+    {"masks_to_steno_list", (PyCFunction)StrokeHelper_masks_to_steno_list, METH_VARARGS | METH_KEYWORDS, "Convert masks to a list of steno (one per mask, or per outline when `offsets` is given): the reverse of `steno_list_to_masks`."},
+    {"sort_outlines"     , (PyCFunction)StrokeHelper_sort_outlines     , METH_VARARGS | METH_KEYWORDS, "Sort outlines (steno, outlines, or sequences of strokes) in steno order: return the sorted indexes, or sort the list in place."},
+    // Stroke: new.
+    {"stroke_from_any"   , (PyCFunction)StrokeHelper_stroke_from_any   , METH_O, "Convert an integer (keys mask), string (steno), or sequence of keys to a stroke."},
+    {"stroke_from_int"   , (PyCFunction)StrokeHelper_stroke_from_int   , METH_O, "Convert an integer (keys mask) to a stroke."},
+    {"stroke_from_keys"  , (PyCFunction)StrokeHelper_stroke_from_keys  , METH_O, "Convert keys to a stroke."},
+    {"stroke_from_steno" , (PyCFunction)StrokeHelper_stroke_from_steno , METH_O, "Convert steno to a stroke."},
+    {"stroke_from_buffer", (PyCFunction)StrokeHelper_stroke_from_buffer, METH_VARARGS | METH_KEYWORDS, "Convert ASCII steno from a bytes-like object (`buffer[start:end]`) to a stroke."},
+    // Stroke: methods.
+    {"stroke_first_key"  , (PyCFunction)StrokeHelper_stroke_first_key  , METH_O, "Return the stroke first key."},
+    {"stroke_last_key"   , (PyCFunction)StrokeHelper_stroke_last_key   , METH_O, "Return the stroke last key."},
+    {"stroke_invert"     , (PyCFunction)StrokeHelper_stroke_invert     , METH_O, "Invert stroke."},
+    {"stroke_len"        , (PyCFunction)StrokeHelper_stroke_len        , METH_O, "Return the stroke number of keys."},
+    {"stroke_has_digit"  , (PyCFunction)StrokeHelper_stroke_has_digit  , METH_O, "Return True if the stroke contains one or more digits."},
+    {"stroke_is_number"  , (PyCFunction)StrokeHelper_stroke_is_number  , METH_O, "Return True if the stroke is a number."},
+    // Stroke: ops.
+    {"stroke_cmp"        , (PyCFunction)StrokeHelper_stroke_cmp        , METH_VARARGS, "Compare strokes."},
+    {"stroke_eq"         , (PyCFunction)StrokeHelper_stroke_eq         , METH_VARARGS, "Compare strokes: `s1 == s2`."},
+    {"stroke_ne"         , (PyCFunction)StrokeHelper_stroke_ne         , METH_VARARGS, "Compare strokes: `s1 != s2`."},
+    {"stroke_ge"         , (PyCFunction)StrokeHelper_stroke_ge         , METH_VARARGS, "Compare strokes: `s1 >= s2`."},
+    {"stroke_gt"         , (PyCFunction)StrokeHelper_stroke_gt         , METH_VARARGS, "Compare strokes: `s1 > s2`."},
+    {"stroke_le"         , (PyCFunction)StrokeHelper_stroke_le         , METH_VARARGS, "Compare strokes: `s1 <= s2`."},
+    {"stroke_lt"         , (PyCFunction)StrokeHelper_stroke_lt         , METH_VARARGS, "Compare strokes: `s1 < s2`."},
+    {"stroke_in"         , (PyCFunction)StrokeHelper_stroke_in         , METH_VARARGS, "`s1 in s2."},
+    {"stroke_or"         , (PyCFunction)StrokeHelper_stroke_or         , METH_VARARGS, "`s1 | s2."},
+    {"stroke_and"        , (PyCFunction)StrokeHelper_stroke_and        , METH_VARARGS, "`s1 & s2."},
+    {"stroke_add"        , (PyCFunction)StrokeHelper_stroke_add        , METH_VARARGS, "`s1 + s2."},
+    {"stroke_sub"        , (PyCFunction)StrokeHelper_stroke_sub        , METH_VARARGS, "`s1 - s2."},
+    {"stroke_is_prefix"  , (PyCFunction)StrokeHelper_stroke_is_prefix  , METH_VARARGS, "Check if `s1` is a prefix of `s2`."},
+    {"stroke_is_suffix"  , (PyCFunction)StrokeHelper_stroke_is_suffix  , METH_VARARGS, "Check if `s1` is a suffix of `s2`."},
+    // Stroke: convert.
+    {"stroke_to_keys"    , (PyCFunction)StrokeHelper_stroke_to_keys    , METH_O, "Convert stroke to a tuple of keys."},
+    {"stroke_to_steno"   , (PyCFunction)StrokeHelper_stroke_to_steno   , METH_O, "Convert stroke to steno."},
+    {"stroke_to_sort_key", (PyCFunction)StrokeHelper_stroke_to_sort_key, METH_O, "Convert stroke to a binary sort key."},
+    {"stroke_to_order_key", (PyCFunction)StrokeHelper_stroke_to_order_key, METH_O, "Convert stroke to an integer, whose natural order matches the steno order."},
+    {"masks_to_order_keys", (PyCFunction)StrokeHelper_masks_to_order_keys, METH_O, "Convert keys masks (buffer of unsigned 64 bits integers, outline, or sequence of strokes) to an `array('Q')` of order keys."},
+    {"masks_valid"        , (PyCFunction)StrokeHelper_masks_valid        , METH_O, "Return an `array('B')` with, for each keys mask (buffer of unsigned 64 bits integers, outline, or sequence of strokes), 1 if it's valid for the system, 0 otherwise."},
+    {"masks_len"          , (PyCFunction)StrokeHelper_masks_len          , METH_O, "Return an `array('B')` with the number of keys of each keys mask."},
+    {"masks_first_key"    , (PyCFunction)StrokeHelper_masks_first_key    , METH_O, "Return an `array('b')` with the index of the first key of each keys mask (-1 if empty)."},
+    {"masks_last_key"     , (PyCFunction)StrokeHelper_masks_last_key     , METH_O, "Return an `array('b')` with the index of the last key of each keys mask (-1 if empty)."},
+    {"masks_has_digit"    , (PyCFunction)StrokeHelper_masks_has_digit    , METH_O, "Return an `array('B')` with, for each keys mask, 1 if it contains one or more digits, 0 otherwise."},
+    {"masks_is_number"    , (PyCFunction)StrokeHelper_masks_is_number    , METH_O, "Return an `array('B')` with, for each keys mask, 1 if it's a number, 0 otherwise."},
+    {"masks_or"           , (PyCFunction)StrokeHelper_masks_or           , METH_VARARGS, "Return an `array('Q')` of `masks1 | masks2`, with `masks2` a single stroke, or keys masks of the same length (or a single mask)."},
+    {"masks_and"          , (PyCFunction)StrokeHelper_masks_and          , METH_VARARGS, "Return an `array('Q')` of `masks1 & masks2`, with `masks2` a single stroke, or keys masks of the same length (or a single mask)."},
+    {"masks_sub"          , (PyCFunction)StrokeHelper_masks_sub          , METH_VARARGS, "Return an `array('Q')` of `masks1 & ~masks2`, with `masks2` a single stroke, or keys masks of the same length (or a single mask)."},
+    {"near_strokes"      , (PyCFunction)StrokeHelper_near_strokes      , METH_VARARGS | METH_KEYWORDS, "Find the strokes in `masks` within `max_distance` (weighted Hamming distance) of `stroke`, return `(masks, distances)` (`array('Q')` and `array('B')`), closest first (optionally, only the `limit` closest)."},
+    {"set_adjacent_keys" , (PyCFunction)StrokeHelper_set_adjacent_keys , METH_O, "Set the pairs of adjacent keys used for weighted distances (None to restore the default: consecutive keys on the same side)."},
+    {NULL}
+};
+
+static void StrokeHelper_dealloc(StrokeHelper *self)
+{
+    steno_cache_resize(&self->from_steno_cache, 0);
+    steno_cache_resize(&self->to_steno_cache, 0);
+    keys_cache_clear(self);
+    stroke_helper_decref(self->helper);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *StrokeHelper_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    StrokeHelper *self;
+
+    self = (StrokeHelper *)PyType_GenericNew(type, args, kwargs);
+    if (self == NULL)
+        return NULL;
+
+    self->helper = stroke_helper_new();
+    if (self->helper == NULL)
+    {
+        Py_DECREF(self);
+        return NULL;
+    }
+
+    return (PyObject *)self;
+}
+
+static PyTypeObject StrokeHelperType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name      = "_plover_stroke.StrokeHelper",
+    .tp_basicsize = sizeof (StrokeHelper),
+    .tp_itemsize  = 0,
+    .tp_flags     = Py_TPFLAGS_DEFAULT,
+    .tp_new       = StrokeHelper_new,
+    .tp_dealloc   = (destructor)StrokeHelper_dealloc,
+    .tp_methods   = StrokeHelper_methods,
+    .tp_getset    = StrokeHelper_getset,
+};
+
+// Wide mode: systems with more than `MAX_KEYS` keys (up to `MAX_WIDE_KEYS`),
+// using 2 words masks. Only the core single stroke operations are supported
+// (no batch operations): the compiled helper code is shared with the single
+// word helper (see `_plover_stroke_helper.h`), only the masks operations
+// are specific.
+
+typedef struct
+{
+    uint64_t w[2];
+
+} wide_mask_t;
+
+// Note: bit 127 is never set in a valid mask (see `MAX_WIDE_KEYS`).
+static const wide_mask_t WIDE_INVALID_STROKE = {{~(uint64_t)0, ~(uint64_t)0}};
+static const wide_mask_t WIDE_ZERO = {{0, 0}};
+
+static inline int wide_is_invalid(wide_mask_t m)
+{
+    return m.w[1] == ~(uint64_t)0;
+}
+
+static inline wide_mask_t wide_bit(unsigned k)
+{
+    wide_mask_t m = WIDE_ZERO;
+
+    m.w[k / 64] = (uint64_t)1 << (k % 64);
+    return m;
+}
+
+static inline wide_mask_t wide_shr1(wide_mask_t m)
+{
+    m.w[0] = (m.w[0] >> 1) | (m.w[1] << 63);
+    m.w[1] >>= 1;
+    return m;
+}
+
+static inline int wide_test(wide_mask_t m, unsigned k)
+{
+    return (m.w[k / 64] >> (k % 64)) & 1;
+}
+
+static inline int wide_is_zero(wide_mask_t m)
+{
+    return !(m.w[0] | m.w[1]);
+}
+
+static inline int wide_eq(wide_mask_t m1, wide_mask_t m2)
+{
+    return m1.w[0] == m2.w[0] && m1.w[1] == m2.w[1];
+}
+
+static inline wide_mask_t wide_or(wide_mask_t m1, wide_mask_t m2)
+{
+    m1.w[0] |= m2.w[0];
+    m1.w[1] |= m2.w[1];
+    return m1;
+}
+
+static inline wide_mask_t wide_and(wide_mask_t m1, wide_mask_t m2)
+{
+    m1.w[0] &= m2.w[0];
+    m1.w[1] &= m2.w[1];
+    return m1;
+}
+
+static inline wide_mask_t wide_and_not(wide_mask_t m1, wide_mask_t m2)
+{
+    m1.w[0] &= ~m2.w[0];
+    m1.w[1] &= ~m2.w[1];
+    return m1;
+}
+
+static unsigned wide_popcount(wide_mask_t m)
+{
+    return popcount(m.w[0]) + popcount(m.w[1]);
+}
+
+// Mask of the first `num_keys` keys.
+static wide_mask_t wide_keys_mask(unsigned num_keys)
+{
+    wide_mask_t m;
+
+    m.w[0] = num_keys >= 64 ? ~(uint64_t)0 : ((uint64_t)1 << num_keys) - 1;
+    m.w[1] = num_keys <= 64 ? 0 : ((uint64_t)1 << (num_keys - 64)) - 1;
+
+    return m;
+}
+
+// Index of the first key, or -1 if empty.
+static int wide_first_key(wide_mask_t m)
+{
+    if (m.w[0])
+        return bit_index(lsb(m.w[0]));
+    if (m.w[1])
+        return 64 + bit_index(lsb(m.w[1]));
+    return -1;
+}
+
+// Index of the last key, or -1 if empty.
+static int wide_last_key(wide_mask_t m)
+{
+    if (m.w[1])
+        return 64 + bit_index(msb(m.w[1]));
+    if (m.w[0])
+        return bit_index(msb(m.w[0]));
+    return -1;
+}
+
+// Steno order: compare the strokes as sequences of keys (a prefix sorting
+// first), i.e. the first key in only one of the strokes decides, unless
+// the other stroke has no more keys.
+static int wide_compare(wide_mask_t m1, wide_mask_t m2)
+{
+    wide_mask_t diff;
+    int         k;
+
+    diff.w[0] = m1.w[0] ^ m2.w[0];
+    diff.w[1] = m1.w[1] ^ m2.w[1];
+    k = wide_first_key(diff);
+    if (k < 0)
+        return 0;
+
+    if (wide_test(m1, k))
+        return wide_last_key(m2) > k ? -1 : 1;
+
+    return wide_last_key(m1) > k ? 1 : -1;
+}
+
+// Same as `stroke_to_order_key`, but with 128 bits order keys (key `k`
+// maps to bit `126 - k` in the reversed mask).
+static wide_mask_t wide_to_order_key(wide_mask_t mask)
+{
+    wide_mask_t r, key;
+    uint64_t    low_lsb, high_lsb, borrow;
+
+    if (wide_is_zero(mask))
+        return mask;
+
+    r.w[0] = (bit_reverse(mask.w[1]) >> 1) | (bit_reverse(mask.w[0]) << 63);
+    r.w[1] = bit_reverse(mask.w[0]) >> 1;
+
+    low_lsb = lsb(r.w[0]);
+    high_lsb = r.w[0] ? 0 : lsb(r.w[1]);
+
+    // key = 2 ** 127 - r - lsb(r)
+    key.w[0] = 0 - r.w[0];
+    borrow = r.w[0] != 0;
+    key.w[1] = ((uint64_t)1 << 63) - r.w[1] - borrow;
+    borrow = key.w[0] < low_lsb;
+    key.w[0] -= low_lsb;
+    key.w[1] -= high_lsb + borrow;
+
+    // key += popcount
+    key.w[0] += wide_popcount(mask);
+    key.w[1] += key.w[0] < wide_popcount(mask);
+
+    return key;
+}
+
+// The integers 64 and 2 ** 64 (initialized on module load).
+static PyObject *int_64;
+static PyObject *int_2_64;
+
+static PyObject *wide_to_int(wide_mask_t m)
+{
+    PyObject *hi, *lo, *tmp, *result;
+
+    if (!m.w[1])
+        return PyLong_FromUnsignedLongLong(m.w[0]);
+
+    hi = PyLong_FromUnsignedLongLong(m.w[1]);
+    lo = PyLong_FromUnsignedLongLong(m.w[0]);
+    tmp = hi == NULL ? NULL : PyNumber_Lshift(hi, int_64);
+    result = tmp == NULL || lo == NULL ? NULL : PyNumber_Or(tmp, lo);
+    Py_XDECREF(tmp);
+    Py_XDECREF(lo);
+    Py_XDECREF(hi);
+
+    return result;
+}
+
+typedef struct
+{
+    unsigned      num_keys;
+    key_side_t    key_side[MAX_WIDE_KEYS];
+    Py_UCS4       key_letter[MAX_WIDE_KEYS];
+    Py_UCS4       key_number[MAX_WIDE_KEYS];
+    Py_UCS4       feral_number_key_letter;
+    wide_mask_t   implicit_hyphen_mask;
+    wide_mask_t   number_key_mask;
+    wide_mask_t   numbers_mask;
+    unsigned      right_keys_index;
+    // Parsing tables: same as for `stroke_helper_t`.
+    unsigned      num_letters;
+    uint8_t       ascii_letter_index[128];
+    Py_UCS4       letters_hash[WIDE_LETTERS_HASH_SIZE];
+    uint8_t       letters_hash_index[WIDE_LETTERS_HASH_SIZE];
+    uint8_t       next_key[MAX_WIDE_KEYS + 1][MAX_WIDE_LETTERS + 1];
+    // Interned keys strings (letter and number variants).
+    PyObject     *key_str[2][MAX_WIDE_KEYS];
+
+} wide_helper_t;
+
+typedef struct
+{
+    PyObject_HEAD
+    wide_helper_t helper;
+
+} WideStrokeHelper;
+
+static PyTypeObject WideStrokeHelperType;
+
+static wide_mask_t wide_stroke_from_int(const wide_helper_t *helper, PyObject *integer)
+{
+    wide_mask_t  mask;
+    PyObject    *hi;
+    PyObject    *single_word;
+
+    // Note: avoid raising (and clearing) an `OverflowError` for 2 words
+    // masks, and use the integer comparison (`integer` can be a stroke).
+    if (!PyLong_Check(integer))
+    {
+        PyErr_Format(PyExc_TypeError, "expected an integer, got: %R", integer);
+        return WIDE_INVALID_STROKE;
+    }
+    single_word = PyLong_Type.tp_richcompare(integer, int_2_64, Py_LT);
+    if (single_word == NULL)
+        return WIDE_INVALID_STROKE;
+    Py_DECREF(single_word);
+
+    if (single_word == Py_True)
+    {
+        mask.w[1] = 0;
+        mask.w[0] = PyLong_AsUnsignedLongLong(integer);
+    }
+    else
+    {
+        hi = PyNumber_Rshift(integer, int_64);
+        if (hi == NULL)
+            return WIDE_INVALID_STROKE;
+        mask.w[1] = PyLong_AsUnsignedLongLong(hi);
+        Py_DECREF(hi);
+        if (mask.w[1] != (uint64_t)-1 || !PyErr_Occurred())
+            mask.w[0] = PyLong_AsUnsignedLongLongMask(integer);
+    }
+
+    // Note: negative integers are rejected here.
+    if ((mask.w[0] == (uint64_t)-1 || mask.w[1] == (uint64_t)-1) && PyErr_Occurred())
+    {
+        if (!PyErr_ExceptionMatches(PyExc_OverflowError))
+            return WIDE_INVALID_STROKE;
+        PyErr_Clear();
+        goto invalid;
+    }
+
+    if (wide_is_zero(wide_and_not(mask, wide_keys_mask(helper->num_keys))))
+        return mask;
+
+invalid:
+    PyErr_Format(PyExc_ValueError, "invalid keys mask: %R", integer);
+    return WIDE_INVALID_STROKE;
+}
+
+// Compiled helper code, for wide masks.
+#define HELPER_T                  wide_helper_t
+#define HELPER_MAX_KEYS           MAX_WIDE_KEYS
+#define HELPER_MAX_STENO          MAX_WIDE_STENO
+#define HELPER_MAX_LETTERS        MAX_WIDE_LETTERS
+#define HELPER_LETTERS_HASH_SIZE  WIDE_LETTERS_HASH_SIZE
+#define HELPER_PY_T               WideStrokeHelper
+#define HELPER_OF(self)           (&(self)->helper)
+#define HELPER_FN(name)           wide_##name
+#define HELPER_PY_FN(name)        WideStrokeHelper_##name
+#define MASK_T                    wide_mask_t
+#define MASK_INVALID              WIDE_INVALID_STROKE
+#define MASK_IS_INVALID(m)        wide_is_invalid(m)
+#define MASK_ZERO                 WIDE_ZERO
+#define MASK_BIT(k)               wide_bit(k)
+#define MASK_TEST(m, k)           wide_test(m, k)
+#define MASK_SHR1(m)              wide_shr1(m)
+#define MASK_OR(m1, m2)           wide_or(m1, m2)
+#define MASK_AND(m1, m2)          wide_and(m1, m2)
+#define MASK_AND_NOT(m1, m2)      wide_and_not(m1, m2)
+#define MASK_IS_ZERO(m)           wide_is_zero(m)
+#define MASK_POPCOUNT(m)          wide_popcount(m)
+#define MASK_FIRST_KEY(m)         wide_first_key(m)
+#define MASK_TO_PYLONG(m)         wide_to_int(m)
+#include "_plover_stroke_helper.h"
+
+static PyObject *WideStrokeHelper_setup(WideStrokeHelper *self, PyObject *args, PyObject *kwargs)
+{
+    system_t      system;
+    wide_helper_t helper;
+
+    if (parse_system(args, kwargs, MAX_WIDE_KEYS, &system) ||
+        wide_compile_system(&helper, &system))
+        return NULL;
+
+    wide_stroke_helper_clear(&self->helper);
+    self->helper = helper;
+
+    Py_RETURN_NONE;
+}
+
+static int wide_unpack_2_strokes(const wide_helper_t *helper, PyObject *args, const char *fn_name,
+                                 wide_mask_t *first_stroke, wide_mask_t *second_stroke)
+{
+    PyObject *s1, *s2;
+
+    if (!PyArg_UnpackTuple(args, fn_name, 2, 2, &s1, &s2))
+        return 0;
+
+    *first_stroke = wide_stroke_from_any(helper, s1);
+    if (wide_is_invalid(*first_stroke))
+        return 0;
+    *second_stroke = wide_stroke_from_any(helper, s2);
+
+    return !wide_is_invalid(*second_stroke);
+}
+
+static PyObject *WideStrokeHelper_stroke_from_any(WideStrokeHelper *self, PyObject *obj)
+{
+    wide_mask_t mask;
+
+    mask = wide_stroke_from_any(&self->helper, obj);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return wide_to_int(mask);
+}
+
+static PyObject *WideStrokeHelper_stroke_from_int(WideStrokeHelper *self, PyObject *integer)
+{
+    wide_mask_t mask;
+
+    mask = wide_stroke_from_int(&self->helper, integer);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return wide_to_int(mask);
+}
+
+static PyObject *WideStrokeHelper_stroke_from_keys(WideStrokeHelper *self, PyObject *keys_sequence)
+{
+    wide_mask_t mask;
+
+    keys_sequence = PySequence_Fast(keys_sequence, "expected a list or tuple");
+    if (keys_sequence == NULL)
+        return NULL;
+
+    mask = wide_stroke_from_keys(&self->helper, keys_sequence);
+    Py_DECREF(keys_sequence);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return wide_to_int(mask);
+}
+
+static PyObject *WideStrokeHelper_stroke_from_steno(WideStrokeHelper *self, PyObject *steno)
+{
+    wide_mask_t mask;
+
+    if (!PyUnicode_Check(steno))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a string");
+        return NULL;
+    }
+
+    mask = wide_stroke_from_steno(&self->helper, steno);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return wide_to_int(mask);
+}
+
+static PyObject *WideStrokeHelper_stroke_to_keys(WideStrokeHelper *self, PyObject *stroke)
+{
+    wide_mask_t mask;
+
+    mask = wide_stroke_from_any(&self->helper, stroke);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return wide_stroke_to_keys(&self->helper, mask);
+}
+
+static PyObject *WideStrokeHelper_stroke_to_steno(WideStrokeHelper *self, PyObject *stroke)
+{
+    wide_mask_t mask;
+
+    mask = wide_stroke_from_any(&self->helper, stroke);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return wide_stroke_to_str(&self->helper, mask);
+}
+
+static PyObject *WideStrokeHelper_stroke_to_order_key(WideStrokeHelper *self, PyObject *stroke)
+{
+    wide_mask_t mask;
+
+    mask = wide_stroke_from_any(&self->helper, stroke);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return wide_to_int(wide_to_order_key(mask));
+}
+
+static PyObject *wide_stroke_end_key(WideStrokeHelper *self, PyObject *stroke, int last)
+{
+    wide_mask_t mask;
+    int         key_index;
+
+    mask = wide_stroke_from_any(&self->helper, stroke);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    key_index = last ? wide_last_key(mask) : wide_first_key(mask);
+    if (key_index < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "empty stroke");
+        return NULL;
+    }
+
+    return wide_key_str(&self->helper, key_index, 0);
+}
+
+static PyObject *WideStrokeHelper_stroke_first_key(WideStrokeHelper *self, PyObject *stroke)
+{
+    return wide_stroke_end_key(self, stroke, 0);
+}
+
+static PyObject *WideStrokeHelper_stroke_last_key(WideStrokeHelper *self, PyObject *stroke)
+{
+    return wide_stroke_end_key(self, stroke, 1);
+}
+
+static PyObject *WideStrokeHelper_stroke_invert(WideStrokeHelper *self, PyObject *stroke)
+{
+    wide_mask_t mask;
+
+    mask = wide_stroke_from_any(&self->helper, stroke);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return wide_to_int(wide_and_not(wide_keys_mask(self->helper.num_keys), mask));
+}
+
+static PyObject *WideStrokeHelper_stroke_len(WideStrokeHelper *self, PyObject *stroke)
+{
+    wide_mask_t mask;
+
+    mask = wide_stroke_from_any(&self->helper, stroke);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return PyLong_FromUnsignedLong(wide_popcount(mask));
+}
+
+static PyObject *WideStrokeHelper_stroke_has_digit(WideStrokeHelper *self, PyObject *stroke)
+{
+    wide_mask_t mask;
+
+    mask = wide_stroke_from_any(&self->helper, stroke);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return PyBool_FromLong(wide_stroke_has_digit(&self->helper, mask));
+}
+
+static PyObject *WideStrokeHelper_stroke_is_number(WideStrokeHelper *self, PyObject *stroke)
+{
+    wide_mask_t mask;
+
+    mask = wide_stroke_from_any(&self->helper, stroke);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return PyBool_FromLong(wide_stroke_is_number(&self->helper, mask));
+}
+
+#define WIDE_STROKE_CMP_FN(FnName, Op) \
+    static PyObject *WideStrokeHelper_##FnName(WideStrokeHelper *self, PyObject *args) \
+    { \
+        wide_mask_t m1, m2; \
+        if (!wide_unpack_2_strokes(&self->helper, args, #FnName, &m1, &m2)) \
+            return NULL; \
+        return cmp_result(wide_compare(m1, m2), Op); \
+    }
+
+WIDE_STROKE_CMP_FN(stroke_cmp, CMP_OP_CMP);
+WIDE_STROKE_CMP_FN(stroke_eq, CMP_OP_EQ);
+WIDE_STROKE_CMP_FN(stroke_ne, CMP_OP_NE);
+WIDE_STROKE_CMP_FN(stroke_ge, CMP_OP_GE);
+WIDE_STROKE_CMP_FN(stroke_gt, CMP_OP_GT);
+WIDE_STROKE_CMP_FN(stroke_le, CMP_OP_LE);
+WIDE_STROKE_CMP_FN(stroke_lt, CMP_OP_LT);
+
+#undef WIDE_STROKE_CMP_FN
+
+static PyObject *WideStrokeHelper_stroke_in(WideStrokeHelper *self, PyObject *args)
+{
+    wide_mask_t m1, m2;
+
+    if (!wide_unpack_2_strokes(&self->helper, args, "stroke_in", &m1, &m2))
+        return NULL;
+
+    return PyBool_FromLong(wide_eq(wide_and(m1, m2), m1));
+}
+
+static PyObject *WideStrokeHelper_stroke_or(WideStrokeHelper *self, PyObject *args)
+{
+    wide_mask_t m1, m2;
+
+    if (!wide_unpack_2_strokes(&self->helper, args, "stroke_or", &m1, &m2))
+        return NULL;
+
+    return wide_to_int(wide_or(m1, m2));
+}
+
+static PyObject *WideStrokeHelper_stroke_and(WideStrokeHelper *self, PyObject *args)
+{
+    wide_mask_t m1, m2;
+
+    if (!wide_unpack_2_strokes(&self->helper, args, "stroke_and", &m1, &m2))
+        return NULL;
+
+    return wide_to_int(wide_and(m1, m2));
+}
+
+static PyObject *WideStrokeHelper_stroke_add(WideStrokeHelper *self, PyObject *args)
+{
+    wide_mask_t m1, m2;
+
+    if (!wide_unpack_2_strokes(&self->helper, args, "stroke_add", &m1, &m2))
+        return NULL;
+
+    return wide_to_int(wide_or(m1, m2));
+}
+
+static PyObject *WideStrokeHelper_stroke_sub(WideStrokeHelper *self, PyObject *args)
+{
+    wide_mask_t m1, m2;
+
+    if (!wide_unpack_2_strokes(&self->helper, args, "stroke_sub", &m1, &m2))
+        return NULL;
+
+    return wide_to_int(wide_and_not(m1, m2));
+}
+
+// Note: an empty stroke sorts before the first key (like with `lsb` / `msb`).
+static PyObject *WideStrokeHelper_stroke_is_prefix(WideStrokeHelper *self, PyObject *args)
+{
+    wide_mask_t m1, m2;
+
+    if (!wide_unpack_2_strokes(&self->helper, args, "stroke_is_prefix", &m1, &m2))
+        return NULL;
+
+    return PyBool_FromLong(wide_last_key(m1) < wide_first_key(m2));
+}
+
+static PyObject *WideStrokeHelper_stroke_is_suffix(WideStrokeHelper *self, PyObject *args)
+{
+    wide_mask_t m1, m2;
+
+    if (!wide_unpack_2_strokes(&self->helper, args, "stroke_is_suffix", &m1, &m2))
+        return NULL;
+
+    return PyBool_FromLong(wide_first_key(m1) > wide_last_key(m2));
+}
+
+// Return a new helper object, with a copy of the compiled helper.
+static PyObject *WideStrokeHelper_copy(WideStrokeHelper *self, PyObject *Py_UNUSED(ignored))
+{
+    WideStrokeHelper *copy;
+
+    copy = (WideStrokeHelper *)PyObject_CallObject((PyObject *)Py_TYPE(self), NULL);
+    if (copy == NULL)
+        return NULL;
+
+    copy->helper = self->helper;
+    for (unsigned k = 0; k < copy->helper.num_keys; ++k)
+    {
+        Py_INCREF(copy->helper.key_str[0][k]);
+        Py_INCREF(copy->helper.key_str[1][k]);
+    }
+
+    return (PyObject *)copy;
+}
+
+static PyObject *WideStrokeHelper_reduce(WideStrokeHelper *self, PyObject *Py_UNUSED(ignored))
+{
+    PyObject *state;
+
+    if (!self->helper.num_keys)
+        return Py_BuildValue("(O())", Py_TYPE(self));
+
+    state = Py_BuildValue("{sNsNsNsNsN}",
+                          "keys", WideStrokeHelper_get_keys(self, NULL),
+                          "implicit_hyphen_keys", WideStrokeHelper_get_implicit_hyphen_keys(self, NULL),
+                          "number_key", WideStrokeHelper_get_number_key(self, NULL),
+                          "numbers", WideStrokeHelper_get_numbers(self, NULL),
+                          "feral_number_key", WideStrokeHelper_get_feral_number_key(self, NULL));
+    if (state == NULL)
+        return NULL;
+
+    return Py_BuildValue("(O()N)", Py_TYPE(self), state);
+}
+
+static PyObject *WideStrokeHelper_setstate(WideStrokeHelper *self, PyObject *state)
+{
+    PyObject *args;
+    PyObject *result;
+
+    if (!PyDict_Check(state))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a dictionary");
+        return NULL;
+    }
+
+    args = PyTuple_New(0);
+    if (args == NULL)
+        return NULL;
+
+    result = WideStrokeHelper_setup(self, args, state);
+    Py_DECREF(args);
+
+    return result;
+}
+
+static PyGetSetDef WideStrokeHelper_getset[] =
+{
+    // For getting back the arguments passed to setup.
+    {"keys", (getter)WideStrokeHelper_get_keys, NULL, "List of supported keys.", NULL},
+    {"implicit_hyphen_keys", (getter)WideStrokeHelper_get_implicit_hyphen_keys, NULL, "Set of implicit hyphen keys.", NULL},
+    {"number_key", (getter)WideStrokeHelper_get_number_key, NULL, "Number key.", NULL},
+    {"numbers", (getter)WideStrokeHelper_get_numbers, NULL, "Mapping of key to number.", NULL},
+    {"feral_number_key", (getter)WideStrokeHelper_get_feral_number_key, NULL, "Is the number key feral?", NULL},
+    // Other derived fields.
+    {"key_letter", (getter)WideStrokeHelper_get_key_letter, NULL, "Letters for the supported keys.", NULL},
+    {"key_number", (getter)WideStrokeHelper_get_key_number, NULL, "Numbers for the supported keys.", NULL},
+    {"feral_number_key_letter", (getter)WideStrokeHelper_get_feral_number_key_letter, NULL, "Letter for the feral number key.", NULL},
+    {"num_keys", (getter)WideStrokeHelper_get_num_keys, NULL, "Number of keys.", NULL},
+    {"implicit_hyphen_mask", (getter)WideStrokeHelper_get_implicit_hyphen_mask, NULL, "Implicit hyphen mask.", NULL},
+    {"number_key_mask", (getter)WideStrokeHelper_get_number_key_mask, NULL, "Number key mask.", NULL},
+    {"numbers_mask", (getter)WideStrokeHelper_get_numbers_mask, NULL, "Numbers mask.", NULL},
+    {"right_keys_index", (getter)WideStrokeHelper_get_right_keys_index, NULL, "Right keys index.", NULL},
+    {NULL}
+};
+
+static PyMethodDef WideStrokeHelper_methods[] =
+{
+    {"setup"             , (PyCFunction)WideStrokeHelper_setup             , METH_VARARGS | METH_KEYWORDS, "Setup."},
+    // Pickle.
+    {"__reduce__"        , (PyCFunction)WideStrokeHelper_reduce            , METH_NOARGS, NULL},
+    {"__setstate__"      , (PyCFunction)WideStrokeHelper_setstate          , METH_O, NULL},
+    {"copy"              , (PyCFunction)WideStrokeHelper_copy              , METH_NOARGS, "Return a new helper, with a copy of the compiled system."},
+    // Stroke: new.
+    {"stroke_from_any"   , (PyCFunction)WideStrokeHelper_stroke_from_any   , METH_O, "Convert an integer (keys mask), string (steno), or sequence of keys to a stroke."},
+    {"stroke_from_int"   , (PyCFunction)WideStrokeHelper_stroke_from_int   , METH_O, "Convert an integer (keys mask) to a stroke."},
+    {"stroke_from_keys"  , (PyCFunction)WideStrokeHelper_stroke_from_keys  , METH_O, "Convert keys to a stroke."},
+    {"stroke_from_steno" , (PyCFunction)WideStrokeHelper_stroke_from_steno , METH_O, "Convert steno to a stroke."},
+    // Stroke: methods.
+    {"stroke_first_key"  , (PyCFunction)WideStrokeHelper_stroke_first_key  , METH_O, "Return the stroke first key."},
+    {"stroke_last_key"   , (PyCFunction)WideStrokeHelper_stroke_last_key   , METH_O, "Return the stroke last key."},
+    {"stroke_invert"     , (PyCFunction)WideStrokeHelper_stroke_invert     , METH_O, "Invert stroke."},
+    {"stroke_len"        , (PyCFunction)WideStrokeHelper_stroke_len        , METH_O, "Return the stroke number of keys."},
+    {"stroke_has_digit"  , (PyCFunction)WideStrokeHelper_stroke_has_digit  , METH_O, "Return True if the stroke contains one or more digits."},
+    {"stroke_is_number"  , (PyCFunction)WideStrokeHelper_stroke_is_number  , METH_O, "Return True if the stroke is a number."},
+    // Stroke: ops.
+    {"stroke_cmp"        , (PyCFunction)WideStrokeHelper_stroke_cmp        , METH_VARARGS, "Compare strokes."},
+    {"stroke_eq"         , (PyCFunction)WideStrokeHelper_stroke_eq         , METH_VARARGS, "Compare strokes: `s1 == s2`."},
+    {"stroke_ne"         , (PyCFunction)WideStrokeHelper_stroke_ne         , METH_VARARGS, "Compare strokes: `s1 != s2`."},
+    {"stroke_ge"         , (PyCFunction)WideStrokeHelper_stroke_ge         , METH_VARARGS, "Compare strokes: `s1 >= s2`."},
+    {"stroke_gt"         , (PyCFunction)WideStrokeHelper_stroke_gt         , METH_VARARGS, "Compare strokes: `s1 > s2`."},
+    {"stroke_le"         , (PyCFunction)WideStrokeHelper_stroke_le         , METH_VARARGS, "Compare strokes: `s1 <= s2`."},
+    {"stroke_lt"         , (PyCFunction)WideStrokeHelper_stroke_lt         , METH_VARARGS, "Compare strokes: `s1 < s2`."},
+    {"stroke_in"         , (PyCFunction)WideStrokeHelper_stroke_in         , METH_VARARGS, "`s1 in s2."},
+    {"stroke_or"         , (PyCFunction)WideStrokeHelper_stroke_or         , METH_VARARGS, "`s1 | s2."},
+    {"stroke_and"        , (PyCFunction)WideStrokeHelper_stroke_and        , METH_VARARGS, "`s1 & s2."},
+    {"stroke_add"        , (PyCFunction)WideStrokeHelper_stroke_add        , METH_VARARGS, "`s1 + s2."},
+    {"stroke_sub"        , (PyCFunction)WideStrokeHelper_stroke_sub        , METH_VARARGS, "`s1 - s2."},
+    {"stroke_is_prefix"  , (PyCFunction)WideStrokeHelper_stroke_is_prefix  , METH_VARARGS, "Check if `s1` is a prefix of `s2`."},
+    {"stroke_is_suffix"  , (PyCFunction)WideStrokeHelper_stroke_is_suffix  , METH_VARARGS, "Check if `s1` is a suffix of `s2`."},
+    // Stroke: convert.
+    {"stroke_to_keys"    , (PyCFunction)WideStrokeHelper_stroke_to_keys    , METH_O, "Convert stroke to a tuple of keys."},
+    {"stroke_to_steno"   , (PyCFunction)WideStrokeHelper_stroke_to_steno   , METH_O, "Convert stroke to steno."},
+    {"stroke_to_order_key", (PyCFunction)WideStrokeHelper_stroke_to_order_key, METH_O, "Convert stroke to an integer, whose natural order matches the steno order."},
+    {NULL}
+};
+
+static void WideStrokeHelper_dealloc(WideStrokeHelper *self)
+{
+    wide_stroke_helper_clear(&self->helper);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyTypeObject WideStrokeHelperType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name      = "_plover_stroke.WideStrokeHelper",
+    .tp_basicsize = sizeof (WideStrokeHelper),
+    .tp_itemsize  = 0,
+    .tp_flags     = Py_TPFLAGS_DEFAULT,
+    .tp_doc       = "Helper for systems with more than 63 keys (up to 127), using 128 bits masks.",
+    .tp_new       = PyType_GenericNew,
+    .tp_dealloc   = (destructor)WideStrokeHelper_dealloc,
+    .tp_methods   = WideStrokeHelper_methods,
+    .tp_getset    = WideStrokeHelper_getset,
+};
+
+static PyTypeObject BaseStrokeType;
+
+static PyObject *str__helper;
+static PyObject *str__instances;
+static PyObject *str__instances_max_keys;
+
+// Return the helper (new reference) of a stroke class.
+//
+// Note: this can be a `WideStrokeHelper` (check with `helper_is_wide`),
+// in which case the stroke methods use the wide masks code paths.
+static StrokeHelper *type_helper(PyTypeObject *type)
+{
+    PyObject *helper;
+
+    helper = PyObject_GetAttr((PyObject *)type, str__helper);
+    if (helper == NULL)
+        return NULL;
+
+    if (!PyObject_TypeCheck(helper, &StrokeHelperType) &&
+        Py_TYPE(helper) != &WideStrokeHelperType)
+    {
+        PyErr_Format(PyExc_TypeError, "%s has not been setup", type->tp_name);
+        Py_DECREF(helper);
+        return NULL;
+    }
+
+    return (StrokeHelper *)helper;
+}
+
+static StrokeHelper *stroke_class_helper(PyObject *stroke)
+{
+    return type_helper(Py_TYPE(stroke));
+}
+
+#define helper_is_wide(helper) (Py_TYPE(helper) == &WideStrokeHelperType)
+#define WIDE_HELPER(helper)    (&((WideStrokeHelper *)(helper))->helper)
+
+// Return an instance of a stroke class from a (valid) mask
+// `value` (with `num_keys` keys).
+//
+// If the class has an instances cache (`_instances` dictionary),
+// strokes with up to `_instances_max_keys` keys are shared.
+static PyObject *stroke_new_from_value(PyTypeObject *type, PyObject *value, unsigned num_keys)
+{
+    PyObject *instances;
+    PyObject *args;
+    PyObject *stroke;
+    PyObject *max_keys;
+    long      max_keys_value;
+
+    stroke = NULL;
+    args = NULL;
+
+    instances = PyObject_GetAttr((PyObject *)type, str__instances);
+    if (instances == NULL)
+        return NULL;
+
+    if (PyDict_CheckExact(instances))
+    {
+        stroke = PyDict_GetItemWithError(instances, value);
+        if (stroke != NULL)
+        {
+            // Note: the dictionary could be inherited from a parent class.
+            if (Py_TYPE(stroke) == type)
+            {
+                Py_INCREF(stroke);
+                goto end;
+            }
+            stroke = NULL;
+        }
+        else if (PyErr_Occurred())
+            goto end;
+    }
+
+    args = PyTuple_Pack(1, value);
+    if (args == NULL)
+        goto end;
+
+    stroke = PyLong_Type.tp_new(type, args, NULL);
+    // Note: only update the class own cache.
+    if (stroke == NULL || !PyDict_CheckExact(instances) ||
+        PyDict_GetItemWithError(type->tp_dict, str__instances) != instances)
+        goto end;
+
+    max_keys = PyObject_GetAttr((PyObject *)type, str__instances_max_keys);
+    if (max_keys == NULL)
+        goto error;
+    max_keys_value = PyLong_AsLong(max_keys);
+    Py_DECREF(max_keys);
+    if (max_keys_value == -1 && PyErr_Occurred())
+        goto error;
+
+    if (num_keys <= max_keys_value && PyDict_SetItem(instances, value, stroke))
+        goto error;
+
+    goto end;
+
+error:
+    Py_CLEAR(stroke);
+end:
+    Py_XDECREF(args);
+    Py_DECREF(instances);
+    return stroke;
+}
+
+static PyObject *stroke_new(PyTypeObject *type, stroke_uint_t mask)
+{
+    PyObject *value;
+    PyObject *stroke;
+
+    value = PyLong_FromStrokeUint(mask);
+    if (value == NULL)
+        return NULL;
+
+    stroke = stroke_new_from_value(type, value, popcount(mask));
+    Py_DECREF(value);
+
+    return stroke;
+}
+
+static PyObject *wide_stroke_new(PyTypeObject *type, wide_mask_t mask)
+{
+    PyObject *value;
+    PyObject *stroke;
+
+    value = wide_to_int(mask);
+    if (value == NULL)
+        return NULL;
+
+    stroke = stroke_new_from_value(type, value, wide_popcount(mask));
+    Py_DECREF(value);
+
+    return stroke;
+}
+
+// Wide masks variant of the `BaseStroke` constructors: parse `obj`
+// with `parse`, release the helper, and return a new stroke.
+static PyObject *wide_stroke_create(PyTypeObject  *type,
+                                    StrokeHelper  *helper,
+                                    PyObject      *obj,
+                                    wide_mask_t  (*parse)(const wide_helper_t *, PyObject *))
+{
+    wide_mask_t mask;
+
+    mask = parse(WIDE_HELPER(helper), obj);
+    Py_DECREF(helper);
+    if (wide_is_invalid(mask))
+        return NULL;
+
+    return wide_stroke_new(type, mask);
+}
+
+// Parse 2 strokes with a wide helper (released).
+static int wide_unpack_2_objs(StrokeHelper *helper, PyObject *s1, PyObject *s2,
+                              wide_mask_t *mask1, wide_mask_t *mask2)
+{
+    *mask1 = wide_stroke_from_any(WIDE_HELPER(helper), s1);
+    *mask2 = wide_is_invalid(*mask1) ? WIDE_INVALID_STROKE : wide_stroke_from_any(WIDE_HELPER(helper), s2);
+    Py_DECREF(helper);
+
+    return !wide_is_invalid(*mask2);
+}
+
+static PyObject *BaseStroke_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"value", NULL};
+
+    PyObject      *value;
+    StrokeHelper  *helper;
+    stroke_uint_t  mask;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O", kwlist, &value))
+        return NULL;
+
+    helper = type_helper(type);
+    if (helper == NULL)
+        return NULL;
+
+    if (helper_is_wide(helper))
+        return wide_stroke_create(type, helper, value, wide_stroke_from_any);
+
+    mask = helper_stroke_from_any(helper, value);
+    Py_DECREF(helper);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return stroke_new(type, mask);
+}
+
+static PyObject *BaseStroke_from_steno(PyTypeObject *type, PyObject *steno)
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask;
+
+    if (!PyUnicode_Check(steno))
+    {
+        PyErr_SetString(PyExc_TypeError, "expected a string");
+        return NULL;
+    }
+
+    helper = type_helper(type);
+    if (helper == NULL)
+        return NULL;
+
+    if (helper_is_wide(helper))
+        return wide_stroke_create(type, helper, steno, wide_stroke_from_steno);
+
+    mask = helper_stroke_from_steno(helper, steno);
+    Py_DECREF(helper);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return stroke_new(type, mask);
+}
+
+static PyObject *BaseStroke_from_keys(PyTypeObject *type, PyObject *keys_sequence)
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask;
+    PyObject      *stroke;
+
+    keys_sequence = PySequence_Fast(keys_sequence, "expected a list or tuple");
+    if (keys_sequence == NULL)
+        return NULL;
+
+    helper = type_helper(type);
+    if (helper == NULL)
+    {
+        Py_DECREF(keys_sequence);
+        return NULL;
+    }
+
+    if (helper_is_wide(helper))
+    {
+        stroke = wide_stroke_create(type, helper, keys_sequence, wide_stroke_from_keys);
+        Py_DECREF(keys_sequence);
+        return stroke;
+    }
+
+    mask = helper_stroke_from_keys(helper, keys_sequence);
+    Py_DECREF(helper);
+    Py_DECREF(keys_sequence);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return stroke_new(type, mask);
+}
+
+static PyObject *BaseStroke_from_integer(PyTypeObject *type, PyObject *integer)
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask;
+
+    helper = type_helper(type);
+    if (helper == NULL)
+        return NULL;
+
+    if (helper_is_wide(helper))
+        return wide_stroke_create(type, helper, integer, wide_stroke_from_int);
+
+    mask = stroke_from_int(helper->helper, integer);
+    Py_DECREF(helper);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return stroke_new(type, mask);
+}
+
+static PyObject *BaseStroke_richcompare(PyObject *self, PyObject *other, int op)
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask1, mask2;
+    wide_mask_t    wide_mask1, wide_mask2;
+    cmp_op_t       cmp_op;
+
+    switch (op)
+    {
+    case Py_LT:
+        cmp_op = CMP_OP_LT;
+        break;
+    case Py_LE:
+        cmp_op = CMP_OP_LE;
+        break;
+    case Py_EQ:
+        cmp_op = CMP_OP_EQ;
+        break;
+    case Py_NE:
+        cmp_op = CMP_OP_NE;
+        break;
+    case Py_GT:
+        cmp_op = CMP_OP_GT;
+        break;
+    case Py_GE:
+        cmp_op = CMP_OP_GE;
+        break;
+    default:
+        UNREACHABLE();
+    }
+
+    helper = stroke_class_helper(self);
+    if (helper == NULL)
+        return NULL;
+
+    if (helper_is_wide(helper))
+    {
+        if (!wide_unpack_2_objs(helper, self, other, &wide_mask1, &wide_mask2))
+            return NULL;
+        return cmp_result(wide_compare(wide_mask1, wide_mask2), cmp_op);
+    }
+
+    mask1 = helper_stroke_from_any(helper, self);
+    mask2 = mask1 == INVALID_STROKE ? INVALID_STROKE : helper_stroke_from_any(helper, other);
+    Py_DECREF(helper);
+    if (mask2 == INVALID_STROKE)
+        return NULL;
+
+    return cmp_result(stroke_compare(mask1, mask2), cmp_op);
+}
+
+static Py_hash_t BaseStroke_hash(PyObject *self)
+{
+    // Same as `hash(int(self))`.
+    return PyLong_Type.tp_hash(self);
+}
+
+typedef enum
+{
+    BINARY_OP_OR,
+    BINARY_OP_AND,
+    BINARY_OP_SUB,
+
+} binary_op_t;
+
+static PyObject *wide_stroke_binary_op(PyObject *self, StrokeHelper *helper,
+                                       PyObject *s1, PyObject *s2, binary_op_t op)
+{
+    wide_mask_t mask1, mask2;
+
+    if (!wide_unpack_2_objs(helper, s1, s2, &mask1, &mask2))
+        return NULL;
+
+    switch (op)
+    {
+    case BINARY_OP_OR:
+        mask1 = wide_or(mask1, mask2);
+        break;
+    case BINARY_OP_AND:
+        mask1 = wide_and(mask1, mask2);
+        break;
+    case BINARY_OP_SUB:
+        mask1 = wide_and_not(mask1, mask2);
+        break;
+    default:
+        UNREACHABLE();
+    }
+
+    return wide_stroke_new(Py_TYPE(self), mask1);
+}
+
+static PyObject *stroke_binary_op(PyObject *s1, PyObject *s2, binary_op_t op)
+{
+    PyObject      *self;
+    StrokeHelper  *helper;
+    stroke_uint_t  mask1, mask2;
+
+    // Note: one of the 2 operands may not be a stroke
+    // (e.g. `'S' | stroke`), use the other's class.
+    self = PyObject_TypeCheck(s1, &BaseStrokeType) ? s1 : s2;
+
+    helper = stroke_class_helper(self);
+    if (helper == NULL)
+        return NULL;
+
+    if (helper_is_wide(helper))
+        return wide_stroke_binary_op(self, helper, s1, s2, op);
+
+    mask1 = helper_stroke_from_any(helper, s1);
+    mask2 = mask1 == INVALID_STROKE ? INVALID_STROKE : helper_stroke_from_any(helper, s2);
+    Py_DECREF(helper);
+    if (mask2 == INVALID_STROKE)
+        return NULL;
+
+    switch (op)
+    {
+    case BINARY_OP_OR:
+        mask1 |= mask2;
+        break;
+    case BINARY_OP_AND:
+        mask1 &= mask2;
+        break;
+    case BINARY_OP_SUB:
+        mask1 &= ~mask2;
+        break;
+    default:
+        UNREACHABLE();
+    }
+
+    return stroke_new(Py_TYPE(self), mask1);
+}
+
+static PyObject *BaseStroke_or(PyObject *s1, PyObject *s2)
+{
+    return stroke_binary_op(s1, s2, BINARY_OP_OR);
+}
+
+static PyObject *BaseStroke_and(PyObject *s1, PyObject *s2)
+{
+    return stroke_binary_op(s1, s2, BINARY_OP_AND);
+}
+
+static PyObject *BaseStroke_sub(PyObject *s1, PyObject *s2)
+{
+    return stroke_binary_op(s1, s2, BINARY_OP_SUB);
+}
+
+static PyObject *BaseStroke_invert(PyObject *self)
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask;
+    wide_mask_t    wide_mask;
+
+    helper = stroke_class_helper(self);
+    if (helper == NULL)
+        return NULL;
+
+    if (helper_is_wide(helper))
+    {
+        wide_mask = wide_stroke_from_any(WIDE_HELPER(helper), self);
+        if (!wide_is_invalid(wide_mask))
+            wide_mask = wide_and_not(wide_keys_mask(WIDE_HELPER(helper)->num_keys), wide_mask);
+        Py_DECREF(helper);
+        return wide_is_invalid(wide_mask) ? NULL : wide_stroke_new(Py_TYPE(self), wide_mask);
+    }
+
+    mask = helper_stroke_from_any(helper, self);
+    if (mask != INVALID_STROKE)
+        mask = ~mask & ((STROKE_1 << helper->helper->num_keys) - 1);
+    Py_DECREF(helper);
+    if (mask == INVALID_STROKE)
+        return NULL;
+
+    return stroke_new(Py_TYPE(self), mask);
+}
+
+static Py_ssize_t BaseStroke_length(PyObject *self)
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask;
+    wide_mask_t    wide_mask;
+
+    helper = stroke_class_helper(self);
+    if (helper == NULL)
+        return -1;
+
+    if (helper_is_wide(helper))
+    {
+        wide_mask = wide_stroke_from_any(WIDE_HELPER(helper), self);
+        Py_DECREF(helper);
+        return wide_is_invalid(wide_mask) ? -1 : (Py_ssize_t)wide_popcount(wide_mask);
+    }
+
+    mask = helper_stroke_from_any(helper, self);
+    Py_DECREF(helper);
+    if (mask == INVALID_STROKE)
+        return -1;
+
+    return popcount(mask);
+}
+
+static int BaseStroke_contains(PyObject *self, PyObject *other)
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask1, mask2;
+    wide_mask_t    wide_mask1, wide_mask2;
+
+    helper = stroke_class_helper(self);
+    if (helper == NULL)
+        return -1;
+
+    if (helper_is_wide(helper))
+    {
+        if (!wide_unpack_2_objs(helper, other, self, &wide_mask1, &wide_mask2))
+            return -1;
+        return wide_eq(wide_and(wide_mask1, wide_mask2), wide_mask1);
+    }
+
+    mask1 = helper_stroke_from_any(helper, other);
+    mask2 = mask1 == INVALID_STROKE ? INVALID_STROKE : helper_stroke_from_any(helper, self);
+    Py_DECREF(helper);
+    if (mask2 == INVALID_STROKE)
+        return -1;
+
+    return (mask1 & mask2) == mask1;
+}
+
+static PyObject *BaseStroke_iter(PyObject *self)
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask;
+    wide_mask_t    wide_mask;
+    PyObject      *keys;
+    PyObject      *iterator;
+
+    helper = stroke_class_helper(self);
+    if (helper == NULL)
+        return NULL;
+
+    if (helper_is_wide(helper))
+    {
+        wide_mask = wide_stroke_from_any(WIDE_HELPER(helper), self);
+        keys = wide_is_invalid(wide_mask) ? NULL : wide_stroke_to_keys(WIDE_HELPER(helper), wide_mask);
+    }
+    else
+    {
+        mask = helper_stroke_from_any(helper, self);
+        keys = mask == INVALID_STROKE ? NULL : helper_stroke_to_keys(helper, mask);
+    }
+    Py_DECREF(helper);
+    if (keys == NULL)
+        return NULL;
+
+    iterator = PyObject_GetIter(keys);
+    Py_DECREF(keys);
+
+    return iterator;
+}
+
+static PyObject *BaseStroke_str(PyObject *self)
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask;
+    wide_mask_t    wide_mask;
+    PyObject      *steno;
+
+    helper = stroke_class_helper(self);
+    if (helper == NULL)
+        return NULL;
+
+    if (helper_is_wide(helper))
+    {
+        wide_mask = wide_stroke_from_any(WIDE_HELPER(helper), self);
+        steno = wide_is_invalid(wide_mask) ? NULL : wide_stroke_to_str(WIDE_HELPER(helper), wide_mask);
+    }
+    else
+    {
+        mask = helper_stroke_from_any(helper, self);
+        steno = mask == INVALID_STROKE ? NULL : helper_stroke_to_str(helper, mask);
+    }
+    Py_DECREF(helper);
+
+    return steno;
+}
+
+static PyObject *BaseStroke_order_key(PyObject *self, PyObject *Py_UNUSED(ignored))
+{
+    StrokeHelper  *helper;
+    stroke_uint_t  mask;
+    wide_mask_t    wide_mask;
+
+    helper = stroke_class_helper(self);
+    if (helper == NULL)
+        return NULL;
+
+    if (helper_is_wide(helper))
+    {
+        wide_mask = wide_stroke_from_int(WIDE_HELPER(helper), self);
+        Py_DECREF(helper);
+        return wide_is_invalid(wide_mask) ? NULL : wide_to_int(wide_to_order_key(wide_mask));
+    }
+    Py_DECREF(helper);
+
+    // Note: no need for the helper checks, the keys mask was validated on creation.
+    mask = PyLong_AsStrokeUint(self);
+    if (mask == INVALID_STROKE && PyErr_Occurred())
+        return NULL;
+
+    return PyLong_FromStrokeUint(stroke_to_order_key(mask));
+}
+
+static PyNumberMethods BaseStroke_as_number =
+{
+    .nb_add      = BaseStroke_or,
+    .nb_subtract = BaseStroke_sub,
+    .nb_invert   = BaseStroke_invert,
+    .nb_and      = BaseStroke_and,
+    .nb_or       = BaseStroke_or,
+};
+
+static PySequenceMethods BaseStroke_as_sequence =
+{
+    .sq_length   = BaseStroke_length,
+    .sq_contains = BaseStroke_contains,
+};
+
+static PyMethodDef BaseStroke_methods[] =
+{
+    {"from_steno"  , (PyCFunction)BaseStroke_from_steno  , METH_O | METH_CLASS, "Create a stroke from steno."},
+    {"from_keys"   , (PyCFunction)BaseStroke_from_keys   , METH_O | METH_CLASS, "Create a stroke from a sequence of keys."},
+    {"from_integer", (PyCFunction)BaseStroke_from_integer, METH_O | METH_CLASS, "Create a stroke from an integer (keys mask)."},
+    {"order_key"   , (PyCFunction)BaseStroke_order_key   , METH_NOARGS, "Return an integer whose natural order matches the steno order (e.g. for `sorted(strokes, key=Stroke.order_key)`)."},
+    {NULL}
+};
+
+static PyTypeObject BaseStrokeType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name        = "_plover_stroke.BaseStroke",
+    .tp_flags       = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
+    .tp_doc         = "Base stroke type: an integer (keys mask) with steno aware operators.",
+    .tp_new         = BaseStroke_new,
+    .tp_methods     = BaseStroke_methods,
+    .tp_richcompare = BaseStroke_richcompare,
+    .tp_hash        = BaseStroke_hash,
+    .tp_as_number   = &BaseStroke_as_number,
+    .tp_as_sequence = &BaseStroke_as_sequence,
+    .tp_iter        = BaseStroke_iter,
+    .tp_repr        = BaseStroke_str,
+    .tp_str         = BaseStroke_str,
+};
+
+static PyObject *Outline_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "strokes", NULL };
+    PyObject      *strokes;
+    Py_ssize_t     num_strokes;
+    Outline       *outline;
+
+    strokes = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O", kwlist, &strokes))
+        return NULL;
+
+    if (strokes == NULL)
+        return outline_new(NULL, 0);
+
+    if (Py_TYPE(strokes) == &OutlineType)
+    {
+        Py_INCREF(strokes);
+        return strokes;
+    }
+
+    strokes = PySequence_Fast(strokes, "expected a sequence of strokes");
+    if (strokes == NULL)
+        return NULL;
+
+    num_strokes = PySequence_Fast_GET_SIZE(strokes);
+
+    outline = PyObject_NewVar(Outline, &OutlineType, num_strokes);
+    if (outline == NULL)
+        goto error;
+
+    for (Py_ssize_t n = 0; n < num_strokes; ++n)
+    {
+        outline->strokes[n] = outline_mask_from_obj(PySequence_Fast_GET_ITEM(strokes, n));
+        if (outline->strokes[n] == INVALID_STROKE)
+            goto error;
+    }
+    outline->hash = outline_hash(outline->strokes, num_strokes);
+
+    Py_DECREF(strokes);
+    return (PyObject *)outline;
+
+error:
+    Py_XDECREF(outline);
+    Py_DECREF(strokes);
+    return NULL;
+}
+
+static Py_ssize_t Outline_length(Outline *self)
+{
+    return Py_SIZE(self);
+}
+
+static PyObject *Outline_item(Outline *self, Py_ssize_t index)
+{
+    if (index < 0 || index >= Py_SIZE(self))
+    {
+        PyErr_SetString(PyExc_IndexError, "outline index out of range");
+        return NULL;
+    }
+
+    return PyLong_FromStrokeUint(self->strokes[index]);
+}
+
+static int Outline_contains(Outline *self, PyObject *stroke)
+{
+    stroke_uint_t mask;
+
+    if (!PyLong_Check(stroke))
+        return 0;
+
+    mask = PyLong_AsStrokeUint(stroke);
+    if (mask == INVALID_STROKE && PyErr_Occurred())
+    {
+        // Negative or too big: can't be in the outline.
+        PyErr_Clear();
+        return 0;
+    }
+
+    for (Py_ssize_t n = 0; n < Py_SIZE(self); ++n)
+        if (self->strokes[n] == mask)
+            return 1;
+
+    return 0;
+}
+
+static PyObject *Outline_subscript(Outline *self, PyObject *item)
+{
+    Py_ssize_t start, stop, step, length;
+    Outline   *outline;
+
+    if (PyIndex_Check(item))
+    {
+        Py_ssize_t index = PyNumber_AsSsize_t(item, PyExc_IndexError);
+        if (index == -1 && PyErr_Occurred())
+            return NULL;
+        if (index < 0)
+            index += Py_SIZE(self);
+        return Outline_item(self, index);
+    }
+
+    if (!PySlice_Check(item))
+    {
+        PyErr_Format(PyExc_TypeError, "outline indices must be integers or slices, not %.200s",
+                     Py_TYPE(item)->tp_name);
+        return NULL;
+    }
+
+    if (PySlice_Unpack(item, &start, &stop, &step) < 0)
+        return NULL;
+    length = PySlice_AdjustIndices(Py_SIZE(self), &start, &stop, step);
+
+    if (step == 1)
+    {
+        if (length == Py_SIZE(self))
+        {
+            Py_INCREF(self);
+            return (PyObject *)self;
+        }
+        return outline_new(&self->strokes[start], length);
+    }
+
+    outline = PyObject_NewVar(Outline, &OutlineType, length);
+    if (outline == NULL)
+        return NULL;
+
+    for (Py_ssize_t n = 0; n < length; ++n, start += step)
+        outline->strokes[n] = self->strokes[start];
+    outline->hash = outline_hash(outline->strokes, length);
+
+    return (PyObject *)outline;
+}
+
+static PyObject *Outline_richcompare(Outline *self, PyObject *other, int op)
+{
+    int eq;
+
+    if ((op != Py_EQ && op != Py_NE) || !PyObject_TypeCheck(other, &OutlineType))
+        Py_RETURN_NOTIMPLEMENTED;
+
+    eq = (
+        Py_SIZE(self) == Py_SIZE(other) &&
+        self->hash == ((Outline *)other)->hash &&
+        !memcmp(self->strokes, ((Outline *)other)->strokes,
+                Py_SIZE(self) * sizeof (*self->strokes))
+    );
+
+    return PyBool_FromLong(op == Py_EQ ? eq : !eq);
+}
+
+static Py_hash_t Outline_hash(Outline *self)
+{
+    return self->hash;
+}
+
+static PyObject *Outline_masks(Outline *self)
+{
+    PyObject *masks;
+
+    masks = PyTuple_New(Py_SIZE(self));
+    if (masks == NULL)
+        return NULL;
+
+    for (Py_ssize_t n = 0; n < Py_SIZE(self); ++n)
+    {
+        PyObject *mask = PyLong_FromStrokeUint(self->strokes[n]);
+        if (mask == NULL)
+        {
+            Py_DECREF(masks);
+            return NULL;
+        }
+        PyTuple_SET_ITEM(masks, n, mask);
+    }
+
+    return masks;
+}
+
+static PyObject *Outline_repr(Outline *self)
+{
+    PyObject *masks;
+    PyObject *repr;
+
+    masks = Outline_masks(self);
+    if (masks == NULL)
+        return NULL;
+
+    repr = PyUnicode_FromFormat("Outline(%R)", masks);
+    Py_DECREF(masks);
+
+    return repr;
+}
+
+static PyObject *Outline_reduce(Outline *self, PyObject *Py_UNUSED(ignored))
+{
+    PyObject *masks;
+    PyObject *result;
+
+    masks = Outline_masks(self);
+    if (masks == NULL)
+        return NULL;
+
+    result = Py_BuildValue("O(N)", Py_TYPE(self), masks);
+
+    return result;
+}
+
+// Read-only buffer of unsigned 64 bits integers.
+static int Outline_getbuffer(Outline *self, Py_buffer *view, int flags)
+{
+    if ((flags & PyBUF_WRITABLE))
+    {
+        PyErr_SetString(PyExc_BufferError, "outlines are read-only");
+        view->obj = NULL;
+        return -1;
+    }
+
+    view->obj = (PyObject *)self;
+    Py_INCREF(self);
+    view->buf = self->strokes;
+    view->len = Py_SIZE(self) * sizeof (*self->strokes);
+    view->readonly = 1;
+    view->itemsize = sizeof (*self->strokes);
+    view->format = (flags & PyBUF_FORMAT) ? "Q" : NULL;
+    view->ndim = 1;
+    view->shape = (flags & PyBUF_ND) ? &((PyVarObject *)self)->ob_size : NULL;
+    view->strides = (flags & PyBUF_STRIDES) ? &view->itemsize : NULL;
+    view->suboffsets = NULL;
+    view->internal = NULL;
+
+    return 0;
+}
+
+static PyBufferProcs Outline_as_buffer =
+{
+    .bf_getbuffer = (getbufferproc)Outline_getbuffer,
+};
+
+static PySequenceMethods Outline_as_sequence =
+{
+    .sq_length   = (lenfunc)Outline_length,
+    .sq_item     = (ssizeargfunc)Outline_item,
+    .sq_contains = (objobjproc)Outline_contains,
+};
+
+static PyMappingMethods Outline_as_mapping =
+{
+    .mp_length    = (lenfunc)Outline_length,
+    .mp_subscript = (binaryfunc)Outline_subscript,
+};
+
+static PyMethodDef Outline_methods[] =
+{
+    {"masks"     , (PyCFunction)Outline_masks , METH_NOARGS, "Return the strokes (keys masks) as a tuple of integers."},
+    {"__reduce__", (PyCFunction)Outline_reduce, METH_NOARGS, NULL},
+    {NULL}
+};
+
+static PyTypeObject OutlineType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name        = "_plover_stroke.Outline",
+    .tp_basicsize   = offsetof(Outline, strokes),
+    .tp_itemsize    = sizeof (stroke_uint_t),
+    .tp_flags       = Py_TPFLAGS_DEFAULT,
+    .tp_doc         = "Immutable sequence of strokes (keys masks), usable as a dictionary key.",
+    .tp_new         = Outline_new,
+    .tp_methods     = Outline_methods,
+    .tp_richcompare = (richcmpfunc)Outline_richcompare,
+    .tp_hash        = (hashfunc)Outline_hash,
+    .tp_as_sequence = &Outline_as_sequence,
+    .tp_as_mapping  = &Outline_as_mapping,
+    .tp_as_buffer   = &Outline_as_buffer,
+    .tp_repr        = (reprfunc)Outline_repr,
+};
+
+#define NO_NODE  ((uint32_t)-1)
+
+typedef struct
+{
+    stroke_uint_t  mask;         // Stroke leading to this node.
+    uint32_t       parent;       // Parent node (or next free node).
+    uint32_t       num_children;
+    PyObject      *value;        // Value of the outline ending here, or NULL.
+
+} trie_node_t;
+
+// Trie of outlines:
+// - nodes are stored in an array (the root is at index 0), unused
+//   nodes are chained through their `parent` field in a free list
+// - edges are stored in a linear probing hash table, indexed by
+//   `(parent, mask)`, of child nodes indexes (0 for an empty slot)
+typedef struct
+{
+    PyObject_HEAD
+    trie_node_t   *nodes;
+    uint32_t       num_nodes;
+    uint32_t       max_nodes;
+    uint32_t       free_node;
+    uint32_t      *edges;
+    size_t         edges_mask;
+    size_t         num_edges;
+    Py_ssize_t     size;
+
+} OutlineTrie;
+
+static size_t trie_edge_home(const OutlineTrie *trie, uint32_t parent, stroke_uint_t mask)
+{
+    return (size_t)mask_hash(mask + parent * 0xff51afd7ed558ccdULL) & trie->edges_mask;
+}
+
+static uint32_t trie_find_child(const OutlineTrie *trie, uint32_t parent, stroke_uint_t mask)
+{
+    const trie_node_t *node;
+    uint32_t           index;
+
+    if (trie->edges == NULL)
+        return NO_NODE;
+
+    for (size_t slot = trie_edge_home(trie, parent, mask); ; slot = (slot + 1) & trie->edges_mask)
+    {
+        index = trie->edges[slot];
+        if (!index)
+            return NO_NODE;
+        node = &trie->nodes[index];
+        if (node->mask == mask && node->parent == parent)
+            return index;
+    }
+}
+
+static void trie_edge_insert(OutlineTrie *trie, uint32_t index)
+{
+    size_t slot;
+
+    slot = trie_edge_home(trie, trie->nodes[index].parent, trie->nodes[index].mask);
+    while (trie->edges[slot])
+        slot = (slot + 1) & trie->edges_mask;
+    trie->edges[slot] = index;
+}
+
+static int trie_edges_resize(OutlineTrie *trie, size_t capacity)
+{
+    uint32_t *old_edges;
+    size_t    old_capacity;
+
+    old_edges = trie->edges;
+    old_capacity = old_edges == NULL ? 0 : trie->edges_mask + 1;
+
+    trie->edges = PyMem_Calloc(capacity, sizeof (*trie->edges));
+    if (trie->edges == NULL)
+    {
+        trie->edges = old_edges;
+        PyErr_NoMemory();
+        return 0;
+    }
+    trie->edges_mask = capacity - 1;
+
+    for (size_t slot = 0; slot < old_capacity; ++slot)
+        if (old_edges[slot])
+            trie_edge_insert(trie, old_edges[slot]);
+
+    PyMem_Free(old_edges);
+
+    return 1;
+}
+
+static uint32_t trie_add_child(OutlineTrie *trie, uint32_t parent, stroke_uint_t mask)
+{
+    trie_node_t *nodes;
+    uint32_t     index;
+
+    if ((trie->num_edges + 1) * 2 > (trie->edges == NULL ? 0 : trie->edges_mask + 1))
+    {
+        if (!trie_edges_resize(trie, trie->edges == NULL ? 16 : (trie->edges_mask + 1) * 2))
+            return NO_NODE;
+    }
+
+    if (trie->free_node != NO_NODE)
+    {
+        index = trie->free_node;
+        trie->free_node = trie->nodes[index].parent;
+    }
+    else
+    {
+        if (trie->num_nodes == trie->max_nodes)
+        {
+            if (trie->max_nodes > UINT32_MAX / 4)
+            {
+                PyErr_NoMemory();
+                return NO_NODE;
+            }
+            nodes = PyMem_Realloc(trie->nodes, trie->max_nodes * 2 * sizeof (*nodes));
+            if (nodes == NULL)
+            {
+                PyErr_NoMemory();
+                return NO_NODE;
+            }
+            trie->nodes = nodes;
+            trie->max_nodes *= 2;
+        }
+        index = trie->num_nodes++;
+    }
+
+    trie->nodes[index].mask = mask;
+    trie->nodes[index].parent = parent;
+    trie->nodes[index].num_children = 0;
+    trie->nodes[index].value = NULL;
+    ++trie->nodes[parent].num_children;
+
+    trie_edge_insert(trie, index);
+    ++trie->num_edges;
+
+    return index;
+}
+
+// Remove unused nodes (without a value or children),
+// starting from `index` and going up the tree.
+static void trie_prune(OutlineTrie *trie, uint32_t index)
+{
+    trie_node_t *node;
+    size_t       slot, next, home;
+    uint32_t     parent;
+
+    while (index)
+    {
+        node = &trie->nodes[index];
+        if (node->value != NULL || node->num_children)
+            break;
+
+        slot = trie_edge_home(trie, node->parent, node->mask);
+        while (trie->edges[slot] != index)
+            slot = (slot + 1) & trie->edges_mask;
+
+        // Backward shift deletion.
+        for (next = slot; ; )
+        {
+            next = (next + 1) & trie->edges_mask;
+            if (!trie->edges[next])
+                break;
+            home = trie_edge_home(trie, trie->nodes[trie->edges[next]].parent,
+                                  trie->nodes[trie->edges[next]].mask);
+            // Can the entry at `next` be moved to `slot`?
+            if (slot <= next ? (home <= slot || home > next) : (home <= slot && home > next))
+            {
+                trie->edges[slot] = trie->edges[next];
+                slot = next;
+            }
+        }
+        trie->edges[slot] = 0;
+        --trie->num_edges;
+
+        parent = node->parent;
+        --trie->nodes[parent].num_children;
+        node->parent = trie->free_node;
+        trie->free_node = index;
+        index = parent;
+    }
+}
+
+// Return the node of an outline, or `NO_NODE`.
+static uint32_t trie_find(const OutlineTrie *trie, const stroke_uint_t *masks, Py_ssize_t num_strokes)
+{
+    uint32_t index = 0;
+
+    for (Py_ssize_t n = 0; n < num_strokes && index != NO_NODE; ++n)
+        index = trie_find_child(trie, index, masks[n]);
+
+    return index;
+}
+
+static int trie_init(OutlineTrie *trie)
+{
+    trie->nodes = PyMem_Malloc(16 * sizeof (*trie->nodes));
+    if (trie->nodes == NULL)
+    {
+        PyErr_NoMemory();
+        return 0;
+    }
+    trie->max_nodes = 16;
+    trie->num_nodes = 1;
+    trie->free_node = NO_NODE;
+    trie->nodes[0].mask = 0;
+    trie->nodes[0].parent = NO_NODE;
+    trie->nodes[0].num_children = 0;
+    trie->nodes[0].value = NULL;
+    trie->edges = NULL;
+    trie->edges_mask = 0;
+    trie->num_edges = 0;
+    trie->size = 0;
+    return 1;
+}
+
+static void trie_clear(OutlineTrie *trie)
+{
+    trie_node_t *nodes;
+    uint32_t     num_nodes;
+
+    nodes = trie->nodes;
+    num_nodes = trie->num_nodes;
+
+    PyMem_Free(trie->edges);
+    trie->nodes = NULL;
+    trie->num_nodes = trie->max_nodes = 0;
+    trie->free_node = NO_NODE;
+    trie->edges = NULL;
+    trie->edges_mask = 0;
+    trie->num_edges = 0;
+    trie->size = 0;
+
+    // Note: release values last, as this can trigger arbitrary code.
+    for (uint32_t index = 0; index < num_nodes; ++index)
+        Py_XDECREF(nodes[index].value);
+    PyMem_Free(nodes);
+}
+
+static PyObject *OutlineTrie_new(PyTypeObject *type, PyObject *Py_UNUSED(args), PyObject *Py_UNUSED(kwargs))
+{
+    OutlineTrie *self;
+
+    self = (OutlineTrie *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
+
+    if (!trie_init(self))
+    {
+        Py_DECREF(self);
+        return NULL;
+    }
+
+    return (PyObject *)self;
+}
+
+static int OutlineTrie_traverse(OutlineTrie *self, visitproc visit, void *arg)
+{
+    for (uint32_t index = 0; index < self->num_nodes; ++index)
+        Py_VISIT(self->nodes[index].value);
+    return 0;
+}
+
+static int OutlineTrie_tp_clear(OutlineTrie *self)
+{
+    trie_clear(self);
+    return 0;
+}
+
+static void OutlineTrie_dealloc(OutlineTrie *self)
+{
+    PyObject_GC_UnTrack(self);
+    trie_clear(self);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static Py_ssize_t OutlineTrie_length(OutlineTrie *self)
+{
+    return self->size;
+}
+
+// Return the value (borrowed reference) of an outline, or NULL.
+static PyObject *trie_get(OutlineTrie *self, PyObject *key, int *error)
+{
+    stroke_uint_t  buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t *masks;
+    Py_ssize_t     num_strokes;
+    uint32_t       index;
+
+    *error = 0;
+
+    num_strokes = strokes_to_masks(key, buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_strokes < 0)
+    {
+        *error = 1;
+        return NULL;
+    }
+
+    // Note: the trie may have not been re-initialized after a clear (GC).
+    index = self->nodes == NULL ? NO_NODE : trie_find(self, masks, num_strokes);
+    strokes_masks_free(key, buffer, masks);
+
+    return index == NO_NODE ? NULL : self->nodes[index].value;
+}
+
+static PyObject *OutlineTrie_subscript(OutlineTrie *self, PyObject *key)
+{
+    PyObject *value;
+    int       error;
+
+    value = trie_get(self, key, &error);
+    if (value == NULL)
+    {
+        if (!error)
+            PyErr_SetObject(PyExc_KeyError, key);
+        return NULL;
+    }
+
+    Py_INCREF(value);
+    return value;
+}
+
+static int OutlineTrie_ass_subscript(OutlineTrie *self, PyObject *key, PyObject *value)
+{
+    stroke_uint_t  buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t *masks;
+    Py_ssize_t     num_strokes;
+    uint32_t       index, child;
+    PyObject      *old_value;
+
+    num_strokes = strokes_to_masks(key, buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_strokes < 0)
+        return -1;
+
+    if (self->nodes == NULL && !trie_init(self))
+        goto error;
+
+    if (value == NULL)
+    {
+        index = trie_find(self, masks, num_strokes);
+        if (index == NO_NODE || self->nodes[index].value == NULL)
+        {
+            PyErr_SetObject(PyExc_KeyError, key);
+            goto error;
+        }
+        old_value = self->nodes[index].value;
+        self->nodes[index].value = NULL;
+        --self->size;
+        trie_prune(self, index);
+    }
+    else
+    {
+        index = 0;
+        for (Py_ssize_t n = 0; n < num_strokes; ++n)
+        {
+            child = trie_find_child(self, index, masks[n]);
+            if (child == NO_NODE)
+            {
+                child = trie_add_child(self, index, masks[n]);
+                if (child == NO_NODE)
+                {
+                    trie_prune(self, index);
+                    goto error;
+                }
+            }
+            index = child;
+        }
+        old_value = self->nodes[index].value;
+        if (old_value == NULL)
+            ++self->size;
+        Py_INCREF(value);
+        self->nodes[index].value = value;
+    }
+
+    strokes_masks_free(key, buffer, masks);
+    Py_XDECREF(old_value);
+    return 0;
+
+error:
+    strokes_masks_free(key, buffer, masks);
+    return -1;
+}
+
+static int OutlineTrie_contains(OutlineTrie *self, PyObject *key)
+{
+    PyObject *value;
+    int       error;
+
+    value = trie_get(self, key, &error);
+
+    return error ? -1 : value != NULL;
+}
+
+static PyObject *OutlineTrie_get(OutlineTrie *self, PyObject *args)
+{
+    PyObject *key;
+    PyObject *default_value;
+    PyObject *value;
+    int       error;
+
+    default_value = Py_None;
+
+    if (!PyArg_UnpackTuple(args, "get", 1, 2, &key, &default_value))
+        return NULL;
+
+    value = trie_get(self, key, &error);
+    if (error)
+        return NULL;
+    if (value == NULL)
+        value = default_value;
+
+    Py_INCREF(value);
+    return value;
+}
+
+// Walk the trie along `strokes`, calling `callback` for each prefix
+// with a value: stop when `callback` returns 0, or on error (-1).
+static int trie_walk(OutlineTrie *self, PyObject *strokes,
+                     int (*callback)(void *, Py_ssize_t, PyObject *), void *data)
+{
+    stroke_uint_t  buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t *masks;
+    Py_ssize_t     num_strokes;
+    uint32_t       index;
+    int            ret;
+
+    num_strokes = strokes_to_masks(strokes, buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_strokes < 0)
+        return -1;
+
+    ret = 1;
+    index = self->nodes == NULL ? NO_NODE : 0;
+    for (Py_ssize_t n = 0; index != NO_NODE; ++n)
+    {
+        if (self->nodes[index].value != NULL)
+        {
+            ret = callback(data, n, self->nodes[index].value);
+            if (ret <= 0)
+                break;
+        }
+        if (n == num_strokes)
+            break;
+        index = trie_find_child(self, index, masks[n]);
+    }
+
+    strokes_masks_free(strokes, buffer, masks);
+    return ret < 0 ? -1 : 0;
+}
+
+typedef struct
+{
+    Py_ssize_t  length;
+    PyObject   *value;
+
+} trie_match_t;
+
+static int longest_match_callback(void *data, Py_ssize_t length, PyObject *value)
+{
+    ((trie_match_t *)data)->length = length;
+    ((trie_match_t *)data)->value = value;
+    return 1;
+}
+
+static PyObject *OutlineTrie_longest_match(OutlineTrie *self, PyObject *strokes)
+{
+    trie_match_t match = { -1, NULL };
+
+    if (trie_walk(self, strokes, longest_match_callback, &match) < 0)
+        return NULL;
+
+    if (match.value == NULL)
+        Py_RETURN_NONE;
+
+    return Py_BuildValue("(nO)", match.length, match.value);
+}
+
+static int prefixes_callback(void *data, Py_ssize_t length, PyObject *value)
+{
+    PyObject *item;
+    int       ret;
+
+    item = Py_BuildValue("(nO)", length, value);
+    if (item == NULL)
+        return -1;
+
+    ret = PyList_Append((PyObject *)data, item);
+    Py_DECREF(item);
+
+    return ret < 0 ? -1 : 1;
+}
+
+static PyObject *OutlineTrie_prefixes(OutlineTrie *self, PyObject *strokes)
+{
+    PyObject *prefixes;
+
+    prefixes = PyList_New(0);
+    if (prefixes == NULL)
+        return NULL;
+
+    if (trie_walk(self, strokes, prefixes_callback, prefixes) < 0)
+    {
+        Py_DECREF(prefixes);
+        return NULL;
+    }
+
+    return prefixes;
+}
+
+static PyObject *OutlineTrie_clear(OutlineTrie *self, PyObject *Py_UNUSED(ignored))
+{
+    trie_clear(self);
+
+    if (self->nodes == NULL && !trie_init(self))
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
+static PySequenceMethods OutlineTrie_as_sequence =
+{
+    .sq_contains = (objobjproc)OutlineTrie_contains,
+};
+
+static PyMappingMethods OutlineTrie_as_mapping =
+{
+    .mp_length        = (lenfunc)OutlineTrie_length,
+    .mp_subscript     = (binaryfunc)OutlineTrie_subscript,
+    .mp_ass_subscript = (objobjargproc)OutlineTrie_ass_subscript,
+};
+
+static PyMethodDef OutlineTrie_methods[] =
+{
+    {"get"          , (PyCFunction)OutlineTrie_get          , METH_VARARGS, "Return the value of an outline if present, else `default`."},
+    {"longest_match", (PyCFunction)OutlineTrie_longest_match, METH_O, "Return `(length, value)` for the longest prefix of `strokes` present in the trie, or None."},
+    {"prefixes"     , (PyCFunction)OutlineTrie_prefixes     , METH_O, "Return a list of `(length, value)` for all the prefixes of `strokes` present in the trie (shortest first)."},
+    {"clear"        , (PyCFunction)OutlineTrie_clear        , METH_NOARGS, "Remove all the outlines."},
+    {NULL}
+};
+
+static PyTypeObject OutlineTrieType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name        = "_plover_stroke.OutlineTrie",
+    .tp_basicsize   = sizeof (OutlineTrie),
+    .tp_itemsize    = 0,
+    .tp_flags       = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_doc         = "Trie of outlines (keys: outlines or sequences of strokes), for prefix lookups.",
+    .tp_new         = OutlineTrie_new,
+    .tp_dealloc     = (destructor)OutlineTrie_dealloc,
+    .tp_traverse    = (traverseproc)OutlineTrie_traverse,
+    .tp_clear       = (inquiry)OutlineTrie_tp_clear,
+    .tp_methods     = OutlineTrie_methods,
+    .tp_as_sequence = &OutlineTrie_as_sequence,
+    .tp_as_mapping  = &OutlineTrie_as_mapping,
+};
+
+// Index of a set of strokes, for subsets / supersets queries:
+// strokes are stored in steno order, along with one bitmap (over
+// the strokes) per key ("bit-sliced" index).
+typedef struct
+{
+    PyObject_HEAD
+    Py_ssize_t     size;
+    stroke_uint_t *masks;
+    Py_ssize_t     num_words;
+    unsigned       num_slices;
+    uint64_t      *slices;
+    stroke_uint_t  all_keys;
+
+} StrokeSetIndex;
+
+static int order_key_cmp(const void *p1, const void *p2)
+{
+    stroke_uint_t k1 = *(const stroke_uint_t *)p1;
+    stroke_uint_t k2 = *(const stroke_uint_t *)p2;
+
+    return k1 < k2 ? -1 : k1 > k2;
+}
+
+static PyObject *StrokeSetIndex_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "masks", NULL };
+    PyObject       *masks_obj;
+    Py_buffer       view;
+    stroke_uint_t   masks_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t  *masks;
+    Py_ssize_t      num_masks;
+    StrokeSetIndex *self;
+    stroke_uint_t  *keys;
+    Py_ssize_t      size;
+    Py_ssize_t      invalid_index;
+    uint64_t       *slice;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O", kwlist, &masks_obj))
+        return NULL;
+
+    num_masks = masks_from_obj(masks_obj, &view, masks_buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_masks < 0)
+        return NULL;
+
+    self = NULL;
+
+    // Sort (in steno order) and deduplicate.
+    keys = PyMem_Malloc(Py_MAX(num_masks, 1) * sizeof (*keys));
+    if (keys == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
+    invalid_index = -1;
+    size = 0;
+    BEGIN_ALLOW_THREADS_IF(num_masks >= GIL_RELEASE_THRESHOLD)
+    for (Py_ssize_t n = 0; n < num_masks; ++n)
+    {
+        if ((masks[n] >> MAX_KEYS))
+        {
+            invalid_index = n;
+            break;
+        }
+        keys[n] = stroke_to_order_key(masks[n]);
+    }
+    if (invalid_index < 0)
+    {
+        qsort(keys, num_masks, sizeof (*keys), order_key_cmp);
+        for (Py_ssize_t n = 0; n < num_masks; ++n)
+        {
+            if (!size || keys[n] != keys[size - 1])
+                keys[size++] = keys[n];
+        }
+    }
+    END_ALLOW_THREADS_IF
+
+    if (invalid_index >= 0)
+    {
+        char error[40];
+
+        snprintf(error, sizeof (error), "invalid keys mask: "STROKE_UINT_FMT, masks[invalid_index]);
+        PyErr_SetString(PyExc_ValueError, error);
+        goto end;
+    }
+
+    self = (StrokeSetIndex *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        goto end;
+
+    self->size = size;
+    self->num_words = (size + 63) / 64;
+    self->masks = PyMem_Malloc(Py_MAX(size, 1) * sizeof (*self->masks));
+    if (self->masks == NULL)
+    {
+        Py_CLEAR(self);
+        PyErr_NoMemory();
+        goto end;
+    }
+
+    self->all_keys = 0;
+    for (Py_ssize_t n = 0; n < size; ++n)
+    {
+        self->masks[n] = order_key_to_stroke(keys[n]);
+        self->all_keys |= self->masks[n];
+    }
+    self->num_slices = self->all_keys ? bit_index(msb(self->all_keys)) + 1 : 0;
+
+    self->slices = PyMem_Calloc(Py_MAX(self->num_slices * self->num_words, 1), sizeof (*self->slices));
+    if (self->slices == NULL)
+    {
+        Py_CLEAR(self);
+        PyErr_NoMemory();
+        goto end;
+    }
+    BEGIN_ALLOW_THREADS_IF(size >= GIL_RELEASE_THRESHOLD)
+    for (unsigned key = 0; key < self->num_slices; ++key)
+    {
+        slice = &self->slices[key * self->num_words];
+        for (Py_ssize_t n = 0; n < size; ++n)
+            if ((self->masks[n] >> key) & 1)
+                slice[n / 64] |= (uint64_t)1 << (n % 64);
+    }
+    END_ALLOW_THREADS_IF
+
+end:
+    PyMem_Free(keys);
+    masks_from_obj_release(masks_obj, &view, masks_buffer, masks);
+    return (PyObject *)self;
+}
+
+static void StrokeSetIndex_dealloc(StrokeSetIndex *self)
+{
+    PyMem_Free(self->masks);
+    PyMem_Free(self->slices);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static Py_ssize_t StrokeSetIndex_length(StrokeSetIndex *self)
+{
+    return self->size;
+}
+
+static int StrokeSetIndex_contains(StrokeSetIndex *self, PyObject *stroke)
+{
+    stroke_uint_t key;
+    stroke_uint_t mask;
+
+    if (!PyLong_Check(stroke))
+        return 0;
+
+    mask = PyLong_AsStrokeUint(stroke);
+    if (mask == INVALID_STROKE && PyErr_Occurred())
+    {
+        PyErr_Clear();
+        return 0;
+    }
+
+    if ((mask & ~self->all_keys) || !self->size)
+        return 0;
 
-    mask = stroke_from_ucs4(helper, stroke_ucs4, stroke_len);
-    if (mask == INVALID_STROKE)
-        return NULL;
+    key = stroke_to_order_key(mask);
+    for (Py_ssize_t lo = 0, hi = self->size; lo < hi; )
+    {
+        Py_ssize_t mid = lo + (hi - lo) / 2;
+        stroke_uint_t mid_key = stroke_to_order_key(self->masks[mid]);
+        if (mid_key == key)
+            return 1;
+        if (mid_key < key)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
 
-    return stroke_to_str(helper, mask);
+    return 0;
 }
 
-static PyObject *key_str(const stroke_helper_t *helper, unsigned key_index, int number)
+// Return the matching strokes (as an `array('Q')`) for a bitmap.
+static PyObject *stroke_set_index_select(const StrokeSetIndex *self, const uint64_t *bitmap)
 {
-    Py_UCS4  key_ucs4[2];
-    unsigned key_ucs4_len;
+    stroke_uint_t *masks;
+    Py_ssize_t     num_masks;
+    uint64_t       word;
+    PyObject      *result;
 
-    key_ucs4[0] = (number ? helper->key_number : helper->key_letter)[key_index];
+    num_masks = 0;
+    for (Py_ssize_t w = 0; w < self->num_words; ++w)
+        num_masks += popcount(bitmap[w]);
 
-    switch (helper->key_side[key_index])
+    masks = PyMem_Malloc(Py_MAX(num_masks, 1) * sizeof (*masks));
+    if (masks == NULL)
+        return PyErr_NoMemory();
+
+    num_masks = 0;
+    for (Py_ssize_t w = 0; w < self->num_words; ++w)
     {
-    case KEY_SIDE_NONE:
-        key_ucs4_len = 1;
-        break;
-    case KEY_SIDE_LEFT:
-        key_ucs4[1] = '-';
-        key_ucs4_len = 2;
-        break;
-    case KEY_SIDE_RIGHT:
-        key_ucs4[1] = key_ucs4[0];
-        key_ucs4[0] = '-';
-        key_ucs4_len = 2;
-        break;
-    default:
-        UNREACHABLE();
+        for (word = bitmap[w]; word; word &= word - 1)
+            masks[num_masks++] = self->masks[w * 64 + bit_index(lsb(word))];
     }
 
-    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, key_ucs4, key_ucs4_len);
+    result = new_array("Q", masks, num_masks * sizeof (*masks));
+    PyMem_Free(masks);
+
+    return result;
 }
 
-static PyObject *StrokeHelper_setup(StrokeHelper *self, PyObject *args, PyObject *kwargs)
+static PyObject *stroke_set_index_query(StrokeSetIndex *self, PyObject *stroke, int subsets)
 {
-    static char *kwlist[] = {"keys", "implicit_hyphen_keys", "number_key", "numbers", "feral_number_key", NULL};
-
-    PyObject        *implicit_hyphen_keys = Py_None;
-    PyObject        *number_key = Py_None;
-    PyObject        *numbers = Py_None;
-    int              feral_number_key = 0;
-    PyObject        *keys_sequence;
-    Py_ssize_t       num_keys;
-    stroke_uint_t    unique_letters_mask;
-    Py_UCS4          number_key_letter;
-    PyObject        *key;
-    Py_UCS4          key_letter;
-    stroke_uint_t    key_mask;
-    key_side_t       key_side;
-    stroke_helper_t  helper;
+    stroke_uint_t  mask;
+    stroke_uint_t  keys;
+    uint64_t      *bitmap;
+    const uint64_t *slice;
+    unsigned       key;
+    PyObject      *result;
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OOOp", kwlist,
-                                     &keys_sequence, &implicit_hyphen_keys,
-                                     &number_key, &numbers,
-                                     &feral_number_key))
+    mask = outline_mask_from_obj(stroke);
+    if (mask == INVALID_STROKE)
         return NULL;
 
-    keys_sequence = PySequence_Fast(keys_sequence, "expected `keys` to be a list or tuple");
-    if (keys_sequence == NULL)
-        return NULL;
+    bitmap = PyMem_Malloc(Py_MAX(self->num_words, 1) * sizeof (*bitmap));
+    if (bitmap == NULL)
+        return PyErr_NoMemory();
 
-    num_keys = PySequence_Fast_GET_SIZE(keys_sequence);
-    if (num_keys == 0 || num_keys > MAX_KEYS)
-    {
-        PyErr_SetString(PyExc_ValueError, "unsupported number of keys");
-        return NULL;
-    }
+    // Note: the index is immutable, so it can be queried without the GIL.
+    BEGIN_ALLOW_THREADS_IF(self->size >= GIL_RELEASE_THRESHOLD)
 
-    if (number_key == Py_None)
-    {
-        if (numbers != Py_None)
-        {
-            PyErr_SetString(PyExc_TypeError, "expected `numbers` to be None (since `number_key` is None)");
-            return NULL;
-        }
+    // Start with all the strokes...
+    for (Py_ssize_t w = 0; w < self->num_words; ++w)
+        bitmap[w] = (uint64_t)-1;
+    if (self->size % 64)
+        bitmap[self->num_words - 1] = ((uint64_t)1 << (self->size % 64)) - 1;
 
-        if (feral_number_key)
+    if (subsets)
+    {
+        // ...and remove the ones with a key not in `mask`.
+        for (keys = self->all_keys & ~mask; keys; keys &= keys - 1)
         {
-            PyErr_SetString(PyExc_TypeError, "expected `feral_number_key` to be False (since `number_key` is None)");
-            return NULL;
+            key = bit_index(lsb(keys));
+            slice = &self->slices[key * self->num_words];
+            for (Py_ssize_t w = 0; w < self->num_words; ++w)
+                bitmap[w] &= ~slice[w];
         }
-
-        number_key_letter = 0;
-        numbers = NULL;
+    }
+    else if ((mask & ~self->all_keys))
+    {
+        // No stroke can contain a key not in the index.
+        memset(bitmap, 0, self->num_words * sizeof (*bitmap));
     }
     else
     {
-        if (!PyUnicode_Check(number_key))
+        // ...and only keep the ones with all the keys in `mask`.
+        for (keys = mask; keys; keys &= keys - 1)
         {
-            PyErr_SetString(PyExc_TypeError, "expected `number_key` to be a string");
-            return NULL;
+            key = bit_index(lsb(keys));
+            slice = &self->slices[key * self->num_words];
+            for (Py_ssize_t w = 0; w < self->num_words; ++w)
+                bitmap[w] &= slice[w];
         }
+    }
 
-        number_key_letter = key_to_letter(number_key, &key_side);
-        if (!number_key_letter)
-        {
-            PyErr_SetString(PyExc_ValueError, "invalid `number_key`");
-            return NULL;
-        }
+    END_ALLOW_THREADS_IF
 
-        if (!PyDict_Check(numbers))
-        {
-            PyErr_SetString(PyExc_TypeError, "expected `numbers` to be a dictionary");
-            return NULL;
-        }
-    }
+    result = stroke_set_index_select(self, bitmap);
+    PyMem_Free(bitmap);
 
-    if (implicit_hyphen_keys != Py_None && !PySet_Check(implicit_hyphen_keys))
-    {
-        PyErr_SetString(PyExc_TypeError, "expected `implicit_hyphen_keys` to be a set");
-        return NULL;
-    }
+    return result;
+}
 
-    helper.num_keys = (unsigned)num_keys;
-    helper.right_keys_index = helper.num_keys;
-    helper.feral_number_key_letter = 0;
-    helper.implicit_hyphen_mask = 0;
-    helper.number_key_mask = 0;
-    helper.numbers_mask = 0;
+static PyObject *StrokeSetIndex_subsets(StrokeSetIndex *self, PyObject *stroke)
+{
+    return stroke_set_index_query(self, stroke, 1);
+}
 
-    for (unsigned k = 0; k < helper.num_keys; ++k)
-    {
-        key = PySequence_Fast_GET_ITEM(keys_sequence, k);
-        if (!PyUnicode_Check(key))
-        {
-            PyErr_Format(PyExc_ValueError, "invalid `keys`; key %u is not a string: %R", k, key);
-            return NULL;
-        }
+static PyObject *StrokeSetIndex_supersets(StrokeSetIndex *self, PyObject *stroke)
+{
+    return stroke_set_index_query(self, stroke, 0);
+}
 
-        key_letter = key_to_letter(key, &key_side);
-        if (!key_letter)
-        {
-            PyErr_Format(PyExc_ValueError, "invalid `keys`; key %u is not valid: %R", k, key);
-            return NULL;
-        }
+static PyObject *StrokeSetIndex_masks(StrokeSetIndex *self, PyObject *Py_UNUSED(ignored))
+{
+    return new_array("Q", self->masks, self->size * sizeof (*self->masks));
+}
 
-        key_mask = STROKE_1 << k;
+static PySequenceMethods StrokeSetIndex_as_sequence =
+{
+    .sq_length   = (lenfunc)StrokeSetIndex_length,
+    .sq_contains = (objobjproc)StrokeSetIndex_contains,
+};
 
-        switch (key_side)
-        {
-        case KEY_SIDE_NONE:
-            break;
-        case KEY_SIDE_LEFT:
-            if (helper.right_keys_index != helper.num_keys)
-            {
-                PyErr_Format(PyExc_ValueError, "invalid `keys`; left-key on the right-hand side: %R", key);
-                return NULL;
-            }
-            break;
-        case KEY_SIDE_RIGHT:
-            if (helper.right_keys_index == helper.num_keys)
-                helper.right_keys_index = k;
-            break;
-        default:
-            UNREACHABLE();
-        }
+static PyMethodDef StrokeSetIndex_methods[] =
+{
+    {"subsets"  , (PyCFunction)StrokeSetIndex_subsets  , METH_O, "Return the strokes contained in `stroke` (as an `array('Q')`, in steno order)."},
+    {"supersets", (PyCFunction)StrokeSetIndex_supersets, METH_O, "Return the strokes containing `stroke` (as an `array('Q')`, in steno order)."},
+    {"masks"    , (PyCFunction)StrokeSetIndex_masks    , METH_NOARGS, "Return all the strokes (as an `array('Q')`, in steno order)."},
+    {NULL}
+};
 
-        if (key_letter == number_key_letter)
-            helper.number_key_mask = key_mask;
+static PyTypeObject StrokeSetIndexType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name        = "_plover_stroke.StrokeSetIndex",
+    .tp_basicsize   = sizeof (StrokeSetIndex),
+    .tp_itemsize    = 0,
+    .tp_flags       = Py_TPFLAGS_DEFAULT,
+    .tp_doc         = "Immutable index of a set of strokes (keys masks), for subsets / supersets queries.",
+    .tp_new         = StrokeSetIndex_new,
+    .tp_dealloc     = (destructor)StrokeSetIndex_dealloc,
+    .tp_methods     = StrokeSetIndex_methods,
+    .tp_as_sequence = &StrokeSetIndex_as_sequence,
+};
 
-        if (implicit_hyphen_keys != Py_None && PySet_Contains(implicit_hyphen_keys, key))
-            helper.implicit_hyphen_mask |= key_mask;
+// Maximum size of a machine protocol packet (in bytes).
+#define KEY_MAP_MAX_BYTES  32
 
-        helper.key_side[k] = key_side;
-        helper.key_letter[k] = key_letter;
+// Compiled mapping of machine protocol bits to keys: bits are numbered
+// from the least significant bit of the first byte of a packet (i.e.
+// like `int.from_bytes(packet, 'little')`), and there's one 256
+// entries table per packet byte (byte value to keys mask).
+typedef struct
+{
+    PyObject_HEAD
+    Py_ssize_t     packet_size;
+    stroke_uint_t  tables[KEY_MAP_MAX_BYTES][256];
 
-        if (number_key_letter)
-        {
-            number_key = PyDict_GetItem(numbers, key);
-            if (number_key != NULL)
-            {
-                key_letter = key_to_letter(number_key, &key_side);
-                if (!key_letter)
-                {
-                    PyErr_Format(PyExc_ValueError, "invalid `numbers`; entry for %R is not valid: %R", key, number_key);
-                    return NULL;
-                }
-                helper.numbers_mask |= key_mask;
-            }
-        }
+} KeyMap;
 
-        helper.key_number[k] = key_letter;
-    }
+static stroke_uint_t key_map_lookup(const KeyMap *self, const uint8_t *packet, Py_ssize_t size)
+{
+    stroke_uint_t mask = 0;
 
-    if (number_key_letter)
-    {
-        if (!helper.number_key_mask)
-        {
-            PyErr_SetString(PyExc_ValueError, "invalid `number_key`");
-            return NULL;
-        }
+    for (Py_ssize_t n = 0; n < size; ++n)
+        mask |= self->tables[n][packet[n]];
 
-        if (popcount(helper.numbers_mask) != 10)
-        {
-            PyErr_SetString(PyExc_ValueError, "invalid `numbers`");
-            return NULL;
-        }
-    }
+    return mask;
+}
 
-    // Find out unique letters.
-    unique_letters_mask = 0;
-    {
-        unsigned k, l;
+static PyObject *KeyMap_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "helper", "mapping", "packet_size", NULL };
+    PyObject      *helper;
+    PyObject      *mapping;
+    PyObject      *packet_size_obj;
+    Py_ssize_t     packet_size;
+    PyObject      *items;
+    PyObject      *bit_obj;
+    PyObject      *keys;
+    Py_ssize_t     bit;
+    Py_ssize_t     max_bit;
+    stroke_uint_t  mask;
+    stroke_uint_t  bits_masks[KEY_MAP_MAX_BYTES * 8];
+    KeyMap        *self;
 
-        for (k = 0; k < helper.num_keys; ++k)
-        {
-            for (l = 0; l < helper.num_keys; ++l)
-                if (l != k && helper.key_letter[l] == helper.key_letter[k])
-                    break;
-            if (l == helper.num_keys)
-                unique_letters_mask |= (STROKE_1 << k);
-        }
-    }
+    packet_size_obj = Py_None;
 
-    if (implicit_hyphen_keys != Py_None)
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!O|O", kwlist,
+                                     &StrokeHelperType, &helper,
+                                     &mapping, &packet_size_obj))
+        return NULL;
+
+    items = PyMapping_Items(mapping);
+    if (items == NULL)
+        return NULL;
+
+    memset(bits_masks, 0, sizeof (bits_masks));
+    max_bit = -1;
+
+    for (Py_ssize_t n = 0; n < PyList_GET_SIZE(items); ++n)
     {
-        if ((Py_ssize_t)popcount(helper.implicit_hyphen_mask) != PySet_GET_SIZE(implicit_hyphen_keys))
+        if (!PyArg_ParseTuple(PyList_GET_ITEM(items, n), "OO", &bit_obj, &keys))
+            goto error;
+        bit = PyNumber_AsSsize_t(bit_obj, PyExc_OverflowError);
+        if (bit == -1 && PyErr_Occurred())
+            goto error;
+        if (bit < 0 || bit >= KEY_MAP_MAX_BYTES * 8)
         {
-            PyErr_SetString(PyExc_ValueError, "invalid `implicit_hyphen_keys`: not all keys accounted for");
-            return NULL;
+            PyErr_Format(PyExc_ValueError, "invalid bit: %zd", bit);
+            goto error;
         }
+        // A bit can map to one key, several keys, or none (ignored).
+        if (keys == Py_None)
+            continue;
+        if (PyUnicode_Check(keys))
+            keys = PyTuple_Pack(1, keys);
+        else
+            keys = PySequence_Fast(keys, "expected a key, a sequence of keys, or None");
+        if (keys == NULL)
+            goto error;
+        mask = stroke_from_keys(((StrokeHelper *)helper)->helper, keys);
+        Py_DECREF(keys);
+        if (mask == INVALID_STROKE)
+            goto error;
+        bits_masks[bit] |= mask;
+        max_bit = Py_MAX(max_bit, bit);
+    }
 
-        // Implicit hyphen keys must be a continuous block.
-        if (helper.implicit_hyphen_mask != (// Mask of all bits <= msb.
-                                            ((msb(helper.implicit_hyphen_mask) << 1) - 1) &
-                                            // Mask of all bits >= lsb.
-                                            ~(lsb(helper.implicit_hyphen_mask) - 1)))
-        {
-            PyErr_SetString(PyExc_ValueError, "invalid `implicit_hyphen_keys`: not a continuous block");
-            return NULL;
-        }
+    Py_CLEAR(items);
 
-        if ((helper.implicit_hyphen_mask & unique_letters_mask) != helper.implicit_hyphen_mask)
+    if (packet_size_obj == Py_None)
+        packet_size = max_bit / 8 + 1;
+    else
+    {
+        packet_size = PyNumber_AsSsize_t(packet_size_obj, PyExc_OverflowError);
+        if (packet_size == -1 && PyErr_Occurred())
+            return NULL;
+        if (packet_size <= 0 || packet_size > KEY_MAP_MAX_BYTES || packet_size * 8 <= max_bit)
         {
-            PyErr_SetString(PyExc_ValueError, "invalid `implicit_hyphen_keys`: some letters are not unique");
+            PyErr_SetString(PyExc_ValueError, "invalid packet size");
             return NULL;
         }
     }
-    else
-    {
-        unsigned k, l;
 
-        for (k = helper.right_keys_index; k && (unique_letters_mask & (STROKE_1 << --k)); )
-            ;
-        for (l = helper.right_keys_index; l < helper.num_keys && (unique_letters_mask & (STROKE_1 << l)); ++l)
-            ;
-
-        helper.implicit_hyphen_mask = unique_letters_mask & ~((STROKE_1 << k) - 1) & ((STROKE_1 << l) - 1);
-    }
+    self = (KeyMap *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
 
-    if (feral_number_key)
+    self->packet_size = packet_size;
+    for (Py_ssize_t n = 0; n < packet_size; ++n)
     {
-        if (helper.number_key_mask & helper.implicit_hyphen_mask)
+        for (unsigned value = 0; value < 256; ++value)
         {
-            PyErr_SetString(PyExc_ValueError, "invalid `number_key`: cannot be both feral and an implicit hyphen key");
-            return NULL;
+            mask = 0;
+            for (unsigned b = 0; b < 8; ++b)
+                if ((value >> b) & 1)
+                    mask |= bits_masks[n * 8 + b];
+            self->tables[n][value] = mask;
         }
-
-        helper.feral_number_key_letter = number_key_letter;
     }
 
-    self->helper = helper;
+    return (PyObject *)self;
 
-    Py_RETURN_NONE;
+error:
+    Py_DECREF(items);
+    return NULL;
 }
 
-#define STROKE_CMP_FN(FnName, Op) \
-    static PyObject *StrokeHelper_##FnName(const StrokeHelper *self, PyObject *args) \
-    { \
-        return stroke_cmp(&self->helper, args, #FnName, Op); \
+static PyObject *KeyMap_stroke_from_bits(KeyMap *self, PyObject *bits_obj)
+{
+    unsigned long long bits;
+    uint8_t            packet[sizeof (bits)];
+
+    if (!PyLong_Check(bits_obj))
+    {
+        PyErr_Format(PyExc_TypeError, "expected an integer, got: %R", bits_obj);
+        return NULL;
     }
 
-STROKE_CMP_FN(stroke_cmp, CMP_OP_CMP);
-STROKE_CMP_FN(stroke_eq, CMP_OP_EQ);
-STROKE_CMP_FN(stroke_ne, CMP_OP_NE);
-STROKE_CMP_FN(stroke_ge, CMP_OP_GE);
-STROKE_CMP_FN(stroke_gt, CMP_OP_GT);
-STROKE_CMP_FN(stroke_le, CMP_OP_LE);
-STROKE_CMP_FN(stroke_lt, CMP_OP_LT);
+    bits = PyLong_AsUnsignedLongLong(bits_obj);
+    if (bits == (unsigned long long)-1 && PyErr_Occurred())
+        return NULL;
 
-#undef STROKE_CMP_FN
+    for (unsigned n = 0; n < sizeof (packet); ++n)
+        packet[n] = (uint8_t)(bits >> (n * 8));
 
-static PyObject *StrokeHelper_stroke_in(const StrokeHelper *self, PyObject *args)
+    return PyLong_FromStrokeUint(key_map_lookup(self, packet, Py_MIN(self->packet_size, (Py_ssize_t)sizeof (packet))));
+}
+
+static PyObject *KeyMap_stroke_from_packet(KeyMap *self, PyObject *packet)
 {
-    stroke_uint_t mask1, mask2;
+    Py_buffer     view;
+    stroke_uint_t mask;
 
-    if (!unpack_2_strokes(&self->helper, args, "stroke_in", &mask1, &mask2))
+    if (PyObject_GetBuffer(packet, &view, PyBUF_SIMPLE))
         return NULL;
 
-    if ((mask1 & mask2) == mask1)
-        Py_RETURN_TRUE;
+    // Note: extra bytes are ignored.
+    mask = key_map_lookup(self, view.buf, Py_MIN(self->packet_size, view.len));
 
-    Py_RETURN_FALSE;
+    PyBuffer_Release(&view);
+
+    return PyLong_FromStrokeUint(mask);
 }
 
-static PyObject *StrokeHelper_stroke_or(const StrokeHelper *self, PyObject *args)
+static PyObject *KeyMap_packets_to_masks(KeyMap *self, PyObject *args, PyObject *kwargs)
 {
-    stroke_uint_t mask1, mask2;
+    static char *kwlist[] = { "buffer", "packet_size", NULL };
+    Py_buffer      view;
+    Py_ssize_t     packet_size;
+    Py_ssize_t     num_packets;
+    const uint8_t *packet;
+    stroke_uint_t *masks;
+    PyObject      *result;
+
+    packet_size = self->packet_size;
 
-    if (!unpack_2_strokes(&self->helper, args, "stroke_or", &mask1, &mask2))
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*|n", kwlist, &view, &packet_size))
         return NULL;
 
-    return PyLong_FromStrokeUint(mask1 | mask2);
-}
+    result = NULL;
+    masks = NULL;
 
-static PyObject *StrokeHelper_stroke_and(const StrokeHelper *self, PyObject *args)
-{
-    stroke_uint_t mask1, mask2;
+    if (packet_size <= 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid packet size");
+        goto end;
+    }
+    if (view.len % packet_size)
+    {
+        PyErr_Format(PyExc_ValueError, "buffer size is not a multiple of the packet size (%zd)", packet_size);
+        goto end;
+    }
 
-    if (!unpack_2_strokes(&self->helper, args, "stroke_and", &mask1, &mask2))
-        return NULL;
+    num_packets = view.len / packet_size;
+    masks = PyMem_Malloc(Py_MAX(num_packets, 1) * sizeof (*masks));
+    if (masks == NULL)
+    {
+        PyErr_NoMemory();
+        goto end;
+    }
 
-    return PyLong_FromStrokeUint(mask1 & mask2);
-}
+    // Note: the key map is immutable, so it can be used without the GIL.
+    BEGIN_ALLOW_THREADS_IF(num_packets >= GIL_RELEASE_THRESHOLD)
+    packet = view.buf;
+    for (Py_ssize_t n = 0; n < num_packets; ++n, packet += packet_size)
+        masks[n] = key_map_lookup(self, packet, Py_MIN(self->packet_size, packet_size));
+    END_ALLOW_THREADS_IF
 
-static PyObject *StrokeHelper_stroke_add(const StrokeHelper *self, PyObject *args)
-{
-    stroke_uint_t mask1, mask2;
+    result = new_array("Q", masks, num_packets * sizeof (*masks));
 
-    if (!unpack_2_strokes(&self->helper, args, "stroke_add", &mask1, &mask2))
-        return NULL;
+end:
+    PyMem_Free(masks);
+    PyBuffer_Release(&view);
+    return result;
+}
 
-    return PyLong_FromStrokeUint(mask1 | mask2);
+static PyObject *KeyMap_get_packet_size(KeyMap *self, void *Py_UNUSED(closure))
+{
+    return PyLong_FromSsize_t(self->packet_size);
 }
 
-static PyObject *StrokeHelper_stroke_sub(const StrokeHelper *self, PyObject *args)
+static PyGetSetDef KeyMap_getset[] =
 {
-    stroke_uint_t mask1, mask2;
+    {"packet_size", (getter)KeyMap_get_packet_size, NULL, "Packet size (in bytes).", NULL},
+    {NULL}
+};
 
-    if (!unpack_2_strokes(&self->helper, args, "stroke_sub", &mask1, &mask2))
-        return NULL;
+static PyMethodDef KeyMap_methods[] =
+{
+    {"stroke_from_bits"  , (PyCFunction)KeyMap_stroke_from_bits  , METH_O, "Convert a protocol bit field (integer, up to 64 bits) to a stroke (keys mask)."},
+    {"stroke_from_packet", (PyCFunction)KeyMap_stroke_from_packet, METH_O, "Convert a packet (bytes-like object) to a stroke (keys mask)."},
+    {"packets_to_masks"  , (PyCFunction)KeyMap_packets_to_masks  , METH_VARARGS | METH_KEYWORDS, "Convert a buffer of consecutive packets (of `packet_size` bytes) to an `array('Q')` of keys masks."},
+    {NULL}
+};
 
-    return PyLong_FromStrokeUint(mask1 & ~mask2);
-}
+static PyTypeObject KeyMapType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name        = "_plover_stroke.KeyMap",
+    .tp_basicsize   = sizeof (KeyMap),
+    .tp_itemsize    = 0,
+    .tp_flags       = Py_TPFLAGS_DEFAULT,
+    .tp_doc         = "Immutable mapping of machine protocol bits to keys, for converting raw packets to strokes.",
+    .tp_new         = KeyMap_new,
+    .tp_getset      = KeyMap_getset,
+    .tp_methods     = KeyMap_methods,
+};
 
-static PyObject *StrokeHelper_stroke_is_prefix(const StrokeHelper *self, PyObject *args)
+// Incremental tokenizer for Plover's strokes log, e.g.:
+//
+//   2021-03-07 12:34:56,789 Stroke(STKPW : ['S-', 'T-', 'K-', 'P-', 'W-'])
+//
+// Lines without a stroke (e.g. translations) are ignored.
+typedef struct
 {
-    stroke_uint_t mask1, mask2;
+    PyObject_HEAD
+    StrokeHelper  *helper;
+    // Incomplete last line (from the previous chunk).
+    char          *pending;
+    Py_ssize_t     pending_len;
+    Py_ssize_t     pending_size;
+    // Masks of the chunk being tokenized.
+    stroke_uint_t *masks;
+    Py_ssize_t     num_masks;
+    Py_ssize_t     masks_size;
 
-    if (!unpack_2_strokes(&self->helper, args, "stroke_is_prefix", &mask1, &mask2))
-        return NULL;
+} StrokeLogTokenizer;
 
-    if (msb(mask1) < lsb(mask2))
-        Py_RETURN_TRUE;
+static const char stroke_log_marker[] = "Stroke(";
 
-    Py_RETURN_FALSE;
-}
+#define STROKE_LOG_MARKER_LEN  (sizeof (stroke_log_marker) - 1)
 
-static PyObject *StrokeHelper_stroke_is_suffix(const StrokeHelper *self, PyObject *args)
+// Tokenize one line: return 0 on error (invalid steno, or out of memory).
+static int stroke_log_tokenize_line(StrokeLogTokenizer *self, const char *line, Py_ssize_t len)
 {
-    stroke_uint_t mask1, mask2;
+    const char    *end = line + len;
+    const char    *steno;
+    const char    *steno_end;
+    stroke_uint_t  mask;
+    int            ascii;
+    uint64_t       stats_start_ns;
 
-    if (!unpack_2_strokes(&self->helper, args, "stroke_is_suffix", &mask1, &mask2))
-        return NULL;
+    // Find the marker.
+    for (steno = line; ; ++steno)
+    {
+        steno = memchr(steno, stroke_log_marker[0], end - steno);
+        if (steno == NULL || end - steno < (Py_ssize_t)STROKE_LOG_MARKER_LEN)
+            return 1;
+        if (!memcmp(steno, stroke_log_marker, STROKE_LOG_MARKER_LEN))
+            break;
+    }
+    steno += STROKE_LOG_MARKER_LEN;
 
-    if (lsb(mask1) > msb(mask2))
-        Py_RETURN_TRUE;
+    ascii = 1;
+    for (steno_end = steno; steno_end < end && *steno_end != ' ' && *steno_end != ')'; ++steno_end)
+        ascii &= !(*steno_end & 0x80);
 
-    Py_RETURN_FALSE;
+    if (ascii)
+    {
+        stats_start_ns = self->helper->stats_mode ? stats_start(self->helper) : 0;
+        mask = stroke_from_data(self->helper->helper, PyUnicode_1BYTE_KIND, steno, steno_end - steno);
+        if (self->helper->stats_mode)
+            stats_record(self->helper, STAT_FROM_STENO, stats_start_ns,
+                         mask == INVALID_STROKE, steno_end - steno,
+                         mask != INVALID_STROKE);
+        if (mask == INVALID_STROKE)
+        {
+            PyObject *steno_obj = PyBytes_FromStringAndSize(steno, steno_end - steno);
+            if (steno_obj != NULL)
+            {
+                PyErr_Format(PyExc_ValueError, "invalid steno: %R", steno_obj);
+                Py_DECREF(steno_obj);
+            }
+            return 0;
+        }
+    }
+    else
+    {
+        PyObject *steno_obj = PyUnicode_DecodeUTF8(steno, steno_end - steno, NULL);
+        if (steno_obj == NULL)
+            return 0;
+        mask = helper_stroke_from_steno(self->helper, steno_obj);
+        Py_DECREF(steno_obj);
+        if (mask == INVALID_STROKE)
+            return 0;
+    }
+
+    if (self->num_masks == self->masks_size)
+    {
+        Py_ssize_t     size = Py_MAX(64, self->masks_size * 2);
+        stroke_uint_t *masks = PyMem_Realloc(self->masks, size * sizeof (*masks));
+        if (masks == NULL)
+        {
+            PyErr_NoMemory();
+            return 0;
+        }
+        self->masks = masks;
+        self->masks_size = size;
+    }
+    self->masks[self->num_masks++] = mask;
+
+    return 1;
 }
 
-static PyObject *StrokeHelper_normalize_stroke(const StrokeHelper *self, PyObject *stroke)
+static int stroke_log_append_pending(StrokeLogTokenizer *self, const char *data, Py_ssize_t len)
 {
-    Py_ssize_t  stroke_len;
-    Py_UCS4     stroke_ucs4[MAX_STENO];
-    PyObject   *normalized_stroke;
-
-    if (!PyUnicode_Check(stroke))
+    if (self->pending_len + len > self->pending_size)
     {
-        PyErr_SetString(PyExc_TypeError, "expected a string");
-        return NULL;
+        Py_ssize_t  size = Py_MAX(self->pending_len + len, self->pending_size * 2);
+        char       *pending = PyMem_Realloc(self->pending, size);
+        if (pending == NULL)
+        {
+            PyErr_NoMemory();
+            return 0;
+        }
+        self->pending = pending;
+        self->pending_size = size;
     }
+    memcpy(self->pending + self->pending_len, data, len);
+    self->pending_len += len;
+    return 1;
+}
 
-    if (PyUnicode_READY(stroke))
-        return NULL;
-
-    stroke_len = PyUnicode_GET_LENGTH(stroke);
-    if (!stroke_len || stroke_len > MAX_STENO)
-        goto invalid;
+static PyObject *StrokeLogTokenizer_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "helper", NULL };
+    PyObject           *helper;
+    StrokeLogTokenizer *self;
 
-    if (NULL == PyUnicode_AsUCS4(stroke, stroke_ucs4, MAX_STENO, 0))
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!", kwlist, &StrokeHelperType, &helper))
         return NULL;
 
-    normalized_stroke = normalize_stroke_ucs4(&self->helper, stroke_ucs4, stroke_len);
-    if (normalized_stroke == NULL)
-        goto invalid;
+    self = (StrokeLogTokenizer *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
 
-    return normalized_stroke;
+    Py_INCREF(helper);
+    self->helper = (StrokeHelper *)helper;
 
-invalid:
-    PyErr_Format(PyExc_ValueError, "invalid stroke: %R", stroke);
-    return NULL;
+    return (PyObject *)self;
 }
 
-static PyObject *StrokeHelper_normalize_steno(const StrokeHelper *self, PyObject *steno)
+static void StrokeLogTokenizer_dealloc(StrokeLogTokenizer *self)
 {
-    int          steno_kind;
-    const void  *steno_data;
-    Py_ssize_t   steno_len;
-    Py_ssize_t   steno_index;
-    Py_UCS4      stroke_ucs4[MAX_STENO + 1]; // Account for '/'.
-    Py_ssize_t   stroke_len;
-    PyObject    *stroke;
-    Py_ssize_t   max_strokes;
-    PyObject   **strokes_list;
-    Py_ssize_t   num_strokes;
-    PyObject    *result;
+    Py_XDECREF(self->helper);
+    PyMem_Free(self->pending);
+    PyMem_Free(self->masks);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
 
-    strokes_list = NULL;
-    result = NULL;
+static PyObject *StrokeLogTokenizer_feed(StrokeLogTokenizer *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "data", "final", NULL };
+    PyObject   *data_obj;
+    int         final;
+    Py_buffer   view;
+    const char *data;
+    const char *end;
+    const char *eol;
+    Py_ssize_t  len;
+    PyObject   *result;
+
+    final = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|p", kwlist, &data_obj, &final))
+        return NULL;
 
-    if (!PyUnicode_Check(steno))
+    view.obj = NULL;
+    if (PyUnicode_Check(data_obj))
     {
-        PyErr_SetString(PyExc_TypeError, "expected a string");
-        goto end;
+        // Note: no copy for ASCII strings.
+        data = PyUnicode_AsUTF8AndSize(data_obj, &len);
+        if (data == NULL)
+            return NULL;
     }
-
-    if (PyUnicode_READY(steno))
-        goto end;
-
-    steno_len = PyUnicode_GET_LENGTH(steno);
-    if (!steno_len)
+    else
     {
-        result = PyTuple_New(0);
-        goto end;
+        if (PyObject_GetBuffer(data_obj, &view, PyBUF_SIMPLE))
+            return NULL;
+        data = view.buf;
+        len = view.len;
     }
 
-    max_strokes = steno_len / 2 + 1;
+    result = NULL;
+    self->num_masks = 0;
+    end = data + len;
 
-    strokes_list = PyMem_Malloc(max_strokes * sizeof (*strokes_list));
-    if (strokes_list == NULL)
+    // Complete the pending line first.
+    if (self->pending_len)
     {
-        PyErr_NoMemory();
-        goto end;
+        eol = memchr(data, '\n', len);
+        if (!stroke_log_append_pending(self, data, (eol == NULL ? end : eol) - data))
+            goto end;
+        if (eol == NULL && !final)
+        {
+            data = end;
+            goto done;
+        }
+        len = self->pending_len;
+        self->pending_len = 0;
+        if (!stroke_log_tokenize_line(self, self->pending, len))
+            goto end;
+        data = eol == NULL ? end : eol + 1;
     }
 
-    steno_kind = PyUnicode_KIND(steno);
-    steno_data = PyUnicode_DATA(steno);
-
-    num_strokes = 0;
-    steno_index = 0;
-    stroke_len = 0;
+    for (;;)
+    {
+        eol = memchr(data, '\n', end - data);
+        if (eol == NULL)
+            break;
+        if (!stroke_log_tokenize_line(self, data, eol - data))
+            goto end;
+        data = eol + 1;
+    }
 
-    while (1)
+done:
+    if (data != end)
     {
-        stroke_ucs4[stroke_len] = PyUnicode_READ(steno_kind, steno_data, steno_index);
-        if (stroke_ucs4[stroke_len] == '/')
+        if (final)
         {
-            // No trailing '/' allowed.
-            if (++steno_index == steno_len)
-                goto invalid;
-            if (!stroke_len)
-            {
-                // Allow one '/' at the start.
-                if (num_strokes)
-                    goto invalid;
-                stroke = PyUnicode_New(0, 0);
-                if (stroke == NULL)
-                    goto error;
-                strokes_list[num_strokes++] = stroke;
-                continue;
-            }
+            if (!stroke_log_tokenize_line(self, data, end - data))
+                goto end;
         }
-        else if (++stroke_len > MAX_STENO)
-            goto invalid;
-        else if (++steno_index < steno_len)
-            continue;
-        stroke = normalize_stroke_ucs4(&self->helper, stroke_ucs4, stroke_len);
-        if (stroke == NULL)
-            goto invalid;
-        assert(num_strokes < max_strokes);
-        strokes_list[num_strokes++] = stroke;
-        if (steno_index == steno_len)
-            break;
-        stroke_len = 0;
+        else if (!stroke_log_append_pending(self, data, end - data))
+            goto end;
     }
 
-    result = PyTuple_New(num_strokes);
-    if (result == NULL)
-        goto error;
-
-    while (num_strokes--)
-        PyTuple_SET_ITEM(result, num_strokes, strokes_list[num_strokes]);
-
-    goto end;
+    result = new_array("Q", self->masks, self->num_masks * sizeof (*self->masks));
 
-invalid:
-    PyErr_Format(PyExc_ValueError, "invalid steno: %R", steno);
-error:
-    while (num_strokes--)
-        Py_XDECREF(strokes_list[num_strokes]);
 end:
-    PyMem_Free(strokes_list);
+    if (result == NULL)
+        self->pending_len = 0;
+    if (view.obj != NULL)
+        PyBuffer_Release(&view);
     return result;
 }
 
-static PyObject *StrokeHelper_steno_to_sort_key(const StrokeHelper *self, PyObject *steno)
+static PyObject *StrokeLogTokenizer_get_pending(StrokeLogTokenizer *self, void *Py_UNUSED(closure))
 {
-    int            steno_kind;
-    const void    *steno_data;
-    Py_ssize_t     steno_len;
-    Py_ssize_t     steno_index;
-    Py_UCS4        stroke_ucs4[MAX_STENO + 1]; // Account for '/'.
-    Py_ssize_t     stroke_len;
-    stroke_uint_t  mask;
-    char          *sort_key;
-    Py_ssize_t     sort_key_index;
-    Py_ssize_t     sort_key_max_len;
-    PyObject      *result;
+    return PyLong_FromSsize_t(self->pending_len);
+}
 
-    sort_key = NULL;
-    result = NULL;
+static PyGetSetDef StrokeLogTokenizer_getset[] =
+{
+    {"pending", (getter)StrokeLogTokenizer_get_pending, NULL, "Size (in bytes) of the incomplete last line, waiting for more data.", NULL},
+    {NULL}
+};
 
-    if (!PyUnicode_Check(steno))
-    {
-        PyErr_SetString(PyExc_TypeError, "expected a string");
-        goto end;
-    }
+static PyMethodDef StrokeLogTokenizer_methods[] =
+{
+    {"feed", (PyCFunction)StrokeLogTokenizer_feed, METH_VARARGS | METH_KEYWORDS, "Tokenize the next chunk of the log (str or bytes-like object), and return an `array('Q')` with the masks of the strokes from the lines completed by this chunk: the incomplete last line is kept for the next call, unless `final` is true."},
+    {NULL}
+};
 
-    if (PyUnicode_READY(steno))
-        goto end;
+static PyTypeObject StrokeLogTokenizerType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name        = "_plover_stroke.StrokeLogTokenizer",
+    .tp_basicsize   = sizeof (StrokeLogTokenizer),
+    .tp_itemsize    = 0,
+    .tp_flags       = Py_TPFLAGS_DEFAULT,
+    .tp_doc         = "Incremental tokenizer for Plover's strokes log.",
+    .tp_new         = StrokeLogTokenizer_new,
+    .tp_dealloc     = (destructor)StrokeLogTokenizer_dealloc,
+    .tp_getset      = StrokeLogTokenizer_getset,
+    .tp_methods     = StrokeLogTokenizer_methods,
+};
 
-    steno_len = PyUnicode_GET_LENGTH(steno);
-    if (!steno_len)
-        goto invalid;
+// Frequency table: open addressing, keyed by a pair of masks
+// (the second mask is 0 for single strokes), empty slots have
+// a zero count.
+typedef struct
+{
+    stroke_uint_t first;
+    stroke_uint_t second;
+    uint64_t      count;
 
-    // Note: account for possible extra hyphens.
-    sort_key_max_len = steno_len * 2;
+} freq_entry_t;
+
+typedef struct
+{
+    freq_entry_t *entries;
+    size_t        table_mask;
+    Py_ssize_t    size;
+
+} freq_table_t;
+
+static size_t freq_table_home(const freq_table_t *table, stroke_uint_t first, stroke_uint_t second)
+{
+    uint64_t h;
+
+    // Note: fold the high bits, as the low bits of the product
+    // only depend on the low bits of the masks.
+    h = (first * 0x9e3779b97f4a7c15ULL) ^ (second * 0xc2b2ae3d27d4eb4fULL);
+    h ^= h >> 29;
+    h *= 0xbf58476d1ce4e5b9ULL;
+    h ^= h >> 32;
 
-    sort_key = PyMem_Malloc(sort_key_max_len * sizeof (*sort_key));
-    if (sort_key == NULL)
+    return (size_t)h & table->table_mask;
+}
+
+static int freq_table_resize(freq_table_t *table, size_t table_size)
+{
+    freq_entry_t *entries;
+    freq_entry_t *entry;
+    size_t        old_table_size;
+
+    entries = PyMem_Calloc(table_size, sizeof (*entries));
+    if (entries == NULL)
     {
         PyErr_NoMemory();
-        goto end;
+        return 0;
     }
 
-    steno_kind = PyUnicode_KIND(steno);
-    steno_data = PyUnicode_DATA(steno);
-
-    sort_key_index = 0;
-    steno_index = 0;
-    stroke_len = 0;
-
-    while (1)
+    old_table_size = table->entries == NULL ? 0 : table->table_mask + 1;
+    table->table_mask = table_size - 1;
+    for (size_t n = 0; n < old_table_size; ++n)
     {
-        stroke_ucs4[stroke_len] = PyUnicode_READ(steno_kind, steno_data, steno_index);
-        if (stroke_ucs4[stroke_len] == '/')
+        if (!table->entries[n].count)
+            continue;
+        for (size_t slot = freq_table_home(table, table->entries[n].first, table->entries[n].second); ;
+             slot = (slot + 1) & table->table_mask)
         {
-            // No trailing '/' allowed.
-            if (++steno_index == steno_len)
-                goto invalid;
-            if (!stroke_len)
+            entry = &entries[slot];
+            if (!entry->count)
             {
-                // Allow one '/' at the start.
-                if (sort_key_index)
-                    goto invalid;
-                sort_key[sort_key_index++] = 0;
-                continue;
+                *entry = table->entries[n];
+                break;
             }
         }
-        else if (++stroke_len > MAX_STENO)
-            goto invalid;
-        else if (++steno_index < steno_len)
-            continue;
-        mask = stroke_from_ucs4(&self->helper, stroke_ucs4, stroke_len);
-        if (mask == INVALID_STROKE)
-            goto invalid;
-        sort_key_index += stroke_to_sort_key(&self->helper, mask, &sort_key[sort_key_index]);
-        if (steno_index == steno_len)
-            break;
-        sort_key[sort_key_index++] = 0;
-        stroke_len = 0;
     }
-    assert(sort_key_index <= sort_key_max_len);
 
-    result = PyBytes_FromStringAndSize(sort_key, sort_key_index);
-
-    goto end;
+    PyMem_Free(table->entries);
+    table->entries = entries;
 
-invalid:
-    PyErr_Format(PyExc_ValueError, "invalid steno: %R", steno);
-end:
-    PyMem_Free(sort_key);
-    return result;
+    return 1;
 }
 
-static PyObject *StrokeHelper_stroke_from_any(const StrokeHelper *self, PyObject *obj)
+// Add `count` to the entry for `(first, second)`.
+static int freq_table_add(freq_table_t *table, stroke_uint_t first, stroke_uint_t second, uint64_t count)
 {
-    stroke_uint_t mask;
+    freq_entry_t *entry;
 
-    mask = stroke_from_any(&self->helper, obj);
-    if (mask == INVALID_STROKE)
-        return NULL;
+    // Keep the load factor under 1/2.
+    if (table->entries == NULL || (size_t)table->size >= (table->table_mask + 1) / 2)
+    {
+        if (!freq_table_resize(table, table->entries == NULL ? 64 : (table->table_mask + 1) * 2))
+            return 0;
+    }
 
-    return PyLong_FromStrokeUint(mask);
+    for (size_t slot = freq_table_home(table, first, second); ; slot = (slot + 1) & table->table_mask)
+    {
+        entry = &table->entries[slot];
+        if (!entry->count)
+        {
+            entry->first = first;
+            entry->second = second;
+            ++table->size;
+            break;
+        }
+        if (entry->first == first && entry->second == second)
+            break;
+    }
+    entry->count += count;
+
+    return 1;
 }
 
-static PyObject *StrokeHelper_stroke_from_int(const StrokeHelper *self, PyObject *integer)
+static uint64_t freq_table_get(const freq_table_t *table, stroke_uint_t first, stroke_uint_t second)
 {
-    stroke_uint_t mask;
+    const freq_entry_t *entry;
 
-    mask = stroke_from_int(&self->helper, integer);
-    if (mask == INVALID_STROKE)
-        return NULL;
+    if (table->entries == NULL)
+        return 0;
 
-    return PyLong_FromStrokeUint(mask);
+    for (size_t slot = freq_table_home(table, first, second); ; slot = (slot + 1) & table->table_mask)
+    {
+        entry = &table->entries[slot];
+        if (!entry->count)
+            return 0;
+        if (entry->first == first && entry->second == second)
+            return entry->count;
+    }
 }
 
-static PyObject *StrokeHelper_stroke_from_keys(const StrokeHelper *self, PyObject *keys_sequence)
+static int freq_entry_cmp(const void *p1, const void *p2)
 {
-    stroke_uint_t mask;
-
-    keys_sequence = PySequence_Fast(keys_sequence, "expected a list or tuple");
-    if (keys_sequence == NULL)
-        return NULL;
-
-    mask = stroke_from_keys(&self->helper, keys_sequence);
-    if (mask == INVALID_STROKE)
-        return NULL;
-
-    return PyLong_FromStrokeUint(mask);
+    const freq_entry_t *e1 = p1;
+    const freq_entry_t *e2 = p2;
+
+    // Most common first, then in masks order.
+    if (e1->count != e2->count)
+        return e1->count < e2->count ? 1 : -1;
+    if (e1->first != e2->first)
+        return e1->first < e2->first ? -1 : 1;
+    if (e1->second != e2->second)
+        return e1->second < e2->second ? -1 : 1;
+    return 0;
 }
 
-static PyObject *StrokeHelper_stroke_from_steno(const StrokeHelper *self, PyObject *steno)
+// Return the (sorted) entries of `table`, to be freed by the caller.
+static freq_entry_t *freq_table_sorted(const freq_table_t *table)
 {
-    stroke_uint_t mask;
+    freq_entry_t *entries;
+    Py_ssize_t    num_entries;
 
-    if (!PyUnicode_Check(steno))
+    entries = PyMem_Malloc(Py_MAX(table->size, 1) * sizeof (*entries));
+    if (entries == NULL)
     {
-        PyErr_SetString(PyExc_TypeError, "expected a string");
+        PyErr_NoMemory();
         return NULL;
     }
 
-    mask = stroke_from_steno(&self->helper, steno);
-    if (mask == INVALID_STROKE)
-        return NULL;
+    num_entries = 0;
+    for (size_t n = 0; table->entries != NULL && n <= table->table_mask; ++n)
+        if (table->entries[n].count)
+            entries[num_entries++] = table->entries[n];
+    assert(num_entries == table->size);
 
-    return PyLong_FromStrokeUint(mask);
+    qsort(entries, num_entries, sizeof (*entries), freq_entry_cmp);
+
+    return entries;
 }
 
-static PyObject *StrokeHelper_stroke_to_keys(const StrokeHelper *self, PyObject *stroke)
+// Per-key, stroke, and stroke bigram frequency counter.
+typedef struct
 {
-    stroke_uint_t mask;
+    PyObject_HEAD
+    unsigned       num_keys;
+    uint64_t       total;
+    freq_table_t   strokes;
+    freq_table_t   bigrams;
+    // Last stroke, for counting bigrams across `update` calls.
+    int            has_last;
+    stroke_uint_t  last;
 
-    mask = stroke_from_any(&self->helper, stroke);
-    if (mask == INVALID_STROKE)
-        return NULL;
+} StrokeCounter;
 
-    return stroke_to_keys(&self->helper, mask);
-}
+static PyTypeObject StrokeCounterType;
 
-static PyObject *StrokeHelper_stroke_first_key(const StrokeHelper *self, PyObject *stroke)
+static PyObject *StrokeCounter_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
 {
-    stroke_uint_t mask;
-    unsigned      first_key;
+    static char *kwlist[] = { "num_keys", NULL };
+    unsigned       num_keys;
+    StrokeCounter *self;
 
-    mask = stroke_from_any(&self->helper, stroke);
-    if (mask == INVALID_STROKE)
+    num_keys = MAX_KEYS;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|I", kwlist, &num_keys))
         return NULL;
 
-    if (!mask)
+    if (!num_keys || num_keys > MAX_KEYS)
     {
-        PyErr_SetString(PyExc_ValueError, "empty stroke");
+        PyErr_Format(PyExc_ValueError, "invalid number of keys: %u", num_keys);
         return NULL;
     }
 
-    first_key = popcount(lsb(mask) - 1);
+    self = (StrokeCounter *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
+
+    self->num_keys = num_keys;
 
-    return key_str(&self->helper, first_key, 0);
+    return (PyObject *)self;
 }
 
-static PyObject *StrokeHelper_stroke_last_key(const StrokeHelper *self, PyObject *stroke)
+static void StrokeCounter_dealloc(StrokeCounter *self)
 {
-    stroke_uint_t mask;
-    unsigned      last_key;
+    PyMem_Free(self->strokes.entries);
+    PyMem_Free(self->bigrams.entries);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
 
-    mask = stroke_from_any(&self->helper, stroke);
-    if (mask == INVALID_STROKE)
+static int stroke_counter_add(StrokeCounter *self, stroke_uint_t mask, uint64_t count)
+{
+    if (!freq_table_add(&self->strokes, mask, 0, count))
+        return 0;
+
+    self->total += count;
+
+    return 1;
+}
+
+static PyObject *StrokeCounter_update(StrokeCounter *self, PyObject *masks_obj)
+{
+    Py_buffer      view;
+    stroke_uint_t  masks_buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t *masks;
+    Py_ssize_t     num_masks;
+    PyObject      *result;
+
+    num_masks = masks_from_obj(masks_obj, &view, masks_buffer, MASKS_BUFFER_LEN, &masks);
+    if (num_masks < 0)
         return NULL;
 
-    if (!mask)
+    result = NULL;
+
+    // Validate first, so invalid masks don't result in a partial update.
+    for (Py_ssize_t n = 0; n < num_masks; ++n)
     {
-        PyErr_SetString(PyExc_ValueError, "empty stroke");
-        return NULL;
+        if ((masks[n] >> self->num_keys))
+        {
+            invalid_mask_error(masks[n]);
+            goto end;
+        }
+    }
+
+    for (Py_ssize_t n = 0; n < num_masks; ++n)
+    {
+        if (!stroke_counter_add(self, masks[n], 1))
+            goto end;
+        if (self->has_last && !freq_table_add(&self->bigrams, self->last, masks[n], 1))
+            goto end;
+        self->last = masks[n];
+        self->has_last = 1;
     }
 
-    last_key = popcount(msb(mask) - 1);
+    result = Py_None;
+    Py_INCREF(result);
 
-    return key_str(&self->helper, last_key, 0);
+end:
+    masks_from_obj_release(masks_obj, &view, masks_buffer, masks);
+    return result;
 }
 
-static PyObject *StrokeHelper_stroke_invert(const StrokeHelper *self, PyObject *stroke)
+static PyObject *StrokeCounter_end_sequence(StrokeCounter *self, PyObject *Py_UNUSED(ignored))
 {
-    stroke_uint_t mask;
-
-    mask = stroke_from_any(&self->helper, stroke);
-    if (mask == INVALID_STROKE)
-        return NULL;
-
-    mask = ~mask & ((STROKE_1 << self->helper.num_keys) - 1);
-
-    return PyLong_FromStrokeUint(mask);
+    self->has_last = 0;
+    Py_RETURN_NONE;
 }
 
-static PyObject *StrokeHelper_stroke_len(const StrokeHelper *self, PyObject *stroke)
+static PyObject *StrokeCounter_merge(StrokeCounter *self, PyObject *other_obj)
 {
-    stroke_uint_t mask;
+    const StrokeCounter *other;
 
-    mask = stroke_from_any(&self->helper, stroke);
-    if (mask == INVALID_STROKE)
+    if (!PyObject_TypeCheck(other_obj, &StrokeCounterType))
+    {
+        PyErr_Format(PyExc_TypeError, "expected a StrokeCounter, got: %R", other_obj);
         return NULL;
-
-    return PyLong_FromStrokeInt(popcount(mask));
-}
-
-static PyObject *StrokeHelper_stroke_has_digit(const StrokeHelper *self, PyObject *stroke)
-{
-    stroke_uint_t mask;
-
-    mask = stroke_from_any(&self->helper, stroke);
-    if (mask == INVALID_STROKE)
+    }
+    other = (const StrokeCounter *)other_obj;
+    if (other->num_keys != self->num_keys)
+    {
+        PyErr_SetString(PyExc_ValueError, "mismatched number of keys");
         return NULL;
+    }
+    if (other == self)
+    {
+        PyErr_SetString(PyExc_ValueError, "cannot merge a counter with itself");
+        return NULL;
+    }
 
-    if (stroke_has_digit(&self->helper, mask))
-        Py_RETURN_TRUE;
+    for (size_t n = 0; other->strokes.entries != NULL && n <= other->strokes.table_mask; ++n)
+    {
+        const freq_entry_t *entry = &other->strokes.entries[n];
+        if (entry->count && !stroke_counter_add(self, entry->first, entry->count))
+            return NULL;
+    }
+    for (size_t n = 0; other->bigrams.entries != NULL && n <= other->bigrams.table_mask; ++n)
+    {
+        const freq_entry_t *entry = &other->bigrams.entries[n];
+        if (entry->count && !freq_table_add(&self->bigrams, entry->first, entry->second, entry->count))
+            return NULL;
+    }
 
-    Py_RETURN_FALSE;
+    Py_RETURN_NONE;
 }
 
-static PyObject *StrokeHelper_stroke_is_number(const StrokeHelper *self, PyObject *stroke)
+// Note: per-key counts are derived from the strokes counts
+// on demand, so counting strokes stays a single table update.
+static PyObject *StrokeCounter_key_counts(StrokeCounter *self, PyObject *Py_UNUSED(ignored))
 {
-    stroke_uint_t mask;
+    uint64_t key_counts[MAX_KEYS];
 
-    mask = stroke_from_any(&self->helper, stroke);
-    if (mask == INVALID_STROKE)
-        return NULL;
+    memset(key_counts, 0, sizeof (key_counts));
 
-    if (stroke_is_number(&self->helper, mask))
-        Py_RETURN_TRUE;
+    for (size_t n = 0; self->strokes.entries != NULL && n <= self->strokes.table_mask; ++n)
+    {
+        const freq_entry_t *entry = &self->strokes.entries[n];
+        stroke_uint_t       mask = entry->first;
 
-    Py_RETURN_FALSE;
+        for (unsigned k = 0; mask; ++k, mask >>= 1)
+            if ((mask & 1))
+                key_counts[k] += entry->count;
+    }
+
+    return new_array("Q", key_counts, self->num_keys * sizeof (*key_counts));
 }
 
-static PyObject *StrokeHelper_stroke_to_steno(const StrokeHelper *self, PyObject *stroke)
+static PyObject *StrokeCounter_stroke_count(StrokeCounter *self, PyObject *stroke)
 {
     stroke_uint_t mask;
 
-    mask = stroke_from_any(&self->helper, stroke);
-    if (mask == INVALID_STROKE)
+    if (!PyLong_Check(stroke))
+    {
+        PyErr_Format(PyExc_TypeError, "expected an integer (mask of keys), got: %R", stroke);
+        return NULL;
+    }
+    mask = PyLong_AsStrokeUint(stroke);
+    if (mask == INVALID_STROKE && PyErr_Occurred())
         return NULL;
 
-    return stroke_to_str(&self->helper, mask);
+    return PyLong_FromUnsignedLongLong(freq_table_get(&self->strokes, mask, 0));
 }
 
-static PyObject *StrokeHelper_stroke_to_sort_key(const StrokeHelper *self, PyObject *stroke)
+static PyObject *StrokeCounter_bigram_count(StrokeCounter *self, PyObject *args)
 {
-    char          sort_key[MAX_KEYS];
-    unsigned      sort_key_len;
-    stroke_uint_t mask;
+    stroke_uint_t first;
+    stroke_uint_t second;
 
-    mask = stroke_from_any(&self->helper, stroke);
-    if (mask == INVALID_STROKE)
+    if (!PyArg_ParseTuple(args, "KK", &first, &second))
         return NULL;
 
-    sort_key_len = stroke_to_sort_key(&self->helper, mask, sort_key);
-
-    return PyBytes_FromStringAndSize(sort_key, sort_key_len);
+    return PyLong_FromUnsignedLongLong(freq_table_get(&self->bigrams, first, second));
 }
 
-static PyObject *StrokeHelper_get_keys(const StrokeHelper *self, void *Py_UNUSED(closure))
+// Return a list of `(key, count)` pairs, most common first.
+static PyObject *freq_table_most_common(const freq_table_t *table, PyObject *args, int bigrams)
 {
-    PyObject *keys_tuple;
-    PyObject *key;
+    PyObject     *limit_obj;
+    Py_ssize_t    limit;
+    freq_entry_t *entries;
+    PyObject     *result;
+
+    limit_obj = Py_None;
 
-    keys_tuple = PyTuple_New(self->helper.num_keys);
-    if (keys_tuple == NULL)
+    if (!PyArg_ParseTuple(args, "|O", &limit_obj))
         return NULL;
 
-    for (unsigned k = 0; k < self->helper.num_keys; ++k)
+    if (limit_obj == Py_None)
+        limit = table->size;
+    else
     {
-        key = key_str(&self->helper, k, 0);
-        if (key == NULL)
-        {
-            Py_DECREF(keys_tuple);
+        limit = PyNumber_AsSsize_t(limit_obj, PyExc_OverflowError);
+        if (limit == -1 && PyErr_Occurred())
             return NULL;
-        }
-        PyTuple_SET_ITEM(keys_tuple, k, key);
+        limit = Py_MAX(0, Py_MIN(limit, table->size));
     }
 
-    return keys_tuple;
+    entries = freq_table_sorted(table);
+    if (entries == NULL)
+        return NULL;
+
+    result = PyList_New(limit);
+    for (Py_ssize_t n = 0; result != NULL && n < limit; ++n)
+    {
+        PyObject *item;
+
+        if (bigrams)
+            item = Py_BuildValue("((KK)K)", (unsigned long long)entries[n].first,
+                                 (unsigned long long)entries[n].second,
+                                 (unsigned long long)entries[n].count);
+        else
+            item = Py_BuildValue("(KK)", (unsigned long long)entries[n].first,
+                                 (unsigned long long)entries[n].count);
+        if (item == NULL)
+            Py_CLEAR(result);
+        else
+            PyList_SET_ITEM(result, n, item);
+    }
+
+    PyMem_Free(entries);
+    return result;
 }
 
-static PyObject *StrokeHelper_get_implicit_hyphen_keys(const StrokeHelper *self, void *Py_UNUSED(closure))
+static PyObject *StrokeCounter_most_common(StrokeCounter *self, PyObject *args)
 {
-    PyObject *implicit_hyphen_keys;
-    PyObject *key;
+    return freq_table_most_common(&self->strokes, args, 0);
+}
 
-    implicit_hyphen_keys = PySet_New(NULL);
-    if (implicit_hyphen_keys == NULL)
-        return NULL;
+static PyObject *StrokeCounter_most_common_bigrams(StrokeCounter *self, PyObject *args)
+{
+    return freq_table_most_common(&self->bigrams, args, 1);
+}
 
-    for (unsigned k = 0; k < self->helper.num_keys; ++k)
+// Pack the entries of `table` to an `array('Q')`:
+// `first, count` (or `first, second, count` for bigrams).
+static PyObject *freq_table_pack(const freq_table_t *table, int bigrams)
+{
+    uint64_t   *data;
+    Py_ssize_t  len;
+    unsigned    entry_len;
+    PyObject   *result;
+
+    entry_len = bigrams ? 3 : 2;
+    data = PyMem_Malloc(Py_MAX(table->size, 1) * entry_len * sizeof (*data));
+    if (data == NULL)
+        return PyErr_NoMemory();
+
+    len = 0;
+    for (size_t n = 0; table->entries != NULL && n <= table->table_mask; ++n)
     {
-        if (!(self->helper.implicit_hyphen_mask & (1 << k)))
+        const freq_entry_t *entry = &table->entries[n];
+        if (!entry->count)
             continue;
-        key = key_str(&self->helper, k, 0);
-        if (key == NULL || PySet_Add(implicit_hyphen_keys, key))
-        {
-            Py_DECREF(implicit_hyphen_keys);
-            Py_XDECREF(key);
-            return NULL;
-        }
+        data[len++] = entry->first;
+        if (bigrams)
+            data[len++] = entry->second;
+        data[len++] = entry->count;
     }
 
-    return implicit_hyphen_keys;
+    result = new_array("Q", data, len * sizeof (*data));
+    PyMem_Free(data);
+    return result;
 }
 
-static PyObject *StrokeHelper_get_number_key(const StrokeHelper *self, void *Py_UNUSED(closure))
+static PyObject *StrokeCounter_reduce(StrokeCounter *self, PyObject *Py_UNUSED(ignored))
 {
-    if (!self->helper.number_key_mask)
-        Py_RETURN_NONE;
+    PyObject *last;
+
+    if (self->has_last)
+        last = PyLong_FromStrokeUint(self->last);
+    else
+    {
+        last = Py_None;
+        Py_INCREF(last);
+    }
+    if (last == NULL)
+        return NULL;
 
-    return StrokeHelper_stroke_to_steno(self, PyLong_FromStrokeUint(self->helper.number_key_mask));
+    return Py_BuildValue("(O(I)(NNN))", Py_TYPE(self), self->num_keys, last,
+                         freq_table_pack(&self->strokes, 0),
+                         freq_table_pack(&self->bigrams, 1));
 }
 
-static PyObject *StrokeHelper_get_numbers(const StrokeHelper *self, void *Py_UNUSED(closure))
+static PyObject *StrokeCounter_setstate(StrokeCounter *self, PyObject *state)
 {
-    PyObject *numbers;
-    PyObject *key;
-    PyObject *key_number;
-
-    if (!self->helper.number_key_mask)
-        Py_RETURN_NONE;
+    PyObject      *last_obj;
+    PyObject      *packed_obj[2];
+    Py_buffer      view;
+    stroke_uint_t  buffer[MASKS_BUFFER_LEN];
+    stroke_uint_t *data;
+    Py_ssize_t     len;
+    int            ok;
+
+    if (!PyArg_ParseTuple(state, "OOO", &last_obj, &packed_obj[0], &packed_obj[1]))
+        return NULL;
 
-    numbers = PyDict_New();
-    if (numbers == NULL)
+    if (self->total || self->strokes.size || self->bigrams.size)
+    {
+        PyErr_SetString(PyExc_ValueError, "counter is not empty");
         return NULL;
+    }
 
-    for (unsigned k = 0; k < self->helper.num_keys; ++k)
+    if (last_obj != Py_None)
     {
-        if (self->helper.key_letter[k] == self->helper.key_number[k])
-            continue;
-        key = key_str(&self->helper, k, 0);
-        key_number = key_str(&self->helper, k, 1);
-        if (key == NULL || key_number == NULL || PyDict_SetItem(numbers, key, key_number))
+        self->last = PyLong_AsStrokeUint(last_obj);
+        if (self->last == INVALID_STROKE && PyErr_Occurred())
+            return NULL;
+        self->has_last = 1;
+    }
+
+    for (int bigrams = 0; bigrams < 2; ++bigrams)
+    {
+        len = masks_from_obj(packed_obj[bigrams], &view, buffer, MASKS_BUFFER_LEN, &data);
+        if (len < 0)
+            return NULL;
+        ok = len % (bigrams ? 3 : 2) == 0;
+        for (Py_ssize_t n = 0; ok && n < len; n += bigrams ? 3 : 2)
+        {
+            // Note: a zero count would take a slot without marking it as used.
+            if ((data[n] >> self->num_keys) || (bigrams && (data[n + 1] >> self->num_keys)) ||
+                !data[n + (bigrams ? 2 : 1)])
+                ok = 0;
+            else if (bigrams)
+                ok = freq_table_add(&self->bigrams, data[n], data[n + 1], data[n + 2]);
+            else
+                ok = stroke_counter_add(self, data[n], data[n + 1]);
+        }
+        masks_from_obj_release(packed_obj[bigrams], &view, buffer, data);
+        if (!ok)
         {
-            Py_DECREF(numbers);
-            Py_XDECREF(key_number);
-            Py_XDECREF(key);
+            if (!PyErr_Occurred())
+                PyErr_SetString(PyExc_ValueError, "invalid state");
             return NULL;
         }
     }
 
-    return numbers;
-}
-
-static PyObject *StrokeHelper_get_feral_number_key(const StrokeHelper *self, void *Py_UNUSED(closure))
-{
-    return PyBool_FromLong(self->helper.feral_number_key_letter != 0);
+    Py_RETURN_NONE;
 }
 
-static PyObject *StrokeHelper_get_key_letter(const StrokeHelper *self, void *Py_UNUSED(closure))
+static Py_ssize_t StrokeCounter_len(StrokeCounter *self)
 {
-    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, self->helper.key_letter, self->helper.num_keys);
+    return self->strokes.size;
 }
 
-static PyObject *StrokeHelper_get_key_number(const StrokeHelper *self, void *Py_UNUSED(closure))
+static PyObject *StrokeCounter_get_num_keys(StrokeCounter *self, void *Py_UNUSED(closure))
 {
-    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, self->helper.key_number, self->helper.num_keys);
+    return PyLong_FromUnsignedLong(self->num_keys);
 }
 
-static PyObject *StrokeHelper_get_feral_number_key_letter(const StrokeHelper *self, void *Py_UNUSED(closure))
+static PyObject *StrokeCounter_get_total(StrokeCounter *self, void *Py_UNUSED(closure))
 {
-    if (self->helper.feral_number_key_letter == 0)
-        Py_RETURN_NONE;
-
-    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, &self->helper.feral_number_key_letter, 1);
+    return PyLong_FromUnsignedLongLong(self->total);
 }
 
-static PyGetSetDef StrokeHelper_getset[] =
+static PySequenceMethods StrokeCounter_as_sequence =
 {
-    // For getting back the arguments passed to setup.
-    {"keys", (getter)StrokeHelper_get_keys, NULL, "List of supported keys.", NULL},
-    {"implicit_hyphen_keys", (getter)StrokeHelper_get_implicit_hyphen_keys, NULL, "Set of implicit hyphen keys.", NULL},
-    {"number_key", (getter)StrokeHelper_get_number_key, NULL, "Number key.", NULL},
-    {"numbers", (getter)StrokeHelper_get_numbers, NULL, "Mapping of key to number.", NULL},
-    {"feral_number_key", (getter)StrokeHelper_get_feral_number_key, NULL, "Is the number key feral?", NULL},
-    // Other derived fields.
-    {"key_letter", (getter)StrokeHelper_get_key_letter, NULL, "Letters for the supported keys.", NULL},
-    {"key_number", (getter)StrokeHelper_get_key_number, NULL, "Numbers for the supported keys.", NULL},
-    {"feral_number_key_letter", (getter)StrokeHelper_get_feral_number_key_letter, NULL, "Letter for the feral number key.", NULL},
-    {NULL}
+    .sq_length = (lenfunc)StrokeCounter_len,
 };
 
-static PyMemberDef StrokeHelper_members[] =
+static PyGetSetDef StrokeCounter_getset[] =
 {
-    {"num_keys"            , T_UINT       , offsetof(StrokeHelper, helper.num_keys)            , READONLY, "Number of keys."},
-    {"implicit_hyphen_mask", T_STROKE_UINT, offsetof(StrokeHelper, helper.implicit_hyphen_mask), READONLY, "Implicit hyphen mask."},
-    {"number_key_mask"     , T_STROKE_UINT, offsetof(StrokeHelper, helper.number_key_mask)     , READONLY, "Number key mask."},
-    {"numbers_mask"        , T_STROKE_UINT, offsetof(StrokeHelper, helper.numbers_mask)        , READONLY, "Numbers mask."},
-    {"right_keys_index"    , T_UINT       , offsetof(StrokeHelper, helper.right_keys_index)    , READONLY, "Right keys index."},
+    {"num_keys", (getter)StrokeCounter_get_num_keys, NULL, "Number of keys.", NULL},
+    {"total", (getter)StrokeCounter_get_total, NULL, "Total number of strokes counted.", NULL},
     {NULL}
 };
 
-static PyMethodDef StrokeHelper_methods[] =
+static PyMethodDef StrokeCounter_methods[] =
 {
-    {"setup"             , (PyCFunction)StrokeHelper_setup             , METH_VARARGS | METH_KEYWORDS, "Setup."},
-    // Steno.
-    {"normalize_stroke"  , (PyCFunction)StrokeHelper_normalize_stroke  , METH_O, "Normalize stroke."},
-    {"normalize_steno"   , (PyCFunction)StrokeHelper_normalize_steno   , METH_O, "Normalize steno."},
-    {"steno_to_sort_key" , (PyCFunction)StrokeHelper_steno_to_sort_key , METH_O, "Convert steno to a binary sort key."},
-    // Stroke: new.
-    {"stroke_from_any"   , (PyCFunction)StrokeHelper_stroke_from_any   , METH_O, "Convert an integer (keys mask), string (steno), or sequence of keys to a stroke."},
-    {"stroke_from_int"   , (PyCFunction)StrokeHelper_stroke_from_int   , METH_O, "Convert an integer (keys mask) to a stroke."},
-    {"stroke_from_keys"  , (PyCFunction)StrokeHelper_stroke_from_keys  , METH_O, "Convert keys to a stroke."},
-    {"stroke_from_steno" , (PyCFunction)StrokeHelper_stroke_from_steno , METH_O, "Convert steno to a stroke."},
-    // Stroke: methods.
-    {"stroke_first_key"  , (PyCFunction)StrokeHelper_stroke_first_key  , METH_O, "Return the stroke first key."},
-    {"stroke_last_key"   , (PyCFunction)StrokeHelper_stroke_last_key   , METH_O, "Return the stroke last key."},
-    {"stroke_invert"     , (PyCFunction)StrokeHelper_stroke_invert     , METH_O, "Invert stroke."},
-    {"stroke_len"        , (PyCFunction)StrokeHelper_stroke_len        , METH_O, "Return the stroke number of keys."},
-    {"stroke_has_digit"  , (PyCFunction)StrokeHelper_stroke_has_digit  , METH_O, "Return True if the stroke contains one or more digits."},
-    {"stroke_is_number"  , (PyCFunction)StrokeHelper_stroke_is_number  , METH_O, "Return True if the stroke is a number."},
-    // Stroke: ops.
-    {"stroke_cmp"        , (PyCFunction)StrokeHelper_stroke_cmp        , METH_VARARGS, "Compare strokes."},
-    {"stroke_eq"         , (PyCFunction)StrokeHelper_stroke_eq         , METH_VARARGS, "Compare strokes: `s1 == s2`."},
-    {"stroke_ne"         , (PyCFunction)StrokeHelper_stroke_ne         , METH_VARARGS, "Compare strokes: `s1 != s2`."},
-    {"stroke_ge"         , (PyCFunction)StrokeHelper_stroke_ge         , METH_VARARGS, "Compare strokes: `s1 >= s2`."},
-    {"stroke_gt"         , (PyCFunction)StrokeHelper_stroke_gt         , METH_VARARGS, "Compare strokes: `s1 > s2`."},
-    {"stroke_le"         , (PyCFunction)StrokeHelper_stroke_le         , METH_VARARGS, "Compare strokes: `s1 <= s2`."},
-    {"stroke_lt"         , (PyCFunction)StrokeHelper_stroke_lt         , METH_VARARGS, "Compare strokes: `s1 < s2`."},
-    {"stroke_in"         , (PyCFunction)StrokeHelper_stroke_in         , METH_VARARGS, "`s1 in s2."},
-    {"stroke_or"         , (PyCFunction)StrokeHelper_stroke_or         , METH_VARARGS, "`s1 | s2."},
-    {"stroke_and"        , (PyCFunction)StrokeHelper_stroke_and        , METH_VARARGS, "`s1 & s2."},
-    {"stroke_add"        , (PyCFunction)StrokeHelper_stroke_add        , METH_VARARGS, "`s1 + s2."},
-    {"stroke_sub"        , (PyCFunction)StrokeHelper_stroke_sub        , METH_VARARGS, "`s1 - s2."},
-    {"stroke_is_prefix"  , (PyCFunction)StrokeHelper_stroke_is_prefix  , METH_VARARGS, "Check if `s1` is a prefix of `s2`."},
-    {"stroke_is_suffix"  , (PyCFunction)StrokeHelper_stroke_is_suffix  , METH_VARARGS, "Check if `s1` is a suffix of `s2`."},
-    // Stroke: convert.
-    {"stroke_to_keys"    , (PyCFunction)StrokeHelper_stroke_to_keys    , METH_O, "Convert stroke to a tuple of keys."},
-    {"stroke_to_steno"   , (PyCFunction)StrokeHelper_stroke_to_steno   , METH_O, "Convert stroke to steno."},
-    {"stroke_to_sort_key", (PyCFunction)StrokeHelper_stroke_to_sort_key, METH_O, "Convert stroke to a binary sort key."},
+    {"update"              , (PyCFunction)StrokeCounter_update              , METH_O, "Count keys masks (buffer of unsigned 64 bits integers, outline, or sequence of strokes): consecutive calls are treated as one sequence of strokes (for counting bigrams)."},
+    {"end_sequence"        , (PyCFunction)StrokeCounter_end_sequence        , METH_NOARGS, "End the current sequence of strokes: the next stroke won't form a bigram with the last one."},
+    {"merge"               , (PyCFunction)StrokeCounter_merge               , METH_O, "Add the counts of another counter (e.g. from another shard)."},
+    {"key_counts"          , (PyCFunction)StrokeCounter_key_counts          , METH_NOARGS, "Return an `array('Q')` with the number of presses of each key."},
+    {"stroke_count"        , (PyCFunction)StrokeCounter_stroke_count        , METH_O, "Return the count for a stroke (keys mask)."},
+    {"bigram_count"        , (PyCFunction)StrokeCounter_bigram_count        , METH_VARARGS, "Return the count for a pair of consecutive strokes (keys masks)."},
+    {"most_common"         , (PyCFunction)StrokeCounter_most_common         , METH_VARARGS, "Return a list of the `n` (default: all) most common strokes, as `(mask, count)` pairs."},
+    {"most_common_bigrams" , (PyCFunction)StrokeCounter_most_common_bigrams , METH_VARARGS, "Return a list of the `n` (default: all) most common bigrams, as `((mask1, mask2), count)` pairs."},
+    {"__reduce__"          , (PyCFunction)StrokeCounter_reduce              , METH_NOARGS, NULL},
+    {"__setstate__"        , (PyCFunction)StrokeCounter_setstate            , METH_O, NULL},
     {NULL}
 };
 
-static PyTypeObject StrokeHelperType =
+static PyTypeObject StrokeCounterType =
 {
     PyVarObject_HEAD_INIT(NULL, 0)
-    .tp_name      = "stroke_helper.StrokeHelper",
-    .tp_basicsize = sizeof (StrokeHelper),
-    .tp_itemsize  = 0,
-    .tp_flags     = Py_TPFLAGS_DEFAULT,
-    .tp_new       = PyType_GenericNew,
-    .tp_methods   = StrokeHelper_methods,
-    .tp_members   = StrokeHelper_members,
-    .tp_getset    = StrokeHelper_getset,
+    .tp_name        = "_plover_stroke.StrokeCounter",
+    .tp_basicsize   = sizeof (StrokeCounter),
+    .tp_itemsize    = 0,
+    .tp_flags       = Py_TPFLAGS_DEFAULT,
+    .tp_doc         = "Per-key, stroke, and stroke bigram frequency counter.",
+    .tp_new         = StrokeCounter_new,
+    .tp_dealloc     = (destructor)StrokeCounter_dealloc,
+    .tp_as_sequence = &StrokeCounter_as_sequence,
+    .tp_getset      = StrokeCounter_getset,
+    .tp_methods     = StrokeCounter_methods,
 };
 
 static struct PyModuleDef module =
@@ -1526,10 +7754,91 @@ PyMODINIT_FUNC PyInit__plover_stroke(void)
     if (PyType_Ready(&StrokeHelperType) < 0)
         return NULL;
 
+    if (PyType_Ready(&WideStrokeHelperType) < 0)
+        return NULL;
+
+    BaseStrokeType.tp_base = &PyLong_Type;
+    if (PyType_Ready(&BaseStrokeType) < 0)
+        return NULL;
+
+    if (PyType_Ready(&OutlineType) < 0)
+        return NULL;
+
+    if (PyType_Ready(&OutlineTrieType) < 0)
+        return NULL;
+
+    if (PyType_Ready(&StrokeSetIndexType) < 0)
+        return NULL;
+
+    if (PyType_Ready(&KeyMapType) < 0)
+        return NULL;
+
+    if (PyType_Ready(&StrokeLogTokenizerType) < 0)
+        return NULL;
+
+    if (PyType_Ready(&StrokeCounterType) < 0)
+        return NULL;
+
+    if (array_type == NULL)
+    {
+        PyObject *array_module = PyImport_ImportModule("array");
+        if (array_module == NULL)
+            return NULL;
+        array_type = PyObject_GetAttrString(array_module, "array");
+        Py_DECREF(array_module);
+        if (array_type == NULL)
+            return NULL;
+    }
+
+    if (int_64 == NULL)
+    {
+        PyObject *one = PyLong_FromLong(1);
+        int_64 = PyLong_FromLong(64);
+        int_2_64 = one == NULL || int_64 == NULL ? NULL : PyNumber_Lshift(one, int_64);
+        Py_XDECREF(one);
+        if (int_2_64 == NULL)
+            return NULL;
+    }
+
+    if (str_slash == NULL)
+    {
+        str_slash = PyUnicode_InternFromString("/");
+        if (str_slash == NULL)
+            return NULL;
+    }
+
+    if (str__helper == NULL)
+    {
+        str__helper = PyUnicode_InternFromString("_helper");
+        str__instances = PyUnicode_InternFromString("_instances");
+        str__instances_max_keys = PyUnicode_InternFromString("_instances_max_keys");
+        if (str__helper == NULL || str__instances == NULL || str__instances_max_keys == NULL)
+            return NULL;
+    }
+
     m = PyModule_Create(&module);
     if (m == NULL)
         return NULL;
 
+    if (PyModule_AddIntConstant(m, "MAX_KEYS", MAX_KEYS) < 0 ||
+        PyModule_AddIntConstant(m, "MAX_WIDE_KEYS", MAX_WIDE_KEYS) < 0)
+    {
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    for (unsigned error = 0; error < NUM_STENO_ERRORS; ++error)
+    {
+        char name[40];
+
+        snprintf(name, sizeof (name), "STENO_%s", steno_error_name[error]);
+        if (PyModule_AddIntConstant(m, name, error) < 0)
+        {
+            Py_DECREF(m);
+            return NULL;
+        }
+    }
+
     Py_INCREF(&StrokeHelperType);
 
     if (PyModule_AddObject(m, "StrokeHelper", (PyObject *)&StrokeHelperType) < 0)
@@ -1539,5 +7848,77 @@ PyMODINIT_FUNC PyInit__plover_stroke(void)
         return NULL;
     }
 
+    Py_INCREF(&WideStrokeHelperType);
+
+    if (PyModule_AddObject(m, "WideStrokeHelper", (PyObject *)&WideStrokeHelperType) < 0)
+    {
+        Py_DECREF(&WideStrokeHelperType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    Py_INCREF(&BaseStrokeType);
+
+    if (PyModule_AddObject(m, "BaseStroke", (PyObject *)&BaseStrokeType) < 0)
+    {
+        Py_DECREF(&BaseStrokeType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    Py_INCREF(&OutlineType);
+
+    if (PyModule_AddObject(m, "Outline", (PyObject *)&OutlineType) < 0)
+    {
+        Py_DECREF(&OutlineType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    Py_INCREF(&OutlineTrieType);
+
+    if (PyModule_AddObject(m, "OutlineTrie", (PyObject *)&OutlineTrieType) < 0)
+    {
+        Py_DECREF(&OutlineTrieType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    Py_INCREF(&StrokeSetIndexType);
+
+    if (PyModule_AddObject(m, "StrokeSetIndex", (PyObject *)&StrokeSetIndexType) < 0)
+    {
+        Py_DECREF(&StrokeSetIndexType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    Py_INCREF(&KeyMapType);
+
+    if (PyModule_AddObject(m, "KeyMap", (PyObject *)&KeyMapType) < 0)
+    {
+        Py_DECREF(&KeyMapType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    Py_INCREF(&StrokeLogTokenizerType);
+
+    if (PyModule_AddObject(m, "StrokeLogTokenizer", (PyObject *)&StrokeLogTokenizerType) < 0)
+    {
+        Py_DECREF(&StrokeLogTokenizerType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    Py_INCREF(&StrokeCounterType);
+
+    if (PyModule_AddObject(m, "StrokeCounter", (PyObject *)&StrokeCounterType) < 0)
+    {
+        Py_DECREF(&StrokeCounterType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
     return m;
 }
@@ -0,0 +1,583 @@
+// Compiled helper code shared by the single word (`stroke_helper_t`) and
+// wide (`wide_helper_t`) helpers: this file is included once for each
+// masks width, with the following macros defined:
+//
+// - `HELPER_T`: the compiled helper type (see `stroke_helper_t`), and
+//   `HELPER_MAX_KEYS`, `HELPER_MAX_STENO`, `HELPER_MAX_LETTERS`, and
+//   `HELPER_LETTERS_HASH_SIZE` for its tables sizes.
+// - `HELPER_PY_T`: the helper object type, and `HELPER_OF(self)`
+//   for its compiled helper.
+// - `HELPER_FN(name)` and `HELPER_PY_FN(name)`: functions and
+//   methods names.
+// - `MASK_T`: the keys mask type, with its operations: `MASK_INVALID`,
+//   `MASK_IS_INVALID(m)`, `MASK_ZERO`, `MASK_BIT(k)`, `MASK_TEST(m, k)`,
+//   `MASK_SHR1(m)`, `MASK_OR(m1, m2)`, `MASK_AND(m1, m2)`,
+//   `MASK_AND_NOT(m1, m2)`, `MASK_IS_ZERO(m)`, `MASK_POPCOUNT(m)`,
+//   `MASK_FIRST_KEY(m)`, and `MASK_TO_PYLONG(m)`.
+//
+// `HELPER_FN(stroke_from_int)` must also be defined (the conversion
+// from a Python integer is specific to each width).
+
+static unsigned HELPER_FN(letters_hash_slot)(const HELPER_T *helper, Py_UCS4 letter)
+{
+    unsigned slot = (letter * 2654435761u) >> 16;
+
+    for (;;)
+    {
+        slot &= HELPER_LETTERS_HASH_SIZE - 1;
+        if (helper->letters_hash[slot] == letter || !helper->letters_hash[slot])
+            return slot;
+        ++slot;
+    }
+}
+
+static unsigned HELPER_FN(letter_index)(const HELPER_T *helper, Py_UCS4 letter)
+{
+    if (letter < 128)
+        return helper->ascii_letter_index[letter];
+
+    return helper->letters_hash_index[HELPER_FN(letters_hash_slot)(helper, letter)];
+}
+
+// Note: `kind` is a constant in each of the `stroke_from_data` calls,
+// so the compiler can generate a specialized version for each kind.
+static inline MASK_T HELPER_FN(stroke_from_kind_data)(const HELPER_T *helper,
+                                                      int             kind,
+                                                      const void     *data,
+                                                      Py_ssize_t      len)
+{
+    MASK_T      mask;
+    Py_UCS4     letter;
+    int         key_index;
+    Py_ssize_t  index;
+    int         implicit_number_key;
+
+    mask = MASK_ZERO;
+    key_index = -1;
+    implicit_number_key = 0;
+
+    for (index = 0; index < len; ++index)
+    {
+        letter = PyUnicode_READ(kind, data, index);
+        if (letter == helper->feral_number_key_letter)
+        {
+            if (!MASK_IS_ZERO(MASK_AND(mask, helper->number_key_mask)))
+                return MASK_INVALID;
+            mask = MASK_OR(mask, helper->number_key_mask);
+            continue;
+        }
+        if (letter == '-')
+        {
+            if (key_index > (int)helper->right_keys_index)
+                return MASK_INVALID;
+            key_index = helper->right_keys_index - 1;
+            continue;
+        }
+        if ('0' <= letter && letter <= '9')
+            implicit_number_key = 1;
+        key_index = helper->next_key[key_index + 1][HELPER_FN(letter_index)(helper, letter)];
+        if (key_index == NO_KEY)
+            return MASK_INVALID;
+        mask = MASK_OR(mask, MASK_BIT(key_index));
+    }
+
+    if (implicit_number_key)
+        mask = MASK_OR(mask, helper->number_key_mask);
+
+    return mask;
+}
+
+// Parse one stroke, directly from a string data (or a buffer,
+// with `kind == PyUnicode_1BYTE_KIND`): no copy is involved.
+static MASK_T HELPER_FN(stroke_from_data)(const HELPER_T *helper,
+                                          int             kind,
+                                          const void     *data,
+                                          Py_ssize_t      len)
+{
+    if (len > HELPER_MAX_STENO)
+        return MASK_INVALID;
+
+    switch (kind)
+    {
+    case PyUnicode_1BYTE_KIND:
+        return HELPER_FN(stroke_from_kind_data)(helper, PyUnicode_1BYTE_KIND, data, len);
+    case PyUnicode_2BYTE_KIND:
+        return HELPER_FN(stroke_from_kind_data)(helper, PyUnicode_2BYTE_KIND, data, len);
+    case PyUnicode_4BYTE_KIND:
+        return HELPER_FN(stroke_from_kind_data)(helper, PyUnicode_4BYTE_KIND, data, len);
+    default:
+        UNREACHABLE();
+    }
+}
+
+static MASK_T HELPER_FN(stroke_from_keys)(const HELPER_T *helper, PyObject *keys_sequence)
+{
+    MASK_T         mask;
+    PyObject      *key;
+    Py_UCS4        key_letter;
+    key_side_t     key_side;
+    const Py_UCS4 *possible_letters;
+    unsigned       k, k_end;
+
+    mask = MASK_ZERO;
+
+    for (Py_ssize_t num_keys = PySequence_Fast_GET_SIZE(keys_sequence); num_keys--; )
+    {
+        key = PySequence_Fast_GET_ITEM(keys_sequence, num_keys);
+        if (!PyUnicode_Check(key))
+        {
+            PyErr_Format(PyExc_ValueError, "invalid `keys`; key %zd is not a string: %R", num_keys, key);
+            return MASK_INVALID;
+        }
+
+        key_letter = key_to_letter(key, &key_side);
+        if (!key_letter)
+        {
+            PyErr_Format(PyExc_ValueError, "invalid `keys`; key %zd is not valid: %R", num_keys, key);
+            return MASK_INVALID;
+        }
+
+        if ('0' <= key_letter && key_letter <= '9')
+        {
+            mask = MASK_OR(mask, helper->number_key_mask);
+            possible_letters = helper->key_number;
+        }
+        else
+        {
+            possible_letters = helper->key_letter;
+        }
+
+        switch (key_side)
+        {
+        case KEY_SIDE_NONE:
+            k = 0;
+            k_end = helper->num_keys;
+            break;
+        case KEY_SIDE_LEFT:
+            k = 0;
+            k_end = helper->right_keys_index;
+            break;
+        case KEY_SIDE_RIGHT:
+            k = helper->right_keys_index;
+            k_end = helper->num_keys;
+            break;
+        default:
+            UNREACHABLE();
+        }
+
+        for (; k < k_end; ++k)
+        {
+            if (key_letter == possible_letters[k] && key_side == helper->key_side[k])
+                break;
+        }
+
+        if (k == k_end)
+        {
+            PyErr_Format(PyExc_ValueError, "invalid key: %R", key);
+            return MASK_INVALID;
+        }
+
+        mask = MASK_OR(mask, MASK_BIT(k));
+    }
+
+    return mask;
+}
+
+static MASK_T HELPER_FN(stroke_from_steno)(const HELPER_T *helper, PyObject *steno)
+{
+    MASK_T mask;
+
+    if (PyUnicode_READY(steno))
+        return MASK_INVALID;
+
+    mask = HELPER_FN(stroke_from_data)(helper,
+                                       PyUnicode_KIND(steno),
+                                       PyUnicode_DATA(steno),
+                                       PyUnicode_GET_LENGTH(steno));
+    if (MASK_IS_INVALID(mask))
+        PyErr_Format(PyExc_ValueError, "invalid steno: %R", steno);
+
+    return mask;
+}
+
+static MASK_T HELPER_FN(stroke_from_any)(const HELPER_T *helper, PyObject *obj)
+{
+    PyObject *keys_sequence;
+    MASK_T    mask;
+
+    if (PyLong_Check(obj))
+        return HELPER_FN(stroke_from_int)(helper, obj);
+
+    if (PyUnicode_Check(obj))
+        return HELPER_FN(stroke_from_steno)(helper, obj);
+
+    keys_sequence = PySequence_Fast(obj, "expected a list or tuple");
+    if (keys_sequence == NULL)
+    {
+        PyErr_Format(PyExc_TypeError,
+                     "expected an integer (mask of keys), "
+                     "sequence of keys, or a string (steno), "
+                     "got: %R", obj);
+        return MASK_INVALID;
+    }
+
+    mask = HELPER_FN(stroke_from_keys)(helper, keys_sequence);
+    Py_DECREF(keys_sequence);
+
+    return mask;
+}
+
+static int HELPER_FN(stroke_has_digit)(const HELPER_T *helper, MASK_T mask)
+{
+    return !MASK_IS_ZERO(MASK_AND(mask, helper->number_key_mask)) &&
+           !MASK_IS_ZERO(MASK_AND(mask, helper->numbers_mask));
+}
+
+static int HELPER_FN(stroke_is_number)(const HELPER_T *helper, MASK_T mask)
+{
+    // Must have the number key, at least one digit, and no other non-digit key.
+    return HELPER_FN(stroke_has_digit)(helper, mask) &&
+           MASK_IS_ZERO(MASK_AND_NOT(mask, MASK_OR(helper->number_key_mask, helper->numbers_mask)));
+}
+
+static PyObject *HELPER_FN(key_str)(const HELPER_T *helper, unsigned key_index, int number)
+{
+    PyObject *key = helper->key_str[number ? 1 : 0][key_index];
+
+    Py_INCREF(key);
+
+    return key;
+}
+
+static PyObject *HELPER_FN(stroke_to_keys)(const HELPER_T *helper, MASK_T mask)
+{
+    PyObject *keys_tuple;
+    unsigned  stroke_index;
+    unsigned  key_index;
+
+    keys_tuple = PyTuple_New(MASK_POPCOUNT(mask));
+    if (keys_tuple == NULL)
+        return NULL;
+
+    for (stroke_index = key_index = 0; !MASK_IS_ZERO(mask); ++key_index, mask = MASK_SHR1(mask))
+    {
+        if (MASK_TEST(mask, 0))
+            PyTuple_SET_ITEM(keys_tuple, stroke_index++, HELPER_FN(key_str)(helper, key_index, 0));
+    }
+
+    return keys_tuple;
+}
+
+// Render a stroke into `stroke` (with room for `HELPER_MAX_STENO`
+// characters), return its length. Note: can be used without the GIL.
+static unsigned HELPER_FN(stroke_to_ucs4)(const HELPER_T *helper, MASK_T mask, Py_UCS4 *stroke)
+{
+    const Py_UCS4 *letters;
+    unsigned       key_index;
+    unsigned       hyphen_index;
+    unsigned       stroke_index;
+
+    if (HELPER_FN(stroke_has_digit)(helper, mask))
+    {
+        mask = MASK_AND_NOT(mask, helper->number_key_mask);
+        letters = helper->key_number;
+    }
+    else
+    {
+        letters = helper->key_letter;
+    }
+
+    if (!MASK_IS_ZERO(MASK_AND(mask, helper->implicit_hyphen_mask)))
+        hyphen_index = HELPER_MAX_KEYS;
+    else
+        hyphen_index = helper->right_keys_index;
+
+    for (stroke_index = key_index = 0; !MASK_IS_ZERO(mask); ++key_index, mask = MASK_SHR1(mask))
+    {
+        if (MASK_TEST(mask, 0))
+        {
+            if (key_index >= hyphen_index)
+            {
+                stroke[stroke_index++] = '-';
+                hyphen_index = HELPER_MAX_KEYS;
+            }
+            stroke[stroke_index++] = letters[key_index];
+        }
+    }
+
+    return stroke_index;
+}
+
+static PyObject *HELPER_FN(stroke_to_str)(const HELPER_T *helper, MASK_T mask)
+{
+    Py_UCS4  stroke[HELPER_MAX_STENO];
+    unsigned stroke_len;
+
+    stroke_len = HELPER_FN(stroke_to_ucs4)(helper, mask, stroke);
+
+    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, stroke, stroke_len);
+}
+
+static void HELPER_FN(stroke_helper_clear)(HELPER_T *helper)
+{
+    for (unsigned k = 0; k < helper->num_keys; ++k)
+    {
+        Py_CLEAR(helper->key_str[0][k]);
+        Py_CLEAR(helper->key_str[1][k]);
+    }
+    helper->num_keys = 0;
+}
+
+static int HELPER_FN(compile_key_strs)(HELPER_T *helper)
+{
+    for (unsigned k = 0; k < helper->num_keys; ++k)
+    {
+        helper->key_str[0][k] = helper->key_str[1][k] = NULL;
+    }
+
+    for (unsigned k = 0; k < helper->num_keys; ++k)
+    {
+        for (int number = 0; number < 2; ++number)
+        {
+            helper->key_str[number][k] = key_str_new((number ? helper->key_number : helper->key_letter)[k],
+                                                     helper->key_side[k]);
+            if (helper->key_str[number][k] == NULL)
+            {
+                HELPER_FN(stroke_helper_clear)(helper);
+                return -1;
+            }
+        }
+    }
+
+    return 0;
+}
+
+// Build the parsing tables.
+static void HELPER_FN(compile_letters)(HELPER_T *helper)
+{
+    Py_UCS4  letters[HELPER_MAX_LETTERS + 1];
+    Py_UCS4  letter;
+    unsigned slot;
+    unsigned l;
+    unsigned next;
+
+    helper->num_letters = 0;
+    memset(helper->ascii_letter_index, 0, sizeof (helper->ascii_letter_index));
+    memset(helper->letters_hash, 0, sizeof (helper->letters_hash));
+    memset(helper->letters_hash_index, 0, sizeof (helper->letters_hash_index));
+
+    // Note: when parsing, digits are looked up in the keys numbers,
+    // and anything else in the keys letters.
+    for (unsigned k = 0; k < helper->num_keys; ++k)
+    {
+        for (int digit = 0; digit < 2; ++digit)
+        {
+            letter = (digit ? helper->key_number : helper->key_letter)[k];
+            if (('0' <= letter && letter <= '9') != digit || HELPER_FN(letter_index)(helper, letter))
+                continue;
+            l = ++helper->num_letters;
+            assert(l <= HELPER_MAX_LETTERS);
+            letters[l] = letter;
+            if (letter < 128)
+                helper->ascii_letter_index[letter] = l;
+            else
+            {
+                slot = HELPER_FN(letters_hash_slot)(helper, letter);
+                helper->letters_hash[slot] = letter;
+                helper->letters_hash_index[slot] = l;
+            }
+        }
+    }
+
+    memset(helper->next_key, NO_KEY, sizeof (helper->next_key));
+
+    for (l = 1; l <= helper->num_letters; ++l)
+    {
+        letter = letters[l];
+        next = NO_KEY;
+        for (unsigned k = helper->num_keys; k--; )
+        {
+            if (letter == (('0' <= letter && letter <= '9') ? helper->key_number : helper->key_letter)[k])
+                next = k;
+            helper->next_key[k][l] = next;
+        }
+    }
+}
+
+// Compile a system definition (see `parse_system`).
+static int HELPER_FN(compile_system)(HELPER_T *helper, const system_t *system)
+{
+    memset(helper, 0, sizeof (*helper));
+
+    helper->num_keys = system->num_keys;
+    helper->right_keys_index = system->right_keys_index;
+    helper->feral_number_key_letter = system->feral_number_key_letter;
+
+    for (unsigned k = 0; k < system->num_keys; ++k)
+    {
+        helper->key_side[k] = system->key_side[k];
+        helper->key_letter[k] = system->key_letter[k];
+        helper->key_number[k] = system->key_number[k];
+        if (system->key_has_number[k])
+            helper->numbers_mask = MASK_OR(helper->numbers_mask, MASK_BIT(k));
+    }
+
+    for (unsigned k = system->implicit_hyphen_start; k < system->implicit_hyphen_end; ++k)
+        helper->implicit_hyphen_mask = MASK_OR(helper->implicit_hyphen_mask, MASK_BIT(k));
+
+    if (system->number_key_index >= 0)
+        helper->number_key_mask = MASK_BIT(system->number_key_index);
+
+    HELPER_FN(compile_letters)(helper);
+
+    return HELPER_FN(compile_key_strs)(helper);
+}
+
+// Getters: for getting back the arguments passed to setup.
+
+static PyObject *HELPER_PY_FN(get_keys)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    const HELPER_T *helper = HELPER_OF(self);
+    PyObject       *keys_tuple;
+
+    keys_tuple = PyTuple_New(helper->num_keys);
+    if (keys_tuple == NULL)
+        return NULL;
+
+    for (unsigned k = 0; k < helper->num_keys; ++k)
+        PyTuple_SET_ITEM(keys_tuple, k, HELPER_FN(key_str)(helper, k, 0));
+
+    return keys_tuple;
+}
+
+static PyObject *HELPER_PY_FN(get_implicit_hyphen_keys)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    const HELPER_T *helper = HELPER_OF(self);
+    PyObject       *implicit_hyphen_keys;
+
+    implicit_hyphen_keys = PySet_New(NULL);
+    if (implicit_hyphen_keys == NULL)
+        return NULL;
+
+    for (unsigned k = 0; k < helper->num_keys; ++k)
+    {
+        if (MASK_TEST(helper->implicit_hyphen_mask, k) &&
+            PySet_Add(implicit_hyphen_keys, helper->key_str[0][k]))
+        {
+            Py_DECREF(implicit_hyphen_keys);
+            return NULL;
+        }
+    }
+
+    return implicit_hyphen_keys;
+}
+
+static PyObject *HELPER_PY_FN(get_number_key)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    const HELPER_T *helper = HELPER_OF(self);
+
+    if (MASK_IS_ZERO(helper->number_key_mask))
+        Py_RETURN_NONE;
+
+    return HELPER_FN(key_str)(helper, MASK_FIRST_KEY(helper->number_key_mask), 0);
+}
+
+static PyObject *HELPER_PY_FN(get_numbers)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    const HELPER_T *helper = HELPER_OF(self);
+    PyObject       *numbers;
+
+    if (MASK_IS_ZERO(helper->number_key_mask))
+        Py_RETURN_NONE;
+
+    numbers = PyDict_New();
+    if (numbers == NULL)
+        return NULL;
+
+    for (unsigned k = 0; k < helper->num_keys; ++k)
+    {
+        if (helper->key_letter[k] == helper->key_number[k])
+            continue;
+        if (PyDict_SetItem(numbers, helper->key_str[0][k], helper->key_str[1][k]))
+        {
+            Py_DECREF(numbers);
+            return NULL;
+        }
+    }
+
+    return numbers;
+}
+
+static PyObject *HELPER_PY_FN(get_feral_number_key)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    return PyBool_FromLong(HELPER_OF(self)->feral_number_key_letter != 0);
+}
+
+// Getters: other derived fields.
+
+static PyObject *HELPER_PY_FN(get_key_letter)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, HELPER_OF(self)->key_letter, HELPER_OF(self)->num_keys);
+}
+
+static PyObject *HELPER_PY_FN(get_key_number)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, HELPER_OF(self)->key_number, HELPER_OF(self)->num_keys);
+}
+
+static PyObject *HELPER_PY_FN(get_feral_number_key_letter)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    if (HELPER_OF(self)->feral_number_key_letter == 0)
+        Py_RETURN_NONE;
+
+    return PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, &HELPER_OF(self)->feral_number_key_letter, 1);
+}
+
+static PyObject *HELPER_PY_FN(get_num_keys)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    return PyLong_FromUnsignedLong(HELPER_OF(self)->num_keys);
+}
+
+static PyObject *HELPER_PY_FN(get_implicit_hyphen_mask)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    return MASK_TO_PYLONG(HELPER_OF(self)->implicit_hyphen_mask);
+}
+
+static PyObject *HELPER_PY_FN(get_number_key_mask)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    return MASK_TO_PYLONG(HELPER_OF(self)->number_key_mask);
+}
+
+static PyObject *HELPER_PY_FN(get_numbers_mask)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    return MASK_TO_PYLONG(HELPER_OF(self)->numbers_mask);
+}
+
+static PyObject *HELPER_PY_FN(get_right_keys_index)(const HELPER_PY_T *self, void *Py_UNUSED(closure))
+{
+    return PyLong_FromUnsignedLong(HELPER_OF(self)->right_keys_index);
+}
+
+#undef HELPER_T
+#undef HELPER_MAX_KEYS
+#undef HELPER_MAX_STENO
+#undef HELPER_MAX_LETTERS
+#undef HELPER_LETTERS_HASH_SIZE
+#undef HELPER_PY_T
+#undef HELPER_OF
+#undef HELPER_FN
+#undef HELPER_PY_FN
+#undef MASK_T
+#undef MASK_INVALID
+#undef MASK_IS_INVALID
+#undef MASK_ZERO
+#undef MASK_BIT
+#undef MASK_TEST
+#undef MASK_SHR1
+#undef MASK_OR
+#undef MASK_AND
+#undef MASK_AND_NOT
+#undef MASK_IS_ZERO
+#undef MASK_POPCOUNT
+#undef MASK_FIRST_KEY
+#undef MASK_TO_PYLONG
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+import argparse
+import array
+import functools
+import json
+import random
+import sys
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+from plover_stroke import (
+    BaseStroke,
+    KeyMap,
+    StrokeCounter,
+    StrokeLogTokenizer,
+    WideStrokeHelper,
+)
+
+
+ENGLISH_SYSTEM = dict(
+    keys='''
+    #
+    S- T- K- P- W- H- R-
+    A- O-
+    *
+    -E -U
+    -F -R -P -B -L -G -T -S -D -Z
+    '''.split(),
+    implicit_hyphen_keys='A- O- * -E -U'.split(),
+    number_key='#',
+    numbers={
+        'S-': '1-',
+        'T-': '2-',
+        'P-': '3-',
+        'H-': '4-',
+        'A-': '5-',
+        'O-': '0-',
+        '-F': '-6',
+        '-P': '-7',
+        '-L': '-8',
+        '-T': '-9',
+    },
+)
+
+NO_NUMBERS_SYSTEM = dict(
+    keys=ENGLISH_SYSTEM['keys'][1:],
+    implicit_hyphen_keys=ENGLISH_SYSTEM['implicit_hyphen_keys'],
+)
+
+FERAL_SYSTEM = dict(ENGLISH_SYSTEM, feral_number_key=True)
+
+# 63 keys: the maximum supported (standard masks).
+MAX_KEYS_SYSTEM = dict(
+    keys=(
+        [l + '-' for l in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcd'] +
+        ['-' + l for l in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefg']
+    ),
+)
+
+# English, but using wide masks: for comparing
+# the wide masks code paths against the standard ones.
+ENGLISH_WIDE_SYSTEM = dict(ENGLISH_SYSTEM, helper_class=WideStrokeHelper)
+
+WIDE_LETTERS = (
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    'abcdefghijklmnopqrstuvwxyz'
+    'αβγδεζηθικλμνξοπρστυφχψω'
+)
+
+# 127 keys: the maximum supported (wide masks).
+MAX_WIDE_KEYS_SYSTEM = dict(
+    keys=(
+        [l + '-' for l in WIDE_LETTERS[:63]] +
+        ['-' + l for l in WIDE_LETTERS[:64]]
+    ),
+)
+
+SYSTEMS = {
+    'english': ENGLISH_SYSTEM,
+    'no-numbers': NO_NUMBERS_SYSTEM,
+    'feral': FERAL_SYSTEM,
+    '63-keys': MAX_KEYS_SYSTEM,
+    'english-wide': ENGLISH_WIDE_SYSTEM,
+    '127-keys': MAX_WIDE_KEYS_SYSTEM,
+}
+
+
+def make_stroke_class(system):
+    system = dict(system)
+    helper_class = system.pop('helper_class', None)
+    class Stroke(BaseStroke):
+        __slots__ = ()
+    if helper_class is None:
+        Stroke.setup(**system)
+    else:
+        if system.get('implicit_hyphen_keys') is not None:
+            system['implicit_hyphen_keys'] = set(system['implicit_hyphen_keys'])
+        helper = helper_class()
+        helper.setup(**system)
+        Stroke._helper = helper
+        Stroke._instances = {}
+    return Stroke
+
+
+class Corpus:
+    ''' Synthetic dictionary: random (but valid) strokes, and outlines. '''
+
+    def __init__(self, stroke_class, size, seed=0):
+        rnd = random.Random(seed)
+        num_keys = stroke_class._helper.num_keys
+        self.strokes = []
+        for __ in range(size):
+            mask = 0
+            for key in rnd.sample(range(num_keys), rnd.randint(1, 8)):
+                mask |= 1 << key
+            self.strokes.append(stroke_class.from_integer(mask))
+        self.steno = [str(s) for s in self.strokes]
+        self.keys = [s.keys() for s in self.strokes]
+        self.masks = [int(s) for s in self.strokes]
+        # Like in a real dictionary: mostly 1 or 2 strokes outlines.
+        self.outlines = [
+            '/'.join(rnd.sample(self.steno, rnd.choice((1, 1, 2, 2, 3))))
+            for __ in range(size)
+        ]
+
+    def __len__(self):
+        return len(self.strokes)
+
+
+# Note: each benchmark processes all the corpus items once,
+# the results are reported in nanoseconds per item.
+BENCHMARKS = {
+    # Stroke: new.
+    'from_steno': lambda cls, corpus: (
+        lambda fn=cls.from_steno: [fn(s) for s in corpus.steno]
+    ),
+    'from_keys': lambda cls, corpus: (
+        lambda fn=cls.from_keys: [fn(k) for k in corpus.keys]
+    ),
+    'from_integer': lambda cls, corpus: (
+        lambda fn=cls.from_integer: [fn(m) for m in corpus.masks]
+    ),
+    'stroke_from_buffer': lambda cls, corpus: _bench_stroke_from_buffer(cls._helper, corpus),
+    'stroke_log': lambda cls, corpus: _bench_stroke_log(cls._helper, corpus),
+    'stroke_from_packet': lambda cls, corpus: _bench_key_map(cls._helper, corpus, batch=False),
+    # Stroke: convert.
+    'stroke_to_steno': lambda cls, corpus: (
+        lambda: [str(s) for s in corpus.strokes]
+    ),
+    'stroke_to_keys': lambda cls, corpus: (
+        lambda: [s.keys() for s in corpus.strokes]
+    ),
+    # Stroke: ops.
+    'compare': lambda cls, corpus: (
+        lambda pairs=list(zip(corpus.strokes, corpus.strokes[1:])): [s1 < s2 for s1, s2 in pairs]
+    ),
+    'hash': lambda cls, corpus: (
+        lambda: [hash(s) for s in corpus.strokes]
+    ),
+    'sort': lambda cls, corpus: (
+        lambda: sorted(corpus.strokes)
+    ),
+    # Steno.
+    'normalize_steno': lambda cls, corpus: (
+        lambda fn=cls._helper.normalize_steno: [fn(s) for s in corpus.outlines]
+    ),
+    'steno_to_sort_key': lambda cls, corpus: (
+        lambda fn=cls._helper.steno_to_sort_key: [fn(s) for s in corpus.outlines]
+    ),
+    # Batch operations.
+    'steno_list_to_masks': lambda cls, corpus: (
+        lambda: cls._helper.steno_list_to_masks(corpus.outlines)
+    ),
+    'validate_steno_list': lambda cls, corpus: (
+        lambda: cls._helper.validate_steno_list(corpus.outlines)
+    ),
+    'masks_to_steno_list': lambda cls, corpus: (
+        lambda masks=cls._helper.steno_list_to_masks(corpus.outlines)[:2]:
+        cls._helper.masks_to_steno_list(*masks)
+    ),
+    'masks_len': lambda cls, corpus: (
+        lambda masks=_masks_array(corpus): cls._helper.masks_len(masks)
+    ),
+    'masks_is_number': lambda cls, corpus: (
+        lambda masks=_masks_array(corpus): cls._helper.masks_is_number(masks)
+    ),
+    'masks_or': lambda cls, corpus: (
+        lambda masks=_masks_array(corpus): cls._helper.masks_or(masks, masks)
+    ),
+    'stroke_counter': lambda cls, corpus: (
+        lambda masks=_masks_array(corpus): StrokeCounter(cls._helper.num_keys).update(masks)
+    ),
+    'sort_outlines': lambda cls, corpus: (
+        lambda: cls._helper.sort_outlines(corpus.outlines)
+    ),
+    'packets_to_masks': lambda cls, corpus: _bench_key_map(cls._helper, corpus, batch=True),
+    'threaded_steno_list_to_masks': lambda cls, corpus: _bench_threaded(cls._helper.steno_list_to_masks, corpus.outlines),
+    'threaded_sort_outlines': lambda cls, corpus: _bench_threaded(cls._helper.sort_outlines, corpus.outlines),
+}
+
+# Benchmarks supported with wide masks (single stroke operations).
+WIDE_BENCHMARKS = {
+    'from_steno', 'from_keys', 'from_integer',
+    'stroke_to_steno', 'stroke_to_keys',
+    'compare', 'hash', 'sort',
+}
+
+# Benchmarks run on the shared thread pool (passed as argument).
+THREADED_BENCHMARKS = {
+    'threaded_steno_list_to_masks', 'threaded_sort_outlines',
+}
+
+def _masks_array(corpus):
+    return array.array('Q', corpus.masks)
+
+def _bench_stroke_from_buffer(helper, corpus):
+    # Parse each stroke in place from a single buffer, like
+    # when scanning a memory-mapped dictionary.
+    buffer = '\n'.join(corpus.steno).encode()
+    ranges = []
+    start = 0
+    for steno in corpus.steno:
+        ranges.append((start, start + len(steno)))
+        start += len(steno) + 1
+    return lambda fn=helper.stroke_from_buffer: [fn(buffer, s, e) for s, e in ranges]
+
+def _bench_stroke_log(helper, corpus):
+    # Tokenize a strokes log, fed in 64KiB chunks.
+    log = ''.join(
+        '2021-03-07 12:34:56,789 Stroke(%s : %r)\n' % (steno, list(keys))
+        for steno, keys in zip(corpus.steno, corpus.keys)
+    ).encode()
+    chunks = [log[n:n + 65536] for n in range(0, len(log), 65536)]
+    def fn():
+        tokenizer = StrokeLogTokenizer(helper)
+        return [tokenizer.feed(chunk) for chunk in chunks]
+    return fn
+
+def _bench_key_map(helper, corpus, batch):
+    # Identity mapping (protocol bit N is key N), with
+    # each stroke sent as an 8 bytes packet.
+    key_map = KeyMap(helper, dict(enumerate(helper.keys)), packet_size=8)
+    packets = [m.to_bytes(8, 'little') for m in corpus.masks]
+    if batch:
+        return lambda buffer=b''.join(packets): key_map.packets_to_masks(buffer)
+    return lambda fn=key_map.stroke_from_packet: [fn(p) for p in packets]
+
+THREADS = 4
+
+def _bench_threaded(fn, items):
+    # Split the items in chunks, processed on a thread pool:
+    # should scale with the number of cores (the GIL is released).
+    chunk_size = (len(items) + THREADS - 1) // THREADS
+    chunks = [items[n:n + chunk_size] for n in range(0, len(items), chunk_size)]
+    return lambda executor: list(executor.map(fn, chunks))
+
+
+def run(systems, benchmarks, corpus_size, repeat):
+    ''' Run the benchmarks, yield `(system, benchmark, ns_per_item)`. '''
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        for system_name in systems:
+            stroke_class = make_stroke_class(SYSTEMS[system_name])
+            corpus = Corpus(stroke_class, corpus_size)
+            wide = isinstance(stroke_class._helper, WideStrokeHelper)
+            for name in benchmarks:
+                if wide and name not in WIDE_BENCHMARKS:
+                    continue
+                fn = BENCHMARKS[name](stroke_class, corpus)
+                if name in THREADED_BENCHMARKS:
+                    fn = functools.partial(fn, executor)
+                best = min(timeit.repeat(fn, number=1, repeat=repeat))
+                yield system_name, name, best * 1e9 / len(corpus)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark plover_stroke.')
+    parser.add_argument('-n', '--corpus-size', type=int, default=100000,
+                        help='number of strokes / outlines in the corpus')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of repetitions (best is reported)')
+    parser.add_argument('-s', '--system', action='append', choices=list(SYSTEMS),
+                        help='system(s) to benchmark (default: all)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results (JSON), for use as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='when comparing, report slowdowns above this '
+                        'percentage as regressions (and exit with an error)')
+    parser.add_argument('benchmark', nargs='*', metavar='BENCHMARK',
+                        help='benchmark(s) to run (default: all): %s' % ', '.join(BENCHMARKS))
+    options = parser.parse_args()
+    for name in options.benchmark:
+        if name not in BENCHMARKS:
+            parser.error('invalid benchmark: %s' % name)
+    baseline = {}
+    if options.compare is not None:
+        with open(options.compare) as fp:
+            baseline = json.load(fp)['results']
+    results = {}
+    regressions = 0
+    for system_name, name, ns in run(options.system or list(SYSTEMS),
+                                     options.benchmark or list(BENCHMARKS),
+                                     options.corpus_size, options.repeat):
+        results.setdefault(system_name, {})[name] = ns
+        line = '%-12s %-28s %8.1f ns/item' % (system_name, name, ns)
+        base_ns = baseline.get(system_name, {}).get(name)
+        if base_ns is not None:
+            change = (ns - base_ns) * 100 / base_ns
+            line += ' [baseline: %8.1f ns/item, %+6.1f%%]' % (base_ns, change)
+            if change > options.threshold:
+                line += ' REGRESSION'
+                regressions += 1
+        print(line, flush=True)
+    if options.save is not None:
+        with open(options.save, 'w') as fp:
+            json.dump({
+                'corpus_size': options.corpus_size,
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+    if regressions:
+        print('%u regression(s) above %g%%' % (regressions, options.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
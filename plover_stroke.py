@@ -1,90 +1,115 @@
-from _plover_stroke import StrokeHelper
-
-
-class BaseStroke(int):
+import array
+import enum
+import json
+import mmap
+import re
+
+from _plover_stroke import (
+    MAX_KEYS,
+    MAX_WIDE_KEYS,
+    BaseStroke as _BaseStroke,
+    KeyMap,
+    Outline,
+    OutlineTrie,
+    StrokeCounter,
+    StrokeHelper,
+    StrokeLogTokenizer,
+    StrokeSetIndex,
+    WideStrokeHelper,
+)
+import _plover_stroke
+
+
+class StenoError(enum.IntEnum):
+    """
+    Steno validation error codes, as returned
+    by `StrokeHelper.validate_steno_list`.
+    """
+
+    OK = _plover_stroke.STENO_OK
+    EMPTY_STROKE = _plover_stroke.STENO_EMPTY_STROKE
+    TOO_LONG = _plover_stroke.STENO_TOO_LONG
+    INVALID_LETTER = _plover_stroke.STENO_INVALID_LETTER
+    MISORDERED_KEY = _plover_stroke.STENO_MISORDERED_KEY
+    DUPLICATE_NUMBER_KEY = _plover_stroke.STENO_DUPLICATE_NUMBER_KEY
+    MISPLACED_HYPHEN = _plover_stroke.STENO_MISPLACED_HYPHEN
+    NOT_STENO = _plover_stroke.STENO_NOT_STENO
+
+
+# Registry of compiled systems: normalized definition -> helper.
+_SYSTEM_HELPERS = {}
+
+def system_helper(keys, implicit_hyphen_keys=None,
+                  number_key=None, numbers=None,
+                  feral_number_key=False):
+    """
+    Return a helper setup for the given system: the compiled system is
+    shared with all the other helpers for the same system definition
+    (but each helper has its own caches and stats).
+
+    Systems with more than `MAX_KEYS` keys use a `WideStrokeHelper`
+    (128 bits masks), which only supports single stroke operations.
+    """
+    if implicit_hyphen_keys is not None and not isinstance(implicit_hyphen_keys, set):
+        implicit_hyphen_keys = set(implicit_hyphen_keys)
+    try:
+        keys = tuple(keys)
+        definition = (
+            keys,
+            None if implicit_hyphen_keys is None else frozenset(implicit_hyphen_keys),
+            number_key,
+            None if numbers is None else frozenset(numbers.items()),
+            bool(feral_number_key),
+        )
+        helper = _SYSTEM_HELPERS.get(definition)
+    except (AttributeError, TypeError):
+        # Invalid definition: let `setup` report the error.
+        definition = None
+        helper = None
+    if helper is None:
+        helper = StrokeHelper() if len(keys) <= MAX_KEYS else WideStrokeHelper()
+        helper.setup(keys, implicit_hyphen_keys=implicit_hyphen_keys,
+                     number_key=number_key, numbers=numbers,
+                     feral_number_key=feral_number_key)
+        if definition is not None:
+            helper = _SYSTEM_HELPERS.setdefault(definition, helper)
+    return helper.copy()
+
+
+class BaseStroke(_BaseStroke):
+
+    # Note: subclasses should also use `__slots__ = ()`,
+    # so instances don't carry a `__dict__`.
+    __slots__ = ()
 
     _helper = None
 
+    # Cache of instances (mask -> stroke), reset on setup:
+    # strokes with up to `_instances_max_keys` keys are shared.
+    _instances = None
+    _instances_max_keys = 4
+
     @classmethod
     def setup(cls, keys, implicit_hyphen_keys=None,
               number_key=None, numbers=None,
               feral_number_key=False):
-        cls._helper = StrokeHelper()
+        cls._instances = {}
         if number_key is None:
             assert numbers is None
         else:
             assert numbers is not None
-        if implicit_hyphen_keys is not None and not isinstance(implicit_hyphen_keys, set):
-            implicit_hyphen_keys = set(implicit_hyphen_keys)
-        cls._helper.setup(keys, implicit_hyphen_keys=implicit_hyphen_keys,
-                          number_key=number_key, numbers=numbers,
-                          feral_number_key=feral_number_key)
+        cls._helper = system_helper(keys, implicit_hyphen_keys=implicit_hyphen_keys,
+                                    number_key=number_key, numbers=numbers,
+                                    feral_number_key=feral_number_key)
 
-    @classmethod
-    def from_steno(cls, steno):
-        return int.__new__(cls, cls._helper.stroke_from_steno(steno))
+    # Note: `from_steno`, `from_keys`, `from_integer`, and `__new__`
+    # are implemented natively, as well as comparison, hashing, and the
+    # `|`, `&`, `+`, `-`, `~`, `in`, `len`, `iter`, `str`, and `repr`
+    # operators.
 
     @classmethod
-    def from_keys(cls, keys):
-        return int.__new__(cls, cls._helper.stroke_from_keys(keys))
-
-    @classmethod
-    def from_integer(cls, integer):
-        return int.__new__(cls, cls._helper.stroke_from_int(integer))
-
-    def __new__(cls, value):
-        return int.__new__(cls, cls._helper.stroke_from_any(value))
-
-    def __hash__(self):
-        return int(self)
-
-    def __eq__(self, other):
-        return self._helper.stroke_eq(self, other)
-
-    def __ge__(self, other):
-        return self._helper.stroke_ge(self, other)
-
-    def __gt__(self, other):
-        return self._helper.stroke_gt(self, other)
-
-    def __le__(self, other):
-        return self._helper.stroke_le(self, other)
-
-    def __lt__(self, other):
-        return self._helper.stroke_lt(self, other)
-
-    def __ne__(self, other):
-        return self._helper.stroke_ne(self, other)
-
-    def __contains__(self, other):
-        return self._helper.stroke_in(other, self)
-
-    def __invert__(self):
-        return self.from_integer(self._helper.stroke_invert(self))
-
-    def __or__(self, other):
-        return self.from_integer(self._helper.stroke_or(self, other))
-
-    def __and__(self, other):
-        return self.from_integer(self._helper.stroke_and(self, other))
-
-    def __add__(self, other):
-        return self.from_integer(self._helper.stroke_or(self, other))
-
-    def __sub__(self, other):
-        return self.from_integer(self._helper.stroke_sub(self, other))
-
-    def __len__(self):
-        return self._helper.stroke_len(self)
-
-    def __iter__(self):
-        return iter(self._helper.stroke_to_keys(self))
-
-    def __repr__(self):
-        return self._helper.stroke_to_steno(self)
-
-    def __str__(self):
-        return self._helper.stroke_to_steno(self)
+    def from_outline(cls, outline):
+        return tuple(map(cls.from_integer, outline))
 
     def first(self):
         return self._helper.stroke_first_key(self)
@@ -107,6 +132,155 @@ class BaseStroke(int):
     def is_suffix(self, other):
         return self._helper.stroke_is_suffix(self, other)
 
+    # Note: the helper is pickled along with the stroke, so
+    # the class can be setup on unpickling (e.g. in a worker
+    # process of a `ProcessPoolExecutor`).
+    def __reduce__(self):
+        return _stroke_from_helper, (type(self), self._helper, int(self))
+
+
+def _stroke_from_helper(stroke_class, helper, mask):
+    if stroke_class._helper is None:
+        stroke_class._helper = helper
+        stroke_class._instances = {}
+    return stroke_class.from_integer(mask)
+
+
+# Layout of a shared masks block: a header with the number of masks
+# and offsets, followed by the masks and the offsets (all unsigned
+# 64 bits integers, in native byte order).
+_SHARED_MASKS_HEADER_LEN = 2
+
+def masks_to_shared_memory(masks, offsets=None, name=None):
+    """
+    Copy `masks` (and optionally `offsets`, see `steno_list_to_masks`)
+    to a new `multiprocessing.shared_memory.SharedMemory` block, and
+    return it: the caller is responsible for closing / unlinking it.
+
+    Other processes can attach to the block (using its name), and
+    call `masks_from_shared_memory` to access its contents.
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    masks = array.array('Q', masks)
+    offsets = array.array('Q', () if offsets is None else offsets)
+    header = array.array('Q', (len(masks), len(offsets)))
+    size = (len(header) + len(masks) + len(offsets)) * header.itemsize
+    shm = SharedMemory(name=name, create=True, size=size)
+    data = shm.buf.cast('Q')
+    try:
+        pos = 0
+        for part in (header, masks, offsets):
+            data[pos:pos + len(part)] = part
+            pos += len(part)
+    finally:
+        data.release()
+    return shm
+
+def masks_from_shared_memory(shm):
+    """
+    Return a `(masks, offsets)` tuple of read-only views (with `offsets`
+    None if there are no offsets) on a shared masks block created by
+    `masks_to_shared_memory`: the views can be passed directly to the
+    batch operations (no copy is made), but must be released before
+    closing `shm`.
+    """
+    data = shm.buf.toreadonly().cast('Q')
+    try:
+        num_masks, num_offsets = data[:_SHARED_MASKS_HEADER_LEN]
+        pos = _SHARED_MASKS_HEADER_LEN
+        masks = data[pos:pos + num_masks]
+        pos += num_masks
+        offsets = data[pos:pos + num_offsets] if num_offsets else None
+    finally:
+        data.release()
+    return masks, offsets
+
+
+_JSON_DICTIONARY_START_RX = re.compile(br'(?:\xef\xbb\xbf)?[ \t\n\r]*\{[ \t\n\r]*(\})?')
+# Note: ASCII keys without escapes are captured by the first group,
+# so they can be parsed in place, other keys by the second group.
+_JSON_DICTIONARY_ENTRY_RX = re.compile(br"""
+[ \t\n\r]*
+"(?:([\x20\x21\x23-\x5b\x5d-\x7e]*)|([^"\\]*(?:\\.[^"\\]*)*))"
+[ \t\n\r]*:[ \t\n\r]*
+"([^"\\]*(?:\\.[^"\\]*)*)"
+[ \t\n\r]*([,}])
+""", re.DOTALL | re.VERBOSE)
+_JSON_DICTIONARY_END_RX = re.compile(br'[ \t\n\r]*')
+
+def iter_json_dictionary(helper, filename):
+    """
+    Iterate over the entries of a JSON steno dictionary, yielding
+    `(masks, translation)` pairs, with `masks` a tuple of strokes masks.
+
+    The file is memory-mapped and scanned incrementally: ASCII steno
+    is parsed in place, without decoding it to a string first.
+    """
+    with open(filename, 'rb') as fp:
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file.
+            data = b''
+        try:
+            yield from _iter_json_dictionary(helper, data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+def _iter_json_dictionary(helper, data):
+    m = _JSON_DICTIONARY_START_RX.match(data)
+    if m is None:
+        raise ValueError('invalid JSON dictionary: expected an object at offset 0')
+    pos = m.end()
+    done = m.group(1) is not None
+    while not done:
+        m = _JSON_DICTIONARY_ENTRY_RX.match(data, pos)
+        if m is None:
+            raise ValueError('invalid JSON dictionary: invalid entry at offset %u' % pos)
+        if m.start(1) >= 0:
+            try:
+                masks = helper.steno_buffer_to_masks(data, m.start(1), m.end(1))
+            except ValueError:
+                raise ValueError('invalid steno at offset %u: %r'
+                                 % (m.start(1), m.group(1).decode())) from None
+        else:
+            steno = json.loads(b'"' + m.group(2) + b'"')
+            masks, __, invalid = helper.steno_list_to_masks((steno,))
+            if invalid:
+                raise ValueError('invalid steno at offset %u: %r'
+                                 % (m.start(2), steno))
+            masks = tuple(masks)
+        translation = m.group(3)
+        if b'\\' in translation:
+            translation = json.loads(b'"' + translation + b'"')
+        else:
+            translation = translation.decode('utf-8')
+        yield masks, translation
+        pos = m.end()
+        done = m.group(4) == b'}'
+    pos = _JSON_DICTIONARY_END_RX.match(data, pos).end()
+    if pos != len(data):
+        raise ValueError('invalid JSON dictionary: extra data at offset %u' % pos)
+
+
+def iter_stroke_log(helper, filename, chunk_size=1024 * 1024):
+    """
+    Iterate over the strokes of a Plover strokes log, yielding
+    `array('Q')` batches of masks (one per chunk of the file).
+
+    The file is read in chunks of `chunk_size` bytes, so even
+    huge logs can be processed in constant memory.
+    """
+    tokenizer = StrokeLogTokenizer(helper)
+    with open(filename, 'rb') as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            masks = tokenizer.feed(chunk, final=not chunk)
+            if masks:
+                yield masks
+            if not chunk:
+                break
 
 # Prevent use of 'from stroke import *'.
 __all__ = ()
@@ -6,6 +6,7 @@ from setuptools import Extension, setup
 setup(
     ext_modules=[
         Extension('_plover_stroke',
-                  sources=['_plover_stroke.c']),
+                  sources=['_plover_stroke.c'],
+                  depends=['_plover_stroke_helper.h']),
     ],
 )
@@ -1,11 +1,37 @@
+import array
+import collections
 import functools
+import heapq
 import inspect
+import json
 import operator
+import pickle
+import random
 import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import pytest
 
-from plover_stroke import BaseStroke
+from plover_stroke import (
+    MAX_KEYS,
+    MAX_WIDE_KEYS,
+    BaseStroke,
+    KeyMap,
+    Outline,
+    OutlineTrie,
+    StrokeCounter,
+    StenoError,
+    StrokeHelper,
+    StrokeLogTokenizer,
+    StrokeSetIndex,
+    WideStrokeHelper,
+    iter_json_dictionary,
+    iter_stroke_log,
+    masks_from_shared_memory,
+    masks_to_shared_memory,
+    system_helper,
+)
 
 
 @pytest.fixture
@@ -508,6 +534,119 @@ def test_new(english_stroke_class, in_keys, in_rtfcre, keys, rtfcre, value, has_
         assert s.has_digit() == has_digit
         assert s.is_number() == is_number
 
+def test_keys_interned(english_stroke_class):
+    s1 = english_stroke_class('STKPW')
+    s2 = english_stroke_class('#TP')
+    assert s1.keys() is s1.keys()
+    assert s1.keys()[1] is s2.keys()[1]
+    assert s1.keys()[1] is english_stroke_class._helper.keys[2]
+    # Setup again: the cache must be cleared.
+    english_stroke_class._helper.setup('S- T- K- P- W- -R'.split())
+    assert s1.keys() == ('T-', 'K-', 'P-', 'W-', '-R')
+
+def test_cache(english_stroke_class):
+    helper = english_stroke_class._helper
+    assert helper.cache_info()['max_size'] == 0
+    helper.set_cache_size(8)
+    steno_list = [
+        '/'.join(expected)
+        for steno, expected in NORMALIZE_STENO_TESTS
+        if not inspect.isclass(expected)
+    ]
+    for n in range(3):
+        for steno in steno_list:
+            for s in steno.split('/'):
+                assert helper.stroke_to_steno(helper.stroke_from_steno(s)) == s
+                assert str(english_stroke_class(s)) == s
+    info = helper.cache_info()
+    assert info['max_size'] == 8
+    assert info['from_steno_size'] == 8
+    assert info['to_steno_size'] == 8
+    assert info['from_steno_hits'] > 0
+    assert info['from_steno_misses'] > 0
+    assert info['to_steno_hits'] > 0
+    assert info['to_steno_misses'] > 0
+    # Small working set: only hits.
+    helper.cache_clear()
+    for n in range(10):
+        assert english_stroke_class('STKPW') == 'STKPW'
+        assert str(english_stroke_class('-T')) == '-T'
+    info = helper.cache_info()
+    assert info['from_steno_misses'] == 2
+    assert info['from_steno_hits'] == 28
+    assert info['to_steno_misses'] == 1
+    assert info['to_steno_hits'] == 9
+    # Invalid steno are not cached.
+    with pytest.raises(ValueError):
+        helper.stroke_from_steno('TEFT/')
+    assert helper.cache_info()['from_steno_size'] == 2
+    # Setup clears the caches.
+    helper.setup('S- T- K- P- W- -R'.split())
+    info = helper.cache_info()
+    assert info['max_size'] == 8
+    assert info['from_steno_size'] == 0
+    assert info['to_steno_size'] == 0
+    assert helper.stroke_from_steno('R') == 0b100000
+    # Disable.
+    helper.set_cache_size(0)
+    assert helper.stroke_from_steno('R') == 0b100000
+    assert helper.cache_info()['from_steno_size'] == 0
+    with pytest.raises(ValueError):
+        helper.set_cache_size(-1)
+
+def test_stats(english_stroke_class):
+    helper = english_stroke_class._helper
+    def counters(op):
+        return {name: value for name, value in helper.stats()[op].items()
+                if name != 'ns'}
+    # Disabled by default: nothing is counted.
+    english_stroke_class('STKPW')
+    assert all(not any(op_stats.values()) for op_stats in helper.stats().values())
+    helper.set_stats(True)
+    english_stroke_class('STKPW')
+    with pytest.raises(ValueError):
+        english_stroke_class('STKPWX')
+    assert helper.stroke_from_buffer(b'-T') == 1 << 19
+    assert counters('from_steno') == dict(calls=3, failures=1, chars=13, strokes=2)
+    assert english_stroke_class(('S-', 'T-')).keys() == ('S-', 'T-')
+    assert counters('from_keys') == dict(calls=1, failures=0, chars=0, strokes=1)
+    assert counters('to_keys') == dict(calls=1, failures=0, chars=0, strokes=1)
+    assert str(english_stroke_class(('S-', 'T-'))) == 'ST'
+    assert counters('to_steno') == dict(calls=1, failures=0, chars=2, strokes=1)
+    masks, offsets, invalid = helper.steno_list_to_masks(['TEFT/-G', 'X', 'S'])
+    assert counters('steno_to_masks') == dict(calls=1, failures=1, chars=9, strokes=3)
+    assert helper.masks_to_steno_list(masks, offsets) == ['TEFT/-G', '', 'S']
+    assert counters('masks_to_steno') == dict(calls=1, failures=0, chars=8, strokes=3)
+    assert list(helper.validate_steno_list(['TEFT/-G', 'X'])) == [0, 3]
+    assert counters('validate') == dict(calls=1, failures=1, chars=8, strokes=0)
+    assert counters('steno_to_masks') == dict(calls=1, failures=1, chars=9, strokes=3)
+    assert helper.sort_outlines(['TEFT/-G', 'S']) == [1, 0]
+    assert counters('sort_outlines') == dict(calls=1, failures=0, chars=0, strokes=3)
+    helper.near_strokes('TEFT', masks)
+    assert counters('near_strokes') == dict(calls=1, failures=0, chars=0, strokes=3)
+    assert 'ns' not in helper.stats()['from_steno']
+    # Cache statistics are included, when enabled.
+    helper.set_cache_size(8)
+    english_stroke_class('STKPW')
+    english_stroke_class('STKPW')
+    stats = helper.stats()['from_steno']
+    assert stats['cache_hits'] == 1
+    assert stats['cache_misses'] == 1
+    # Reset.
+    helper.reset_stats()
+    assert all(not any(op_stats.values()) for op_stats in helper.stats().values())
+    # Timing.
+    helper.set_stats(True, timing=True)
+    helper.steno_list_to_masks(['STKPW'] * 1000)
+    assert helper.stats()['steno_to_masks']['ns'] > 0
+    StrokeLogTokenizer(helper).feed(b'Stroke(STKPW : [])\n' * 1000)
+    assert helper.stats()['from_steno']['ns'] > 0
+    helper.reset_stats()
+    # Disable.
+    helper.set_stats(False)
+    english_stroke_class('STKPW')
+    assert helper.stats()['from_steno']['calls'] == 0
+
 def test_empty_stroke(english_stroke_class):
     empty_stroke = english_stroke_class(0)
     assert int(empty_stroke) == 0
@@ -595,6 +734,79 @@ def test_op(english_stroke_class, s1, op, s2, expected):
     }[op]
     assert op(english_stroke_class(s1), s2) == expected
 
+REFLECTED_OP_TESTS = (
+    ('ST', '|', '#', '12'),
+    ('#ST', '&', '12', '12'),
+    ('#STK', '-', '12', 'K'),
+    ('#', '+', 'PL', '38'),
+)
+
+@pytest.mark.parametrize('s1, op, s2, expected', REFLECTED_OP_TESTS)
+def test_reflected_op(english_stroke_class, s1, op, s2, expected):
+    op = {
+        '|': operator.or_,
+        '&': operator.and_,
+        '+': operator.add,
+        '-': operator.sub,
+    }[op]
+    result = op(s1, english_stroke_class(s2))
+    assert type(result) is english_stroke_class
+    assert result == expected
+
+def test_not_setup(stroke_class):
+    with pytest.raises(TypeError):
+        stroke_class(3)
+    with pytest.raises(TypeError):
+        stroke_class.from_integer(3)
+    with pytest.raises(TypeError):
+        stroke_class.from_steno('ST')
+
+def test_instances_cache(english_stroke_class):
+    s = english_stroke_class('ST')
+    assert s is english_stroke_class.from_integer(0b110)
+    assert s is english_stroke_class.from_keys(['S-', 'T-'])
+    assert s is english_stroke_class.from_steno('ST')
+    assert (s | '#') is english_stroke_class('12')
+    assert (s - 'S') is english_stroke_class('T')
+    # Too many keys: not cached.
+    s = english_stroke_class('STKPW')
+    assert s == english_stroke_class('STKPW')
+    assert s is not english_stroke_class('STKPW')
+    # Subclasses of a setup class must get their own instances.
+    class SubStroke(english_stroke_class):
+        pass
+    s = SubStroke('ST')
+    assert type(s) is SubStroke
+    assert type(s | 'K') is SubStroke
+    # Setup resets the cache.
+    s = english_stroke_class('ST')
+    english_stroke_class.setup('S- T- K- P- W- -R'.split())
+    assert english_stroke_class('ST') is not s
+    # Disable.
+    english_stroke_class._instances_max_keys = -1
+    english_stroke_class.setup('S- T- K- P- W- -R'.split())
+    assert english_stroke_class('ST') is not english_stroke_class('ST')
+
+def test_keys_no_leak(english_stroke_class):
+    helper = english_stroke_class._helper
+    s = english_stroke_class('ST')
+    for keys in (['S-', 'T-'], ['S-', 'X-']):
+        refcount = sys.getrefcount(keys)
+        for __ in range(1000):
+            for fn in (english_stroke_class, helper.stroke_from_keys,
+                       helper.stroke_from_any, lambda k: s | k):
+                try:
+                    fn(keys)
+                except ValueError:
+                    pass
+        assert sys.getrefcount(keys) == refcount
+
+def test_no_dict():
+    class Stroke(BaseStroke):
+        __slots__ = ()
+    Stroke.setup('S- T- K- P- W- -R'.split())
+    assert not hasattr(Stroke('ST'), '__dict__')
+
 CMP_OP = {
     '<': operator.lt,
     '<=': operator.le,
@@ -675,6 +887,98 @@ def test_sort_key(english_stroke_class):
     '''.split()
     assert sorted(unsorted_strokes, key=stroke_to_sort_key) == sorted_strokes
 
+def test_sort_outlines(english_stroke_class):
+    helper = english_stroke_class._helper
+    unsorted_steno = '''
+        AOE
+        ST-PB/*Z
+        *Z
+        #
+        R-R
+        ST-PB
+        /ST-PB
+        ST-PB/#
+        R-R/R-R
+        S
+    '''.split() + ['']
+    sorted_steno = [''] + '''
+        /ST-PB
+        #
+        S
+        ST-PB
+        ST-PB/#
+        ST-PB/*Z
+        R-R
+        R-R/R-R
+        AOE
+        *Z
+    '''.split()
+    order = helper.sort_outlines(unsorted_steno)
+    assert [unsorted_steno[n] for n in order] == sorted_steno
+    # Outlines and sequences of strokes.
+    outlines = [helper.steno_to_outline(s) for s in unsorted_steno]
+    assert helper.sort_outlines(outlines) == order
+    assert helper.sort_outlines(tuple(tuple(o) for o in outlines)) == order
+    # Mixed, and stable.
+    mixed = [s if n % 3 == 0 else outlines[n] if n % 3 == 1 else list(outlines[n])
+             for n, s in enumerate(unsorted_steno)]
+    assert helper.sort_outlines(mixed + mixed) == [n + offset for n in order for offset in (0, len(mixed))]
+    # In place.
+    steno_list = list(unsorted_steno)
+    assert helper.sort_outlines(steno_list, in_place=True) is None
+    assert steno_list == sorted_steno
+    assert helper.sort_outlines([]) == []
+    with pytest.raises(TypeError):
+        helper.sort_outlines(tuple(unsorted_steno), in_place=True)
+    with pytest.raises(TypeError):
+        helper.sort_outlines(['S', 42])
+    with pytest.raises(ValueError, match="invalid steno: 'TEFT/'"):
+        helper.sort_outlines(steno_list + ['TEFT/'], in_place=True)
+    assert steno_list == sorted_steno
+
+def test_sort_outlines_order(english_stroke_class):
+    helper = english_stroke_class._helper
+    rnd = random.Random(0)
+    steno_list = [
+        '/'.join(
+            str(english_stroke_class.from_integer((rnd.getrandbits(helper.num_keys) & rnd.getrandbits(helper.num_keys)) or 1))
+            for __ in range(rnd.randint(1, 3))
+        )
+        for __ in range(2000)
+    ]
+    assert helper.sort_outlines(steno_list) == sorted(range(len(steno_list)),
+                                                      key=lambda n: helper.steno_to_sort_key(steno_list[n]))
+
+def test_order_key(english_stroke_class):
+    helper = english_stroke_class._helper
+    rnd = random.Random(0)
+    masks = [0, 1, 2**helper.num_keys - 1] + [
+        rnd.getrandbits(helper.num_keys) & rnd.getrandbits(helper.num_keys)
+        for __ in range(2000)
+    ]
+    strokes = [english_stroke_class.from_integer(m) for m in masks]
+    expected = sorted(strokes, key=helper.stroke_to_sort_key)
+    assert sorted(strokes, key=english_stroke_class.order_key) == expected
+    assert sorted(strokes, key=helper.stroke_to_order_key) == expected
+    assert sorted(strokes) == expected
+    assert [s.order_key() for s in strokes] == [helper.stroke_to_order_key(str(s)) for s in strokes]
+    heap = [(s.order_key(), s) for s in strokes]
+    heapq.heapify(heap)
+    assert [heapq.heappop(heap)[1] for __ in range(len(heap))] == expected
+    # Batch version.
+    order_keys = helper.masks_to_order_keys(array.array('Q', masks))
+    assert order_keys.typecode == 'Q'
+    assert list(order_keys) == [s.order_key() for s in strokes]
+    assert helper.masks_to_order_keys(Outline(masks)) == order_keys
+    assert helper.masks_to_order_keys(strokes) == order_keys
+    assert list(helper.masks_to_order_keys([])) == []
+    with pytest.raises(TypeError):
+        helper.masks_to_order_keys(array.array('B', [1, 2]))
+    with pytest.raises(TypeError):
+        helper.masks_to_order_keys(array.array('q', [1, 2]))
+    with pytest.raises(ValueError):
+        helper.masks_to_order_keys(array.array('Q', [2**63]))
+
 def test_no_numbers_system():
     class Stroke(BaseStroke):
         pass
@@ -690,6 +994,28 @@ def test_no_numbers_system():
     )
     s1 = Stroke(23)
 
+NON_ASCII_NORMALIZE_STENO_TESTS = (
+    ('СТ', ('СТ',)),
+    ('ТЛ', ('ТЛ',)),
+    ('Т-Л', ('Т-Л',)),
+    ('СТ-ЛТ', ('СТ-ЛТ',)),
+    ('СЯТ', ('СЯТ',)),
+    ('Я', ('Я',)),
+    ('Т-С', ValueError),
+    ('ТС', ValueError),
+    ('СX', ValueError),
+)
+
+@pytest.mark.parametrize('steno, expected', NON_ASCII_NORMALIZE_STENO_TESTS)
+def test_normalize_steno_non_ascii(stroke_class, steno, expected):
+    stroke_class.setup('С- Т- Л- Я -Л -Т'.split())
+    normalize_steno = stroke_class._helper.normalize_steno
+    if inspect.isclass(expected):
+        with pytest.raises(expected):
+            normalize_steno(steno)
+        return
+    assert normalize_steno(steno) == expected
+
 COMMON_NORMALIZE_STENO_TESTS = (
     ('#STKPWHRAO*-EUFRPBLGTSDZ/12K3W4R50*-EU6R7B8G9SDZ',
      ('12K3W4R50*EU6R7B8G9SDZ', '12K3W4R50*EU6R7B8G9SDZ')),
@@ -848,3 +1174,1156 @@ def test_steno_sort_key_2(english_stroke_class):
         )
     ]
     assert sorted(steno_list, key=steno_to_sort_key) == sorted_with_stroke_sort
+
+def test_steno_list_to_masks(english_stroke_class):
+    helper = english_stroke_class._helper
+    steno_list = []
+    expected_masks = []
+    expected_offsets = [0]
+    expected_invalid = []
+    for steno, expected in NORMALIZE_STENO_TESTS:
+        if inspect.isclass(expected):
+            expected_invalid.append(len(steno_list))
+        else:
+            expected_masks.extend(int(english_stroke_class(s)) for s in expected)
+        steno_list.append(steno)
+        expected_offsets.append(len(expected_masks))
+    masks, offsets, invalid = helper.steno_list_to_masks(iter(steno_list))
+    assert masks.typecode == 'Q'
+    assert offsets.typecode == 'Q'
+    assert list(masks) == expected_masks
+    assert list(offsets) == expected_offsets
+    assert invalid == expected_invalid
+    masks, offsets, invalid = helper.steno_list_to_masks([])
+    assert list(masks) == []
+    assert list(offsets) == [0]
+    assert invalid == []
+    masks, offsets, invalid = helper.steno_list_to_masks(
+        [s.encode('ascii') for s in steno_list])
+    assert list(masks) == expected_masks
+    assert list(offsets) == expected_offsets
+    assert invalid == expected_invalid
+    with pytest.raises(TypeError):
+        helper.steno_list_to_masks(['STKPW', 42])
+
+def test_masks_to_steno_list(english_stroke_class):
+    helper = english_stroke_class._helper
+    steno_list = [
+        expected
+        for steno, expected in NORMALIZE_STENO_TESTS
+        if not inspect.isclass(expected)
+    ]
+    masks, offsets, invalid = helper.steno_list_to_masks(
+        '/'.join(expected) for expected in steno_list)
+    assert invalid == []
+    assert helper.masks_to_steno_list(masks, offsets) == ['/'.join(expected) for expected in steno_list]
+    assert helper.masks_to_steno_list(masks, offsets=list(offsets)) == ['/'.join(expected) for expected in steno_list]
+    assert helper.masks_to_steno_list(masks) == [s for expected in steno_list for s in expected]
+    assert helper.masks_to_steno_list([]) == []
+    assert helper.masks_to_steno_list([], [0]) == []
+    assert helper.masks_to_steno_list([], []) == []
+    with pytest.raises(ValueError):
+        helper.masks_to_steno_list([1 << helper.num_keys])
+    for invalid_offsets in ([0, 3], [1, 0], [0, 2, 1]):
+        with pytest.raises(ValueError):
+            helper.masks_to_steno_list([1, 2], invalid_offsets)
+    with pytest.raises(TypeError):
+        helper.masks_to_steno_list(array.array('B', [1, 2]))
+
+VALIDATE_STENO_TESTS = (
+    ('', StenoError.OK),
+    ('TEFT', StenoError.OK),
+    ('/TEFT', StenoError.OK),
+    ('TEFT/-G', StenoError.OK),
+    (b'TEFT/-G', StenoError.OK),
+    (bytearray(b'TEFT/-G'), StenoError.OK),
+    ('TEFT/', StenoError.EMPTY_STROKE),
+    ('/', StenoError.EMPTY_STROKE),
+    ('TEFT//-G', StenoError.EMPTY_STROKE),
+    ('S' * 65, StenoError.TOO_LONG),
+    ('TEFT/' + 'S' * 65, StenoError.TOO_LONG),
+    ('X', StenoError.INVALID_LETTER),
+    ('TEFT/-GX', StenoError.INVALID_LETTER),
+    ('TÉFT', StenoError.INVALID_LETTER),
+    ('1-2', StenoError.MISORDERED_KEY),
+    ('-ZS', StenoError.MISORDERED_KEY),
+    ('#1#', StenoError.DUPLICATE_NUMBER_KEY),
+    ('-T-', StenoError.MISPLACED_HYPHEN),
+    (42, StenoError.NOT_STENO),
+    (None, StenoError.NOT_STENO),
+)
+
+def test_validate_steno_list(english_stroke_class):
+    helper = english_stroke_class._helper
+    steno_list, expected = zip(*VALIDATE_STENO_TESTS)
+    errors = helper.validate_steno_list(iter(steno_list))
+    assert errors.typecode == 'B'
+    assert [StenoError(e) for e in errors] == list(expected)
+    assert list(helper.validate_steno_list([])) == []
+    # Must agree with parsing.
+    steno_list = [steno for steno, expected in NORMALIZE_STENO_TESTS]
+    errors = helper.validate_steno_list(steno_list)
+    __, __, invalid = helper.steno_list_to_masks(steno_list)
+    assert [n for n, e in enumerate(errors) if e != StenoError.OK] == invalid
+
+@pytest.mark.parametrize('steno, expected', NORMALIZE_STENO_TESTS)
+def test_steno_buffer_to_masks(english_stroke_class, steno, expected):
+    steno_buffer_to_masks = english_stroke_class._helper.steno_buffer_to_masks
+    buffer = b'"' + steno.encode() + b'": "'
+    for args in (
+        (steno.encode(),),
+        (bytearray(buffer), 1, -4),
+        (memoryview(buffer), 1, len(buffer) - 4),
+    ):
+        if inspect.isclass(expected):
+            with pytest.raises(expected):
+                steno_buffer_to_masks(*args)
+            continue
+        assert steno_buffer_to_masks(*args) == tuple(int(english_stroke_class(s)) for s in expected)
+
+def test_stroke_from_buffer(english_stroke_class):
+    stroke_from_buffer = english_stroke_class._helper.stroke_from_buffer
+    assert stroke_from_buffer(b'TEFT') == int(english_stroke_class('TEFT'))
+    assert stroke_from_buffer(b'"TEFT"', 1, 5) == int(english_stroke_class('TEFT'))
+    assert stroke_from_buffer(b'"TEFT"', start=1, end=-1) == int(english_stroke_class('TEFT'))
+    assert stroke_from_buffer(bytearray(b'T-EFT/-G'), 6) == int(english_stroke_class('-G'))
+    assert stroke_from_buffer(memoryview(b'#S46')) == int(english_stroke_class('14-6'))
+    assert stroke_from_buffer(b'TEFT', 2, 2) == 0
+    with pytest.raises(ValueError, match=r"invalid steno: b'T-EFT/-G'"):
+        stroke_from_buffer(b'T-EFT/-G')
+    with pytest.raises(ValueError):
+        stroke_from_buffer(b'S' * 65)
+    with pytest.raises(TypeError):
+        stroke_from_buffer('TEFT')
+
+def test_iter_json_dictionary(english_stroke_class, tmp_path):
+    helper = english_stroke_class._helper
+    dictionary = {
+        'TEFT': 'test',
+        '/PRE': '{pre^}',
+        'T-EFT/-G': 'testing',
+        'S2': '\u00e9t\u00e9 "quoted"\n',
+        '#S': '1',
+        '': 'empty',
+    }
+    expected = [
+        (tuple(int(english_stroke_class(s)) for s in helper.normalize_steno(steno)), translation)
+        for steno, translation in json.loads(json.dumps(dictionary)).items()
+    ]
+    filename = tmp_path / 'dict.json'
+    for ensure_ascii in (False, True):
+        for indent in (None, 0, 2):
+            filename.write_text(json.dumps(dictionary, ensure_ascii=ensure_ascii, indent=indent), encoding='utf-8')
+            assert list(iter_json_dictionary(helper, str(filename))) == expected
+    # BOM.
+    filename.write_bytes(b'\xef\xbb\xbf' + json.dumps(dictionary).encode())
+    assert list(iter_json_dictionary(helper, str(filename))) == expected
+    # Escaped steno.
+    filename.write_bytes(b'{"1\\u0032/T\\u002dG": "escaped"}')
+    assert list(iter_json_dictionary(helper, str(filename))) == [
+        ((int(english_stroke_class('12')), int(english_stroke_class('T-G'))), 'escaped'),
+    ]
+    # Empty dictionary.
+    for contents in (b'{}', b' { } \n'):
+        filename.write_bytes(contents)
+        assert list(iter_json_dictionary(helper, str(filename))) == []
+
+INVALID_JSON_DICTIONARY_TESTS = (
+    (b'', 'expected an object'),
+    (b'[]', 'expected an object'),
+    (b'{"TEFT": "test"', 'invalid entry'),
+    (b'{"TEFT": "test",}', 'invalid entry'),
+    (b'{"TEFT": 42}', 'invalid entry'),
+    (b'{"TEFT": "test"} {}', 'extra data'),
+    (b'{"TEFT/": "test"}', "invalid steno at offset 2: 'TEFT/'"),
+    (b'{"T\\u00c9FT": "test"}', "invalid steno at offset 2: 'T\u00c9FT'"),
+)
+
+@pytest.mark.parametrize('contents, match', INVALID_JSON_DICTIONARY_TESTS)
+def test_iter_json_dictionary_invalid(english_stroke_class, tmp_path, contents, match):
+    filename = tmp_path / 'dict.json'
+    filename.write_bytes(contents)
+    with pytest.raises(ValueError, match=re.escape(match)) as excinfo:
+        list(iter_json_dictionary(english_stroke_class._helper, str(filename)))
+    assert excinfo.value.__cause__ is None
+    assert excinfo.value.__suppress_context__ or excinfo.value.__context__ is None
+
+STROKE_LOG = '''\
+2021-03-07 12:34:56,789 Stroke(STKPW : ['S-', 'T-', 'K-', 'P-', 'W-'])
+2021-03-07 12:34:56,790 Translation(('STKPW',) : "z")
+2021-03-07 12:34:57,001 Stroke(12 : ['#', 'S-', 'T-'])
+2021-03-07 12:34:57,002 Stroke(-Z : ['-Z'])\r
+garbage Stroke
+2021-03-07 12:34:57,123 Stroke(TEFT : ['T-', '-E', '-F', '-T'])'''
+
+STROKE_LOG_STENO = 'STKPW 12 -Z TEFT'.split()
+
+def test_stroke_log_tokenizer(english_stroke_class):
+    helper = english_stroke_class._helper
+    expected = [int(english_stroke_class(s)) for s in STROKE_LOG_STENO]
+    for log in (STROKE_LOG, STROKE_LOG.encode()):
+        # All at once.
+        tokenizer = StrokeLogTokenizer(helper)
+        masks = tokenizer.feed(log)
+        assert masks.typecode == 'Q'
+        assert list(masks) == expected[:-1]
+        assert tokenizer.pending == len(log.splitlines()[-1])
+        assert list(tokenizer.feed(log[:0], final=True)) == expected[-1:]
+        assert tokenizer.pending == 0
+        # Chunked: strokes split across chunks.
+        for chunk_size in (1, 2, 7, 30, 100):
+            tokenizer = StrokeLogTokenizer(helper)
+            masks = []
+            for n in range(0, len(log), chunk_size):
+                masks.extend(tokenizer.feed(log[n:n + chunk_size]))
+            masks.extend(tokenizer.feed(log[:0], final=True))
+            assert masks == expected
+    # Final chunk.
+    tokenizer = StrokeLogTokenizer(helper)
+    assert list(tokenizer.feed('x Stroke(S')) == []
+    assert list(tokenizer.feed('KWR', final=True)) == [int(english_stroke_class('SKWR'))]
+    # Invalid steno.
+    tokenizer = StrokeLogTokenizer(helper)
+    with pytest.raises(ValueError, match=re.escape("invalid steno: b'SXT'")):
+        tokenizer.feed('Stroke(SXT : [])\n')
+    assert list(tokenizer.feed('Stroke(ST : [])\n')) == [int(english_stroke_class('ST'))]
+    with pytest.raises(ValueError):
+        tokenizer.feed('Stroke(TÉFT : [])\n')
+    with pytest.raises(TypeError):
+        StrokeLogTokenizer(None)
+
+def test_stroke_log_tokenizer_unicode(stroke_class):
+    stroke_class.setup(['É-', '-À'])
+    expected = [int(stroke_class(s)) for s in ('É', '-À', 'ÉÀ')]
+    log = ''.join('Stroke(%s : [])\n' % stroke_class.from_integer(m) for m in expected)
+    for chunk in (log, log.encode()):
+        assert list(StrokeLogTokenizer(stroke_class._helper).feed(chunk)) == expected
+    tokenizer = StrokeLogTokenizer(stroke_class._helper)
+    data = log.encode()
+    # Split inside a multi-byte character.
+    assert list(tokenizer.feed(data[:8])) == []
+    assert list(tokenizer.feed(data[8:], final=True)) == expected
+
+def test_iter_stroke_log(english_stroke_class, tmp_path):
+    helper = english_stroke_class._helper
+    expected = [int(english_stroke_class(s)) for s in STROKE_LOG_STENO]
+    filename = tmp_path / 'strokes.log'
+    filename.write_text(STROKE_LOG)
+    for chunk_size in (1, 16, 1024):
+        batches = list(iter_stroke_log(helper, str(filename), chunk_size=chunk_size))
+        assert all(batches)
+        assert [m for masks in batches for m in masks] == expected
+    filename.write_text('')
+    assert list(iter_stroke_log(helper, str(filename))) == []
+
+def test_outline():
+    outline = Outline((0b100, 0, 2**63 - 1))
+    assert len(outline) == 3
+    assert list(outline) == [0b100, 0, 2**63 - 1]
+    assert outline.masks() == (0b100, 0, 2**63 - 1)
+    assert outline[0] == 0b100
+    assert outline[-1] == 2**63 - 1
+    assert outline[1:] == Outline((0, 2**63 - 1))
+    assert outline[::-2] == Outline((2**63 - 1, 0b100))
+    assert 0 in outline
+    assert 1 not in outline
+    assert -1 not in outline
+    assert 'S' not in outline
+    assert outline == Outline([0b100, 0, 2**63 - 1])
+    assert outline != Outline((0b100, 0))
+    assert outline != (0b100, 0, 2**63 - 1)
+    assert hash(outline) == hash(Outline(iter((0b100, 0, 2**63 - 1))))
+    assert {outline: 'value'}[Outline((0b100, 0, 2**63 - 1))] == 'value'
+    assert Outline(outline) is outline
+    assert Outline() == Outline(()) == Outline([])
+    assert len(Outline()) == 0
+    assert repr(outline) == 'Outline((4, 0, 9223372036854775807))'
+    assert pickle.loads(pickle.dumps(outline)) == outline
+    view = memoryview(outline)
+    assert view.readonly
+    assert view.format == 'Q'
+    assert view.tolist() == [0b100, 0, 2**63 - 1]
+    with pytest.raises(IndexError):
+        outline[3]
+    with pytest.raises(TypeError):
+        outline[3] = 0
+    with pytest.raises(TypeError):
+        outline < outline
+    with pytest.raises(TypeError):
+        Outline(('S',))
+    with pytest.raises(ValueError):
+        Outline((2**63,))
+    with pytest.raises(OverflowError):
+        Outline((-1,))
+
+def test_outline_steno(english_stroke_class):
+    helper = english_stroke_class._helper
+    for steno, expected in NORMALIZE_STENO_TESTS:
+        if inspect.isclass(expected):
+            with pytest.raises(expected):
+                helper.steno_to_outline(steno)
+            with pytest.raises(expected):
+                helper.steno_buffer_to_outline(b'"' + steno.encode() + b'"', 1, -1)
+            continue
+        masks = tuple(int(english_stroke_class(s)) for s in expected)
+        outline = helper.steno_to_outline(steno)
+        assert outline == Outline(masks)
+        assert helper.steno_buffer_to_outline(b'"' + steno.encode() + b'"', 1, -1) == outline
+        assert helper.outline_to_steno(outline) == '/'.join(expected)
+        strokes = english_stroke_class.from_outline(outline)
+        assert strokes == tuple(english_stroke_class(s) for s in expected)
+        assert all(type(s) is english_stroke_class for s in strokes)
+        assert Outline(strokes) == outline
+    assert helper.steno_to_outline('') == Outline()
+    assert helper.outline_to_steno(Outline()) == ''
+    with pytest.raises(ValueError):
+        helper.outline_to_steno(Outline((1 << helper.num_keys,)))
+    with pytest.raises(TypeError):
+        helper.outline_to_steno(('S',))
+    with pytest.raises(TypeError):
+        helper.steno_to_outline(b'S')
+
+def test_outline_trie():
+    trie = OutlineTrie()
+    assert len(trie) == 0
+    assert trie.longest_match((1, 2)) is None
+    assert trie.prefixes((1, 2)) == []
+    trie[(1,)] = 'a'
+    trie[Outline((1, 2, 3))] = 'abc'
+    trie[[4]] = 'd'
+    assert len(trie) == 3
+    assert trie[Outline((1,))] == 'a'
+    assert trie[(1, 2, 3)] == 'abc'
+    assert (1, 2) not in trie
+    assert Outline((1, 2, 3)) in trie
+    assert trie.get((1, 2)) is None
+    assert trie.get((1, 2), 'default') == 'default'
+    assert trie.get((4,), 'default') == 'd'
+    with pytest.raises(KeyError):
+        trie[(1, 2)]
+    with pytest.raises(KeyError):
+        del trie[(1, 2)]
+    assert trie.longest_match((1, 2, 3, 4)) == (3, 'abc')
+    assert trie.longest_match(Outline((1, 2, 4))) == (1, 'a')
+    assert trie.longest_match((2,)) is None
+    assert trie.prefixes((1, 2, 3, 4)) == [(1, 'a'), (3, 'abc')]
+    assert trie.prefixes(()) == []
+    trie[()] = 'empty'
+    assert trie.prefixes((1, 2, 3)) == [(0, 'empty'), (1, 'a'), (3, 'abc')]
+    trie[(1,)] = 'A'
+    assert len(trie) == 4
+    del trie[(1,)]
+    assert len(trie) == 3
+    assert trie.prefixes((1, 2, 3)) == [(0, 'empty'), (3, 'abc')]
+    del trie[(1, 2, 3)]
+    assert trie.longest_match((1, 2, 3)) == (0, 'empty')
+    trie.clear()
+    assert len(trie) == 0
+    assert trie.longest_match((4,)) is None
+    with pytest.raises(TypeError):
+        trie['S'] = 'invalid'
+    with pytest.raises(TypeError):
+        trie.longest_match(42)
+
+def test_outline_trie_random():
+    rnd = random.Random(0)
+    trie = OutlineTrie()
+    expected = {}
+    for n in range(20000):
+        key = tuple(rnd.randrange(4) for __ in range(rnd.randint(0, 4)))
+        action = rnd.randrange(3)
+        if action == 0:
+            trie[Outline(key)] = expected[key] = n
+        elif action == 1 and key in expected:
+            del trie[key]
+            del expected[key]
+        else:
+            prefixes = [(length, expected[key[:length]])
+                        for length in range(len(key) + 1)
+                        if key[:length] in expected]
+            assert trie.prefixes(key) == prefixes
+            assert trie.longest_match(key) == (prefixes[-1] if prefixes else None)
+        assert len(trie) == len(expected)
+    for key, value in expected.items():
+        assert trie[key] == value
+
+def test_masks_vectorized(english_stroke_class):
+    helper = english_stroke_class._helper
+    strokes = [english_stroke_class(s) for s in '''
+        12 1-Z 0EU #STKPW S -Z STKPWHRAO*EUFRPBLGTSDZ 1234506789
+    '''.split()] + [english_stroke_class.from_integer(0)]
+    masks = array.array('Q', strokes)
+    for method, fn, typecode in (
+        ('masks_valid', lambda s: 1, 'B'),
+        ('masks_len', len, 'B'),
+        ('masks_first_key', lambda s: helper.keys.index(s.first()) if s else -1, 'b'),
+        ('masks_last_key', lambda s: helper.keys.index(s.last()) if s else -1, 'b'),
+        ('masks_has_digit', BaseStroke.has_digit, 'B'),
+        ('masks_is_number', BaseStroke.is_number, 'B'),
+    ):
+        result = getattr(helper, method)(masks)
+        assert result.typecode == typecode
+        assert list(result) == [int(fn(s)) for s in strokes]
+        # Sequences of strokes are supported too.
+        assert getattr(helper, method)(strokes) == result
+    other = english_stroke_class('-Z')
+    for method, op in (
+        ('masks_or', operator.or_),
+        ('masks_and', operator.and_),
+        ('masks_sub', operator.sub),
+    ):
+        # Broadcast a single stroke (integer or steno).
+        expected = [int(op(s, other)) for s in strokes]
+        for operand in (other, int(other), '-Z', array.array('Q', [other])):
+            result = getattr(helper, method)(masks, operand)
+            assert result.typecode == 'Q'
+            assert list(result) == expected
+        # Element-wise.
+        expected = [int(op(s1, s2)) for s1, s2 in zip(strokes, reversed(strokes))]
+        assert list(getattr(helper, method)(masks, masks[::-1])) == expected
+    invalid = array.array('Q', [1, 1 << helper.num_keys, 2 ** 64 - 1])
+    assert list(helper.masks_valid(invalid)) == [1, 0, 0]
+    for method in ('masks_len', 'masks_first_key', 'masks_last_key',
+                   'masks_has_digit', 'masks_is_number'):
+        with pytest.raises(ValueError):
+            getattr(helper, method)(invalid)
+        assert len(getattr(helper, method)(array.array('Q'))) == 0
+    with pytest.raises(ValueError):
+        helper.masks_or(masks, invalid)
+    with pytest.raises(ValueError):
+        helper.masks_or(invalid[1:], 1)
+    with pytest.raises(ValueError):
+        helper.masks_or(masks, masks[1:])
+    with pytest.raises(ValueError):
+        helper.masks_and(masks, 'X')
+    with pytest.raises(TypeError):
+        helper.masks_len(array.array('I', [1]))
+
+def test_masks_vectorized_numpy(english_stroke_class):
+    numpy = pytest.importorskip('numpy')
+    helper = english_stroke_class._helper
+    masks = numpy.array([int(english_stroke_class(s)) for s in '12 S -Z 0EU'.split()], dtype=numpy.uint64)
+    assert numpy.asarray(helper.masks_len(masks)).tolist() == [3, 1, 1, 4]
+    assert numpy.asarray(helper.masks_is_number(masks)).tolist() == [1, 0, 0, 0]
+    result = numpy.frombuffer(helper.masks_or(masks, masks[:1]), dtype=numpy.uint64)
+    assert result.tolist() == [int(m | masks[0]) for m in masks]
+
+def test_stroke_counter(english_stroke_class):
+    helper = english_stroke_class._helper
+    rnd = random.Random(0)
+    strokes = [english_stroke_class(s) for s in 'S T- -Z TEFT 12 *'.split()]
+    sequence = [rnd.choice(strokes) for __ in range(1000)]
+    counter = StrokeCounter(helper.num_keys)
+    assert counter.num_keys == helper.num_keys
+    assert counter.total == 0
+    assert len(counter) == 0
+    assert counter.most_common() == []
+    assert counter.most_common_bigrams() == []
+    assert list(counter.key_counts()) == [0] * helper.num_keys
+    # Bigrams are counted across updates.
+    counter.update(array.array('Q', sequence[:500]))
+    counter.update(sequence[500:])
+    assert counter.total == len(sequence)
+    stroke_counts = collections.Counter(map(int, sequence))
+    bigram_counts = collections.Counter(zip(map(int, sequence), map(int, sequence[1:])))
+    assert len(counter) == len(stroke_counts)
+    assert counter.most_common() == sorted(stroke_counts.items(), key=lambda i: (-i[1], i[0]))
+    assert counter.most_common(2) == counter.most_common()[:2]
+    assert counter.most_common_bigrams() == sorted(bigram_counts.items(), key=lambda i: (-i[1], i[0]))
+    assert counter.most_common_bigrams(3) == counter.most_common_bigrams()[:3]
+    for stroke in strokes:
+        assert counter.stroke_count(stroke) == stroke_counts[stroke]
+        for other in strokes:
+            assert counter.bigram_count(stroke, other) == bigram_counts[(stroke, other)]
+    assert counter.stroke_count(english_stroke_class('R')) == 0
+    key_counts = [0] * helper.num_keys
+    for stroke in sequence:
+        for k in range(helper.num_keys):
+            key_counts[k] += (stroke >> k) & 1
+    assert counter.key_counts().typecode == 'Q'
+    assert list(counter.key_counts()) == key_counts
+    # Sequences.
+    counter = StrokeCounter()
+    assert counter.num_keys == 63
+    counter.update(strokes[:2])
+    counter.end_sequence()
+    counter.update(strokes[2:3])
+    assert counter.most_common_bigrams() == [((strokes[0], strokes[1]), 1)]
+    # Errors.
+    with pytest.raises(ValueError):
+        StrokeCounter(0)
+    with pytest.raises(ValueError):
+        StrokeCounter(64)
+    counter = StrokeCounter(helper.num_keys)
+    with pytest.raises(ValueError):
+        counter.update([1, 1 << helper.num_keys])
+    assert counter.total == 0
+    with pytest.raises(TypeError):
+        counter.stroke_count('S')
+    with pytest.raises(TypeError):
+        counter.merge(None)
+    with pytest.raises(ValueError):
+        counter.merge(StrokeCounter(helper.num_keys + 1))
+    with pytest.raises(ValueError):
+        counter.merge(counter)
+
+def test_stroke_counter_merge_pickle(english_stroke_class):
+    helper = english_stroke_class._helper
+    rnd = random.Random(0)
+    masks = [int(english_stroke_class(s)) for s in 'S T- -Z TEFT 12 * STKPW'.split()]
+    shards = [[rnd.choice(masks) for __ in range(rnd.randint(0, 300))] for __ in range(4)]
+    expected = StrokeCounter(helper.num_keys)
+    for shard in shards:
+        expected.update(shard)
+        expected.end_sequence()
+    counters = []
+    for shard in shards:
+        counter = StrokeCounter(helper.num_keys)
+        counter.update(shard)
+        counters.append(pickle.loads(pickle.dumps(counter)))
+    merged = StrokeCounter(helper.num_keys)
+    for counter in counters:
+        merged.merge(counter)
+    for counter in (merged, pickle.loads(pickle.dumps(merged))):
+        assert counter.total == expected.total
+        assert len(counter) == len(expected)
+        assert counter.key_counts() == expected.key_counts()
+        assert counter.most_common() == expected.most_common()
+        assert counter.most_common_bigrams() == expected.most_common_bigrams()
+    # The last stroke is pickled too.
+    counter = StrokeCounter(helper.num_keys)
+    counter.update(masks[:1])
+    counter = pickle.loads(pickle.dumps(counter))
+    counter.update(masks[1:2])
+    assert counter.most_common_bigrams() == [(tuple(masks[:2]), 1)]
+    # Crafted states.
+    counter = StrokeCounter(helper.num_keys)
+    counter.__setstate__((None, array.array('Q', [5, 1, 7, 3]), array.array('Q', [5, 7, 2])))
+    assert len(counter) == 2
+    assert counter.most_common() == [(7, 3), (5, 1)]
+    assert counter.most_common_bigrams() == [((5, 7), 2)]
+    for state in (
+        (None, array.array('Q', [5, 0, 7, 3]), array.array('Q')),
+        (None, array.array('Q', [7, 3]), array.array('Q', [5, 7, 0])),
+        (None, array.array('Q', [1 << helper.num_keys, 1]), array.array('Q')),
+        (None, array.array('Q', [5, 1, 7]), array.array('Q')),
+    ):
+        with pytest.raises(ValueError, match='invalid state'):
+            StrokeCounter(helper.num_keys).__setstate__(state)
+
+def test_stroke_set_index(english_stroke_class):
+    helper = english_stroke_class._helper
+    strokes = [english_stroke_class(s) for s in '''
+        S T- TP TPH -T -TS STKPW * A*E -F -Z #
+    '''.split()]
+    index = StrokeSetIndex(strokes + strokes[:3])
+    assert len(index) == len(strokes)
+    expected = sorted(strokes)
+    assert list(index.masks()) == expected
+    for stroke in strokes:
+        assert stroke in index
+    assert english_stroke_class('TPHR') not in index
+    assert 'S' not in index
+    assert -1 not in index
+    def query(method, steno):
+        result = getattr(index, method)(english_stroke_class(steno))
+        assert result.typecode == 'Q'
+        return [str(english_stroke_class.from_integer(m)) for m in result]
+    assert query('subsets', 'STPH') == ['S', 'T', 'TP', 'TPH']
+    assert query('subsets', 'TPH-TS') == ['T', 'TP', 'TPH', '-T', '-TS']
+    assert query('subsets', 'R') == []
+    assert query('supersets', 'T') == ['STKPW', 'T', 'TP', 'TPH']
+    assert query('supersets', '-T') == ['-T', '-TS']
+    assert query('supersets', '*') == ['A*E', '*']
+    assert query('supersets', 'R') == []
+    assert len(index.supersets(0)) == len(strokes)
+    assert len(index.subsets((1 << helper.num_keys) - 1)) == len(strokes)
+    empty = StrokeSetIndex([])
+    assert len(empty) == 0
+    assert list(empty.subsets(0)) == []
+    assert list(empty.supersets(0)) == []
+    with pytest.raises(TypeError):
+        index.subsets('S')
+    with pytest.raises(ValueError):
+        StrokeSetIndex([2**63])
+
+def test_stroke_set_index_random():
+    rnd = random.Random(0)
+    masks = [0, 2**63 - 1] + [rnd.getrandbits(63) & rnd.getrandbits(63) for __ in range(2000)]
+    index = StrokeSetIndex(array.array('Q', masks))
+    assert sorted(index.masks()) == sorted(set(masks))
+    assert list(index.masks()) == sorted(set(masks), key=lambda m: [k for k in range(63) if (m >> k) & 1])
+    for query in masks[:50] + [rnd.getrandbits(63) for __ in range(50)]:
+        assert list(index.subsets(query)) == [m for m in index.masks() if not m & ~query]
+        assert list(index.supersets(query)) == [m for m in index.masks() if m & query == query]
+
+# Gemini PR like protocol: 6 bytes packets, bits numbered
+# from the most significant bit of each byte, skipping
+# the first bit of each byte (packet start marker).
+GEMINI_KEYS = (
+    None, None, None, None, None, None, '#',
+    'S-', 'S-', 'T-', 'K-', 'P-', 'W-', 'H-',
+    'R-', 'A-', 'O-', '*', '*', None, None,
+    None, None, '*', '*', '-E', '-U', '-F',
+    '-R', '-P', '-B', '-L', '-G', '-T', '-S',
+    '-D', '#', '#', '#', '#', '#', '-Z',
+)
+
+def gemini_mapping():
+    mapping = {}
+    for n, key in enumerate(GEMINI_KEYS):
+        byte, bit = divmod(n, 7)
+        mapping[byte * 8 + 6 - bit] = key
+    return mapping
+
+def gemini_packet(keys):
+    packet = bytearray(6)
+    packet[0] = 0x80
+    for n, key in enumerate(GEMINI_KEYS):
+        if key in keys:
+            byte, bit = divmod(n, 7)
+            packet[byte] |= 0x40 >> bit
+    return bytes(packet)
+
+KEY_MAP_TESTS = (
+    (('S-',), 'S'),
+    (('T-', '-E', '-S', '-T'), 'TETS'),
+    (('#', 'S-', 'T-'), '12'),
+    (('*',), '*'),
+    (('#', '*'), '#*'),
+    (('-Z', 'H-'), 'H-Z'),
+    ((), ''),
+)
+
+@pytest.mark.parametrize('keys, expected', KEY_MAP_TESTS)
+def test_key_map(english_stroke_class, keys, expected):
+    key_map = KeyMap(english_stroke_class._helper, gemini_mapping())
+    assert key_map.packet_size == 6
+    packet = gemini_packet(keys)
+    mask = key_map.stroke_from_packet(packet)
+    assert str(english_stroke_class.from_integer(mask)) == expected
+    assert key_map.stroke_from_bits(int.from_bytes(packet, 'little')) == mask
+    masks = key_map.packets_to_masks(packet * 3)
+    assert masks.typecode == 'Q'
+    assert list(masks) == [mask] * 3
+
+def test_key_map_random(english_stroke_class):
+    helper = english_stroke_class._helper
+    rnd = random.Random(0)
+    keys = helper.keys
+    # Several bits per key, one bit for several keys, and unmapped bits.
+    mapping = {bit: rnd.choice(keys) for bit in range(0, 40, 2)}
+    mapping[41] = ('S-', '-Z')
+    mapping[42] = None
+    key_map = KeyMap(helper, mapping, packet_size=8)
+    assert key_map.packet_size == 8
+    def expected_mask(bits):
+        stroke = english_stroke_class.from_integer(0)
+        for bit, value in mapping.items():
+            if value is not None and (bits >> bit) & 1:
+                stroke |= english_stroke_class.from_keys((value,) if isinstance(value, str) else value)
+        return int(stroke)
+    packets = [rnd.getrandbits(64) for __ in range(1000)]
+    buffer = b''.join(p.to_bytes(8, 'little') for p in packets)
+    expected = [expected_mask(p) for p in packets]
+    assert [key_map.stroke_from_bits(p) for p in packets] == expected
+    assert list(key_map.packets_to_masks(buffer)) == expected
+    # Packets can be longer than the key map (extra bytes are ignored).
+    assert list(key_map.packets_to_masks(buffer, packet_size=16)) == expected[::2]
+    assert key_map.stroke_from_packet(buffer[8:]) == expected[1]
+
+def test_key_map_errors(english_stroke_class):
+    helper = english_stroke_class._helper
+    with pytest.raises(TypeError):
+        KeyMap(None, {0: 'S-'})
+    with pytest.raises(ValueError):
+        KeyMap(helper, {0: 'X-'})
+    with pytest.raises(ValueError):
+        KeyMap(helper, {-1: 'S-'})
+    with pytest.raises(ValueError):
+        KeyMap(helper, {256: 'S-'})
+    with pytest.raises(ValueError):
+        KeyMap(helper, {8: 'S-'}, packet_size=1)
+    with pytest.raises(TypeError):
+        KeyMap(helper, {0: 42})
+    key_map = KeyMap(helper, {0: 'S-', 9: '-Z'})
+    assert key_map.packet_size == 2
+    with pytest.raises(ValueError):
+        key_map.packets_to_masks(b'\x01\x02\x03')
+    with pytest.raises(ValueError):
+        key_map.packets_to_masks(b'\x01\x02', packet_size=0)
+    with pytest.raises(TypeError):
+        key_map.stroke_from_bits('1')
+    with pytest.raises(OverflowError):
+        key_map.stroke_from_bits(-1)
+    assert list(key_map.packets_to_masks(b'')) == []
+
+NEAR_STROKES_TESTS = (
+    # Default adjacency: consecutive keys on the same side.
+    ('TEFT', 'TEFT', 0),
+    ('TEFT', 'TEFTS', 1),
+    ('TEFT', 'TEF', 1),
+    ('TEFT', 'KEFT', 1),
+    ('TEFT', 'SEFT', 1),
+    ('TEFT', 'PEFT', 2),
+    ('TEFT', 'TEFL', 2),
+    ('TEFT', 'TEFG', 1),
+    ('TEFT', 'KEFG', 2),
+    ('TEFT', 'TAFT', 2),
+    ('TEFT', 'TUFT', 1),
+    ('TEFT', 'T*EFT', 1),
+    ('-F', '-R', 1),
+    ('-F', '-RP', 2),
+    ('-FR', '-RP', 2),
+    ('-FR', '-FP', 1),
+    ('-FP', '-RB', 2),
+    ('S', '-Z', 2),
+)
+
+@pytest.mark.parametrize('steno1, steno2, distance', NEAR_STROKES_TESTS)
+def test_near_strokes_distance(english_stroke_class, steno1, steno2, distance):
+    helper = english_stroke_class._helper
+    for s1, s2 in ((steno1, steno2), (steno2, steno1)):
+        masks = array.array('Q', [int(english_stroke_class(s2))])
+        for max_distance in range(4):
+            result_masks, result_distances = helper.near_strokes(s1, masks, max_distance)
+            if distance <= max_distance:
+                assert list(result_masks) == list(masks)
+                assert list(result_distances) == [distance]
+            else:
+                assert list(result_masks) == []
+                assert list(result_distances) == []
+
+def test_near_strokes(english_stroke_class):
+    helper = english_stroke_class._helper
+    strokes = [english_stroke_class(s) for s in '''
+        TEFT TEFTS SEFT PEFT TEFG TAFT KAT TEF TEFT T*EFT
+    '''.split()]
+    masks = array.array('Q', strokes)
+    def near(stroke, masks=masks, **kwargs):
+        result_masks, result_distances = helper.near_strokes(stroke, masks, **kwargs)
+        assert result_masks.typecode == 'Q'
+        assert result_distances.typecode == 'B'
+        return [(str(english_stroke_class.from_integer(m)), d)
+                for m, d in zip(result_masks, result_distances)]
+    assert near('TEFT') == [
+        ('TEFT', 0), ('TEFT', 0),
+        ('TEFTS', 1), ('SEFT', 1), ('TEFG', 1), ('TEF', 1), ('T*EFT', 1),
+    ]
+    assert near('TEFT', max_distance=0) == [('TEFT', 0), ('TEFT', 0)]
+    assert near('TEFT', max_distance=2) == near('TEFT', max_distance=1) + [('PEFT', 2), ('TAFT', 2)]
+    # Top-N.
+    assert near('TEFT', limit=3) == [('TEFT', 0), ('TEFT', 0), ('TEFTS', 1)]
+    assert near('TEFT', max_distance=10, limit=1) == [('TEFT', 0)]
+    assert near('KAT', max_distance=10, limit=2) == [('KAT', 0), ('TAFT', 2)]
+    assert near('TEFT', limit=0) == []
+    # Other inputs.
+    assert near(english_stroke_class('TEFT'), masks=strokes) == near('TEFT')
+    assert near(int(english_stroke_class('TEFT')), masks=Outline(strokes)) == near('TEFT')
+    assert near('TEFT', masks=[]) == []
+    with pytest.raises(ValueError):
+        near('TEFT', limit=-1)
+    with pytest.raises(ValueError):
+        near('TEFT/')
+    with pytest.raises(TypeError):
+        near('TEFT', masks=array.array('B', [1, 2]))
+    for invalid in (1 << 23, 1 << 40, 1 << 62):
+        with pytest.raises(ValueError, match='invalid keys mask: %#x' % invalid):
+            near('TEFT', masks=array.array('Q', [1, 3, invalid]), max_distance=3)
+        with pytest.raises(ValueError, match='invalid keys mask: %#x' % invalid):
+            near('TEFT', masks=array.array('Q', [invalid, 1]), limit=1)
+
+def test_near_strokes_adjacent_keys(english_stroke_class):
+    helper = english_stroke_class._helper
+    masks = [int(english_stroke_class(s)) for s in ('KEFT', 'PEFT')]
+    def near(stroke):
+        return [(str(english_stroke_class.from_integer(m)), d)
+                for m, d in zip(*helper.near_strokes(stroke, masks, max_distance=2))]
+    assert near('TEFT') == [('KEFT', 1), ('PEFT', 2)]
+    helper.set_adjacent_keys([('T-', 'P-'), ('K-', 'W-')])
+    assert near('TEFT') == [('PEFT', 1), ('KEFT', 2)]
+    helper.set_adjacent_keys([])
+    assert near('TEFT') == [('KEFT', 2), ('PEFT', 2)]
+    helper.set_adjacent_keys(None)
+    assert near('TEFT') == [('KEFT', 1), ('PEFT', 2)]
+    for invalid in (
+        [('T-',)],
+        [('T-', 'T-')],
+        [('T-', 'K-', 'P-')],
+        [('T-', 'X-')],
+        [42],
+    ):
+        with pytest.raises((TypeError, ValueError)):
+            helper.set_adjacent_keys(invalid)
+    assert near('TEFT') == [('KEFT', 1), ('PEFT', 2)]
+
+HELPER_ATTRIBUTES = (
+    'keys', 'implicit_hyphen_keys', 'number_key', 'numbers',
+    'feral_number_key', 'adjacent_keys', 'key_letter', 'key_number',
+    'num_keys', 'implicit_hyphen_mask', 'number_key_mask', 'numbers_mask',
+)
+
+def test_system_helper(english_stroke_class):
+    helper = english_stroke_class._helper
+    definition = (helper.keys, helper.implicit_hyphen_keys,
+                  helper.number_key, helper.numbers,
+                  helper.feral_number_key)
+    # Helpers for the same system share the compiled system...
+    helper1 = system_helper(*definition)
+    helper2 = system_helper(iter(definition[0]), *definition[1:])
+    assert helper1 is not helper2
+    assert helper1.to_bytes() == helper2.to_bytes() == helper.to_bytes()
+    for name in HELPER_ATTRIBUTES:
+        assert getattr(helper1, name) == getattr(helper, name)
+    # ...but not their caches and stats.
+    helper1.set_stats(True)
+    helper1.stroke_from_steno('TEFT')
+    assert helper2.stats()['from_steno']['calls'] == 0
+    # Modifying one helper does not affect the others.
+    helper1.set_adjacent_keys([('T-', 'P-')])
+    assert helper1.adjacent_keys == [('T-', 'P-')]
+    assert helper2.adjacent_keys == helper.adjacent_keys != helper1.adjacent_keys
+    copy = helper1.copy()
+    assert type(copy) is type(helper1)
+    assert copy.adjacent_keys == helper1.adjacent_keys
+    # Different systems.
+    assert system_helper(definition[0]).to_bytes() != helper.to_bytes()
+    assert system_helper(definition[0], feral_number_key=False).num_keys == helper.num_keys
+    # Invalid systems.
+    with pytest.raises(ValueError):
+        system_helper(['S-', '-'])
+    with pytest.raises(TypeError):
+        system_helper(42)
+
+def test_helper_snapshot(english_stroke_class):
+    helper = english_stroke_class._helper
+    helper.set_adjacent_keys([('T-', 'P-'), ('-R', '-B')])
+    data = helper.to_bytes()
+    assert isinstance(data, bytes)
+    restored = type(helper).from_bytes(data)
+    assert type(restored) is type(helper)
+    for name in HELPER_ATTRIBUTES:
+        assert getattr(restored, name) == getattr(helper, name)
+    for steno in ('#STKPW', 'TEFT', 'PWRAOEUBG', '1-9', ''):
+        mask = helper.stroke_from_steno(steno)
+        assert restored.stroke_from_steno(steno) == mask
+        assert restored.stroke_to_steno(mask) == helper.stroke_to_steno(mask)
+        assert restored.stroke_to_keys(mask) == helper.stroke_to_keys(mask)
+    assert restored.to_bytes() == data
+    assert type(helper).from_bytes(bytearray(type(helper)().to_bytes())).num_keys == 0
+    # Invalid snapshots.
+    for invalid in (b'', data[:-1], data + b'\0', b'XXXX' + data[4:]):
+        with pytest.raises(ValueError, match='invalid helper snapshot'):
+            type(helper).from_bytes(invalid)
+    # Corrupted tables are detected (here: the number of keys).
+    corrupted = bytearray(data)
+    corrupted[16:20] = b'\xff' * 4
+    with pytest.raises(ValueError, match='invalid helper snapshot'):
+        type(helper).from_bytes(bytes(corrupted))
+    with pytest.raises(TypeError):
+        type(helper).from_bytes('data')
+    # Corrupted letters tables (using a system with a non-ASCII letter).
+    helper = StrokeHelper()
+    helper.setup('S- \u0140- -T'.split())
+    data = helper.to_bytes()
+    assert StrokeHelper.from_bytes(data).stroke_from_steno('S\u0140') == 0b11
+    # Locate the letters hash table: the last occurrence of the
+    # non-ASCII letter is its slot (the keys strings are not saved).
+    def ucs4(letter):
+        return ord(letter).to_bytes(4, sys.byteorder)
+    slot = ((0x140 * 2654435761) % 2 ** 32 >> 16) % 128
+    table = data.rindex(ucs4('\u0140')) - 4 * slot
+    def corrupt(offset, value):
+        corrupted = bytearray(data)
+        corrupted[offset:offset + len(value)] = value
+        with pytest.raises(ValueError, match='invalid helper snapshot'):
+            StrokeHelper.from_bytes(bytes(corrupted))
+    # Full table (probing would never end).
+    corrupt(table, b''.join(ucs4('\u0141') if n != slot else ucs4('\u0140')
+                            for n in range(128)))
+    # Letter with no index.
+    corrupt(table + 4 * ((slot + 1) % 128), ucs4('\u0141'))
+    # Letter not on its probe chain.
+    corrupt(table + 4 * slot, ucs4('\u0141'))
+    # Feral number key letter without a number key (it
+    # follows the keys numbers, where `-T` is the last one).
+    corrupt(data.rindex(ucs4('T')) + 4 * (MAX_KEYS - 2), ucs4('#'))
+    # Keys sides not matching the right keys index (`S-` on the right).
+    corrupt(20, (2).to_bytes(4, sys.byteorder))
+
+def test_helper_pickle(english_stroke_class):
+    helper = english_stroke_class._helper
+    for adjacent_keys in (None, [('T-', 'P-'), ('-R', '-B')]):
+        helper.set_adjacent_keys(adjacent_keys)
+        unpickled = pickle.loads(pickle.dumps(helper))
+        assert type(unpickled) is type(helper)
+        for name in HELPER_ATTRIBUTES:
+            assert getattr(unpickled, name) == getattr(helper, name)
+    assert helper.adjacent_keys == [('T-', 'P-'), ('-R', '-B')]
+    assert pickle.loads(pickle.dumps(type(helper)())).num_keys == 0
+    with pytest.raises(TypeError):
+        helper.__setstate__(42)
+
+
+class PickledStroke(BaseStroke):
+    __slots__ = ()
+
+def test_stroke_pickle(english_stroke_class):
+    helper = english_stroke_class._helper
+    PickledStroke.setup(helper.keys, helper.implicit_hyphen_keys,
+                        helper.number_key, helper.numbers,
+                        helper.feral_number_key)
+    strokes = [PickledStroke(s) for s in ('#STKPW', 'TEFT', 'PWRAOEUBG', '')]
+    data = pickle.dumps(strokes)
+    # Unpickling sets up the class if needed (e.g. in a fresh process).
+    PickledStroke._helper = None
+    unpickled = pickle.loads(data)
+    assert PickledStroke._helper is not None
+    assert unpickled == strokes
+    assert [type(s) for s in unpickled] == [PickledStroke] * len(strokes)
+    assert [str(s) for s in unpickled] == ['12K3W', 'TEFT', 'PWRAOEUBG', '']
+    # But does not override an existing setup.
+    helper = PickledStroke._helper
+    assert pickle.loads(data) == strokes
+    assert PickledStroke._helper is helper
+
+
+def _shared_masks_worker(helper, name):
+    from multiprocessing.shared_memory import SharedMemory
+    shm = SharedMemory(name=name)
+    masks, offsets = masks_from_shared_memory(shm)
+    try:
+        return helper.masks_to_steno_list(masks, offsets)
+    finally:
+        masks.release()
+        if offsets is not None:
+            offsets.release()
+        shm.close()
+
+def test_shared_memory(english_stroke_class):
+    pytest.importorskip('multiprocessing.shared_memory')
+    helper = english_stroke_class._helper
+    steno_list = ['STKPW', 'TEFT/-G', '', 'PWRAOEUBG/-S/-Z']
+    masks, offsets, invalid = helper.steno_list_to_masks(steno_list)
+    shm = masks_to_shared_memory(masks, offsets)
+    try:
+        shared_masks, shared_offsets = masks_from_shared_memory(shm)
+        assert shared_masks.readonly
+        assert shared_masks.tolist() == masks.tolist()
+        assert shared_offsets.tolist() == offsets.tolist()
+        assert helper.masks_to_steno_list(shared_masks, shared_offsets) == steno_list
+        assert list(helper.masks_to_order_keys(shared_masks)) == list(helper.masks_to_order_keys(masks))
+        shared_masks.release()
+        shared_offsets.release()
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(_shared_masks_worker, [helper] * 2, [shm.name] * 2))
+        assert results == [steno_list] * 2
+    finally:
+        shm.close()
+        shm.unlink()
+    shm = masks_to_shared_memory([])
+    try:
+        shared_masks, shared_offsets = masks_from_shared_memory(shm)
+        assert shared_masks.tolist() == []
+        assert shared_offsets is None
+        shared_masks.release()
+    finally:
+        shm.close()
+        shm.unlink()
+
+def test_concurrent_batch_operations(english_stroke_class):
+    helper = english_stroke_class._helper
+    setup_args = (helper.keys, helper.implicit_hyphen_keys,
+                  helper.number_key, helper.numbers,
+                  helper.feral_number_key)
+    rnd = random.Random(42)
+    strokes = [english_stroke_class.from_integer(rnd.getrandbits(helper.num_keys))
+               for __ in range(500)]
+    steno_list = ['/'.join(str(s) for s in rnd.sample(strokes, rnd.randint(1, 3)))
+                  for __ in range(2000)]
+    masks, offsets, invalid = helper.steno_list_to_masks(steno_list)
+    assert invalid == []
+    order = helper.sort_outlines(steno_list)
+    near_masks = [int(s) for s in strokes]
+    near_default = helper.near_strokes('TEFT', near_masks, max_distance=3)
+    helper.set_adjacent_keys([('T-', 'P-')])
+    near_custom = helper.near_strokes('TEFT', near_masks, max_distance=3)
+    helper.set_adjacent_keys(None)
+    index = StrokeSetIndex(masks)
+    subsets = index.subsets(int(english_stroke_class('STKPWHRAO*EUFRPBLGTSDZ')))
+    def work(n):
+        assert helper.steno_list_to_masks(steno_list) == (masks, offsets, [])
+        assert helper.masks_to_steno_list(masks, offsets) == steno_list
+        assert helper.sort_outlines(steno_list) == order
+        assert helper.near_strokes('TEFT', near_masks, max_distance=3) in (near_default, near_custom)
+        assert index.subsets(int(english_stroke_class('STKPWHRAO*EUFRPBLGTSDZ'))) == subsets
+        return n
+    # Concurrently re-configure the helper (with the same
+    # system), and toggle its adjacent keys: in-flight batch
+    # operations must keep using a consistent configuration.
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(work, n) for n in range(16)]
+        for n in range(16):
+            helper.setup(*setup_args)
+            helper.set_adjacent_keys([('T-', 'P-')] if n % 2 else None)
+        assert [f.result() for f in futures] == list(range(16))
+
+
+# 73 keys: English, plus a symbols cluster (including non-ASCII letters).
+WIDE_KEYS = '''
+    #
+    S- T- K- P- W- H- R-
+    A- O-
+    *
+    -E -U
+    -F -R -P -B -L -G -T -S -D -Z
+'''.split() + ['-' + l for l in 'abcdefghijklmnopqrstuvwxyz'] + ['-' + l for l in 'αβγδεζηθικλμνξοπρστυφχψω']
+
+@pytest.fixture
+def wide_stroke_class(stroke_class, english_stroke_class):
+    helper = english_stroke_class._helper
+    stroke_class.setup(WIDE_KEYS, helper.implicit_hyphen_keys,
+                       helper.number_key, helper.numbers,
+                       helper.feral_number_key)
+    return stroke_class
+
+def _wide_order_reference(stroke):
+    # Steno order: lexicographical order of the keys indexes.
+    return [WIDE_KEYS.index(k) for k in stroke.keys()]
+
+WIDE_STROKE_TESTS = (
+    # steno, keys
+    ('-Z'         , ('-Z',)),
+    ('-Zaω'       , ('-Z', '-a', '-ω')),
+    ('STKPW-bγ'   , ('S-', 'T-', 'K-', 'P-', 'W-', '-b', '-γ')),
+    ('AOa'        , ('A-', 'O-', '-a')),
+    ('#-ω'        , ('#', '-ω')),
+    ('1-9'        , ('#', 'S-', '-T')),
+    ('12K-z'      , ('#', 'S-', 'T-', 'K-', '-z')),
+    (''           , ()),
+)
+
+@pytest.mark.parametrize('steno, keys', WIDE_STROKE_TESTS)
+def test_wide_stroke(wide_stroke_class, steno, keys):
+    stroke = wide_stroke_class(steno)
+    assert str(stroke) == repr(stroke) == steno
+    assert stroke.keys() == tuple(stroke) == keys
+    assert len(stroke) == len(keys)
+    assert wide_stroke_class.from_keys(keys) == stroke
+    assert wide_stroke_class.from_integer(int(stroke)) == stroke
+    assert wide_stroke_class(int(stroke)) == stroke
+    assert hash(stroke) == hash(int(stroke))
+    if keys:
+        assert stroke.first() == keys[0]
+        assert stroke.last() == keys[-1]
+
+def test_wide_setup(wide_stroke_class, english_stroke_class):
+    helper = wide_stroke_class._helper
+    english_helper = english_stroke_class._helper
+    assert isinstance(helper, WideStrokeHelper)
+    assert helper.num_keys == len(WIDE_KEYS)
+    assert helper.keys == tuple(WIDE_KEYS)
+    for name in ('implicit_hyphen_keys', 'number_key', 'numbers', 'feral_number_key',
+                 'feral_number_key_letter', 'implicit_hyphen_mask', 'number_key_mask',
+                 'numbers_mask', 'right_keys_index'):
+        assert getattr(helper, name) == getattr(english_helper, name)
+    assert helper.key_letter.startswith(english_helper.key_letter)
+    # The helper is picked based on the number of keys.
+    assert isinstance(system_helper(WIDE_KEYS[:MAX_KEYS]), StrokeHelper)
+    assert isinstance(system_helper(WIDE_KEYS[:MAX_KEYS + 1]), WideStrokeHelper)
+    # Batch operations are not supported.
+    assert not hasattr(helper, 'steno_list_to_masks')
+    # Invalid systems.
+    with pytest.raises(ValueError, match='unsupported number of keys'):
+        system_helper(['-%s' % chr(0x100 + n) for n in range(MAX_WIDE_KEYS + 1)])
+    with pytest.raises(ValueError, match='invalid `implicit_hyphen_keys`'):
+        system_helper(WIDE_KEYS, implicit_hyphen_keys={'A-', '-a'})
+    with pytest.raises(ValueError, match='invalid `numbers`'):
+        system_helper(WIDE_KEYS, number_key='#', numbers={'S-': '1-'})
+
+def test_wide_stroke_random(wide_stroke_class):
+    rnd = random.Random(42)
+    all_keys = (1 << len(WIDE_KEYS)) - 1
+    strokes = [wide_stroke_class.from_integer(rnd.getrandbits(len(WIDE_KEYS)) & rnd.getrandbits(len(WIDE_KEYS)))
+               for __ in range(500)]
+    strokes.append(wide_stroke_class(all_keys))
+    for stroke in strokes:
+        mask = int(stroke)
+        assert wide_stroke_class(str(stroke)) == stroke
+        assert wide_stroke_class(stroke.keys()) == stroke
+        assert len(stroke) == bin(mask).count('1')
+        assert int(~stroke) == all_keys & ~mask
+    for s1, s2 in zip(strokes, strokes[1:]):
+        assert int(s1 | s2) == int(s1) | int(s2)
+        assert int(s1 & s2) == int(s1) & int(s2)
+        assert int(s1 - s2) == int(s1) & ~int(s2)
+        assert type(s1 | s2) is wide_stroke_class
+        assert (s1 in s2) == (int(s1) & int(s2) == int(s1))
+        assert (s1 < s2) == (_wide_order_reference(s1) < _wide_order_reference(s2))
+    expected = sorted(strokes, key=_wide_order_reference)
+    assert sorted(strokes) == expected
+    assert sorted(strokes, key=wide_stroke_class.order_key) == expected
+    # Note: the native `order_key` dispatches on the helper.
+    assert 'order_key' not in vars(wide_stroke_class)
+    helper = wide_stroke_class._helper
+    assert [s.order_key() for s in strokes] == [helper.stroke_to_order_key(s) for s in strokes]
+
+def test_wide_english(english_stroke_class):
+    # A wide helper for a small system behaves like the standard one.
+    helper = english_stroke_class._helper
+    wide_helper = WideStrokeHelper()
+    wide_helper.setup(helper.keys, helper.implicit_hyphen_keys,
+                      helper.number_key, helper.numbers,
+                      helper.feral_number_key)
+    rnd = random.Random(42)
+    masks = [0, (1 << helper.num_keys) - 1] + [rnd.getrandbits(helper.num_keys) for __ in range(500)]
+    for m1, m2 in zip(masks, masks[1:]):
+        steno = helper.stroke_to_steno(m1)
+        assert wide_helper.stroke_to_steno(m1) == steno
+        assert wide_helper.stroke_from_steno(steno) == m1
+        assert wide_helper.stroke_to_keys(m1) == helper.stroke_to_keys(m1)
+        for name in ('has_digit', 'is_number', 'len', 'invert'):
+            fn = 'stroke_' + name
+            assert getattr(wide_helper, fn)(m1) == getattr(helper, fn)(m1)
+        for name in ('cmp', 'lt', 'eq', 'in', 'or', 'and', 'sub', 'is_prefix', 'is_suffix'):
+            fn = 'stroke_' + name
+            assert getattr(wide_helper, fn)(m1, m2) == getattr(helper, fn)(m1, m2)
+        order = helper.stroke_to_order_key(m1) < helper.stroke_to_order_key(m2)
+        assert (wide_helper.stroke_to_order_key(m1) < wide_helper.stroke_to_order_key(m2)) == order
+
+def test_wide_errors(wide_stroke_class):
+    helper = wide_stroke_class._helper
+    for mask in (1 << len(WIDE_KEYS), 1 << 200, -1):
+        with pytest.raises(ValueError, match='invalid keys mask'):
+            wide_stroke_class.from_integer(mask)
+    for steno in ('ωa', '-Z-a', 'S' * (MAX_WIDE_KEYS + 2), 'xyz!'):
+        with pytest.raises(ValueError, match='invalid steno'):
+            wide_stroke_class(steno)
+    with pytest.raises(ValueError, match='invalid key'):
+        wide_stroke_class.from_keys(['-!'])
+    with pytest.raises(ValueError, match='empty stroke'):
+        wide_stroke_class('').first()
+    with pytest.raises(TypeError):
+        wide_stroke_class(4.2)
+    with pytest.raises(TypeError):
+        helper.stroke_from_steno(42)
+    with pytest.raises(TypeError):
+        helper.__setstate__(42)
+
+def test_wide_pickle(wide_stroke_class):
+    helper = wide_stroke_class._helper
+    unpickled = pickle.loads(pickle.dumps(helper))
+    assert type(unpickled) is WideStrokeHelper
+    for name in HELPER_ATTRIBUTES:
+        if name != 'adjacent_keys':
+            assert getattr(unpickled, name) == getattr(helper, name)
+    assert pickle.loads(pickle.dumps(WideStrokeHelper())).num_keys == 0
+    copy = helper.copy()
+    assert type(copy) is WideStrokeHelper
+    assert copy.keys == helper.keys
+    PickledStroke.setup(WIDE_KEYS)
+    strokes = [PickledStroke(s) for s in ('-Zaω', 'STKPW-bγ', '')]
+    data = pickle.dumps(strokes)
+    PickledStroke._helper = None
+    assert pickle.loads(data) == strokes
+    assert PickledStroke(1 << 70).order_key() == helper.stroke_to_order_key(1 << 70)